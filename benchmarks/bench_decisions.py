@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+"""
+Time to load and aggregate the columnar decision ledger (mwa_trigger/decisions.py), for a synthetic ledger of
+--rows decisions (the default is several times the number of VOEvents received in a year), and the cost of writing
+one row.
+
+Run from the top level of the repository, eg:
+
+    python benchmarks/bench_decisions.py --rows 1000000
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+TOPDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOPDIR)
+
+import numpy
+
+from mwa_trigger import decisions
+
+
+def make_ledger(directory, nrows, seed):
+    """
+    Write nrows random decisions to a ledger in directory, a column at a time.
+    """
+    ledger = decisions.DecisionLedger(directory=directory)
+    rng = numpy.random.RandomState(seed)
+    start = time.time() - 365 * 86400.0
+    decided = numpy.sort(rng.uniform(start, start + 365 * 86400.0, nrows))
+    issued = decided - rng.exponential(20.0, nrows)
+    columns = {'decided': decided,
+               'issued': issued,
+               'event_time': issued - rng.exponential(30.0, nrows),
+               'source': rng.randint(0, len(ledger.codes['source']), nrows),
+               'outcome': rng.randint(0, len(ledger.codes['outcome']), nrows),
+               'reason': rng.randint(0, len(ledger.codes['reason']), nrows),
+               'trigger_id': numpy.array(['SYNTH_%d' % (i // 3) for i in range(nrows)]),
+               'trace_id': numpy.array(['%016x' % i for i in range(nrows)])}
+    columns['event_latency'] = decided - columns['event_time']
+    columns['notice_latency'] = decided - issued
+    for name in decisions.PARAMETERS:
+        values = rng.uniform(0, 100, nrows)
+        values[rng.uniform(0, 1, nrows) < 0.7] = numpy.nan
+        columns[name] = values
+    for name, dtype in decisions.COLUMNS:
+        columns[name].astype(dtype).tofile(os.path.join(directory, name + '.col'))
+    return ledger
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load and aggregate times for the decision ledger.')
+    parser.add_argument('--rows', type=int, default=1000000, help='Number of synthetic decisions')
+    parser.add_argument('--seed', type=int, default=1, help='Random number seed')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='bench-decisions-')
+    try:
+        ledger = make_ledger(tmpdir, args.rows, args.seed)
+        size = sum([os.path.getsize(os.path.join(tmpdir, name + '.col')) for name, dtype in decisions.COLUMNS])
+
+        start = time.time()
+        data = decisions.load(tmpdir)
+        loaded = time.time() - start
+        start = time.time()
+        for by in ['reason', 'source', 'outcome']:
+            decisions.summarise(data, by=by)
+        aggregated = time.time() - start
+
+        row = {'decided': time.time(), 'issued': time.time() - 10, 'source': 'Swift', 'outcome': 'ignored',
+               'reason': 'busy', 'trigger_id': 'SWIFT_1', 'trace_id': '0123456789abcdef', 'alt': 45.0}
+        nwrites = 1000
+        start = time.time()
+        for i in range(nwrites):
+            ledger._write(row)
+        written = (time.time() - start) / nwrites
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print("%d decisions, %.1f MB on disk (%.0f bytes per row)" % (args.rows, size / 1048576.0,
+                                                                  size / float(args.rows)))
+    print("Load all columns (decoded): %.2f s" % loaded)
+    print("Aggregate by reason, source and outcome, with latency percentiles: %.2f s" % aggregated)
+    print("Write one row: %.0f us" % (written * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+"""
+Time the functions that the handlers depend on, using the VOEvents in test_events/ and the MWA grid points in
+data/grid_points.fits, and save the results as JSON so that they can be compared between commits.
+
+Run from the top level of the repository, eg:
+
+    python benchmarks/bench_hotpaths.py --output bench-$(git rev-parse --short HEAD).json
+    python benchmarks/bench_hotpaths.py --compare bench-1234abc.json
+
+Everything runs offline. The GW benchmarks (load_skymap, compute_coords and get_mwapointing_grid, on a synthetic
+sky map) need healpy and mwa_pb, and are skipped, and listed as skipped in the output, if those aren't installed.
+"""
+
+import argparse
+import glob
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+TOPDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOPDIR)
+
+import voeventparse
+from astropy.time import Time
+
+from mwa_trigger import handlers
+from mwa_trigger import outbox
+from mwa_trigger import FlareStar_swift_maxi, GRB_fermi_swift, Neutrino
+
+logging.disable(logging.CRITICAL)   # The handlers log at DEBUG level, which would dominate the timings
+
+CALC_TIME = Time('2019-04-10T12:00:00', scale='utc')   # Fixed time for the sky map calculations
+
+
+def load_corpus():
+    """
+    :return: A list of (filename, XML bytes) tuples for the events in test_events/.
+    """
+    result = []
+    for fname in sorted(glob.glob(os.path.join(TOPDIR, 'test_events', '*.xml'))):
+        with open(fname, 'rb') as f:
+            result.append((os.path.basename(fname), f.read()))
+    return result
+
+
+def timefunc(func, items, repeat, min_time=0.2):
+    """
+    Call func(item) for every item, as many times as needed to take at least min_time seconds, and repeat that
+    'repeat' times.
+
+    :return: A dictionary containing the median and minimum time per call, in microseconds, and the number of calls.
+    """
+    loops = 1
+    while True:
+        start = time.time()
+        for i in range(loops):
+            for item in items:
+                func(item)
+        elapsed = time.time() - start
+        if elapsed >= min_time or loops >= 1000:
+            break
+        loops *= 2
+    times = [elapsed]
+    for r in range(repeat - 1):
+        start = time.time()
+        for i in range(loops):
+            for item in items:
+                func(item)
+        times.append(time.time() - start)
+    ncalls = loops * len(items)
+    pertimes = sorted([t / ncalls * 1e6 for t in times])
+    return {'median_us': pertimes[len(pertimes) // 2],
+            'min_us': pertimes[0],
+            'calls': ncalls * repeat}
+
+
+def parse_all(corpus):
+    return [voeventparse.loads(xml) for fname, xml in corpus]
+
+
+def usable(func, items):
+    """
+    :return: The items that func() accepts without raising an exception (eg, the events that have a position).
+    """
+    result = []
+    for item in items:
+        try:
+            func(item)
+        except (TypeError, ValueError, AttributeError):
+            continue
+        result.append(item)
+    return result
+
+
+def synthetic_skymap(filename, nside=256):
+    """
+    Write a NESTED healpix map with a Gaussian blob of probability, like a GW localisation, to filename.
+    """
+    import healpy
+    import numpy as np
+    npix = healpy.nside2npix(nside)
+    theta, phi = healpy.pix2ang(nside, np.arange(npix), nest=True)
+    centre = healpy.ang2vec(np.radians(90.0 + 30.0), np.radians(250.0))
+    dist = np.arccos(np.clip(np.dot(healpy.ang2vec(theta, phi), centre), -1, 1))
+    prob = np.exp(-0.5 * (dist / np.radians(5.0)) ** 2)
+    healpy.write_map(filename, prob / prob.sum(), nest=True, overwrite=True)
+
+
+def gw_benchmarks(results, skipped, repeat):
+    try:
+        from mwa_trigger import GW_LIGO
+    except ImportError as error:
+        for name in ['is_gw', 'GW.load_skymap', 'GW.compute_coords', 'GW.get_mwapointing_grid']:
+            skipped[name] = 'ImportError: %s' % error
+        return
+
+    parsed = parse_all(load_corpus())
+    results['is_gw'] = timefunc(GW_LIGO.is_gw, parsed, repeat)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        mapfile = os.path.join(tmpdir, 'synthetic.fits')
+        synthetic_skymap(mapfile)
+        gw = GW_LIGO.GW()
+        results['GW.load_skymap'] = timefunc(lambda f: gw.load_skymap(f, calc_time=CALC_TIME), [mapfile], repeat)
+        results['GW.compute_coords'] = timefunc(lambda x: gw.compute_coords(), [None], repeat)
+        results['GW.get_mwapointing_grid'] = timefunc(lambda x: gw.get_mwapointing_grid(minprob=0.01), [None], repeat)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def run_all(repeat):
+    corpus = load_corpus()
+    parsed = parse_all(corpus)
+    withpos = usable(handlers.get_position_info, parsed)
+    results = {}
+    skipped = {}
+
+    results['voeventparse.loads'] = timefunc(voeventparse.loads, [xml for fname, xml in corpus], repeat)
+    results['is_grb'] = timefunc(GRB_fermi_swift.is_grb, parsed, repeat)
+    results['is_neutrino'] = timefunc(Neutrino.is_neutrino, parsed, repeat)
+    # is_flarestar() modifies MAXI events in place, so give it its own copies, and only those with a Why section
+    results['is_flarestar'] = timefunc(FlareStar_swift_maxi.is_flarestar,
+                                       usable(FlareStar_swift_maxi.is_flarestar, parse_all(corpus)),
+                                       repeat)
+    results['handlers.get_position_info'] = timefunc(handlers.get_position_info, withpos, repeat)
+
+    coords = [handlers.get_position_info(v)[:2] for v in withpos]
+    results['handlers.get_altitude'] = timefunc(lambda c: handlers.get_altitude(c[0], c[1], obstime=CALC_TIME),
+                                                coords, repeat)
+    results['handlers.get_altitude_fast'] = timefunc(lambda c: handlers.get_altitude_fast(c[0], c[1]), coords, repeat)
+
+    attachments = [('voevent.xml', corpus[0][1].decode('latin-1'), 'text/xml'),
+                   ('log.txt', '\n'.join(['Log message %d' % i for i in range(200)]))]
+
+    def assemble(attachments):
+        # What the outbox does for each email sent with handlers.send_email()
+        return outbox.build_message(from_address='mwa@telemetry.mwa128t.org',
+                                    to_addresses=['a@example.com', 'b@example.com'],
+                                    subject='Benchmark',
+                                    msg_text='Benchmark message\n' * 20,
+                                    attachments=outbox.normalise_attachments(attachments)).as_string()
+    results['send_email MIME assembly'] = timefunc(assemble, [attachments], repeat)
+
+    try:
+        gw_benchmarks(results, skipped, repeat)
+    except Exception:
+        skipped['GW'] = traceback.format_exc()
+    return results, skipped
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=TOPDIR).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for the handler hot paths.')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timed repeats for each benchmark')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='Compare the results with those in this JSON file')
+    args = parser.parse_args()
+
+    results, skipped = run_all(args.repeat)
+    report = {'commit': git_commit(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'results': results,
+              'skipped': skipped}
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+
+    print("%-28s %14s %14s %10s" % ('benchmark', 'median us', 'min us', 'vs old'))
+    for name in sorted(results):
+        ratio = '-'
+        if name in previous:
+            ratio = '%.2fx' % (results[name]['median_us'] / previous[name]['median_us'])
+        print("%-28s %14.2f %14.2f %10s" % (name, results[name]['median_us'], results[name]['min_us'], ratio))
+    for name in sorted(skipped):
+        print("%-28s skipped: %s" % (name, skipped[name].strip().splitlines()[-1]))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print("Results written to %s" % args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""
+Measure the cost, in the thread doing the logging, of each DEBUG log record written to the daemon's log file, with:
+
+    astropy_sync    - the original setup: astropy Time.now() in the formatter, and a synchronous FileHandler
+    fastclock_sync  - the fastclock formatter, with a synchronous FileHandler
+    fastclock_queue - the current setup: a QueueHandler, with the fastclock formatter and the file handler in the
+                      listener thread
+
+Run from the top level of the repository, eg:
+
+    python benchmarks/bench_logging.py --records 20000
+
+Use --io-delay to add a fixed delay to every write, to simulate a slow or busy disk.
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from astropy.time import Time
+
+from mwa_trigger import logpipeline
+
+
+class AstropyLogFormatter(logging.Formatter):
+    """
+    The original MWALogFormatter from voevent_handler.py.
+    """
+    def format(self, record):
+        now = Time.now()
+        return "%s=(%d): %s" % (now.iso, int(now.gps), record.getMessage())
+
+
+class SlowFileHandler(logging.FileHandler):
+    """
+    FileHandler with an added delay for each record, to simulate a slow disk.
+    """
+    io_delay = 0.0
+
+    def emit(self, record):
+        if self.io_delay:
+            time.sleep(self.io_delay)
+        logging.FileHandler.emit(self, record)
+
+
+def make_logger(name):
+    logger = logging.getLogger('bench.%s' % name)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    return logger
+
+
+def run(name, logger, nrecords):
+    """
+    Log nrecords DEBUG messages like the ones from the handlers, and return the time per record, in microseconds.
+    """
+    start = time.time()
+    for i in range(nrecords):
+        logger.debug("Event %d: RA=%s, Dec=%s, error=%s deg" % (i, 123.456, -45.678, 0.05))
+    return (time.time() - start) / nrecords * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the per-record cost of the handler daemon logging.')
+    parser.add_argument('--records', type=int, default=20000, help='Number of records to log for each setup')
+    parser.add_argument('--io-delay', type=float, default=0.0, help='Extra delay for each write, in seconds')
+    args = parser.parse_args()
+    SlowFileHandler.io_delay = args.io_delay
+
+    tmpdir = tempfile.mkdtemp()
+    results = []
+    try:
+        # Astropy is much slower, so use fewer records
+        logger = make_logger('astropy_sync')
+        handler = SlowFileHandler(os.path.join(tmpdir, 'astropy_sync.log'))
+        handler.setFormatter(AstropyLogFormatter())
+        logger.addHandler(handler)
+        results.append(('astropy_sync', run('astropy_sync', logger, max(1, args.records // 10)), None))
+        handler.close()
+
+        logger = make_logger('fastclock_sync')
+        handler = SlowFileHandler(os.path.join(tmpdir, 'fastclock_sync.log'))
+        handler.setFormatter(logpipeline.MWALogFormatter())
+        logger.addHandler(handler)
+        results.append(('fastclock_sync', run('fastclock_sync', logger, args.records), None))
+        handler.close()
+
+        logger = make_logger('fastclock_queue')
+        handler = SlowFileHandler(os.path.join(tmpdir, 'fastclock_queue.log'))
+        handler.setFormatter(logpipeline.MWALogFormatter())
+        start = time.time()
+        listener = logpipeline.start_queue_logging(logger, [handler])
+        percall = run('fastclock_queue', logger, args.records)
+        logpipeline.stop_queue_logging(listener)   # Wait for the listener thread to write everything out
+        results.append(('fastclock_queue', percall, (time.time() - start) / args.records * 1e6))
+        handler.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print("%-16s %18s %22s" % ('setup', 'caller us/record', 'end-to-end us/record'))
+    for name, percall, total in results:
+        print("%-16s %18.2f %22s" % (name, percall, '%.2f' % total if total is not None else '-'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""
+Memory used by the handlers' TriggerEvent objects, for a synthetic workload of many tracked triggers.
+
+Each synthetic trigger is a handlers.TriggerEvent with --notices VOEvents (sampled from test_events/, parsed, as the
+handlers add them), a position from each, and the log messages that go with them, which is roughly what a GRB handler
+keeps for a Swift or Fermi trigger. The process RSS is measured before and after creating --triggers of them (lxml
+allocates outside the Python heap, so tracemalloc alone would miss most of it), and the bytes per trigger printed.
+
+Run from the top level of the repository, eg:
+
+    python benchmarks/bench_memory.py --triggers 10000 --output mem.json
+"""
+
+import argparse
+import gc
+import glob
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+TOPDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOPDIR)
+
+import voeventparse
+
+from mwa_trigger import handlers
+from mwa_trigger import introspect
+
+logging.disable(logging.CRITICAL)
+
+
+def load_samples():
+    """
+    :return: A list of the XML (bytes) of the events in test_events/ that have a position.
+    """
+    result = []
+    for fname in sorted(glob.glob(os.path.join(TOPDIR, 'test_events', '*.xml'))):
+        with open(fname, 'rb') as f:
+            xml = f.read()
+        try:
+            handlers.get_position_info(voeventparse.loads(xml))
+        except (TypeError, ValueError, AttributeError):
+            continue
+        result.append(xml)
+    return result
+
+
+def make_triggers(samples, ntriggers, nnotices, rng):
+    """
+    :return: A list of ntriggers TriggerEvent objects, each with nnotices VOEvents and positions.
+    """
+    triggers = []
+    for i in range(ntriggers):
+        tevent = None
+        for n in range(nnotices):
+            v = voeventparse.loads(rng.choice(samples))
+            if tevent is None:
+                tevent = handlers.TriggerEvent(event=v)
+                tevent.trigger_id = 'SYNTH_%d' % i
+            else:
+                tevent.add_event(v)
+            tevent.add_pos(handlers.get_position_info(v))
+            tevent.debug('Synthetic notice %d of %d', n + 1, nnotices)
+        triggers.append(tevent)
+    return triggers
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory used per tracked TriggerEvent.')
+    parser.add_argument('--triggers', type=int, default=10000, help='Number of synthetic triggers')
+    parser.add_argument('--notices', type=int, default=3, help='Number of VOEvents for each trigger')
+    parser.add_argument('--seed', type=int, default=1, help='Random number seed, for sampling events')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    args = parser.parse_args()
+
+    samples = load_samples()
+    rng = random.Random(args.seed)
+    gc.collect()
+    before = introspect.rss_bytes()
+    start = time.time()
+    triggers = make_triggers(samples, args.triggers, args.notices, rng)
+    elapsed = time.time() - start
+    gc.collect()
+    after = introspect.rss_bytes()
+
+    result = {'triggers': len(triggers),
+              'notices': args.notices,
+              'rss_before': before,
+              'rss_after': after,
+              'bytes_per_trigger': (after - before) / float(len(triggers)),
+              'create_us_per_notice': elapsed / (len(triggers) * args.notices) * 1e6}
+    print("%d triggers with %d notices each: %.1f MB, %.1f kB per trigger, %.0f us per notice added" %
+          (len(triggers), args.notices, (after - before) / 1048576.0, result['bytes_per_trigger'] / 1024.0,
+           result['create_us_per_notice']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+        print("Results written to %s" % args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+"""
+Measure the cost of each kind of metrics update, and the total instrumentation cost per event, compared with the time
+taken to handle an event.
+
+Run from the top level of the repository, eg:
+
+    python benchmarks/bench_metrics.py
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mwa_trigger import metrics
+
+UPDATES_PER_EVENT = 12   # Approximate number of metric updates made while one event is received and handled
+
+
+def timeit(func, n):
+    start = time.time()
+    for i in range(n):
+        func()
+    return (time.time() - start) / n * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the metrics registry.')
+    parser.add_argument('--n', type=int, default=200000, help='Number of updates to time for each operation')
+    parser.add_argument('--event-time', type=float, default=0.05,
+                        help='Typical time taken to handle one event, in seconds, for the overhead estimate')
+    args = parser.parse_args()
+
+    registry = metrics.Registry()
+    counter = registry.counter('bench_counter_total', 'Benchmark counter')
+    lcounter = registry.counter('bench_labelled_total', 'Benchmark labelled counter', ['outcome'])
+    histogram = registry.histogram('bench_seconds', 'Benchmark histogram')
+    lhistogram = registry.histogram('bench_labelled_seconds', 'Benchmark labelled histogram', ['endpoint', 'status'])
+
+    results = [('counter.inc()', timeit(counter.inc, args.n)),
+               ('counter.labels().inc()', timeit(lambda: lcounter.labels(outcome='success').inc(), args.n)),
+               ('histogram.observe()', timeit(lambda: histogram.observe(0.123), args.n)),
+               ('histogram.labels().observe()', timeit(lambda: lhistogram.labels(endpoint='obslist',
+                                                                                   status='ok').observe(0.123), args.n))]
+    start = time.time()
+    text = registry.render()
+    render_us = (time.time() - start) * 1e6
+
+    for name, us in results:
+        print("%-30s %8.3f us" % (name, us))
+    print("%-30s %8.1f us (%d bytes)" % ('registry.render()', render_us, len(text)))
+    worst = max([us for name, us in results])
+    print("Estimated overhead: %.4f%% of a %.0f ms event" % (UPDATES_PER_EVENT * worst * 1e-6 / args.event_time * 100,
+                                                              args.event_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
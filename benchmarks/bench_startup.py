@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""
+Time taken by the handlers on the first event after startup, compared with the events after it, for each way the
+handler daemon can start (see mwa_trigger/iersdata.py and mwa_trigger/warmup.py):
+
+    cold    - as before, astropy loads its IERS table (or downloads one) and sets up on the first event
+    iers    - the IERS and leap second tables are loaded from local copies at startup
+    warmup  - the local tables are loaded, and the handlers are run on a synthetic event at startup
+
+Each mode is run --runs times, each time in a new Python process, so nothing has been set up already. The events are
+the Swift and Antares VOEvents in test_events/, handled with the real decision logic against an in-process fake
+trigger web service (fake_triggerservice.LocalTransport), with emails discarded, so everything runs offline. The
+first event (SWIFT00.xml) generates a trigger, which takes about 10 ms even when warm (most of it the altitude
+calculation), as do the other triggering events - so compare the first event with 'rest max' rather than the median
+of the rest, most of which are rejected in well under a millisecond.
+
+Run from the top level of the repository, eg:
+
+    python benchmarks/bench_startup.py --runs 5
+    python benchmarks/bench_startup.py --iers-directory /var/lib/mwa/iers --handler GW_LIGO
+"""
+
+import argparse
+import glob
+import importlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+TOPDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOPDIR)
+
+MODES = ['cold', 'iers', 'warmup']
+HANDLERS = ['GRB_fermi_swift', 'Neutrino']
+EVENT_PATTERNS = ['SWIFT0*.xml', 'Antares*.xml']
+
+
+def child(mode, handler_names, iers_directory):
+    """
+    Start up as the handler daemon does in the given mode, then handle the events, timing each one.
+
+    :return: A dictionary with the 'startup' seconds (after the imports), and a list of seconds for each 'event'.
+    """
+    logging.disable(logging.CRITICAL)   # The handlers log at DEBUG level, which would dominate the timings
+    from mwa_trigger import fake_triggerservice, iersdata, outbox, triggerservice, warmup
+    modules = [importlib.import_module('mwa_trigger.' + name) for name in handler_names]
+
+    start = time.time()
+    if mode in ['iers', 'warmup']:
+        iersdata.configure(iers_directory)
+    if mode == 'warmup':
+        warmup.run(modules)
+    startup = time.time() - start
+
+    outbox.OUTBOX.mailhost = None
+    triggerservice.TRANSPORT = fake_triggerservice.LocalTransport(
+        fake_triggerservice.FakeTriggerService(model=fake_triggerservice.ScheduleModel()))
+    files = []
+    for pattern in EVENT_PATTERNS:
+        files += sorted(glob.glob(os.path.join(TOPDIR, 'test_events', pattern)))
+    times = []
+    for fname in files:
+        with open(fname, 'rb') as f:
+            eventxml = f.read().decode('latin-1')
+        start = time.time()
+        for module in modules:
+            if module.processevent(event=eventxml, pretend=True):
+                break
+        times.append(time.time() - start)
+    return {'startup': startup, 'events': times}
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2] if values else float('nan')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='First event handling time after startup, with and without warm-up.')
+    parser.add_argument('--runs', type=int, default=3, help='Number of new processes to start for each mode')
+    parser.add_argument('--mode', action='append', choices=MODES, help='Mode to run (may be repeated), default all')
+    parser.add_argument('--handler', action='append',
+                        help='Handler module to run (may be repeated), default %s' % ' '.join(HANDLERS))
+    parser.add_argument('--iers-directory', default=None,
+                        help='Directory with the local IERS tables, default that in mwa_trigger/iersdata.py')
+    parser.add_argument('--child', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    handler_names = args.handler or HANDLERS
+
+    if args.child:
+        print(json.dumps(child(args.child, handler_names, args.iers_directory)))
+        return
+
+    cmd = [sys.executable, os.path.abspath(__file__)] + ['--handler=%s' % name for name in handler_names]
+    if args.iers_directory:
+        cmd.append('--iers-directory=%s' % args.iers_directory)
+    print("%-8s %10s %12s %12s %12s" % ('mode', 'startup', 'first event', 'rest median', 'rest max'))
+    for mode in args.mode or MODES:
+        startup, first, rest = [], [], []
+        for run in range(args.runs):
+            output = subprocess.check_output(cmd + ['--child=%s' % mode], cwd=TOPDIR)
+            result = json.loads(output.decode().strip().splitlines()[-1])
+            startup.append(result['startup'])
+            first.append(result['events'][0])
+            rest += result['events'][1:]
+        print("%-8s %9.3fs %11.3fs %11.3fs %11.3fs" % (mode, median(startup), median(first), median(rest), max(rest)))
+
+
+if __name__ == '__main__':
+    main()
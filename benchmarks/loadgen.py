@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+
+"""
+Event storm load generator for the Pyro ingest path of the handler daemon.
+
+This starts the same set-up as replay.py (a Pyro nameserver, the fake trigger web service, an SMTP sink, and
+voevent_handler.py in pretend mode in a subprocess), then sends events sampled at random from test_events/ (or
+--events) to the daemon's putEvent(), from many concurrent clients, with the arrival pattern given by --shape:
+
+    constant - evenly spaced, at --rate events per second
+    poisson  - random (exponential) gaps, averaging --rate events per second
+    burst    - --burst events at once, every --burst-interval seconds
+
+Each event is sent the way push_voevent.py sends it - a new proxy, looked up in the nameserver, for every event - so
+the client side is like COMET starting one push_voevent.py process per packet. The ivorn in each copy is made unique
+(unless --allow-duplicates is given), so that they aren't all discarded by the QueueWorker as already seen.
+
+For each event, the time spent blocked in putEvent() (which waits while the EventQueue is full), and whether the call
+succeeded, timed out (Pyro4.config.COMMTIMEOUT, 10 seconds as in push_voevent.py) or failed, are recorded. The trace
+file written by the daemon gives the time in the EventQueue and the end-to-end latency, from the client starting to
+send the event to the handlers' decision. A summary is printed, and every event is written to --csv.
+
+Run from the top level of the repository, eg:
+
+    python benchmarks/loadgen.py --shape burst --burst 50 --count 200 --csv storm.csv
+    python benchmarks/loadgen.py --shape poisson --rate 20 --count 1000 --output storm.json
+"""
+
+import argparse
+import collections
+import csv
+import glob
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+if sys.version_info.major == 2:
+    import Queue
+else:
+    import queue as Queue
+
+TOPDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOPDIR)
+
+import Pyro4
+import Pyro4.errors
+
+from mwa_trigger import fake_triggerservice
+from mwa_trigger import smtpsink
+from mwa_trigger import tracing
+
+from replay import (PERCENTILES, percentiles, read_jsonl, start_daemon, start_nameserver, stop_daemon,
+                    wait_for_daemon, wait_for_drain)
+
+Pyro4.config.COMMTIMEOUT = 10.0   # As in push_voevent.py
+
+IVORN_RE = re.compile(r'ivorn\s*=\s*"([^"]*)"')
+
+CSV_FIELDS = ['seq', 'file', 'ivorn', 'trace_id', 'scheduled', 'sent', 'blocked', 'status', 'error',
+              'queue_wait', 'handlers', 'end_to_end']
+
+
+def load_samples(patterns):
+    """
+    :return: A list of (filename, XML string) tuples for the event files matching the glob patterns.
+    """
+    result = []
+    for pattern in patterns:
+        for fname in sorted(glob.glob(pattern)):
+            with open(fname, 'rb') as f:
+                result.append((os.path.basename(fname), f.read().decode('latin-1')))
+    return result
+
+
+def schedule(shape, count, rate, burst, burst_interval, rng):
+    """
+    :return: A list of 'count' send times, in seconds from the start of the run.
+    """
+    times = []
+    t = 0.0
+    while len(times) < count:
+        if shape == 'burst':
+            times.extend([t] * min(burst, count - len(times)))
+            t += burst_interval
+        else:
+            times.append(t)
+            t += rng.expovariate(rate) if shape == 'poisson' else 1.0 / rate
+    return times
+
+
+def make_events(samples, times, unique, rng):
+    """
+    :return: A list of dictionaries, one for each event to send, with the sample file, XML, ivorn, trace ID and
+             scheduled send time.
+    """
+    events = []
+    for seq, scheduled in enumerate(times):
+        fname, xml = rng.choice(samples)
+        match = IVORN_RE.search(xml)
+        ivorn = match.group(1) if match else None
+        if unique and match:
+            ivorn = '%s_load%d' % (ivorn, seq)
+            xml = xml[:match.start(1)] + ivorn + xml[match.end(1):]
+        events.append({'seq': seq, 'file': fname, 'xml': xml, 'ivorn': ivorn, 'trace_id': tracing.new_trace_id(),
+                       'scheduled': scheduled, 'sent': None, 'blocked': None, 'status': None, 'error': None})
+    return events
+
+
+def send(ns_port, event):
+    """
+    Send one event to the daemon, as push_voevent.PyroTransmit() does, and record how long putEvent() took, and the
+    result ('accepted', 'timeout' or 'error').
+    """
+    event['sent'] = time.time()
+    try:
+        ns = Pyro4.locateNS(host='localhost', port=ns_port)
+        client = Pyro4.Proxy(ns.lookup('VOEventHandler'))
+        ns._pyroRelease()
+        with client:
+            start = time.time()
+            try:
+                client.putEvent(event=event['xml'], trace_id=event['trace_id'])
+            finally:
+                event['blocked'] = time.time() - start
+        event['status'] = 'accepted'
+    except Pyro4.errors.TimeoutError as error:
+        event['status'] = 'timeout'
+        event['error'] = str(error)
+    except (Pyro4.errors.PyroError, OSError) as error:
+        event['status'] = 'error'
+        event['error'] = '%s: %s' % (type(error).__name__, error)
+
+
+def run(ns_port, events, nclients):
+    """
+    Send the events at their scheduled times, using up to nclients concurrent client threads.
+
+    :return: The number of events that had to wait for a free client thread, because nclients were already busy.
+    """
+    jobs = Queue.Queue()
+    idle = [nclients]
+    lock = threading.Lock()
+
+    def client_thread():
+        while True:
+            event = jobs.get()
+            if event is None:
+                return
+            with lock:
+                idle[0] -= 1
+            send(ns_port, event)
+            with lock:
+                idle[0] += 1
+
+    threads = [threading.Thread(target=client_thread, name='LoadClient-%d' % i) for i in range(nclients)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    starved = 0
+    start = time.time()
+    for event in events:
+        delay = start + event['scheduled'] - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        with lock:
+            if idle[0] <= jobs.qsize():
+                starved += 1
+        event['scheduled'] += start
+        jobs.put(event)
+    for thread in threads:
+        jobs.put(None)
+    for thread in threads:
+        thread.join()
+    return starved
+
+
+def analyse(events, spans):
+    """
+    Add the time in the EventQueue, the time taken by the handlers, and the end-to-end latency (from the client
+    starting to send the event, to the end of the last handler that ran on it) from the trace spans to each event.
+    """
+    bytrace = collections.defaultdict(list)
+    for span in spans:
+        bytrace[span['trace_id']].append(span)
+    for event in events:
+        espans = bytrace.get(event['trace_id'], [])
+        waits = [s['duration'] for s in espans if s['name'] == 'queue_wait']
+        handlerspans = [s for s in espans if s['name'] == 'handler']
+        event['queue_wait'] = waits[0] if waits else None
+        event['handlers'] = sum([s['duration'] for s in handlerspans]) if handlerspans else None
+        event['end_to_end'] = None
+        if handlerspans and event['sent'] is not None:
+            event['end_to_end'] = max([s['start'] + s['duration'] for s in handlerspans]) - event['sent']
+
+
+def summarise(events, elapsed, starved):
+    statuses = collections.Counter([e['status'] for e in events])
+    processed = [e for e in events if e['queue_wait'] is not None]
+    return {'sent': len(events),
+            'elapsed': elapsed,
+            'offered_rate': len(events) / (events[-1]['scheduled'] - events[0]['scheduled'])
+                            if events[-1]['scheduled'] > events[0]['scheduled'] else None,
+            'statuses': dict(statuses),
+            'acceptance_rate': statuses['accepted'] / float(len(events)),
+            'dropped': len(events) - statuses['accepted'],
+            'processed': len(processed),
+            'processed_after_client_gave_up': len([e for e in processed if e['status'] != 'accepted']),
+            'client_starved': starved,
+            'blocked': percentiles([e['blocked'] for e in events]),
+            'queue_wait': percentiles([e['queue_wait'] for e in events]),
+            'handlers': percentiles([e['handlers'] for e in events]),
+            'end_to_end': percentiles([e['end_to_end'] for e in events])}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Event storm load generator for the handler daemon ingest path.')
+    parser.add_argument('--events', action='append',
+                        help="Glob pattern for the event files to sample (may be repeated), default 'test_events/*.xml'")
+    parser.add_argument('--shape', choices=['constant', 'poisson', 'burst'], default='burst',
+                        help='Arrival pattern, default burst')
+    parser.add_argument('--count', type=int, default=100, help='Number of events to send')
+    parser.add_argument('--rate', type=float, default=10.0, help='Events per second, for constant and poisson')
+    parser.add_argument('--burst', type=int, default=20, help='Events in each burst')
+    parser.add_argument('--burst-interval', type=float, default=5.0, help='Seconds between bursts')
+    parser.add_argument('--clients', type=int, default=50, help='Maximum number of concurrent clients')
+    parser.add_argument('--allow-duplicates', action='store_true', help="Don't make the ivorn of each copy unique")
+    parser.add_argument('--seed', type=int, default=1, help='Random number seed, for sampling events and poisson gaps')
+    parser.add_argument('--ws-latency', type=float, default=0.0, help='Fake trigger web service latency, in seconds')
+    parser.add_argument('--smtp-latency', type=float, default=0.0, help='SMTP sink latency, in seconds')
+    parser.add_argument('--timeout', type=float, default=600.0, help='Maximum time to wait for the daemon to finish')
+    parser.add_argument('--csv', help='Write one row for each event sent to this CSV file')
+    parser.add_argument('--output', help='Write the summary to this JSON file')
+    parser.add_argument('--keep', action='store_true', help="Don't delete the daemon's log and trace files")
+    args = parser.parse_args()
+
+    samples = load_samples(args.events or [os.path.join(TOPDIR, 'test_events', '*.xml')])
+    if not samples:
+        sys.exit('No events found')
+    rng = random.Random(args.seed)
+    events = make_events(samples,
+                         schedule(args.shape, args.count, args.rate, args.burst, args.burst_interval, rng),
+                         not args.allow_duplicates,
+                         rng)
+
+    tmpdir = tempfile.mkdtemp(prefix='loadgen-')
+    wsserver, baseurl = fake_triggerservice.start_server(
+        service=fake_triggerservice.FakeTriggerService(model=fake_triggerservice.ScheduleModel(voltage_buffer=True),
+                                                       latency=args.ws_latency))
+    sinkserver, mailhost = smtpsink.start_sink(sink=smtpsink.SMTPSink(latency=args.smtp_latency))
+    ns_port = start_nameserver()
+    proc = start_daemon(tmpdir, ns_port, baseurl, mailhost)
+    try:
+        proxy = wait_for_daemon(ns_port, proc)
+        print("Sending %d events (%s) to the handler daemon (pid %d), files in %s" % (len(events), args.shape,
+                                                                                     proc.pid, tmpdir))
+        start = time.time()
+        starved = run(ns_port, events, args.clients)
+        if not wait_for_drain(proxy, args.timeout):
+            print("WARNING: timed out waiting for the daemon to finish")
+        elapsed = time.time() - start
+    finally:
+        stop_daemon(proc)
+        wsserver.shutdown()
+        sinkserver.shutdown()
+
+    analyse(events, read_jsonl(os.path.join(tmpdir, 'traces.jsonl')))
+    summary = summarise(events, elapsed, starved)
+
+    print("Sent %d events in %.1f s, all handled after %.1f s" % (len(events),
+                                                                  max([e['sent'] for e in events]) - start,
+                                                                  elapsed))
+    print("putEvent() results: %s, acceptance rate %.1f%%, %d processed (%d after the client gave up)" %
+          (summary['statuses'], summary['acceptance_rate'] * 100, summary['processed'],
+           summary['processed_after_client_gave_up']))
+    if starved:
+        print("WARNING: %d events waited for a free client - increase --clients" % starved)
+    print("%-14s %6s %10s %10s %10s %10s" % ('(ms)', 'count', 'p50', 'p90', 'p99', 'max'))
+    for name in ['blocked', 'queue_wait', 'handlers', 'end_to_end']:
+        row = summary[name]
+        print("%-14s %6d %s" % (name, row['count'], ' '.join(['%10s' % ('%.1f' % (row['p%d' % p] * 1000)
+                                                                        if row['p%d' % p] is not None else '-')
+                                                               for p in PERCENTILES])))
+
+    if args.csv:
+        with open(args.csv, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(events)
+        print("Events written to %s" % args.csv)
+    if args.output:
+        summary['options'] = vars(args)
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+        print("Summary written to %s" % args.output)
+    if args.keep:
+        print("Daemon files kept in %s" % tmpdir)
+    else:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
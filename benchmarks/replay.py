@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+
+"""
+End-to-end replay of recorded VOEvents through the real handler daemon.
+
+This starts a Pyro nameserver, the fake trigger web service (mwa_trigger/fake_triggerservice.py) and an SMTP sink
+(mwa_trigger/smtpsink.py) in this process, then runs voevent_handler.py in pretend mode, in a subprocess, with a
+trigger.conf pointing at them. The events in test_events/ (or those matching --events) are sent to the daemon with
+putEvent(), exactly as push_voevent.py does, in the order they were originally issued (their Who Date), separated
+by their original inter-arrival times divided by --speedup, and capped at --max-gap seconds.
+
+The daemon and the fake trigger web service both run on a simulated clock (see mwa_trigger/clock.py), set to the
+time each event was issued as it's sent, as in benchmarks/simulate.py - so the horizon checks, the schedule the
+handlers see and so on are the same on every run, whatever the time of day. Before the clock is moved on to a later
+event, the replay waits for the daemon to finish handling the events already sent, so that no event is handled, or
+sees the schedule, at another event's time. Only events issued at the same time can queue up behind each other.
+
+Once the daemon has handled every event, the trace file (see mwa_trigger/tracing.py) gives the end-to-end latency,
+from putEvent() to the handler's decision, and the time taken by each stage, for every event, the latency ledger
+and audit file give the decision made, and the decision ledger (mwa_trigger/decisions.py) the reason code for it (eg
+prob_below_threshold, busy). Percentiles are printed, and everything is written to --output as JSON. Use --compare
+with an earlier output file to check that a change hasn't altered any of the decisions, or the reasons for them.
+
+Run from the top level of the repository, eg:
+
+    python benchmarks/replay.py --events 'test_events/Fermi_538809001_*.xml' --speedup 100
+    python benchmarks/replay.py --output replay-new.json --compare replay-old.json
+"""
+
+import argparse
+import collections
+import glob
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+TOPDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOPDIR)
+
+import Pyro4
+import Pyro4.errors
+import Pyro4.naming
+import voeventparse
+
+from mwa_trigger import clock
+from mwa_trigger import decisions
+from mwa_trigger import fake_triggerservice
+from mwa_trigger import latency
+from mwa_trigger import smtpsink
+from mwa_trigger import tracing
+
+PERCENTILES = (50, 90, 99, 100)
+
+# Stages reported for each event, as (name, span name) pairs. Spans with the same name are summed.
+STAGES = [('ingest', 'ingest'),
+          ('queue_wait', 'queue_wait'),
+          ('handlers', 'handler'),
+          ('trigger', 'trigger'),
+          ('web_api', 'web_api'),
+          ('side_effects', 'sideeffect'),
+          ('smtp', 'smtp')]
+
+CONF_TEMPLATE = """
+[pyro]
+ns_host = localhost
+ns_port = %(ns_port)d
+
+[triggerservice]
+baseurl = %(baseurl)s
+
+[mail]
+mailhost = %(mailhost)s
+spool_dir = %(tmpdir)s/spool
+batch_window = 0
+
+[logging]
+logfile = %(tmpdir)s/voevents.log
+rotate_when = none
+
+[tracing]
+file = %(tmpdir)s/traces.jsonl
+
+[latency]
+ledger_file = %(tmpdir)s/latency.jsonl
+
+[decisions]
+directory = %(tmpdir)s/decisions
+
+[sideeffects]
+audit_file = %(tmpdir)s/audit.jsonl
+
+[notify]
+window = 1
+burst = 1000
+
+[archive]
+directory = %(tmpdir)s/archive
+
+[clock]
+simulated = %(simulated_clock)s
+"""
+
+
+def load_events(patterns):
+    """
+    Read the events, and sort them by the time they were issued.
+
+    :param patterns: List of glob patterns for the event files.
+    :return: A list of dictionaries with the filename, XML, ivorn and issue time (Unix seconds) of each event.
+    """
+    fnames = set()
+    for pattern in patterns:
+        fnames.update(glob.glob(pattern))
+    events = []
+    for fname in sorted(fnames):
+        with open(fname, 'rb') as f:
+            xml = f.read()
+        v = voeventparse.loads(xml)
+        event_time, issued = latency.event_times(v)
+        events.append({'file': os.path.basename(fname),
+                       'xml': xml.decode('latin-1'),
+                       'ivorn': v.attrib['ivorn'],
+                       'issued': issued if issued is not None else event_time})
+    # Events with no times go last, in filename order
+    events.sort(key=lambda e: (e['issued'] is None, e['issued'] or 0, e['file']))
+    return events
+
+
+def start_nameserver():
+    """
+    :return: The port number of a Pyro nameserver running in a background thread.
+    """
+    uri, daemon, bcserver = Pyro4.naming.startNS(host='localhost', port=0, enableBroadcast=False)
+    thread = threading.Thread(target=daemon.requestLoop, name='PyroNS')
+    thread.daemon = True
+    thread.start()
+    return uri.port
+
+
+def start_daemon(tmpdir, ns_port, baseurl, mailhost, simulated_clock=False):
+    """
+    Write a trigger.conf in tmpdir, pointing at the nameserver, fake trigger web service and SMTP sink, and start
+    voevent_handler.py in pretend mode, in tmpdir, with its output going to tmpdir/daemon.out.
+
+    :param simulated_clock: If True, the daemon's clock is set to the time each event was issued, as it arrives.
+
+    :return: The subprocess.Popen object for the daemon.
+    """
+    with open(os.path.join(tmpdir, 'trigger.conf'), 'w') as f:
+        f.write(CONF_TEMPLATE % {'ns_port': ns_port, 'baseurl': baseurl, 'mailhost': mailhost, 'tmpdir': tmpdir,
+                                 'simulated_clock': simulated_clock})
+    env = dict(os.environ)
+    env['PYTHONPATH'] = TOPDIR + os.pathsep + env.get('PYTHONPATH', '')
+    with open(os.path.join(tmpdir, 'daemon.out'), 'w') as out:
+        return subprocess.Popen([sys.executable, os.path.join(TOPDIR, 'voevent_handler.py'), '-p'],
+                                cwd=tmpdir, env=env, stdout=out, stderr=subprocess.STDOUT)
+
+
+def stop_daemon(proc):
+    """
+    Stop the daemon started by start_daemon().
+    """
+    if proc.poll() is None:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(timeout=10)
+        except Exception:
+            proc.kill()
+
+
+def wait_for_daemon(ns_port, proc, timeout=120.0):
+    """
+    Wait for the handler daemon to register with the nameserver and answer a ping().
+
+    :return: A Pyro4 proxy for the daemon.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('voevent_handler.py exited with status %s' % proc.returncode)
+        try:
+            ns = Pyro4.locateNS(host='localhost', port=ns_port)
+            proxy = Pyro4.Proxy(ns.lookup('VOEventHandler'))
+            proxy.ping()
+            return proxy
+        except (Pyro4.errors.PyroError, OSError):
+            time.sleep(0.5)
+    raise RuntimeError('voevent_handler.py did not start within %d seconds' % timeout)
+
+
+def wait_for_handled(proxy, timeout):
+    """
+    Wait until the daemon has handled every event sent to it, without waiting for the emails and audit records.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proxy.queueStatus()['unfinished'] == 0:
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def wait_for_drain(proxy, timeout):
+    """
+    Wait until every event has been handled, and all the emails and audit records have been written.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        queue = proxy.queueStatus()
+        sideeffects = proxy.sideEffectStatus()
+        outbox = proxy.outboxStatus()
+        digests = proxy.notifyStatus()
+        if (queue['unfinished'] == 0 and digests['pending'] == 0 and
+                sideeffects['backlog'] == 0 and outbox['queued_now'] == 0):
+            return True
+        time.sleep(0.2)
+    return False
+
+
+def read_jsonl(filename):
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentiles(values):
+    values = sorted([x for x in values if x is not None])
+    result = {'count': len(values)}
+    for p in PERCENTILES:
+        result['p%d' % p] = latency.percentile(values, p)
+    return result
+
+
+def read_reasons(directory):
+    """
+    :return: A dictionary of decision reason codes from the decision ledger in directory, by (trace ID, outcome).
+    """
+    columns = decisions.load(directory, columns=['trace_id', 'outcome', 'reason'])
+    return dict(zip(zip(columns['trace_id'].tolist(), columns['outcome'].tolist()), columns['reason'].tolist()))
+
+
+def analyse(events, spans, ledger, audits, reasons):
+    """
+    Combine the injection times, trace spans, latency ledger, audit records and decision reason codes (from
+    read_reasons()) into one result for each event.
+    """
+    bytrace = collections.defaultdict(list)
+    for span in spans:
+        bytrace[span['trace_id']].append(span)
+    decisions = {}
+    for rec in ledger:
+        # The ledger is written by the side effect workers, so not necessarily in order - a trigger outcome wins
+        if rec['trace_id'] not in decisions or rec['outcome'] in latency.TRIGGER_OUTCOMES:
+            decisions[rec['trace_id']] = rec
+    auditmap = dict([(a.get('trace_id'), a) for a in audits])
+
+    results = []
+    for event in events:
+        tid = event['trace_id']
+        espans = bytrace.get(tid, [])
+        stages = {}
+        for name, spanname in STAGES:
+            durations = [s['duration'] for s in espans if s['name'] == spanname]
+            stages[name] = sum(durations) if durations else None
+        handlerspans = [s for s in espans if s['name'] == 'handler']
+        decided = max([s['start'] + s['duration'] for s in handlerspans]) if handlerspans else None
+        accepted_by = [s.get('handler') for s in handlerspans if s.get('handled')]
+
+        decision = decisions.get(tid)
+        audit = auditmap.get(tid)
+        if decision is None:
+            outcome = 'duplicate' if not handlerspans else 'unknown'
+        else:
+            outcome = decision['outcome']
+        reason = reasons.get((tid, outcome), outcome)
+
+        results.append({'file': event['file'],
+                        'ivorn': event['ivorn'],
+                        'trace_id': tid,
+                        'outcome': outcome,
+                        'reason': reason,
+                        'handler': accepted_by[0] if accepted_by else None,
+                        'errors': audit.get('errors') if (audit and outcome == 'trigger_failed') else None,
+                        'trigger_id': decision.get('trigger_id') if decision else None,
+                        'project_id': audit.get('project_id') if audit else None,
+                        'end_to_end': (decided - event['injected']) if decided else None,
+                        'stages': stages})
+    return results
+
+
+def compare(results, filename):
+    """
+    Print the events whose decision (outcome, reason code or trigger ID) differs from those in an earlier output
+    file.
+
+    :return: The number of differences.
+    """
+    with open(filename) as f:
+        previous = dict([(r['file'], r) for r in json.load(f)['events']])
+    differences = 0
+    for r in results:
+        old = previous.get(r['file'])
+        if old is None:
+            continue
+        if (old['outcome'], old['reason'], old['trigger_id']) != (r['outcome'], r['reason'], r['trigger_id']):
+            differences += 1
+            print("DIFFERENT: %s was %s/%s (%s), now %s/%s (%s)" % (r['file'], old['outcome'], old['reason'],
+                                                                     old['trigger_id'], r['outcome'], r['reason'],
+                                                                     r['trigger_id']))
+    print("%d of %d decisions differ from %s" % (differences, len(results), filename))
+    return differences
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded VOEvents through the handler daemon.')
+    parser.add_argument('--events', action='append',
+                        help="Glob pattern for the event files (may be repeated), default 'test_events/*.xml'")
+    parser.add_argument('--speedup', type=float, default=1000.0,
+                        help='Divide the original inter-arrival times by this (0 to send as fast as possible)')
+    parser.add_argument('--max-gap', type=float, default=5.0, help='Maximum delay between events, in seconds')
+    parser.add_argument('--ws-latency', type=float, default=0.0, help='Fake trigger web service latency, in seconds')
+    parser.add_argument('--smtp-latency', type=float, default=0.0, help='SMTP sink latency, in seconds')
+    parser.add_argument('--timeout', type=float, default=300.0, help='Maximum time to wait for the daemon to finish')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='Compare the decisions with those in this earlier output file')
+    parser.add_argument('--keep', action='store_true', help="Don't delete the daemon's log, trace and ledger files")
+    args = parser.parse_args()
+
+    events = load_events(args.events or [os.path.join(TOPDIR, 'test_events', '*.xml')])
+    if not events:
+        sys.exit('No events found')
+
+    tmpdir = tempfile.mkdtemp(prefix='replay-')
+    first = [e['issued'] for e in events if e['issued'] is not None]
+    sim = clock.SimulatedClock(start=first[0] if first else None)
+    clock.set_clock(sim)   # For the fake trigger web service's schedule, the daemon has its own
+    service = fake_triggerservice.FakeTriggerService(model=fake_triggerservice.ScheduleModel(voltage_buffer=True),
+                                                     latency=args.ws_latency)
+    wsserver, baseurl = fake_triggerservice.start_server(service=service)
+    sinkserver, mailhost = smtpsink.start_sink(sink=smtpsink.SMTPSink(latency=args.smtp_latency))
+    ns_port = start_nameserver()
+    proc = start_daemon(tmpdir, ns_port, baseurl, mailhost, simulated_clock=True)
+    try:
+        proxy = wait_for_daemon(ns_port, proc)
+        print("Replaying %d events into the handler daemon (pid %d), files in %s" % (len(events), proc.pid, tmpdir))
+        start = time.time()
+        last_issued = None
+        for event in events:
+            if last_issued is not None and event['issued'] is not None and args.speedup > 0:
+                time.sleep(min(args.max_gap, max(0.0, (event['issued'] - last_issued) / args.speedup)))
+            if event['issued'] is not None:
+                last_issued = event['issued']
+                if event['issued'] > sim.time():
+                    if not wait_for_handled(proxy, args.timeout):
+                        print("WARNING: timed out waiting for the daemon to handle the events before %s" %
+                              event['file'])
+                    sim.set(event['issued'])
+            event['trace_id'] = tracing.new_trace_id()
+            event['injected'] = time.time()
+            proxy.putEvent(event=event['xml'], trace_id=event['trace_id'])
+        sent = time.time() - start
+        if not wait_for_drain(proxy, args.timeout):
+            print("WARNING: timed out waiting for the daemon to finish")
+        elapsed = time.time() - start
+    finally:
+        stop_daemon(proc)
+        wsserver.shutdown()
+        sinkserver.shutdown()
+
+    results = analyse(events,
+                      read_jsonl(os.path.join(tmpdir, 'traces.jsonl')),
+                      read_jsonl(os.path.join(tmpdir, 'latency.jsonl')),
+                      read_jsonl(os.path.join(tmpdir, 'audit.jsonl')),
+                      read_reasons(os.path.join(tmpdir, 'decisions')))
+    summary = {'end_to_end': percentiles([r['end_to_end'] for r in results])}
+    for name, spanname in STAGES:
+        summary[name] = percentiles([r['stages'][name] for r in results])
+    outcomes = collections.Counter([r['outcome'] for r in results])
+
+    print("Sent %d events in %.1f s, all handled after %.1f s. Outcomes: %s" % (len(events), sent, elapsed,
+                                                                                dict(outcomes)))
+    print("Emails received by the SMTP sink: %d" % len(sinkserver.sink.messages))
+    print("%-14s %6s %10s %10s %10s %10s" % ('stage (ms)', 'count', 'p50', 'p90', 'p99', 'max'))
+    for name in ['end_to_end'] + [s[0] for s in STAGES]:
+        row = summary[name]
+        print("%-14s %6d %s" % (name, row['count'], ' '.join(['%10s' % ('%.1f' % (row['p%d' % p] * 1000)
+                                                                        if row['p%d' % p] is not None else '-')
+                                                               for p in PERCENTILES])))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                       'speedup': args.speedup,
+                       'max_gap': args.max_gap,
+                       'summary': summary,
+                       'outcomes': dict(outcomes),
+                       'webservice': service.stats,
+                       'smtp': sinkserver.sink.stats,
+                       'events': results}, f, indent=2, sort_keys=True)
+        print("Results written to %s" % args.output)
+    if args.compare:
+        compare(results, args.compare)
+    if args.keep:
+        print("Daemon files kept in %s" % tmpdir)
+    else:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
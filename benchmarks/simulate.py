@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+"""
+Time-accelerated simulation: push an archive of VOEvents through the real handler code, in this process, with the
+handlers' clock (mwa_trigger/clock.py) replaced by a simulated one, so that each event is handled as if it had just
+arrived at the time it was originally issued (its Who Date).
+
+Trigger requests go to the fake trigger web service (mwa_trigger/fake_triggerservice.py), whose model of the
+observing schedule runs on the same simulated clock, so the obslist/busy state seen by the handlers evolves as the
+triggers fire. Emails go to an SMTP sink (mwa_trigger/smtpsink.py). Decisions are recorded by the latency ledger
+(mwa_trigger/latency.py), exactly as in the handler daemon.
+
+By default (--speed 0) the clock jumps straight from one event to the next, so months of archived events take only
+as long as the handlers need to process them. With --speed N, the simulated clock runs at N times real time between
+events (for at most --max-gap real seconds), so that timers and waits in the handlers see realistic gaps.
+
+Run from the top level of the repository, eg:
+
+    python benchmarks/simulate.py --events '/data/gcn_archive/2019/*.xml'
+    python benchmarks/simulate.py --events 'test_events/*.xml' --speed 1000 --output sim.json
+
+The GW handler isn't enabled in the handler daemon by default, so it's only included here if asked for with
+--handler GW_LIGO (which needs healpy and mwa_pb).
+"""
+
+import argparse
+import collections
+import importlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+TOPDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOPDIR)
+
+import voeventparse
+
+from mwa_trigger import clock
+from mwa_trigger import decisions
+from mwa_trigger import fake_triggerservice
+from mwa_trigger import latency
+from mwa_trigger import notify
+from mwa_trigger import outbox
+from mwa_trigger import sideeffects
+from mwa_trigger import smtpsink
+from mwa_trigger import tracing
+from mwa_trigger import triggerservice
+from mwa_trigger.logpipeline import MWALogFormatter
+
+from replay import load_events, percentiles, read_jsonl
+
+# The same handlers, in the same order, as EVENTHANDLERS in voevent_handler.py
+HANDLERS = ['GRB_fermi_swift', 'Neutrino']
+
+
+def setup_logging(filename):
+    """
+    Send the handlers' log messages to filename, with the simulated time in the timestamps.
+    """
+    handler = logging.FileHandler(filename)
+    handler.setFormatter(MWALogFormatter())
+    handler.addFilter(clock.ClockFilter())
+    logger = logging.getLogger('voevent')
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+    logger.propagate = False
+    logging.getLogger().setLevel(logging.WARNING)   # triggerservice logs some requests to the root logger
+
+
+def run(events, hfuncs, sim, speed, max_gap):
+    """
+    Handle each event in turn, as the QueueWorker in voevent_handler.py does, after setting (or, for speed > 0,
+    waiting for, up to max_gap real seconds) the simulated clock to reach the time it was issued.
+
+    :return: A list of dictionaries with the file, ivorn, trace ID, and real processing time in seconds of each event.
+    """
+    seen = set()
+    results = []
+    for event in events:
+        if event['issued'] is not None:
+            if speed > 0:
+                gap = event['issued'] - sim.time()
+                if gap > 0:
+                    time.sleep(min(max_gap, gap / speed))
+            if event['issued'] > sim.time():
+                sim.set(event['issued'])
+        v = voeventparse.loads(event['xml'].encode('latin-1'))
+        ivorn = v.attrib['ivorn']
+        result = {'file': event['file'], 'ivorn': ivorn, 'issued': event['issued'],
+                  'trace_id': tracing.new_trace_id(), 'seconds': None}
+        results.append(result)
+        if ivorn in seen:
+            continue
+        seen.add(ivorn)
+        tracing.set_trace_id(result['trace_id'])
+        start = time.time()
+        handled = False
+        for hfunc in hfuncs:
+            handled = hfunc(event=event['xml'], pretend=True)
+            if handled:
+                break
+        result['seconds'] = time.time() - start
+        latency.record(v=v, outcome='handled' if handled else 'ignored')
+        tracing.set_trace_id(None)
+    return results
+
+
+def add_outcomes(results, ledger, reasons):
+    """
+    Add the outcome, source and trigger ID from the latency ledger, and the reason from the decision ledger, to
+    each result.
+    """
+    bytrace = {}
+    for rec in ledger:
+        # The ledger is written by the side effect workers, so not necessarily in order - a trigger outcome wins
+        if rec['trace_id'] not in bytrace or rec['outcome'] in latency.TRIGGER_OUTCOMES:
+            bytrace[rec['trace_id']] = rec
+    for result in results:
+        rec = bytrace.get(result['trace_id'])
+        if result['seconds'] is None:
+            result['outcome'] = 'duplicate'
+        else:
+            result['outcome'] = rec['outcome'] if rec else 'unknown'
+        result['source'] = rec['source'] if rec else None
+        result['trigger_id'] = rec.get('trigger_id') if rec else None
+        result['reason'] = reasons.get(result['trace_id'], 'duplicate' if result['seconds'] is None else None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the handlers on an archive of VOEvents, faster than real time.')
+    parser.add_argument('--events', action='append',
+                        help="Glob pattern for the event files (may be repeated), default 'test_events/*.xml'")
+    parser.add_argument('--handler', action='append',
+                        help='Handler module to run (may be repeated), default %s' % ' '.join(HANDLERS))
+    parser.add_argument('--speed', type=float, default=0.0,
+                        help='Simulated seconds per real second between events, or 0 to jump from event to event')
+    parser.add_argument('--max-gap', type=float, default=5.0,
+                        help='With --speed, the longest to wait for the next event, in real seconds')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--keep', action='store_true', help="Don't delete the log, ledger and audit files")
+    args = parser.parse_args()
+
+    events = load_events(args.events or [os.path.join(TOPDIR, 'test_events', '*.xml')])
+    if not events:
+        sys.exit('No events found')
+    hfuncs = [importlib.import_module('mwa_trigger.' + name).processevent for name in (args.handler or HANDLERS)]
+
+    tmpdir = tempfile.mkdtemp(prefix='simulate-')
+    first = [e['issued'] for e in events if e['issued'] is not None]
+    sim = clock.SimulatedClock(start=first[0] if first else None, speed=args.speed)
+    clock.set_clock(sim)
+    setup_logging(os.path.join(tmpdir, 'voevents.log'))
+
+    wsserver, triggerservice.BASEURL = fake_triggerservice.start_server(
+        service=fake_triggerservice.FakeTriggerService(model=fake_triggerservice.ScheduleModel(voltage_buffer=True)))
+    sinkserver, outbox.OUTBOX.mailhost = smtpsink.start_sink()
+    outbox.OUTBOX.batch_window = 0
+    outbox.OUTBOX.start()
+    notify.AGGREGATOR.window = 0.5   # Digest windows are in real time, not simulated time
+    notify.AGGREGATOR.start()
+    latency.LEDGER.ledger_file = os.path.join(tmpdir, 'latency.jsonl')
+    decisions.LEDGER.configure(os.path.join(tmpdir, 'decisions'))
+    sideeffects.PIPELINE.audit_file = os.path.join(tmpdir, 'audit.jsonl')
+    sideeffects.PIPELINE.start()
+
+    try:
+        if first:
+            print("Simulating %d events issued from %s to %s" % (len(events),
+                                                                 time.strftime('%Y-%m-%d', time.gmtime(first[0])),
+                                                                 time.strftime('%Y-%m-%d', time.gmtime(first[-1]))))
+        start = time.time()
+        results = run(events, hfuncs, sim, args.speed, args.max_gap)
+        elapsed = time.time() - start
+        notify.AGGREGATOR.flush(force=True)
+        sideeffects.PIPELINE.join(timeout=60)
+        outbox.OUTBOX.flush(timeout=60)
+    finally:
+        wsserver.shutdown()
+        sinkserver.shutdown()
+
+    columns = decisions.load(decisions.LEDGER.directory, columns=['trace_id', 'reason'])
+    reasons = dict(zip(columns['trace_id'].tolist(), columns['reason'].tolist()))
+    add_outcomes(results, read_jsonl(latency.LEDGER.ledger_file), reasons)
+    outcomes = collections.Counter([r['outcome'] for r in results])
+    byreason = collections.Counter([r['reason'] for r in results])
+    bysource = collections.defaultdict(collections.Counter)
+    for r in results:
+        bysource[r['source'] or 'unknown'][r['outcome']] += 1
+    handled = [r['seconds'] for r in results if r['seconds'] is not None]
+    simulated = (first[-1] - first[0]) if first else 0.0
+    summary = {'events': len(results),
+               'real_seconds': elapsed,
+               'simulated_seconds': simulated,
+               'acceleration': simulated / elapsed if elapsed else None,
+               'events_per_second': len(results) / elapsed if elapsed else None,
+               'handler_seconds': percentiles(handled),
+               'emails': len(sinkserver.sink.messages)}
+
+    print("Handled %d events (%.1f days of simulated time) in %.1f s: %.1f events/s, %.0fx real time" %
+          (len(results), simulated / 86400.0, elapsed, summary['events_per_second'] or 0, summary['acceleration'] or 0))
+    print("Handler time per event (ms): p50 %s, p90 %s, p99 %s, max %s" %
+          tuple(['%.1f' % (summary['handler_seconds']['p%d' % p] * 1000)
+                 if summary['handler_seconds']['p%d' % p] is not None else '-' for p in (50, 90, 99, 100)]))
+    print("Emails sent: %d. Outcomes: %s" % (summary['emails'], dict(outcomes)))
+    print("Reasons: %s" % dict(byreason))
+    for source in sorted(bysource):
+        print("    %-12s %s" % (source, dict(bysource[source])))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                       'speed': args.speed,
+                       'handlers': args.handler or HANDLERS,
+                       'summary': summary,
+                       'outcomes': dict(outcomes),
+                       'reasons': dict(byreason),
+                       'sources': dict([(s, dict(c)) for s, c in bysource.items()]),
+                       'events': results}, f, indent=2, sort_keys=True)
+        print("Results written to %s" % args.output)
+    if args.keep:
+        print("Files kept in %s" % tmpdir)
+    else:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
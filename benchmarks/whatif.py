@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+"""
+Batch 'what if' evaluation of the trigger rules: run the real handler decision logic over a set of archived
+VOEvents once for every combination of a grid of handler settings, and report how many triggers each combination
+would have produced.
+
+Nothing leaves the process - each run has its own simulated clock (mwa_trigger/clock.py) and its own in-process fake
+trigger web service (fake_triggerservice.LocalTransport, with a fresh ScheduleModel, so the obslist/busy state evolves
+as that run's triggers fire), and emails are counted and discarded by the outbox. Because the web service is fake,
+the handlers are run with pretend=False, so that the trigger decisions made are the real ones. Outcomes and reasons
+come from the decision ledger (mwa_trigger/decisions.py), written to a temporary directory for each run.
+
+The runs are spread over a pool of worker processes, each of which handles whole runs, so the handler module
+constants being changed are never shared between runs in progress.
+
+Events are read from the VOEvent archive (mwa_trigger/archive.py), in the order they were received, with the clock set
+to the time each one was received, or from XML files, in the order they were issued. Run from the top level of the
+repository, eg:
+
+    python benchmarks/whatif.py --archive /data/voevents --since 2020-01-01 \\
+        --param GRB_fermi_swift.FERMI_POBABILITY_THRESHOLD=30,50,70 --param GRB_fermi_swift.LONG_SHORT_LIMIT=1,2.05,4
+    python benchmarks/whatif.py --events 'test_events/*.xml' --param Neutrino.MINIMUM_RANKING=1,2,3 --output w.json
+
+Each --param is MODULE.NAME=VALUE,VALUE,... where MODULE is one of the handler modules being run (or 'handlers', for
+the shared settings like HORIZON_LIMIT), and NAME is a module level setting. As in simulate.py, the GW handler is only
+included if asked for with --handler GW_LIGO (which needs healpy and mwa_pb).
+"""
+
+import argparse
+import ast
+import collections
+import importlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+TOPDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOPDIR)
+
+import voeventparse
+
+from mwa_trigger import archive
+from mwa_trigger import clock
+from mwa_trigger import decisions
+from mwa_trigger import eventregistry
+from mwa_trigger import fake_triggerservice
+from mwa_trigger import latency
+from mwa_trigger import outbox
+from mwa_trigger import tracing
+from mwa_trigger import triggerservice
+
+from replay import load_events
+from simulate import HANDLERS
+
+# Set in each worker process by init_worker()
+EVENTS = []
+MODULES = {}
+HFUNCS = []
+
+
+def parse_param(text):
+    """
+    :param text: A --param argument, eg 'GRB_fermi_swift.LONG_SHORT_LIMIT=1,2.05,4'.
+    :return: A tuple of (name, list of values), eg ('GRB_fermi_swift.LONG_SHORT_LIMIT', [1, 2.05, 4]).
+    """
+    if '=' not in text or '.' not in text.split('=')[0]:
+        raise argparse.ArgumentTypeError('Expected MODULE.NAME=VALUE,VALUE,... not %r' % text)
+    name, values = text.split('=', 1)
+    result = []
+    for value in values.split(','):
+        try:
+            result.append(ast.literal_eval(value.strip()))
+        except (ValueError, SyntaxError):
+            result.append(value.strip())
+    return name.strip(), result
+
+
+def load_archive(directory, since=None, until=None, source=None):
+    """
+    Read events from the VOEvent archive, in the order they were received.
+
+    :return: A list of dictionaries like those from replay.load_events(), with 'issued' set to the time each event was
+             received (falling back to the time it was issued), as that's when the handlers saw it.
+    """
+    events = []
+    entries = archive.search(directory, since=since, until=until, source=source, by='received')
+    for entry, eventxml in archive.read_events(entries):
+        when = entry.received if entry.received is not None else entry.issued
+        events.append({'file': os.path.basename(entry.segment),
+                       'xml': eventxml,
+                       'ivorn': entry.ivorn,
+                       'issued': when})
+    events.sort(key=lambda e: (e['issued'] is None, e['issued'] or 0))
+    return events
+
+
+def init_worker(events, handler_names, verbose):
+    """
+    Set up a worker process: import the handlers, and make sure nothing can be sent anywhere.
+    """
+    global EVENTS, MODULES, HFUNCS
+    EVENTS = events
+    MODULES = dict([(name, importlib.import_module('mwa_trigger.' + name)) for name in handler_names + ['handlers']])
+    HFUNCS = [MODULES[name].processevent for name in handler_names]
+    for module in MODULES.values():
+        for name in ['PRETEND', 'GW_PRETEND']:
+            if hasattr(module, name):
+                setattr(module, name, False)
+    outbox.OUTBOX.mailhost = None
+    logging.getLogger('voevent').setLevel(logging.INFO if verbose else logging.ERROR)
+    logging.getLogger().setLevel(logging.WARNING)   # triggerservice logs some requests to the root logger
+
+
+def run_events(sim):
+    """
+    Handle each event in turn, as the QueueWorker in voevent_handler.py does, with the clock set to when it arrived.
+
+    :return: The number of events handled, excluding duplicates.
+    """
+    seen = set()
+    for event in EVENTS:
+        if event['issued'] is not None and event['issued'] > sim.time():
+            sim.set(event['issued'])
+        v = voeventparse.loads(event['xml'].encode('latin-1'))
+        ivorn = v.attrib['ivorn']
+        if ivorn in seen:
+            continue
+        seen.add(ivorn)
+        tracing.set_trace_id(tracing.new_trace_id())
+        handled = False
+        for hfunc in HFUNCS:
+            handled = hfunc(event=event['xml'], pretend=False)
+            if handled:
+                break
+        latency.record(v=v, outcome='handled' if handled else 'ignored')
+        tracing.set_trace_id(None)
+    return len(seen)
+
+
+def evaluate(setting):
+    """
+    Run all the events through the handlers with one combination of settings.
+
+    :param setting: A tuple of (MODULE.NAME, value) tuples.
+    :return: A dictionary with the setting, the number of triggers, and the outcomes, reasons and triggers by source.
+    """
+    saved = []
+    for name, value in setting:
+        modname, attr = name.split('.', 1)
+        saved.append((MODULES[modname], attr, getattr(MODULES[modname], attr)))
+        setattr(MODULES[modname], attr, value)
+    tmpdir = tempfile.mkdtemp(prefix='whatif-')
+    start = time.time()
+    try:
+        eventregistry.EVENTS.clear()
+        latency.LEDGER = latency.LatencyLedger()
+        decisions.LEDGER.configure(tmpdir)
+        first = [e['issued'] for e in EVENTS if e['issued'] is not None]
+        clock.set_clock(clock.SimulatedClock(start=first[0] if first else None))
+        model = fake_triggerservice.ScheduleModel(voltage_buffer=True)
+        triggerservice.TRANSPORT = fake_triggerservice.LocalTransport(
+            fake_triggerservice.FakeTriggerService(model=model))
+        nevents = run_events(clock.CLOCK)
+        data = decisions.load(tmpdir, columns=['source', 'outcome', 'reason', 'trigger_id'])
+        emails = outbox.OUTBOX.counts['discarded']
+        outbox.OUTBOX.counts['discarded'] = 0
+    finally:
+        triggerservice.TRANSPORT = None
+        decisions.LEDGER.configure(None)
+        for module, attr, value in saved:
+            setattr(module, attr, value)
+        shutil.rmtree(tmpdir)
+
+    outcomes, sources, ids = data['outcome'].tolist(), data['source'].tolist(), data['trigger_id'].tolist()
+    triggered = [i for i, outcome in enumerate(outcomes) if outcome in latency.TRIGGER_OUTCOMES]
+    bysource = collections.Counter([sources[i] for i in triggered])
+    trigger_ids = sorted(set([ids[i] for i in triggered]))
+    return {'setting': dict(setting),
+            'events': nevents,
+            'triggers': len(triggered),
+            'trigger_ids': trigger_ids,
+            'observations': len(model.observations),
+            'emails': emails,
+            'outcomes': dict(collections.Counter(outcomes)),
+            'reasons': dict(collections.Counter(data['reason'].tolist())),
+            'sources': dict(bysource),
+            'seconds': time.time() - start}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Count the triggers a grid of handler settings would have produced.')
+    parser.add_argument('--archive', help='VOEvent archive directory to read the events from')
+    parser.add_argument('--since', type=archive._parse_time, help='With --archive, only events received at or after '
+                                                                  'this UTC date or time, eg 2020-01-01')
+    parser.add_argument('--until', type=archive._parse_time, help='With --archive, only events received before this')
+    parser.add_argument('--source', help='With --archive, only events from this source, eg Swift, Fermi, IceCube')
+    parser.add_argument('--events', action='append',
+                        help="Glob pattern for event files (may be repeated), default 'test_events/*.xml' if no "
+                             "--archive is given")
+    parser.add_argument('--handler', action='append',
+                        help='Handler module to run (may be repeated), default %s' % ' '.join(HANDLERS))
+    parser.add_argument('--param', action='append', type=parse_param, default=[],
+                        help='Setting to vary, as MODULE.NAME=VALUE,VALUE,... (may be repeated)')
+    parser.add_argument('--processes', type=int, default=None, help='Number of worker processes, default one per CPU')
+    parser.add_argument('--verbose', action='store_true', help='Show the handler log messages')
+    parser.add_argument('--output', help='Write the results, including the trigger IDs, to this JSON file')
+    args = parser.parse_args()
+
+    handler_names = args.handler or HANDLERS
+    modules = dict([(name, importlib.import_module('mwa_trigger.' + name)) for name in handler_names + ['handlers']])
+    for name, values in args.param:
+        modname, attr = name.split('.', 1)
+        if modname not in modules:
+            sys.exit('%s: module %s is not one of the handlers being run' % (name, modname))
+        if not attr.isupper() or not hasattr(modules[modname], attr):
+            sys.exit('%s: no setting %s in %s' % (name, attr, modname))
+
+    events = []
+    if args.archive:
+        events += load_archive(args.archive, since=args.since, until=args.until, source=args.source)
+    if args.events or not args.archive:
+        events += load_events(args.events or [os.path.join(TOPDIR, 'test_events', '*.xml')])
+    if not events:
+        sys.exit('No events found')
+
+    names = [name for name, values in args.param]
+    settings = [tuple(zip(names, values)) for values in itertools.product(*[values for name, values in args.param])]
+    print("Evaluating %d setting(s) over %d events with %s" % (len(settings), len(events), ', '.join(handler_names)))
+
+    start = time.time()
+    pool = multiprocessing.Pool(processes=min(args.processes or multiprocessing.cpu_count(), len(settings)),
+                                initializer=init_worker, initargs=(events, handler_names, args.verbose))
+    try:
+        results = pool.map(evaluate, settings, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+
+    sources = sorted(set(itertools.chain(*[r['sources'].keys() for r in results])))
+    header = ['%-*s' % (max(len(n), 8), n) for n in names] + ['%8s' % 'triggers', '%8s' % 'IDs'] + \
+             ['%8s' % s[:8] for s in sources]
+    print(' '.join(header))
+    for r in results:
+        row = ['%-*s' % (max(len(n), 8), r['setting'][n]) for n in names]
+        row += ['%8d' % r['triggers'], '%8d' % len(r['trigger_ids'])]
+        row += ['%8d' % r['sources'].get(s, 0) for s in sources]
+        print(' '.join(row))
+    print("%d runs of %d events in %.1f s (%.0f events/s)" % (len(results), len(events), elapsed,
+                                                             len(results) * len(events) / elapsed))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                       'handlers': handler_names,
+                       'events': len(events),
+                       'parameters': dict(args.param),
+                       'seconds': elapsed,
+                       'results': results}, f, indent=2, sort_keys=True)
+        print("Results written to %s" % args.output)
+
+
+if __name__ == '__main__':
+    main()
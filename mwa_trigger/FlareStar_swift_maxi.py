@@ -15,12 +15,15 @@ import logging
 import os
 import astropy
 from astropy.coordinates import Angle
-from astropy.time import Time
 import re
 import sys
 import voeventparse
 
+from . import clock
+from . import decisions
+from . import eventregistry
 from . import handlers
+from . import prefetch
 from . import triggerservice
 
 log = logging.getLogger('voevent.handlers.FlareStar_swift_maxi')   # Inherit the logging setup from handlers.py
@@ -28,6 +31,10 @@ log = logging.getLogger('voevent.handlers.FlareStar_swift_maxi')   # Inherit the
 # Settings
 DEC_LIMIT = 32.
 
+# Pre-fetch the schedule as soon as these events arrive (see prefetch.py)
+PREFETCH_IVORNS = ["ivo://nasa.gsfc.gcn/SWIFT#BAT_GRB_Pos", "ivo://nasa.gsfc.gcn/MAXI"]
+PREFETCH_OBSTIME = 1800
+
 PROJECT_ID = 'G0056'
 SECURE_KEY = handlers.get_secure_key(PROJECT_ID)
 
@@ -50,7 +57,7 @@ Dec:        %(dec)s deg
 
 DEBUG_EMAIL_TEMPLATE = """
 The Flare Star MAXI+Swift handler did NOT trigger an MWA observation for a
-Flare Star. Log messages are:
+Flare Star. The reason was:
 
 %s
 
@@ -58,8 +65,8 @@ Flare Star. Log messages are:
 
 EMAIL_SUBJECT_TEMPLATE = "Flare Star MAXI+Swift handler trigger for %s"
 
-# state storage
-xml_cache = {}
+# state storage, a view of this handler's events in eventregistry.EVENTS
+xml_cache = eventregistry.HandlerCache('FlareStar_swift_maxi', factory=lambda: FlareStar())
 # list of star names
 flare_stars = []
 
@@ -87,6 +94,8 @@ class FlareStar(handlers.TriggerEvent):
     """
     Subclass the TriggerEvent class to add a parameter 'short', relevant only for GRB type events.
     """
+    __slots__ = ()
+
     def __init__(self, event=None):
         handlers.TriggerEvent.__init__(self, event=event)
 
@@ -177,12 +186,14 @@ def handle_flarestar(v, pretend=False):
     if c.dec > DEC_LIMIT:
         msg = "Flare Star {0} above declination cutoff of +10 degrees".format(name)
         log.debug(msg)
+        decisions.reason('declination_limit', trigger_id=trig_id)
         log.debug("Not triggering")
-        handlers.send_email(from_address='mwa@telemetry.mwa128t.org',
-                            to_addresses=DEBUG_NOTIFY_LIST,
-                            subject='GRB_fermi_swift debug notification for trigger: %s' % trig_id,
-                            msg_text=DEBUG_EMAIL_TEMPLATE % msg,
-                            attachments=[('voevent.xml', voeventparse.dumps(v))])
+        handlers.debug_notify(trigger_id=trig_id,
+                              from_address='mwa@telemetry.mwa128t.org',
+                              to_addresses=DEBUG_NOTIFY_LIST,
+                              subject='GRB_fermi_swift debug notification for trigger: %s' % trig_id,
+                              msg_text=DEBUG_EMAIL_TEMPLATE % msg,
+                              attachments=[('voevent.xml', voeventparse.dumps(v))])
         return
 
     if trig_id not in xml_cache:
@@ -201,7 +212,7 @@ def handle_flarestar(v, pretend=False):
     req_time_min = 30
 
     # look at the schedule
-    obslist = triggerservice.obslist(obstime=1800)
+    obslist = prefetch.obslist(ivorn=v.attrib['ivorn'], obstime=1800)
     if obslist is not None and len(obslist) > 0:
         fs.debug("Currently observing:")
         fs.debug(str(obslist))
@@ -213,11 +224,14 @@ def handle_flarestar(v, pretend=False):
         if obs == trig_id:
             fs.info("already observing this star")
             fs.info("not triggering again")
-            handlers.send_email(from_address='mwa@telemetry.mwa128t.org',
-                                to_addresses=DEBUG_NOTIFY_LIST,
-                                subject='GRB_fermi_swift debug notification for trigger: %s' % trig_id,
-                                msg_text=DEBUG_EMAIL_TEMPLATE % '\n'.join([str(x) for x in fs.loglist]),
-                                attachments=[('voevent.xml', voeventparse.dumps(v))])
+            decisions.reason('already_triggered', trigger_id=trig_id)
+            handlers.debug_notify(trigger_id=trig_id,
+                                  from_address='mwa@telemetry.mwa128t.org',
+                                  to_addresses=DEBUG_NOTIFY_LIST,
+                                  subject='GRB_fermi_swift debug notification for trigger: %s' % trig_id,
+                                  msg_text=DEBUG_EMAIL_TEMPLATE % "Already observing this star",
+                                  log_text=fs.since_last_trigger(),
+                                  attachments=[('voevent.xml', voeventparse.dumps(v))])
             return
     else:
         fs.debug("Current schedule empty")
@@ -227,7 +241,7 @@ def handle_flarestar(v, pretend=False):
     ttype = v.attrib['ivorn'].split('/')[-1].split('#')[0]
 
     emaildict = {'triggerid': fs.trigger_id,
-                 'trigtime': Time.now().iso,
+                 'trigtime': clock.astropy_now().iso,
                  'ra': Angle(fs.ra[-1], unit=astropy.units.deg).to_string(unit=astropy.units.hour, sep=':'),
                  'dec': Angle(fs.dec[-1], unit=astropy.units.deg).to_string(unit=astropy.units.deg, sep=':'),
                  'name': name}
@@ -246,11 +260,13 @@ def handle_flarestar(v, pretend=False):
                                     creator='VOEvent_Auto_Trigger: FlareStar_swift_maxi=%s' % __version__,
                                     voevent=voeventparse.dumps(v))
     if result is None:
-        handlers.send_email(from_address='mwa@telemetry.mwa128t.org',
-                            to_addresses=DEBUG_NOTIFY_LIST,
-                            subject='GRB_fermi_swift debug notification for trigger: %s' % trig_id,
-                            msg_text=DEBUG_EMAIL_TEMPLATE % '\n'.join([str(x) for x in fs.loglist]),
-                            attachments=[('voevent.xml', voeventparse.dumps(v))])
+        handlers.debug_notify(trigger_id=trig_id,
+                              from_address='mwa@telemetry.mwa128t.org',
+                              to_addresses=DEBUG_NOTIFY_LIST,
+                              subject='GRB_fermi_swift debug notification for trigger: %s' % trig_id,
+                              msg_text=DEBUG_EMAIL_TEMPLATE % "The trigger request did not schedule an observation",
+                              log_text=fs.since_last_trigger(),
+                              attachments=[('voevent.xml', voeventparse.dumps(v))])
 
 
 if __name__ == "__main__":
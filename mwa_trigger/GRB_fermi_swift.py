@@ -16,12 +16,16 @@ import sys
 
 import astropy
 from astropy.coordinates import Angle, SkyCoord
-from astropy.time import Time
 import astropy.units
 
 import voeventparse
 
+from . import clock
+from . import decisions
+from . import eventregistry
+from . import fastlane
 from . import handlers
+from . import prefetch
 from . import triggerservice
 
 log = logging.getLogger('voevent.handlers.GRB_fermi_swift')   # Inherit the logging setup from handlers.py
@@ -34,6 +38,10 @@ SWIFT_SHORT_TRIGGERS_IN_VCSMODE = True  # Trigger swift triggers of short GRBs i
 SWIFT_LONG_TRIGGERS_IN_VCSMODE = True   # Trigger swift triggers of long GRBs in vcsmode
 SWIFT_SHORT_VCS_TIME = 15   # How many minutes to request if this is a VCS trigger
 
+# Pre-fetch the schedule as soon as these events arrive (see prefetch.py)
+PREFETCH_IVORNS = ["ivo://nasa.gsfc.gcn/SWIFT#BAT_GRB_Pos"]
+PREFETCH_OBSTIME = 1800
+
 PROJECT_ID = 'G0055'
 SECURE_KEY = handlers.get_secure_key(PROJECT_ID)
 PRETEND = False   # If True, override the 'pretend' flag passed, and never actually schedule observations
@@ -58,7 +66,7 @@ Error Rad:  %(err)7.3f deg
 
 DEBUG_EMAIL_TEMPLATE = """
 The GRB Fermi+Swift handler did NOT trigger an MWA observation for a
-Fermi/Swift GRB. Log messages are:
+Fermi/Swift GRB. The reason was:
 
 %s
 
@@ -66,14 +74,17 @@ Fermi/Swift GRB. Log messages are:
 
 EMAIL_SUBJECT_TEMPLATE = "GRB Fermi+Swift handler trigger for %s"
 
-# state storage
-xml_cache = {}
+# state storage, a view of this handler's events in eventregistry.EVENTS
+xml_cache = eventregistry.HandlerCache('GRB_fermi_swift', factory=lambda: GRB())
 
 
 class GRB(handlers.TriggerEvent):
     """
     Subclass the TriggerEvent class to add a parameter 'short', relevant only for GRB type events.
     """
+    __slots__ = ['short']
+    PERSISTED_ATTRIBUTES = handlers.TriggerEvent.PERSISTED_ATTRIBUTES + ['short']
+
     def __init__(self, event=None):
         self.short = False  # True if short
         handlers.TriggerEvent.__init__(self, event=event)
@@ -192,11 +203,13 @@ def handle_grb(v, pretend=False):
         log.debug("StarLock OK? {0}".format(not startrack_lost_lock))
         if startrack_lost_lock:
             log.debug("The SWIFT star tracker lost it's lock")
-            handlers.send_email(from_address='mwa@telemetry.mwa128t.org',
-                                to_addresses=DEBUG_NOTIFY_LIST,
-                                subject='GRB_fermi_swift debug notification for trigger: %s' % trig_id,
-                                msg_text=DEBUG_EMAIL_TEMPLATE % "SWIFT alert for GRB, but with StarTrack_Lost_Lock",
-                                attachments=[('voevent.xml', voeventparse.dumps(v))])
+            decisions.reason('star_tracker_lost_lock', trigger_id=trig_id)
+            handlers.debug_notify(trigger_id=trig_id,
+                                  from_address='mwa@telemetry.mwa128t.org',
+                                  to_addresses=DEBUG_NOTIFY_LIST,
+                                  subject='GRB_fermi_swift debug notification for trigger: %s' % trig_id,
+                                  msg_text=DEBUG_EMAIL_TEMPLATE % "SWIFT alert for GRB, but with StarTrack_Lost_Lock",
+                                  attachments=[('voevent.xml', voeventparse.dumps(v))])
             return
 
         # cache the event using the trigger id
@@ -209,6 +222,7 @@ def handle_grb(v, pretend=False):
             grb.add_event(v)
 
         trig_time = float(v.find(".//Param[@name='Integ_Time']").attrib['value'])
+        decisions.param(integ_time=trig_time)
         if trig_time < LONG_SHORT_LIMIT:
             grb.debug("Probably a short GRB: t={0} < 2".format(trig_time))
             grb.short = True
@@ -239,18 +253,22 @@ def handle_grb(v, pretend=False):
         # eg Fermi#GBM_Gnd_Pos
         if this_trig_type == 'Flt':
             trig_time = float(v.find(".//Param[@name='Trig_Timescale']").attrib['value'])
+            decisions.param(integ_time=trig_time)
             if trig_time < LONG_SHORT_LIMIT:
                 grb.short = True
                 grb.debug("Possibly a short GRB: t={0}".format(trig_time))
             else:
                 msg = "Probably not a short GRB: t={0}".format(trig_time)
                 grb.debug(msg)
+                decisions.reason('not_short_grb', trigger_id=trig_id)
                 grb.debug("Not Triggering")
-                handlers.send_email(from_address='mwa@telemetry.mwa128t.org',
-                                    to_addresses=DEBUG_NOTIFY_LIST,
-                                    subject='GRB_fermi_swift debug notification for trigger: %s' % trig_id,
-                                    msg_text=DEBUG_EMAIL_TEMPLATE % '\n'.join([str(x) for x in grb.loglist]),
-                                    attachments=[('voevent.xml', voeventparse.dumps(v))])
+                handlers.debug_notify(trigger_id=trig_id,
+                                      from_address='mwa@telemetry.mwa128t.org',
+                                      to_addresses=DEBUG_NOTIFY_LIST,
+                                      subject='GRB_fermi_swift debug notification for trigger: %s' % trig_id,
+                                      msg_text=DEBUG_EMAIL_TEMPLATE % msg,
+                                      log_text=grb.since_last_trigger(),
+                                      attachments=[('voevent.xml', voeventparse.dumps(v))])
                 return  # don't trigger
 
             most_likely = int(v.find(".//Param[@name='Most_Likely_Index']").attrib['value'])
@@ -259,6 +277,7 @@ def handle_grb(v, pretend=False):
             if most_likely == 4:
                 grb.debug("MOST_LIKELY = GRB")
                 prob = int(v.find(".//Param[@name='Most_Likely_Prob']").attrib['value'])
+                decisions.param(prob=prob)
 
                 # ignore things that don't reach our probability threshold
                 if prob > FERMI_POBABILITY_THRESHOLD:
@@ -267,22 +286,28 @@ def handle_grb(v, pretend=False):
                 else:
                     msg = "Prob(GRB): {0}% <{1}".format(prob, FERMI_POBABILITY_THRESHOLD)
                     grb.debug(msg)
+                    decisions.reason('prob_below_threshold', trigger_id=trig_id)
                     grb.debug("Not Triggering")
-                    handlers.send_email(from_address='mwa@telemetry.mwa128t.org',
-                                        to_addresses=DEBUG_NOTIFY_LIST,
-                                        subject='GRB_fermi_swift debug notification for trigger: %s' % trig_id,
-                                        msg_text=DEBUG_EMAIL_TEMPLATE % '\n'.join([str(x) for x in grb.loglist]),
-                                        attachments=[('voevent.xml', voeventparse.dumps(v))])
+                    handlers.debug_notify(trigger_id=trig_id,
+                                          from_address='mwa@telemetry.mwa128t.org',
+                                          to_addresses=DEBUG_NOTIFY_LIST,
+                                          subject='GRB_fermi_swift debug notification for trigger: %s' % trig_id,
+                                          msg_text=DEBUG_EMAIL_TEMPLATE % msg,
+                                          log_text=grb.since_last_trigger(),
+                                          attachments=[('voevent.xml', voeventparse.dumps(v))])
                     return
             else:
                 msg = "MOST_LIKELY != GRB"
                 grb.debug(msg)
+                decisions.reason('not_grb', trigger_id=trig_id)
                 grb.debug("Not Triggering")
-                handlers.send_email(from_address='mwa@telemetry.mwa128t.org',
-                                    to_addresses=DEBUG_NOTIFY_LIST,
-                                    subject='GRB_fermi_swift debug notification for trigger: %s' % trig_id,
-                                    msg_text=DEBUG_EMAIL_TEMPLATE % '\n'.join([str(x) for x in grb.loglist]),
-                                    attachments=[('voevent.xml', voeventparse.dumps(v))])
+                handlers.debug_notify(trigger_id=trig_id,
+                                      from_address='mwa@telemetry.mwa128t.org',
+                                      to_addresses=DEBUG_NOTIFY_LIST,
+                                      subject='GRB_fermi_swift debug notification for trigger: %s' % trig_id,
+                                      msg_text=DEBUG_EMAIL_TEMPLATE % msg,
+                                      log_text=grb.since_last_trigger(),
+                                      attachments=[('voevent.xml', voeventparse.dumps(v))])
                 return
         else:
             # for Gnd/Fin we trigger if we already triggered on the Flt position
@@ -291,21 +316,27 @@ def handle_grb(v, pretend=False):
     else:
         msg = "Not a Fermi or SWIFT GRB."
         log.debug(msg)
+        decisions.reason('unknown_event_type')
         log.debug("Not Triggering")
-        handlers.send_email(from_address='mwa@telemetry.mwa128t.org',
-                            to_addresses=DEBUG_NOTIFY_LIST,
-                            subject='GRB_fermi_swift debug notification',
-                            msg_text=DEBUG_EMAIL_TEMPLATE % msg,
-                            attachments=[('voevent.xml', voeventparse.dumps(v))])
+        handlers.debug_notify(trigger_id=None,
+                              from_address='mwa@telemetry.mwa128t.org',
+                              to_addresses=DEBUG_NOTIFY_LIST,
+                              subject='GRB_fermi_swift debug notification',
+                              msg_text=DEBUG_EMAIL_TEMPLATE % msg,
+                              attachments=[('voevent.xml', voeventparse.dumps(v))])
         return
 
     if not trigger:
-        grb.debug("Not Triggering")
-        handlers.send_email(from_address='mwa@telemetry.mwa128t.org',
-                            to_addresses=DEBUG_NOTIFY_LIST,
-                            subject='GRB_fermi_swift debug notification for trigger: %s' % trig_id,
-                            msg_text=DEBUG_EMAIL_TEMPLATE % '\n'.join([str(x) for x in grb.loglist]),
-                            attachments=[('voevent.xml', voeventparse.dumps(v))])
+        msg = "Not triggered on the Flt position for this trigger"
+        grb.debug(msg)
+        decisions.reason('not_triggered_on_flt', trigger_id=trig_id)
+        handlers.debug_notify(trigger_id=trig_id,
+                              from_address='mwa@telemetry.mwa128t.org',
+                              to_addresses=DEBUG_NOTIFY_LIST,
+                              subject='GRB_fermi_swift debug notification for trigger: %s' % trig_id,
+                              msg_text=DEBUG_EMAIL_TEMPLATE % msg,
+                              log_text=grb.since_last_trigger(),
+                              attachments=[('voevent.xml', voeventparse.dumps(v))])
         return
 
     # get current position
@@ -334,7 +365,7 @@ def handle_grb(v, pretend=False):
     #         handlers.send_email(from_address='mwa@telemetry.mwa128t.org',
     #                             to_addresses=DEBUG_NOTIFY_LIST,
     #                             subject='GRB_fermi_swift debug notification',
-    #                             msg_text=DEBUG_EMAIL_TEMPLATE % '\n'.join([str(x) for x in grb.loglist]),
+    #                             msg_text=DEBUG_EMAIL_TEMPLATE % grb.since_last_trigger(),
     #                             attachments=[('voevent.xml', voeventparse.dumps(v))])
     #         return
     #     else:
@@ -344,7 +375,7 @@ def handle_grb(v, pretend=False):
     # end tests
 
     # look at the schedule
-    obslist = triggerservice.obslist(obstime=1800)
+    obslist = prefetch.obslist(ivorn=v.attrib['ivorn'], obstime=1800)
     if obslist is not None and len(obslist) > 0:
         grb.debug("Currently observing:")
         grb.debug(str(obslist))
@@ -363,14 +394,20 @@ def handle_grb(v, pretend=False):
             pos_diff = SkyCoord(ra=last_pos[0], dec=last_pos[1], unit=astropy.units.degree, frame='icrs').separation(
                        SkyCoord(ra=ra, dec=dec, unit=astropy.units.degree, frame='icrs')).degree
             grb.info("New position is {0} deg from previous".format(pos_diff))
+            decisions.param(pos_diff=pos_diff)
             if pos_diff < REPOINTING_LIMIT:
                 grb.info("(less than constraint of {0} deg)".format(REPOINTING_LIMIT))
+                decisions.reason('position_unchanged', trigger_id=trig_id)
                 grb.info("Not triggering")
-                handlers.send_email(from_address='mwa@telemetry.mwa128t.org',
-                                    to_addresses=DEBUG_NOTIFY_LIST,
-                                    subject='GRB_fermi_swift debug notification',
-                                    msg_text=DEBUG_EMAIL_TEMPLATE % '\n'.join([str(x) for x in grb.loglist]),
-                                    attachments=[('voevent.xml', voeventparse.dumps(v))])
+                msg = "New position is {0:.2f} deg from the previous one, less than {1} deg".format(pos_diff,
+                                                                                                  REPOINTING_LIMIT)
+                handlers.debug_notify(trigger_id=trig_id,
+                                      from_address='mwa@telemetry.mwa128t.org',
+                                      to_addresses=DEBUG_NOTIFY_LIST,
+                                      subject='GRB_fermi_swift debug notification',
+                                      msg_text=DEBUG_EMAIL_TEMPLATE % msg,
+                                      log_text=grb.since_last_trigger(),
+                                      attachments=[('voevent.xml', voeventparse.dumps(v))])
                 return
             grb.info("(greater than constraint of {0}deg)".format(REPOINTING_LIMIT))
 
@@ -383,22 +420,28 @@ def handle_grb(v, pretend=False):
                 if this_trig_type == 'Flt' and (prev_type in ['Gnd','Fin']):
                     msg = "{0} positions have precedence over {1}".format(prev_type, this_trig_type)
                     grb.info(msg)
+                    decisions.reason('lower_precedence', trigger_id=trig_id)
                     grb.info("Not triggering")
-                    handlers.send_email(from_address='mwa@telemetry.mwa128t.org',
-                                        to_addresses=DEBUG_NOTIFY_LIST,
-                                        subject='GRB_fermi_swift debug notification for trigger: %s' % trig_id,
-                                        msg_text=DEBUG_EMAIL_TEMPLATE % '\n'.join([str(x) for x in grb.loglist]),
-                                        attachments=[('voevent.xml', voeventparse.dumps(v))])
+                    handlers.debug_notify(trigger_id=trig_id,
+                                          from_address='mwa@telemetry.mwa128t.org',
+                                          to_addresses=DEBUG_NOTIFY_LIST,
+                                          subject='GRB_fermi_swift debug notification for trigger: %s' % trig_id,
+                                          msg_text=DEBUG_EMAIL_TEMPLATE % msg,
+                                          log_text=grb.since_last_trigger(),
+                                          attachments=[('voevent.xml', voeventparse.dumps(v))])
                     return
                 elif this_trig_type == 'Gnd' and prev_type == 'Fin':
                     msg = "{0} positions have precedence over {1}".format(prev_type, this_trig_type)
                     grb.info(msg)
+                    decisions.reason('lower_precedence', trigger_id=trig_id)
                     grb.info("Not triggering")
-                    handlers.send_email(from_address='mwa@telemetry.mwa128t.org',
-                                        to_addresses=DEBUG_NOTIFY_LIST,
-                                        subject='GRB_fermi_swift debug notification for trigger: %s' % trig_id,
-                                        msg_text=DEBUG_EMAIL_TEMPLATE % '\n'.join([str(x) for x in grb.loglist]),
-                                        attachments=[('voevent.xml', voeventparse.dumps(v))])
+                    handlers.debug_notify(trigger_id=trig_id,
+                                          from_address='mwa@telemetry.mwa128t.org',
+                                          to_addresses=DEBUG_NOTIFY_LIST,
+                                          subject='GRB_fermi_swift debug notification for trigger: %s' % trig_id,
+                                          msg_text=DEBUG_EMAIL_TEMPLATE % msg,
+                                          log_text=grb.since_last_trigger(),
+                                          attachments=[('voevent.xml', voeventparse.dumps(v))])
                     return
                 else:
                     grb.info("Triggering {0} to replace {1}".format(this_trig_type, prev_type))
@@ -408,7 +451,7 @@ def handle_grb(v, pretend=False):
             # in VCS mode, we won't be able to interrupt it, and if it wasn't, we still want the normal
             # length of a VCS trigger.
             if (grb.first_trig_time is not None) and not grb.vcsmode:
-                req_time_min = 30 - (Time.now() - grb.first_trig_time).sec // 60
+                req_time_min = 30 - (clock.astropy_now() - grb.first_trig_time).sec // 60
                 grb.debug('Set requested time to %d' % req_time_min)
 
         # if we are observing a SWIFT trigger but not the trigger we just received
@@ -423,20 +466,28 @@ def handle_grb(v, pretend=False):
                 if grb.short and not prev_short:
                     grb.info("Interrupting with a short SWIFT GRB")
                 else:
-                    grb.info("Not interrupting previous observation")
-                    handlers.send_email(from_address='mwa@telemetry.mwa128t.org',
-                                        to_addresses=DEBUG_NOTIFY_LIST,
-                                        subject='GRB_fermi_swift debug notification for trigger: %s' % trig_id,
-                                        msg_text=DEBUG_EMAIL_TEMPLATE % '\n'.join([str(x) for x in grb.loglist]),
-                                        attachments=[('voevent.xml', voeventparse.dumps(v))])
+                    msg = "Not interrupting previous observation"
+                    grb.info(msg)
+                    decisions.reason('busy', trigger_id=trig_id)
+                    handlers.debug_notify(trigger_id=trig_id,
+                                          from_address='mwa@telemetry.mwa128t.org',
+                                          to_addresses=DEBUG_NOTIFY_LIST,
+                                          subject='GRB_fermi_swift debug notification for trigger: %s' % trig_id,
+                                          msg_text=DEBUG_EMAIL_TEMPLATE % msg,
+                                          log_text=grb.since_last_trigger(),
+                                          attachments=[('voevent.xml', voeventparse.dumps(v))])
                     return
             else:
-                grb.info("Not interrupting previous obs")
-                handlers.send_email(from_address='mwa@telemetry.mwa128t.org',
-                                    to_addresses=DEBUG_NOTIFY_LIST,
-                                    subject='GRB_fermi_swift debug notification for trigger: %s' % trig_id,
-                                    msg_text=DEBUG_EMAIL_TEMPLATE % '\n'.join([str(x) for x in grb.loglist]),
-                                    attachments=[('voevent.xml', voeventparse.dumps(v))])
+                msg = "Not interrupting previous obs"
+                grb.info(msg)
+                decisions.reason('busy', trigger_id=trig_id)
+                handlers.debug_notify(trigger_id=trig_id,
+                                      from_address='mwa@telemetry.mwa128t.org',
+                                      to_addresses=DEBUG_NOTIFY_LIST,
+                                      subject='GRB_fermi_swift debug notification for trigger: %s' % trig_id,
+                                      msg_text=DEBUG_EMAIL_TEMPLATE % msg,
+                                      log_text=grb.since_last_trigger(),
+                                      attachments=[('voevent.xml', voeventparse.dumps(v))])
                 return
 
         # if we are observing a FERMI trigger but not the trigger we just received
@@ -445,12 +496,16 @@ def handle_grb(v, pretend=False):
             if "SWIFT" in trig_id:
                 grb.info("Replacing a Fermi trigger with a SWIFT trigger")
             else:
-                grb.info("Currently observing a different Fermi trigger, not interrupting")
-                handlers.send_email(from_address='mwa@telemetry.mwa128t.org',
-                                    to_addresses=DEBUG_NOTIFY_LIST,
-                                    subject='GRB_fermi_swift debug notification for trigger: %s' % trig_id,
-                                    msg_text=DEBUG_EMAIL_TEMPLATE % '\n'.join([str(x) for x in grb.loglist]),
-                                    attachments=[('voevent.xml', voeventparse.dumps(v))])
+                msg = "Currently observing a different Fermi trigger, not interrupting"
+                grb.info(msg)
+                decisions.reason('busy', trigger_id=trig_id)
+                handlers.debug_notify(trigger_id=trig_id,
+                                      from_address='mwa@telemetry.mwa128t.org',
+                                      to_addresses=DEBUG_NOTIFY_LIST,
+                                      subject='GRB_fermi_swift debug notification for trigger: %s' % trig_id,
+                                      msg_text=DEBUG_EMAIL_TEMPLATE % msg,
+                                      log_text=grb.since_last_trigger(),
+                                      attachments=[('voevent.xml', voeventparse.dumps(v))])
                 return
 
         else:
@@ -459,28 +514,42 @@ def handle_grb(v, pretend=False):
         grb.debug("Current schedule empty")
 
     emaildict = {'triggerid': grb.trigger_id,
-                 'trigtime': Time.now().iso,
+                 'trigtime': clock.astropy_now().iso,
                  'ra': Angle(grb.ra[-1], unit=astropy.units.deg).to_string(unit=astropy.units.hour, sep=':'),
                  'dec': Angle(grb.dec[-1], unit=astropy.units.deg).to_string(unit=astropy.units.deg, sep=':'),
                  'err': grb.err[-1]}
     email_text = EMAIL_TEMPLATE % emaildict
     email_subject = EMAIL_SUBJECT_TEMPLATE % grb.trigger_id
 
+    # If the fast lane has already dumped the voltage buffers for this GRB, extend that capture instead of
+    # asking for a new VCS observation, which would be refused while the capture is running.
+    if fastlane.claim(trig_id) is not None:
+        if grb.vcsmode:
+            grb.info("Fast lane already triggered a buffer dump, extending it")
+            grb.buffered = True
+        else:
+            grb.warning("Fast lane triggered a buffer dump, but this is not a VCS mode trigger")
+
     # Do the trigger
-    result = grb.trigger_observation(ttype=this_trig_type,
-                                     obsname=trig_id,
-                                     time_min=req_time_min,
-                                     pretend=(pretend or PRETEND),
-                                     project_id=PROJECT_ID,
-                                     secure_key=SECURE_KEY,
-                                     email_tolist=NOTIFY_LIST,
-                                     email_text=email_text,
-                                     email_subject=email_subject,
-                                     creator='VOEvent_Auto_Trigger: GRB_Fermi_swift=%s' % __version__,
-                                     voevent=voeventparse.dumps(v))
+    try:
+        result = grb.trigger_observation(ttype=this_trig_type,
+                                         obsname=trig_id,
+                                         time_min=req_time_min,
+                                         pretend=(pretend or PRETEND),
+                                         project_id=PROJECT_ID,
+                                         secure_key=SECURE_KEY,
+                                         email_tolist=NOTIFY_LIST,
+                                         email_text=email_text,
+                                         email_subject=email_subject,
+                                         creator='VOEvent_Auto_Trigger: GRB_Fermi_swift=%s' % __version__,
+                                         voevent=voeventparse.dumps(v))
+    finally:
+        grb.buffered = False   # Only this trigger extends the fast lane capture, later ones are new observations
     if result is None:
-        handlers.send_email(from_address='mwa@telemetry.mwa128t.org',
-                            to_addresses=DEBUG_NOTIFY_LIST,
-                            subject='GRB_fermi_swift debug notification for trigger: %s' % trig_id,
-                            msg_text=DEBUG_EMAIL_TEMPLATE % '\n'.join([str(x) for x in grb.loglist]),
-                            attachments=[('voevent.xml', voeventparse.dumps(v))])
+        handlers.debug_notify(trigger_id=trig_id,
+                              from_address='mwa@telemetry.mwa128t.org',
+                              to_addresses=DEBUG_NOTIFY_LIST,
+                              subject='GRB_fermi_swift debug notification for trigger: %s' % trig_id,
+                              msg_text=DEBUG_EMAIL_TEMPLATE % "The trigger request did not schedule an observation",
+                              log_text=grb.since_last_trigger(),
+                              attachments=[('voevent.xml', voeventparse.dumps(v))])
@@ -7,7 +7,7 @@ import logging
 import os
 import random
 import sys
-import time
+import tempfile
 from timeit import default_timer as timer
 
 import astropy
@@ -25,7 +25,11 @@ from mwa_pb import primary_beam
 
 import voeventparse
 
+from . import clock
+from . import decisions
+from . import eventregistry
 from . import handlers
+from . import prefetch
 from . import triggerservice
 
 
@@ -51,7 +55,11 @@ MAX_RESPONSE_TIME = 300
 OBS_LENGTH = 900     # length of the observation in seconds
 MIN_PROB = 0.1
 PROJECT_ID = 'G0094'
+PREFETCH_IVORNS = ["ivo://gwnet/LVC#"]   # Pre-fetch the schedule as soon as these events arrive (see prefetch.py)
+PREFETCH_OBSTIME = OBS_LENGTH
 TEST_PROB = 0.01      # Roughly one test event every four days will generate a 'pretend' trigger
+WARMUP_NSIDE = 128    # NSIDE of the synthetic skymap used by warmup(), more than the 64 it's downsampled to
+COORD_BYTES = 16      # Memory used by each position in a SkyCoord (two float64 components)
 
 
 SECURE_KEY = handlers.get_secure_key(PROJECT_ID)
@@ -75,7 +83,7 @@ Dec:        %(dec)s deg
 
 DEBUG_EMAIL_TEMPLATE = """
 The LIGO-GW handler did NOT trigger an MWA observation for a
-LIGO-GW event. Log messages are:
+LIGO-GW event. The reason was:
 
 %s
 
@@ -107,14 +115,15 @@ We thank the MWA Operations team for supporting these observations
 # observatory location
 MWA = EarthLocation(lat='-26:42:11.95', lon='116:40:14.93', height=377.8 * u.m)
 
-# state storage
-xml_cache = {}
+# state storage, a view of this handler's events in eventregistry.EVENTS
+xml_cache = eventregistry.HandlerCache('GW_LIGO', factory=lambda: GW())
 
 
 ################################################################################
 class MWA_grid_points(object):
     libpath = os.path.join(*os.path.split(__file__)[:-1])
     grid_file = os.path.join(libpath, '..', 'data', 'grid_points.fits')
+    grid_data = None   # The grid points table, read from grid_file once and shared by every instance
 
     def __init__(self, frame, logger=None):
         try:
@@ -123,7 +132,9 @@ class MWA_grid_points(object):
             else:
                 self.logger = logger
             self.frame = frame
-            self.data = Table.read(MWA_grid_points.grid_file)
+            if MWA_grid_points.grid_data is None:
+                MWA_grid_points.grid_data = Table.read(MWA_grid_points.grid_file)
+            self.data = MWA_grid_points.grid_data
             self.logger.debug('Grid points loaded')
 
             self.gridAltAz = SkyCoord(self.data['azimuth'] * u.deg, self.data['elevation'] * u.deg, frame=self.frame)
@@ -203,6 +214,20 @@ class GW(handlers.TriggerEvent):
         self.AltAz_down = None
         handlers.TriggerEvent.__init__(self, event=event, logger=logger)
 
+    ##################################################
+    def array_bytes(self):
+        """
+        Memory used by the skymaps and the coordinate arrays computed from them, for the event registry's size
+        estimate. The full resolution skymap alone can be hundreds of MB.
+        """
+        total = 0
+        for data in [self.gwmap, self.gwmap_down]:
+            total += getattr(data, 'nbytes', 0)   # gwmap is '' until a skymap is loaded
+        for coords in [self.RADec_down, self.AltAz_down, getattr(self.MWA_grid, 'gridAltAz', None)]:
+            if coords is not None:
+                total += COORD_BYTES * coords.size
+        return total
+
     ##################################################
     def load_skymap(self, gwfile, nside=64, calc_time=None):
         self.gwfile = gwfile
@@ -223,7 +248,7 @@ class GW(handlers.TriggerEvent):
             self.obstime = calc_time
         # otherwise computer the pointings for the current time
         else:
-            self.obstime = astropy.time.Time.now()
+            self.obstime = clock.astropy_now()
 
         self.frame = astropy.coordinates.AltAz(obstime=self.obstime, location=MWA)
 
@@ -511,6 +536,26 @@ def is_gw(v):
     return ligo
 
 
+def warmup():
+    """
+    Called by warmup.py when the handler daemon starts, to find the best MWA pointing for a synthetic, uniform skymap
+    written to a temporary file. This reads the MWA grid points, and makes the first healpy, mwa_pb and AltAz frame
+    calls, so the first real GW event doesn't have to.
+
+    :return: None
+    """
+    fd, gwfile = tempfile.mkstemp(prefix='GW_warmup_', suffix='.fits')
+    os.close(fd)
+    try:
+        npix = healpy.nside2npix(WARMUP_NSIDE)
+        healpy.write_map(gwfile, np.ones(npix) / npix, nest=True, overwrite=True)
+        gw = GW()
+        gw.load_skymap(gwfile)
+        gw.get_mwapointing_grid(returndelays=True, returnpower=True, minprob=MIN_PROB)
+    finally:
+        os.remove(gwfile)
+
+
 def handle_gw(v, pretend=False, calc_time=None):
     """
     Handles the parsing of the VOEvent and generates observations.
@@ -530,6 +575,7 @@ def handle_gw(v, pretend=False, calc_time=None):
             pretend = True
         else:
             log.info('Test event, not triggering.')
+            decisions.reason('test_event')
             return
 
     params = {elem.attrib['name']:elem.attrib['value'] for elem in v.iterfind('.//Param')}
@@ -552,39 +598,47 @@ def handle_gw(v, pretend=False, calc_time=None):
 
     if params['Packet_Type'] == "164":
         gw.info("Alert is an event retraction. Not triggering.")
-        handlers.send_email(from_address='mwa@telemetry.mwa128t.org',
-                            to_addresses=DEBUG_NOTIFY_LIST,
-                            subject=debug_email_subject,
-                            msg_text=DEBUG_EMAIL_TEMPLATE % "Alert is an event retraction. Not triggering.",
-                            attachments=[('voevent.xml', voeventparse.dumps(v))])
+        decisions.reason('retraction', trigger_id=trig_id)
+        handlers.debug_notify(trigger_id=trig_id,
+                              from_address='mwa@telemetry.mwa128t.org',
+                              to_addresses=DEBUG_NOTIFY_LIST,
+                              subject=debug_email_subject,
+                              msg_text=DEBUG_EMAIL_TEMPLATE % "Alert is an event retraction. Not triggering.",
+                              attachments=[('voevent.xml', voeventparse.dumps(v))])
         return
 
     if 'HasNS' not in params:
         msg = "HasNS not in params. Not triggering."
         gw.debug(msg)
-        handlers.send_email(from_address='mwa@telemetry.mwa128t.org',
-                            to_addresses=DEBUG_NOTIFY_LIST,
-                            subject=debug_email_subject,
-                            msg_text=DEBUG_EMAIL_TEMPLATE % msg,
-                            attachments=[('voevent.xml', voeventparse.dumps(v))])
+        decisions.reason('no_hasns', trigger_id=trig_id)
+        handlers.debug_notify(trigger_id=trig_id,
+                              from_address='mwa@telemetry.mwa128t.org',
+                              to_addresses=DEBUG_NOTIFY_LIST,
+                              subject=debug_email_subject,
+                              msg_text=DEBUG_EMAIL_TEMPLATE % msg,
+                              attachments=[('voevent.xml', voeventparse.dumps(v))])
         return
     elif float(params['HasNS']) < HAS_NS_THRESH:
         msg = "P_HasNS (%.2f) below threshold (%.2f). Not triggering." % (float(params['HasNS']), HAS_NS_THRESH)
         gw.debug(msg)
-        handlers.send_email(from_address='mwa@telemetry.mwa128t.org',
-                            to_addresses=DEBUG_NOTIFY_LIST,
-                            subject=debug_email_subject,
-                            msg_text=DEBUG_EMAIL_TEMPLATE % msg,
-                            attachments=[('voevent.xml', voeventparse.dumps(v))])
+        decisions.reason('hasns_below_threshold', trigger_id=trig_id, hasns=float(params['HasNS']))
+        handlers.debug_notify(trigger_id=trig_id,
+                              from_address='mwa@telemetry.mwa128t.org',
+                              to_addresses=DEBUG_NOTIFY_LIST,
+                              subject=debug_email_subject,
+                              msg_text=DEBUG_EMAIL_TEMPLATE % msg,
+                              attachments=[('voevent.xml', voeventparse.dumps(v))])
         return
 
     if 'skymap_fits' not in params:
         gw.debug("No skymap in VOEvent. Not triggering.")
-        handlers.send_email(from_address='mwa@telemetry.mwa128t.org',
-                            to_addresses=DEBUG_NOTIFY_LIST,
-                            subject=debug_email_subject,
-                            msg_text=DEBUG_EMAIL_TEMPLATE % "No skymap in VOEvent. Not triggering.",
-                            attachments=[('voevent.xml', voeventparse.dumps(v))])
+        decisions.reason('no_skymap', trigger_id=trig_id, hasns=float(params['HasNS']))
+        handlers.debug_notify(trigger_id=trig_id,
+                              from_address='mwa@telemetry.mwa128t.org',
+                              to_addresses=DEBUG_NOTIFY_LIST,
+                              subject=debug_email_subject,
+                              msg_text=DEBUG_EMAIL_TEMPLATE % "No skymap in VOEvent. Not triggering.",
+                              attachments=[('voevent.xml', voeventparse.dumps(v))])
         return
 
     gw.debug('Skymap given as %s' % params['skymap_fits'])
@@ -593,28 +647,32 @@ def handle_gw(v, pretend=False, calc_time=None):
         gw.load_skymap(params['skymap_fits'], calc_time=calc_time)
     except:
         gw.debug("Failed to load skymap. Retrying in 1 minute")
-        time.sleep(60)    
+        clock.sleep(60)    
         
         gw.load_skymap(params['skymap_fits'], calc_time=calc_time)
 
     RADecgrid, delays, power = gw.get_mwapointing_grid(returndelays=True, returnpower=True, minprob=MIN_PROB)
     if RADecgrid is None:
         gw.info("No pointing from skymap, not triggering")
-        handlers.send_email(from_address='mwa@telemetry.mwa128t.org',
-                            to_addresses=DEBUG_NOTIFY_LIST,
-                            subject=debug_email_subject,
-                            msg_text=DEBUG_EMAIL_TEMPLATE % '\n'.join([str(x) for x in gw.loglist]),
-                            attachments=[('voevent.xml', voeventparse.dumps(v))])
+        decisions.reason('no_pointing', trigger_id=trig_id, hasns=float(params['HasNS']))
+        handlers.debug_notify(trigger_id=trig_id,
+                              from_address='mwa@telemetry.mwa128t.org',
+                              to_addresses=DEBUG_NOTIFY_LIST,
+                              subject=debug_email_subject,
+                              msg_text=DEBUG_EMAIL_TEMPLATE % "No pointing from skymap",
+                              log_text=gw.since_last_trigger(),
+                              attachments=[('voevent.xml', voeventparse.dumps(v))])
         return
 
     ra, dec = RADecgrid.ra, RADecgrid.dec
     gw.info("Pointing at %s, %s" % (ra, dec))
     gw.info("Pointing contains %.3f of the localisation" % (power))
+    decisions.param(hasns=float(params['HasNS']), prob=100.0 * power)
     gw.add_pos((ra.deg, dec.deg, 0.0))
 
     req_time_s = OBS_LENGTH
 
-    obslist = triggerservice.obslist(obstime=req_time_s)
+    obslist = prefetch.obslist(ivorn=v.attrib['ivorn'], obstime=req_time_s)
 
     currently_observing = False
     if obslist is not None and len(obslist) > 0:
@@ -635,11 +693,13 @@ def handle_gw(v, pretend=False, calc_time=None):
           
             if (abs(ra.deg - last_ra) < 5.0) and (abs(dec.deg - last_dec) < 5.0):
                 gw.info("New pointing very close to old pointing. Not triggering.")
-                handlers.send_email(from_address='mwa@telemetry.mwa128t.org',
-                                    to_addresses=DEBUG_NOTIFY_LIST,
-                                    subject=debug_email_subject,
-                                    msg_text=DEBUG_EMAIL_TEMPLATE % "New pointing same as old pointing. Not triggering.",
-                                    attachments=[('voevent.xml', voeventparse.dumps(v))])
+                decisions.reason('position_unchanged', trigger_id=trig_id)
+                handlers.debug_notify(trigger_id=trig_id,
+                                      from_address='mwa@telemetry.mwa128t.org',
+                                      to_addresses=DEBUG_NOTIFY_LIST,
+                                      subject=debug_email_subject,
+                                      msg_text=DEBUG_EMAIL_TEMPLATE % "New pointing same as old pointing. Not triggering.",
+                                      attachments=[('voevent.xml', voeventparse.dumps(v))])
                 return
             
             else:
@@ -647,7 +707,7 @@ def handle_gw(v, pretend=False, calc_time=None):
 
     time_string = v.WhereWhen.ObsDataLocation.ObservationLocation.AstroCoords.Time.TimeInstant.ISOTime.text
     merger_time = Time(time_string)
-    delta_T = Time.now() - merger_time
+    delta_T = clock.astropy_now() - merger_time
     delta_T_sec = delta_T.sec
 
     if not currently_observing:
@@ -656,11 +716,13 @@ def handle_gw(v, pretend=False, calc_time=None):
         if delta_T_sec > MAX_RESPONSE_TIME:
             log_message = "Time since merger (%d s) greater than max response time (%d s). Not triggering" % (delta_T_sec, MAX_RESPONSE_TIME)
             gw.info(log_message)
-            handlers.send_email(from_address='mwa@telemetry.mwa128t.org',
-                                to_addresses=DEBUG_NOTIFY_LIST,
-                                subject=debug_email_subject,
-                                msg_text=DEBUG_EMAIL_TEMPLATE % log_message,
-                                attachments=[('voevent.xml', voeventparse.dumps(v))])
+            decisions.reason('too_late', trigger_id=trig_id)
+            handlers.debug_notify(trigger_id=trig_id,
+                                  from_address='mwa@telemetry.mwa128t.org',
+                                  to_addresses=DEBUG_NOTIFY_LIST,
+                                  subject=debug_email_subject,
+                                  msg_text=DEBUG_EMAIL_TEMPLATE % log_message,
+                                  attachments=[('voevent.xml', voeventparse.dumps(v))])
                                 
             return
         
@@ -668,11 +730,11 @@ def handle_gw(v, pretend=False, calc_time=None):
     if gw.first_trig_time is not None:
         #  If it has been triggered, update the required time for the updated observation
         gw.info("This event has already been triggered.")
-        req_time_s -= (Time.now()-gw.first_trig_time).sec
+        req_time_s -= (clock.astropy_now()-gw.first_trig_time).sec
         gw.info("Required observing time: %.0f s" % (req_time_s))
 
     emaildict = {'triggerid':gw.trigger_id,
-                 'trigtime':Time.now().iso,
+                 'trigtime':clock.astropy_now().iso,
                  'ra':ra.to_string(unit=astropy.units.hour, sep=':'),
                  'dec':dec.to_string(unit=astropy.units.deg, sep=':')}
 
@@ -680,7 +742,7 @@ def handle_gw(v, pretend=False, calc_time=None):
     gw.info(email_text)
 
     gw.info("Template GCN text:")
-    gcn_text = GCN_TEMPLATE % (trig_id, Time.now().iso, delta_T_sec, ra.deg, dec.deg, power)
+    gcn_text = GCN_TEMPLATE % (trig_id, clock.astropy_now().iso, delta_T_sec, ra.deg, dec.deg, power)
     gw.info(gcn_text)
 
     email_subject = EMAIL_SUBJECT_TEMPLATE % gw.trigger_id
@@ -698,11 +760,13 @@ def handle_gw(v, pretend=False, calc_time=None):
                                     creator='VOEvent_Auto_Trigger: GW_LIGO=%s' % __version__,
                                     voevent=voeventparse.dumps(v))
     if result is None:
-        handlers.send_email(from_address='mwa@telemetry.mwa128t.org',
-                            to_addresses=DEBUG_NOTIFY_LIST,
-                            subject=debug_email_subject,
-                            msg_text=DEBUG_EMAIL_TEMPLATE % '\n'.join([str(x) for x in gw.loglist]),
-                            attachments=[('voevent.xml', voeventparse.dumps(v))])
+        handlers.debug_notify(trigger_id=trig_id,
+                              from_address='mwa@telemetry.mwa128t.org',
+                              to_addresses=DEBUG_NOTIFY_LIST,
+                              subject=debug_email_subject,
+                              msg_text=DEBUG_EMAIL_TEMPLATE % "The trigger request did not schedule an observation",
+                              log_text=gw.since_last_trigger(),
+                              attachments=[('voevent.xml', voeventparse.dumps(v))])
 
 
 def test_event(filepath='../test_events/MS190410a-1-Preliminary.xml', test_time=Time('2018-4-03 12:00:00')):
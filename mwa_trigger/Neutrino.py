@@ -11,12 +11,15 @@ import lxml.etree
 
 import astropy
 from astropy.coordinates import EarthLocation, SkyCoord
-from astropy.time import Time
 import astropy.units as u
 
 from timeit import default_timer as timer
 
+from . import clock
+from . import decisions
+from . import eventregistry
 from . import handlers
+from . import prefetch
 from . import triggerservice
 
 log = logging.getLogger('voevent.handlers.neutrino')   # Inherit the logging setup from handlers.py
@@ -26,6 +29,10 @@ MINIMUM_RANKING = 2     # selection criterion for Antares
 REPOINTING_LIMIT = 10   # maximum allowed difference in neutrino direction for different alerts with common trigger ID, in degrees
 PRETEND = False         # If True, force all to be in 'pretend' mode
 
+# Pre-fetch the schedule as soon as these events arrive (see prefetch.py)
+PREFETCH_IVORNS = ["ivo://nasa.gsfc.gcn/AMON#ICECUBE_GOLD", "ivo://nasa.gsfc.gcn/Antares"]
+PREFETCH_OBSTIME = 1800
+
 PROJECT_ID = 'G0072'
 SECURE_KEY = handlers.get_secure_key(PROJECT_ID)
 
@@ -58,14 +65,17 @@ EMAIL_SUBJECT_TEMPLATE = "Neutrino handler trigger for %s"
 # observatory location
 MWA = EarthLocation(lat='-26:42:11.95', lon='116:40:14.93', height=377.8*u.m)
 
-# state storage
-xml_cache = {}
+# state storage, a view of this handler's events in eventregistry.EVENTS
+xml_cache = eventregistry.HandlerCache('Neutrino', factory=lambda: Neutrino())
 
 
 class Neutrino(handlers.TriggerEvent):
     """
     Subclass the TriggerEvent class for neutrino events.
     """
+    __slots__ = ['voe_source']
+    PERSISTED_ATTRIBUTES = handlers.TriggerEvent.PERSISTED_ATTRIBUTES + ['voe_source']
+
     def __init__(self, event=None):
         self.voe_source = None  # the source of the VOEvent message
         handlers.TriggerEvent.__init__(self, event=event)
@@ -156,11 +166,13 @@ def handle_neutrino(v, pretend=False):
         ranking = int(params.get("ranking")["value"])
         if ranking < MINIMUM_RANKING:
             log.info("Event ranking %s below trigger threshold %s. Not triggering." % (ranking, MINIMUM_RANKING))
-            handlers.send_email(from_address='mwa@telemetry.mwa128t.org',
-                                to_addresses=DEBUG_NOTIFY_LIST,
-                                subject='DEBUG Neutrino alert for: %s - below minimum ranking to trigger' % trig_id,
-                                msg_text=DEBUG_EMAIL_TEMPLATE % ("Event ranking %s below trigger threshold %s. Not triggering." % (ranking, MINIMUM_RANKING)),
-                                attachments=[('voevent.xml', voeventparse.dumps(v))])
+            decisions.reason('rank_below_threshold', trigger_id=trig_id)
+            handlers.debug_notify(trigger_id=trig_id,
+                                  from_address='mwa@telemetry.mwa128t.org',
+                                  to_addresses=DEBUG_NOTIFY_LIST,
+                                  subject='DEBUG Neutrino alert for: %s - below minimum ranking to trigger' % trig_id,
+                                  msg_text=DEBUG_EMAIL_TEMPLATE % ("Event ranking %s below trigger threshold %s. Not triggering." % (ranking, MINIMUM_RANKING)),
+                                  attachments=[('voevent.xml', voeventparse.dumps(v))])
             return
 
         if trig_id not in xml_cache:
@@ -194,12 +206,14 @@ def handle_neutrino(v, pretend=False):
 
     else:
         log.debug("Not an ICECUBE or ANTARES neutrino.")
+        decisions.reason('unknown_event_type')
         log.debug("Not Triggering")
-        handlers.send_email(from_address='mwa@telemetry.mwa128t.org',
-                            to_addresses=DEBUG_NOTIFY_LIST,
-                            subject='DEBUG Neutrino alert - Not an ICECUBE or ANTARES event, not triggering',
-                            msg_text=DEBUG_EMAIL_TEMPLATE % ("Unknown event type, not triggering"),
-                            attachments=[('voevent.xml', voeventparse.dumps(v))])
+        handlers.debug_notify(trigger_id=None,
+                              from_address='mwa@telemetry.mwa128t.org',
+                              to_addresses=DEBUG_NOTIFY_LIST,
+                              subject='DEBUG Neutrino alert - Not an ICECUBE or ANTARES event, not triggering',
+                              msg_text=DEBUG_EMAIL_TEMPLATE % ("Unknown event type, not triggering"),
+                              attachments=[('voevent.xml', voeventparse.dumps(v))])
         return
 
     position = voeventparse.convenience.get_event_position(v)
@@ -211,7 +225,7 @@ def handle_neutrino(v, pretend=False):
     req_time_min = 30
 
     # Check for scheduled observations
-    obslist = triggerservice.obslist(obstime=req_time_min * 60)
+    obslist = prefetch.obslist(ivorn=v.attrib['ivorn'], obstime=req_time_min * 60)
 
     if obslist is not None and len(obslist) > 0:
         neutrino.debug("Currently observing:")
@@ -228,10 +242,12 @@ def handle_neutrino(v, pretend=False):
             pos_diff = SkyCoord(ra=last_pos[0], dec=last_pos[1], unit=astropy.units.degree, frame='icrs').separation(
                        SkyCoord(ra=position.ra, dec=position.dec, unit=astropy.units.degree, frame='icrs')).degree
             neutrino.info("New position is {0} deg from previous".format(pos_diff))
+            decisions.param(pos_diff=pos_diff)
             # Continue the current observation when the position difference is less than REPOINTING_DIR
             if pos_diff < REPOINTING_LIMIT:
                 neutrino.info("(less than constraint of {0} deg)".format(REPOINTING_LIMIT))
                 neutrino.info("Not triggering")
+                decisions.reason('position_unchanged', trigger_id=trig_id)
                 return
 
             neutrino.info("(greater than constraint of {0}deg)".format(REPOINTING_LIMIT))
@@ -242,7 +258,7 @@ def handle_neutrino(v, pretend=False):
         neutrino.debug("Current schedule empty")
 
     emaildict = {'triggerid': neutrino.trigger_id,
-                 'trigtime': Time.now().iso,
+                 'trigtime': clock.astropy_now().iso,
                  'ra': position.ra,
                  'dec': position.dec}
     
@@ -261,11 +277,13 @@ def handle_neutrino(v, pretend=False):
                                           creator='VOEvent_Auto_Trigger: Neutrino=%s' % __version__,
                                           voevent=voeventparse.dumps(v))
     if result is None:    # Trigger failed:
-        handlers.send_email(from_address='mwa@telemetry.mwa128t.org',
-                            to_addresses=DEBUG_NOTIFY_LIST,
-                            subject='DEBUG Neutrino alert - Trigger failed',
-                            msg_text=DEBUG_EMAIL_TEMPLATE % '\n'.join([str(x) for x in neutrino.loglist]),
-                            attachments=[('voevent.xml', voeventparse.dumps(v))])
+        handlers.debug_notify(trigger_id=trig_id,
+                              from_address='mwa@telemetry.mwa128t.org',
+                              to_addresses=DEBUG_NOTIFY_LIST,
+                              subject='DEBUG Neutrino alert - Trigger failed',
+                              msg_text=DEBUG_EMAIL_TEMPLATE % "The trigger request did not schedule an observation",
+                              log_text=neutrino.since_last_trigger(),
+                              attachments=[('voevent.xml', voeventparse.dumps(v))])
 
 
 def test_event(filepath='../test_events/Antares_observation.xml'):
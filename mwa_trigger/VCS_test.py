@@ -16,10 +16,12 @@ import sys
 
 import astropy
 from astropy.coordinates import Angle
-from astropy.time import Time
 
 import voeventparse
 
+from . import clock
+from . import decisions
+from . import eventregistry
 from . import handlers
 from . import triggerservice
 
@@ -48,14 +50,17 @@ Error Rad:  %(err)7.3f deg
 
 EMAIL_SUBJECT_TEMPLATE = "VCS_Test Swift handler trigger for %s"
 
-# state storage
-xml_cache = {}
+# state storage, a view of this handler's events in eventregistry.EVENTS
+xml_cache = eventregistry.HandlerCache('VCS_test', factory=lambda: GRB())
 
 
 class GRB(handlers.TriggerEvent):
     """
     Subclass the TriggerEvent class to add a parameter 'short', relevant only for GRB type events.
     """
+    __slots__ = ['short']
+    PERSISTED_ATTRIBUTES = handlers.TriggerEvent.PERSISTED_ATTRIBUTES + ['short']
+
     def __init__(self, event=None):
         handlers.TriggerEvent.__init__(self, event=event)
         self.short = False  # True if short
@@ -129,6 +134,7 @@ def handle_grb(v, pretend=False):
         grbid = v.find(".//Param[@name='GRB_Identified']").attrib['value']
         if grbid != 'true':
             log.debug("SWIFT alert but not a GRB")
+            decisions.reason('not_grb')
             return
         log.debug("SWIFT GRB trigger detected")
         this_trig_type = "SWIFT"
@@ -149,6 +155,7 @@ def handle_grb(v, pretend=False):
             grb.add_event(v)
 
         trig_time = float(v.find(".//Param[@name='Integ_Time']").attrib['value'])
+        decisions.param(integ_time=trig_time)
         if trig_time < LONG_SHORT_LIMIT:
             grb.debug("Probably a short GRB: t={0} < 2".format(trig_time))
             grb.short = True
@@ -161,6 +168,7 @@ def handle_grb(v, pretend=False):
     else:
         log.debug("Not a SWIFT GRB.")
         log.debug("Not Triggering")
+        decisions.reason('unknown_event_type')
         return
 
     if not trigger:
@@ -197,9 +205,11 @@ def handle_grb(v, pretend=False):
                     grb.info("Interrupting with a short SWIFT GRB")
                 else:
                     grb.info("Not interrupting previous obs")
+                    decisions.reason('busy', trigger_id=trig_id)
                     return
             else:
                 grb.info("Not interrupting previous obs")
+                decisions.reason('busy', trigger_id=trig_id)
                 return
         else:
             grb.info("Not currently observing any GRBs")
@@ -207,7 +217,7 @@ def handle_grb(v, pretend=False):
         grb.debug("Current schedule empty")
 
     emaildict = {'triggerid': grb.trigger_id,
-                 'trigtime': Time.now().iso,
+                 'trigtime': clock.astropy_now().iso,
                  'ra': Angle(grb.ra[-1], unit=astropy.units.deg).to_string(unit=astropy.units.hour, sep=':'),
                  'dec': Angle(grb.dec[-1], unit=astropy.units.deg).to_string(unit=astropy.units.deg, sep=':'),
                  'err': grb.err[-1]}
@@ -0,0 +1,614 @@
+"""
+Append-only archive of every VOEvent packet received by the handler daemon, as the raw material for replays,
+benchmarks and audits.
+
+putEvent() hands each packet to ARCHIVE.submit(), which just queues it, and a background thread appends it to the
+current segment file, and a line describing it to that segment's index file. Packets are archived exactly as
+received, before any parsing, so duplicates and packets the handlers can't parse are stored too.
+
+Segment files are named voevents-YYYYMMDD-HHMMSS.xml.gz, after the (UTC) time they were started. Each packet is
+written as a separate gzip member, so a whole segment can be read with zcat or gzip.open(), and any single packet
+can be decompressed on its own, given its offset and length. A new segment is started when the daemon starts, when
+the current one reaches max_mbytes, and at the start of each UTC day.
+
+Each segment has a sidecar index, the same name with .idx instead of .xml.gz, with one tab separated line per packet:
+
+    offset  length  issued  received  source  role  ivorn  trace_id
+
+where offset and length are the position of the gzip member in the segment, issued is the Who Date and received the
+time it reached putEvent() (both in seconds since the Unix epoch), and source is latency.source_name() of the
+ivorn. A line is only written to the index once the packet has been written to the segment, so after a crash, the
+index never points at incomplete data.
+
+At most max_queue packets wait to be written - if the disk is too slow to keep up, any more are dropped (and
+counted in status()), rather than using more and more memory, or holding up putEvent().
+
+search() only reads the index files of the segments that can contain packets in its time range, from the times in
+the segment names: a segment holds the packets received from its start time until the next segment's start time,
+and (allowing ISSUED_SLACK for packets issued long before, or after, they were received) those issued in that range.
+get_event() looks the ivorn up in an ivorn -> (segment, offset, length) index, which is kept in memory for each
+archive directory, and brought up to date on each call by reading only the index lines written since the last one.
+
+Archiving is enabled in trigger.conf with:
+
+    [archive]
+    directory = /var/lib/mwa/voevent_archive
+    max_mbytes = 64
+    max_queue = 1000
+
+The archive can be searched, and events extracted, with the functions below, or from the command line, eg:
+
+    python -m mwa_trigger.archive /var/lib/mwa/voevent_archive list --source Swift --since 2020-01-01
+    python -m mwa_trigger.archive /var/lib/mwa/voevent_archive extract --role observation --outdir events/
+    python -m mwa_trigger.archive /var/lib/mwa/voevent_archive get 'ivo://nasa.gsfc.gcn/SWIFT#BAT_GRB_Pos_772006-7987'
+"""
+
+import argparse
+import bisect
+import calendar
+import collections
+import glob
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import zlib
+
+if sys.version_info.major == 2:
+    import Queue
+else:
+    import queue as Queue
+
+from . import latency
+
+log = logging.getLogger('voevent.handlers.archive')   # Inherit the logging setup from handlers.py
+
+MAX_BYTES = 64 * 1024 * 1024   # Start a new segment when the current one reaches this size
+MAX_QUEUE = 1000               # Maximum number of packets waiting to be written, any more are dropped
+COMPRESSION = 6                # zlib compression level for each packet
+SEGMENT_PREFIX = 'voevents-'
+SEGMENT_SUFFIX = '.xml.gz'
+INDEX_SUFFIX = '.idx'
+SEGMENT_TIME_RE = re.compile(r'^%s(\d{8}-\d{6})' % re.escape(SEGMENT_PREFIX))
+
+# Margins used by search() when deciding from the segment names which segments can contain packets in a time range.
+# Packets received by several RPC threads at once can be written slightly out of order, so a few may have been
+# received just before the start of their segment, and when selecting on the issued time, packets can be issued long
+# before they're received (eg repeated or delayed notices), or after it (if the sender's clock is wrong). Packets
+# further outside their segment's time range than this are missed by search().
+RECEIVED_SLACK = 60
+ISSUED_SLACK = 7 * 86400
+
+# Only the first few kB of each packet are searched for the ivorn, role and Who Date, which are always near the start
+HEADER_CHARS = 4096
+IVORN_RE = re.compile(r'<(?:\w+:)?VOEvent\b[^>]*?\bivorn\s*=\s*["\']([^"\']*)["\']', re.S)
+ROLE_RE = re.compile(r'<(?:\w+:)?VOEvent\b[^>]*?\brole\s*=\s*["\']([^"\']*)["\']', re.S)
+DATE_RE = re.compile(r'<Who\b.*?<Date>\s*([^<]*?)\s*</Date>', re.S)
+
+IndexEntry = collections.namedtuple('IndexEntry', ['segment', 'offset', 'length', 'issued', 'received', 'source',
+                                                   'role', 'ivorn', 'trace_id'])
+
+
+def packet_info(eventxml):
+    """
+    Find the ivorn, role and Who Date of a VOEvent packet, without parsing all of it.
+
+    :param eventxml: string containing XML format VOEvent.
+    :return: A tuple of (ivorn, role, issued), where issued is in seconds since the Unix epoch. Any of them may be
+             None, if the packet doesn't contain them.
+    """
+    header = eventxml[:HEADER_CHARS]
+    m = IVORN_RE.search(header)
+    ivorn = m.group(1) if m else None
+    m = ROLE_RE.search(header)
+    role = m.group(1) if m else None
+    m = DATE_RE.search(eventxml)
+    issued = latency.parse_isotime(m.group(1)) if m else None
+    return ivorn, role, issued
+
+
+def _field(value):
+    """
+    :return: value as a string for an index line, with any tabs or newlines replaced, and '-' for None.
+    """
+    if value is None or value == '':
+        return '-'
+    return re.sub(r'[\t\r\n]', ' ', str(value))
+
+
+def _parse_field(text, convert=None):
+    if text == '-':
+        return None
+    return convert(text) if convert is not None else text
+
+
+class Archive(object):
+    """
+    The archive writer, with a queue of packets waiting to be written, and the background thread that writes them.
+    """
+    def __init__(self, directory=None, max_bytes=MAX_BYTES, max_queue=MAX_QUEUE, logger=log):
+        """
+        :param directory: Directory to write the segment and index files in, or None to disable archiving.
+        :param max_bytes: Start a new segment when the current one reaches this size, in bytes.
+        :param max_queue: Maximum number of packets waiting to be written - if the queue is full, packets are dropped.
+        :param logger: optional logger object.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.logger = logger
+        self.queue = Queue.Queue(maxsize=max_queue)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.segment = None       # Name of the current segment file
+        self.segment_day = None   # UTC date the current segment was started
+        self.datafile = None
+        self.indexfile = None
+        self.counts = collections.Counter()
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    @property
+    def running(self):
+        return (self.thread is not None) and self.thread.is_alive()
+
+    def start(self):
+        """
+        Start (or restart, if it has died) the writing thread.
+        """
+        if self.running or not self.enabled:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.thread = threading.Thread(target=self.run, name='Archive')
+        self.thread.daemon = True
+        self.thread.start()
+        self.logger.info('Archiving VOEvents in %s' % self.directory)
+
+    @property
+    def max_queue(self):
+        return self.queue.maxsize
+
+    @max_queue.setter
+    def max_queue(self, value):
+        with self.queue.mutex:   # Only the limit changes, so packets already queued are kept
+            self.queue.maxsize = value
+
+    def submit(self, eventxml, received=None, trace_id=None):
+        """
+        Add a packet to the archive. If the writing thread hasn't been started, it's written immediately. If the queue
+        of packets waiting to be written is full, the packet is dropped, and counted.
+
+        :param eventxml: string containing XML format VOEvent.
+        :param received: Time the packet was received, in seconds since the Unix epoch, defaults to now.
+        :param trace_id: Optional trace ID string for the packet.
+        """
+        if not self.enabled or not eventxml:
+            return
+        if received is None:
+            received = time.time()
+        if self.running:
+            try:
+                self.queue.put_nowait((eventxml, received, trace_id))
+            except Queue.Full:
+                with self.lock:
+                    self.counts['dropped'] += 1
+                    dropped = self.counts['dropped']
+                self.logger.error('Archive queue full (%d packets), dropped %s (%d dropped so far)' %
+                                  (self.queue.maxsize, packet_info(eventxml)[0], dropped))
+        else:
+            self.write(eventxml, received, trace_id)
+
+    def run(self):
+        """
+        Writing thread loop.
+        """
+        while True:
+            eventxml, received, trace_id = self.queue.get()
+            try:
+                self.write(eventxml, received, trace_id)
+            except Exception:
+                self.logger.exception('Exception in archive writer')
+            finally:
+                self.queue.task_done()
+
+    def write(self, eventxml, received, trace_id=None):
+        """
+        Append one packet to the current segment (starting a new one if necessary), and its line to the index.
+        """
+        if isinstance(eventxml, bytes):
+            data, eventxml = eventxml, eventxml.decode('latin-1')
+        else:
+            data = eventxml.encode('latin-1', 'xmlcharrefreplace')
+        ivorn, role, issued = packet_info(eventxml)
+        compressor = zlib.compressobj(COMPRESSION, zlib.DEFLATED, 31)   # wbits=31 for a gzip member
+        member = compressor.compress(data) + compressor.flush()
+        fields = [len(member), issued, received, latency.source_name(ivorn) if ivorn else None, role, ivorn, trace_id]
+        with self.lock:
+            try:
+                self._rotate(received)
+                offset = self.datafile.tell()
+                self.datafile.write(member)
+                self.datafile.flush()
+                self.indexfile.write('\t'.join([_field(x) for x in [offset] + fields]) + '\n')
+                self.indexfile.flush()
+            except (IOError, OSError):
+                self.counts['errors'] += 1
+                self.logger.exception('Unable to write %s to the archive' % ivorn)
+                self._close()
+                return
+            self.counts['archived'] += 1
+            self.counts['bytes'] += len(member)
+            self.counts['raw_bytes'] += len(data)
+
+    def _rotate(self, now):
+        day = time.strftime('%Y%m%d', time.gmtime(now))
+        if (self.datafile is not None) and (self.datafile.tell() < self.max_bytes) and (day == self.segment_day):
+            return
+        self._close()
+        base = os.path.join(self.directory, SEGMENT_PREFIX + time.strftime('%Y%m%d-%H%M%S', time.gmtime(now)))
+        name = base + SEGMENT_SUFFIX
+        n = 1
+        while os.path.exists(name):   # Never append to an existing segment, eg after a quick restart
+            name = '%s.%d%s' % (base, n, SEGMENT_SUFFIX)
+            n += 1
+        self.datafile = open(name, 'ab')
+        self.indexfile = open(index_name(name), 'a')
+        self.segment = name
+        self.segment_day = day
+        self.counts['segments'] += 1
+        self.logger.info('Started archive segment %s' % name)
+
+    def _close(self):
+        for f in [self.datafile, self.indexfile]:
+            if f is not None:
+                try:
+                    f.close()
+                except (IOError, OSError):
+                    pass
+        self.datafile = self.indexfile = None
+
+    def close(self):
+        """
+        Close the current segment, so that the next packet starts a new one.
+        """
+        with self.lock:
+            self._close()
+
+    def flush(self, timeout=None):
+        """
+        Wait until all queued packets have been written, or the timeout expires.
+
+        :param timeout: Maximum time to wait, in seconds, or None to wait forever.
+        :return: True if the queue was emptied.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while self.queue.unfinished_tasks:
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def status(self):
+        """
+        :return: A dictionary containing the archive directory, the current segment, the number of packets waiting
+                 to be written and the maximum, and counts of packets archived, compressed and raw bytes, segments
+                 started, errors, and packets dropped because the queue was full.
+        """
+        with self.lock:
+            result = {'directory': self.directory,
+                      'segment': self.segment,
+                      'queued_now': self.queue.qsize(),
+                      'max_queue': self.queue.maxsize}
+            result.update(self.counts)
+            return result
+
+
+# The archive written by the handler daemon's putEvent(), configured and started if enabled in trigger.conf
+ARCHIVE = Archive()
+
+
+def index_name(segment):
+    """
+    :return: The name of the index file for a segment file.
+    """
+    return segment[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+
+
+def list_segments(directory):
+    """
+    :return: A list of the segment file names in directory, oldest first.
+    """
+    return sorted(glob.glob(os.path.join(directory, SEGMENT_PREFIX + '*' + SEGMENT_SUFFIX)))
+
+
+def segment_start(segment):
+    """
+    :return: The time a segment was started, from its name, in seconds since the Unix epoch, or None if the name
+             doesn't contain one.
+    """
+    m = SEGMENT_TIME_RE.match(os.path.basename(segment))
+    if m is None:
+        return None
+    return calendar.timegm(time.strptime(m.group(1), '%Y%m%d-%H%M%S'))
+
+
+def _index_lines(segment, start=0):
+    """
+    Read the complete lines in a segment's index file, from a byte offset.
+
+    :param segment: The name of the segment file.
+    :param start: Byte offset in the index file to start reading at.
+    :return: A generator of (end, fields) tuples, where end is the byte offset after the line, and fields the list of
+             strings in it. A last line without a newline (still being written) isn't returned.
+    """
+    try:
+        f = open(index_name(segment), 'rb')
+    except (IOError, OSError):
+        return
+    with f:
+        f.seek(start)
+        for line in iter(f.readline, b''):
+            if not line.endswith(b'\n'):
+                return
+            yield f.tell(), line.decode('utf-8', 'replace').rstrip('\n').split('\t')
+
+
+def read_index(segment):
+    """
+    Read the index for one segment.
+
+    :param segment: The name of the segment file.
+    :return: A generator of IndexEntry tuples, in the order the packets were written.
+    """
+    for end, fields in _index_lines(segment):
+        if len(fields) != 8:
+            continue   # A partly written line, after a crash
+        yield IndexEntry(segment=segment,
+                         offset=int(fields[0]),
+                         length=int(fields[1]),
+                         issued=_parse_field(fields[2], float),
+                         received=_parse_field(fields[3], float),
+                         source=_parse_field(fields[4]),
+                         role=_parse_field(fields[5]),
+                         ivorn=_parse_field(fields[6]),
+                         trace_id=_parse_field(fields[7]))
+
+
+class IvornIndex(object):
+    """
+    The most recently archived packet for each ivorn in an archive directory, as (segment, offset, length), read
+    from the segment index files. Each update() only reads the index lines written since the previous one.
+    """
+    def __init__(self, directory):
+        """
+        :param directory: The archive directory.
+        """
+        self.directory = directory
+        self.positions = {}   # Bytes read so far from each segment's index file, by segment name
+        self.locations = {}   # (segment, offset, length) by ivorn
+        self.lock = threading.Lock()
+
+    def update(self):
+        """
+        Read any index lines written since the last update. If a segment has been removed, the index is rebuilt.
+        """
+        segments = list_segments(self.directory)
+        with self.lock:
+            if set(self.positions) - set(segments):
+                self.positions.clear()
+                self.locations.clear()
+            for segment in segments:
+                position = self.positions.get(segment, 0)
+                for end, fields in _index_lines(segment, start=position):
+                    position = end
+                    if len(fields) == 8 and fields[6] != '-':
+                        self.locations[fields[6]] = (segment, int(fields[0]), int(fields[1]))
+                self.positions[segment] = position
+
+    def lookup(self, ivorn):
+        """
+        :return: The (segment, offset, length) of the most recently archived packet with this ivorn, or None.
+        """
+        self.update()
+        with self.lock:
+            return self.locations.get(ivorn)
+
+
+# IvornIndex objects by archive directory, used by get_event()
+IVORN_INDEXES = {}
+IVORN_INDEXES_LOCK = threading.Lock()
+
+
+def ivorn_index(directory):
+    """
+    :return: The IvornIndex for an archive directory, creating it if this is the first time it's been used.
+    """
+    key = os.path.abspath(directory)
+    with IVORN_INDEXES_LOCK:
+        index = IVORN_INDEXES.get(key)
+        if index is None:
+            index = IVORN_INDEXES[key] = IvornIndex(directory)
+        return index
+
+
+def _segment_ranges(segments):
+    """
+    :return: A list of (start, end) times for each segment, from their names, where end is the start of the next
+             segment started later (None for the last), and start is None if the name doesn't contain a time.
+    """
+    starts = [segment_start(s) for s in segments]
+    distinct = sorted(set([t for t in starts if t is not None]))
+    ranges = []
+    for start in starts:
+        if start is None:
+            ranges.append((None, None))
+            continue
+        i = bisect.bisect_right(distinct, start)
+        ranges.append((start, distinct[i] if i < len(distinct) else None))
+    return ranges
+
+
+def search(directory, since=None, until=None, ivorn=None, source=None, role=None, by='issued'):
+    """
+    Find the archived packets matching all the given criteria, from the index files only. With since or until, only
+    the index files of segments started in (or, allowing RECEIVED_SLACK or ISSUED_SLACK, near) that range are read.
+
+    :param directory: The archive directory.
+    :param since: Only include packets issued (or received) at or after this time, in seconds since the Unix epoch.
+    :param until: Only include packets issued (or received) before this time.
+    :param ivorn: Only include packets with this ivorn.
+    :param source: Only include packets from this source (eg 'Swift', see latency.SOURCES).
+    :param role: Only include packets with this role (eg 'observation', 'test').
+    :param by: 'issued' to select on the Who Date, or 'received' to select on the time the packet arrived.
+    :return: A generator of IndexEntry tuples, oldest segment first.
+    """
+    slack = RECEIVED_SLACK if by == 'received' else ISSUED_SLACK
+    segments = list_segments(directory)
+    for segment, (start, end) in zip(segments, _segment_ranges(segments)):
+        if (since is not None) and (end is not None) and (end + slack <= since):
+            continue
+        if (until is not None) and (start is not None) and (start - slack >= until):
+            continue
+        for entry in read_index(segment):
+            t = getattr(entry, by)
+            if (since is not None) and (t is None or t < since):
+                continue
+            if (until is not None) and (t is None or t >= until):
+                continue
+            if (ivorn is not None) and (entry.ivorn != ivorn):
+                continue
+            if (source is not None) and (entry.source != source):
+                continue
+            if (role is not None) and (entry.role != role):
+                continue
+            yield entry
+
+
+def read_events(entries):
+    """
+    Read the packets for a sequence of index entries, opening each segment file only once for consecutive entries
+    in the same segment.
+
+    :param entries: An iterable of IndexEntry tuples, eg from search().
+    :return: A generator of (IndexEntry, eventxml) tuples, where eventxml is the packet as a string.
+    """
+    f = None
+    try:
+        for entry in entries:
+            if (f is None) or (f.name != entry.segment):
+                if f is not None:
+                    f.close()
+                f = open(entry.segment, 'rb')
+            if f.tell() != entry.offset:
+                f.seek(entry.offset)
+            data = zlib.decompress(f.read(entry.length), 31)
+            yield entry, data.decode('latin-1')
+    finally:
+        if f is not None:
+            f.close()
+
+
+def get_event(directory, ivorn):
+    """
+    :return: The most recently archived packet with the given ivorn, as a string, or None if there isn't one.
+    """
+    location = ivorn_index(directory).lookup(ivorn)
+    if location is None:
+        return None
+    segment, offset, length = location
+    with open(segment, 'rb') as f:
+        f.seek(offset)
+        return zlib.decompress(f.read(length), 31).decode('latin-1')
+
+
+def _parse_time(text):
+    """
+    :return: An ISO 8601 date or time (eg '2020-01-01', '2020-01-01T12:00:00') in seconds since the Unix epoch.
+    """
+    if text is None:
+        return None
+    if 'T' not in text:
+        text += 'T00:00:00'
+    result = latency.parse_isotime(text)
+    if result is None:
+        raise argparse.ArgumentTypeError('Invalid time: %s' % text)
+    return result
+
+
+def _fmt_time(t):
+    if t is None:
+        return '-'
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(t))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Search the VOEvent archive, and extract events from it.')
+    parser.add_argument('directory', help='Archive directory')
+    parser.add_argument('command', choices=['list', 'cat', 'extract', 'get', 'stats'],
+                        help='list matching events, cat them to stdout, extract them to files in --outdir, get one '
+                             'event by ivorn, or show stats by source')
+    parser.add_argument('ivorn', nargs='?', help='ivorn, for the get command')
+    parser.add_argument('--since', help='Only events issued at or after this UTC date or time, eg 2020-01-01')
+    parser.add_argument('--until', help='Only events issued before this UTC date or time')
+    parser.add_argument('--received', action='store_true',
+                        help='Select --since/--until on the time received, not the time issued')
+    parser.add_argument('--source', help='Only events from this source, eg Swift, Fermi, IceCube')
+    parser.add_argument('--role', help='Only events with this role, eg observation, test')
+    parser.add_argument('--outdir', default='.', help='Directory to write events to, for the extract command')
+    args = parser.parse_args(args)
+
+    if args.command == 'get':
+        if not args.ivorn:
+            parser.error('The get command needs an ivorn')
+        eventxml = get_event(args.directory, args.ivorn)
+        if eventxml is None:
+            sys.exit('%s not found' % args.ivorn)
+        sys.stdout.write(eventxml)
+        return
+
+    entries = search(args.directory,
+                     since=_parse_time(args.since),
+                     until=_parse_time(args.until),
+                     ivorn=args.ivorn,
+                     source=args.source,
+                     role=args.role,
+                     by='received' if args.received else 'issued')
+    if args.command == 'list':
+        for entry in entries:
+            print('%s  %s  %-8s %-12s %s' % (_fmt_time(entry.issued), _fmt_time(entry.received), entry.source or '-',
+                                             entry.role or '-', entry.ivorn or '-'))
+    elif args.command == 'stats':
+        counts = collections.Counter()
+        nbytes = collections.Counter()
+        for entry in entries:
+            counts[entry.source or '-'] += 1
+            nbytes[entry.source or '-'] += entry.length
+        for source in sorted(counts):
+            print('%-12s %8d events %10.1f kB' % (source, counts[source], nbytes[source] / 1024.0))
+        print('%-12s %8d events %10.1f kB' % ('total', sum(counts.values()), sum(nbytes.values()) / 1024.0))
+    elif args.command == 'cat':
+        for entry, eventxml in read_events(entries):
+            sys.stdout.write(eventxml)
+            if not eventxml.endswith('\n'):
+                sys.stdout.write('\n')
+    elif args.command == 'extract':
+        if not os.path.isdir(args.outdir):
+            os.makedirs(args.outdir)
+        count = 0
+        for entry, eventxml in read_events(entries):
+            name = re.sub(r'[^A-Za-z0-9_.-]+', '_', (entry.ivorn or 'unknown').split('//', 1)[-1])
+            segname = os.path.basename(entry.segment)[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]
+            with open(os.path.join(args.outdir, '%s_%s_%d.xml' % (name, segname, entry.offset)), 'w') as f:
+                f.write(eventxml)
+            count += 1
+        print('%d events written to %s' % (count, args.outdir))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+The clock used by the handlers for all 'event timeline' times - when a trigger was sent, how long ago the first
+trigger for an event was, whether a source is above the horizon now, the GPS time in the fake trigger service's
+schedule, and so on - instead of calling Time.now() or time.time() directly.
+
+Normally this is just the system clock. Replacing it with a SimulatedClock, eg:
+
+    from mwa_trigger import clock
+    sim = clock.SimulatedClock(start=1500000000.0)
+    clock.set_clock(sim)
+    ...
+    sim.set(issued_time_of_next_event)
+
+lets a simulation push archived VOEvents through the real handler code as if they were arriving at the time they
+were originally issued, at any speed (see benchmarks/simulate.py).
+
+Measurements of how long something actually took to run (metrics, trace spans, web service latency) still use
+time.time(), as they measure the computer, not the event timeline.
+"""
+
+import logging
+import threading
+import time
+
+from astropy.time import Time
+
+
+class SystemClock(object):
+    """
+    The real clock.
+    """
+    simulated = False
+
+    def time(self):
+        """
+        :return: The current time, in seconds since the Unix epoch.
+        """
+        return time.time()
+
+    def sleep(self, seconds):
+        """
+        Wait for the given number of seconds.
+        """
+        time.sleep(seconds)
+
+
+class SimulatedClock(object):
+    """
+    A virtual clock, that either stands still until it's moved with set() or advance() (speed=0), or runs at
+    'speed' times real time from the last time it was set.
+
+    sleep() advances the virtual time immediately if the clock is standing still, otherwise it sleeps for the
+    equivalent real time.
+    """
+    simulated = True
+
+    def __init__(self, start=None, speed=0.0):
+        """
+        :param start: Initial time, in seconds since the Unix epoch. Defaults to now.
+        :param speed: Number of virtual seconds per real second, or 0 for a clock that only moves when told to.
+        """
+        if start is None:
+            start = time.time()
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.base = float(start)      # Virtual time at the last set()
+        self.realbase = time.time()   # Real time at the last set()
+
+    def time(self):
+        """
+        :return: The current virtual time, in seconds since the Unix epoch.
+        """
+        with self.lock:
+            if self.speed:
+                return self.base + (time.time() - self.realbase) * self.speed
+            return self.base
+
+    def set(self, unixtime):
+        """
+        Set the virtual time, in seconds since the Unix epoch.
+        """
+        with self.lock:
+            self.base = float(unixtime)
+            self.realbase = time.time()
+
+    def advance(self, seconds):
+        """
+        Move the virtual time forwards by the given number of seconds.
+        """
+        self.set(self.time() + seconds)
+
+    def sleep(self, seconds):
+        """
+        Wait for the given number of virtual seconds.
+        """
+        if self.speed:
+            time.sleep(seconds / float(self.speed))
+        else:
+            self.advance(seconds)
+
+
+# The clock used by all modules - replace it with set_clock(), not by assigning to it directly
+CLOCK = SystemClock()
+
+
+def set_clock(newclock):
+    """
+    Replace the clock used by all modules.
+
+    :param newclock: A SystemClock or SimulatedClock instance.
+    :return: The previous clock.
+    """
+    global CLOCK
+    previous = CLOCK
+    CLOCK = newclock
+    return previous
+
+
+def now():
+    """
+    :return: The current time from the clock, in seconds since the Unix epoch.
+    """
+    return CLOCK.time()
+
+
+def astropy_now():
+    """
+    :return: The current time from the clock, as an astropy Time object - use this instead of Time.now()
+    """
+    if not CLOCK.simulated:
+        return Time.now()
+    return Time(CLOCK.time(), format='unix', scale='utc')
+
+
+def sleep(seconds):
+    """
+    Wait for the given number of seconds, by the clock.
+    """
+    CLOCK.sleep(seconds)
+
+
+class ClockFilter(logging.Filter):
+    """
+    Logging filter that stamps each record with the time from the clock instead of the real time, so that log files
+    written during a simulation show the virtual time. Add it to the handlers, eg:
+
+        handler.addFilter(clock.ClockFilter())
+    """
+    def filter(self, record):
+        if CLOCK.simulated:
+            record.created = CLOCK.time()
+        return True
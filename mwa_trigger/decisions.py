@@ -0,0 +1,416 @@
+"""
+Columnar ledger of every decision the handlers make, for analysis. Each decision recorded by latency.record() - a
+trigger accepted or refused by the web service, a fast lane buffer dump, or a decision not to trigger - is written
+as one row, with the reason code and key parameters that the handler gave while it was making the decision.
+
+Handlers give the reason for their decision, and any of the key parameters that they looked at, with:
+
+    decisions.reason('prob_below_threshold', trigger_id=trig_id, prob=prob)
+    decisions.param(integ_time=trig_time)
+
+which are kept for the event being handled by the current thread (identified by its trace ID), until latency.record()
+writes the row. The last reason given wins. If a handler gives no reason, it's taken from the outcome - eg
+'triggered', or 'not_handled' if no handler accepted the event.
+
+Each column is appended to its own file in the ledger directory, as fixed width binary values, so a whole column
+(eg a year of decisions) can be loaded into a NumPy array in one read:
+
+    data = decisions.load('/var/lib/mwa/decisions')
+    slow = data['notice_latency'][data['reason'] == 'triggered'] > 60
+
+The source, outcome and reason columns are stored as small integer codes, with the strings for each code in
+columns.json, which also records the type of every column. Missing values are NaN. A partly written row (after a
+crash, or a failed write) is removed from the end of the column files before any more are written, so the columns
+always stay in step. Trigger IDs longer than the trigger_id column are refused (and counted as errors), not cut short.
+
+The ledger is enabled in trigger.conf with:
+
+    [decisions]
+    directory = /var/lib/mwa/decisions
+
+and can be summarised from the command line, eg:
+
+    python -m mwa_trigger.decisions /var/lib/mwa/decisions --by reason --since 2020-01-01
+"""
+
+import argparse
+import calendar
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+import numpy
+
+from . import sideeffects
+from . import tracing
+
+log = logging.getLogger('voevent.handlers.decisions')   # Inherit the logging setup from handlers.py
+
+# Column name and NumPy type (little endian, so the files are portable), in the order they're written
+COLUMNS = [('decided', '<f8'),          # Time of the decision, seconds since the Unix epoch
+           ('issued', '<f8'),           # Notice issue time (the Who Date)
+           ('event_time', '<f8'),       # Instrument event time (the WhereWhen ISOTime)
+           ('event_latency', '<f8'),    # Seconds from event_time to the decision
+           ('notice_latency', '<f8'),   # Seconds from issued to the decision
+           ('source', '<u1'),           # Source code, eg Swift
+           ('outcome', '<u1'),          # Outcome code, eg trigger, ignored
+           ('reason', '<u2'),           # Reason code, eg prob_below_threshold
+           ('trigger_id', 'S64'),
+           ('trace_id', 'S16'),
+           ('prob', '<f4'),             # Fermi Most_Likely_Prob, or neutrino signalness, in percent
+           ('integ_time', '<f4'),       # Swift Integ_Time or Fermi Trig_Timescale, in seconds
+           ('hasns', '<f4'),            # LVC HasNS probability
+           ('alt', '<f4'),              # Target elevation at the trigger time, in degrees
+           ('pos_diff', '<f4')]         # Distance from the previous position, in degrees
+
+PARAMETERS = ['prob', 'integ_time', 'hasns', 'alt', 'pos_diff']
+CATEGORIES = ['source', 'outcome', 'reason']
+
+# The initial codes for the categorical columns. New values are given the next free code when first seen.
+CODES = {'source': ['other', 'Swift', 'Fermi', 'LVC', 'IceCube', 'Antares', 'MAXI'],
+         'outcome': ['ignored', 'handled', 'trigger', 'trigger_failed', 'fastlane', 'fastlane_failed'],
+         'reason': ['not_handled',             # No handler accepted the event
+                    'unspecified',             # Handled, but the handler didn't give a reason
+                    'triggered',               # Trigger request accepted
+                    'trigger_failed',          # Trigger request refused, or the web service didn't respond
+                    'fastlane',                # Fast lane voltage buffer dump
+                    'fastlane_failed',
+                    'unknown_event_type',      # Not a notice type the handler can use
+                    'test_event',
+                    'retraction',
+                    'star_tracker_lost_lock',
+                    'not_short_grb',           # Integration time too long
+                    'not_grb',                 # Fermi MOST_LIKELY != GRB
+                    'prob_below_threshold',
+                    'rank_below_threshold',
+                    'hasns_below_threshold',
+                    'no_skymap',
+                    'no_pointing',
+                    'not_triggered_on_flt',    # Fermi Gnd/Fin notice, for a trigger not observed on the Flt notice
+                    'position_unchanged',      # New position too close to the one already observed
+                    'lower_precedence',        # Position from a lower precedence notice type
+                    'busy',                    # Not interrupting the current observation
+                    'already_triggered',
+                    'too_late',                # Too long since the event
+                    'too_short',               # Requested observing time too short
+                    'below_horizon',
+                    'declination_limit',
+                    'no_hasns']}               # GW notice without a HasNS probability
+
+OUTCOME_REASONS = {'ignored': 'not_handled',
+                   'handled': 'unspecified',
+                   'trigger': 'triggered',
+                   'trigger_failed': 'trigger_failed',
+                   'fastlane': 'fastlane',
+                   'fastlane_failed': 'fastlane_failed'}
+
+_local = threading.local()
+
+
+def _context():
+    """
+    :return: The decision context (a dictionary) for the event being handled by this thread, starting a new one if
+             the trace ID has changed since it was last used.
+    """
+    trace_id = tracing.get_trace_id()
+    context = getattr(_local, 'context', None)
+    if (context is None) or (context['trace_id'] != trace_id):
+        context = _local.context = {'trace_id': trace_id, 'reason': None, 'trigger_id': None, 'params': {}}
+    return context
+
+
+def reason(code, trigger_id=None, **params):
+    """
+    Give the reason for the decision being made about the current event.
+
+    :param code: Reason code string, eg 'prob_below_threshold' (see CODES['reason']).
+    :param trigger_id: Optional trigger ID, if the decision isn't a trigger (which has its own).
+    :param params: Any of the key parameters in PARAMETERS, eg prob=45.
+    """
+    context = _context()
+    context['reason'] = code
+    if trigger_id is not None:
+        context['trigger_id'] = trigger_id
+    context['params'].update(params)
+
+
+def param(**params):
+    """
+    Record key parameters (any of those in PARAMETERS) used in the decision being made about the current event.
+    """
+    _context()['params'].update(params)
+
+
+def current():
+    """
+    :return: A tuple of (reason, trigger_id, params) given so far for the current event.
+    """
+    context = _context()
+    return context['reason'], context['trigger_id'], dict(context['params'])
+
+
+def _float(value):
+    try:
+        return float(value) if value is not None else float('nan')
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+class DecisionLedger(object):
+    """
+    Appends a row to the column files for each decision.
+    """
+    def __init__(self, directory=None, logger=log):
+        """
+        :param directory: Directory holding the column files, or None to disable the ledger.
+        :param logger: optional logger object.
+        """
+        self.directory = None
+        self.logger = logger
+        self.types = list(COLUMNS)   # Column types, from columns.json for an existing ledger
+        self.codes = dict([(name, list(values)) for name, values in CODES.items()])
+        self.lookup = {}
+        self.rows = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.configure(directory)
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    def configure(self, directory=None):
+        """
+        Start writing rows to the given directory, creating it if necessary, and loading the existing codes.
+        """
+        with self.lock:
+            self.directory = directory
+            self.codes = dict([(name, list(values)) for name, values in CODES.items()])
+            if directory is None:
+                return
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            schema = read_schema(directory)
+            self.types = list(COLUMNS)
+            if schema is not None:
+                for name, values in schema['codes'].items():
+                    self.codes[name] = values + [v for v in self.codes.get(name, []) if v not in values]
+                # Keep writing an existing ledger with its own column types (eg an older, narrower trigger_id)
+                old = dict([(name, str(dtype)) for name, dtype in schema['columns']])
+                self.types = [(name, old.get(name, dtype)) for name, dtype in COLUMNS]
+            self._truncate()
+            self.lookup = dict([(name, dict([(v, i) for i, v in enumerate(values)]))
+                                for name, values in self.codes.items()])
+            self._write_schema()
+
+    def record(self, rec):
+        """
+        Queue a row for a decision recorded by latency.record(), with the reason and parameters from the current
+        event's decision context.
+
+        :param rec: The record dictionary from latency.LatencyLedger.record().
+        """
+        code, trigger_id, params = current()
+        _local.context = None   # This decision is finished, the next one about the same event starts afresh
+        if not self.enabled:
+            return
+        if (code is None) or (rec['outcome'] not in ['ignored', 'handled']):
+            # The result of a trigger request or fast lane dump overrides any reason given earlier
+            code = OUTCOME_REASONS.get(rec['outcome'], 'unspecified')
+        row = dict([(name, rec.get(name)) for name in ['decided', 'issued', 'event_time', 'event_latency',
+                                                       'notice_latency', 'source', 'outcome', 'trace_id']])
+        row['reason'] = code
+        row['trigger_id'] = rec.get('trigger_id') or trigger_id
+        for name in PARAMETERS:
+            row[name] = params.get(name)
+        sideeffects.submit('decisions', self._write, row)
+        return row
+
+    def _code(self, name, value):
+        value = value or CODES[name][0]
+        code = self.lookup[name].get(value)
+        if code is None:
+            code = len(self.codes[name])
+            self.codes[name].append(value)
+            self.lookup[name][value] = code
+            self._write_schema()
+        return code
+
+    def _write_schema(self):
+        fname = os.path.join(self.directory, 'columns.json')
+        with open(fname + '.tmp', 'w') as f:
+            json.dump({'columns': self.types, 'codes': self.codes}, f, indent=1)
+        os.rename(fname + '.tmp', fname)
+
+    def _truncate(self):
+        """
+        Cut every column file back to the number of complete rows (the length of the shortest column), removing any
+        partly written row, so that new rows line up in every column.
+
+        :return: The number of complete rows.
+        """
+        sizes = []
+        for name, dtype in self.types:
+            fname = os.path.join(self.directory, name + '.col')
+            sizes.append((fname, numpy.dtype(dtype).itemsize, os.path.getsize(fname) if os.path.exists(fname) else 0))
+        nrows = min([size // itemsize for fname, itemsize, size in sizes])
+        for fname, itemsize, size in sizes:
+            if size > nrows * itemsize:
+                self.logger.warning('Removing a partly written decision from %s (%d bytes)' %
+                                    (fname, size - nrows * itemsize))
+                with open(fname, 'r+b') as f:
+                    f.truncate(nrows * itemsize)
+        return nrows
+
+    def _write(self, row):
+        with self.lock:
+            if self.directory is None:
+                return
+            try:
+                values = []
+                for name, dtype in self.types:
+                    value = row.get(name)
+                    if name in CATEGORIES:
+                        value = self._code(name, value)
+                    elif dtype.startswith('S'):
+                        value = (value or '').encode('ascii', 'replace')
+                        if len(value) > numpy.dtype(dtype).itemsize:
+                            raise ValueError('%s %r is longer than the %s column' % (name, value, dtype))
+                    else:
+                        value = _float(value)
+                    values.append(numpy.array([value], dtype=dtype).tobytes())
+            except ValueError as error:
+                self.errors += 1
+                self.logger.error('Unable to record decision in %s: %s' % (self.directory, error))
+                return
+            try:
+                for (name, dtype), data in zip(self.types, values):
+                    with open(os.path.join(self.directory, name + '.col'), 'ab') as f:
+                        f.write(data)
+            except (IOError, OSError):
+                self.errors += 1
+                self.logger.exception('Unable to write decision to %s' % self.directory)
+                try:
+                    self._truncate()   # Don't leave this row in some of the columns
+                except (IOError, OSError):
+                    pass
+                return
+            self.rows += 1
+
+    def status(self):
+        """
+        :return: A dictionary containing the ledger directory, and the number of rows written and errors since startup.
+        """
+        with self.lock:
+            return {'directory': self.directory, 'rows': self.rows, 'errors': self.errors}
+
+
+# The ledger written by latency.record(), configured by the handler daemon
+LEDGER = DecisionLedger()
+
+
+def read_schema(directory):
+    """
+    :return: The column types and codes from columns.json in directory, or None if there isn't one.
+    """
+    fname = os.path.join(directory, 'columns.json')
+    if not os.path.exists(fname):
+        return None
+    with open(fname) as f:
+        return json.load(f)
+
+
+def load(directory, columns=None, decode=True):
+    """
+    Load the ledger into NumPy arrays, one per column.
+
+    :param directory: The ledger directory.
+    :param columns: Optional list of the column names to load, default all of them.
+    :param decode: If True, convert the source, outcome and reason codes to arrays of strings, and the trigger and
+                   trace IDs from bytes to strings.
+    :return: A dictionary of column name to NumPy array, all the same length.
+    """
+    schema = read_schema(directory)
+    if schema is None:
+        return dict([(name, numpy.zeros(0, dtype=dtype)) for name, dtype in COLUMNS
+                     if columns is None or name in columns])
+    types = [(name, numpy.dtype(str(dtype))) for name, dtype in schema['columns']]
+    # The number of complete rows is the length of the shortest column
+    nrows = min([os.path.getsize(os.path.join(directory, name + '.col')) // dtype.itemsize
+                 if os.path.exists(os.path.join(directory, name + '.col')) else 0 for name, dtype in types])
+    result = {}
+    for name, dtype in types:
+        if columns is not None and name not in columns:
+            continue
+        fname = os.path.join(directory, name + '.col')
+        data = numpy.fromfile(fname, dtype=dtype, count=nrows) if nrows else numpy.zeros(0, dtype=dtype)
+        if decode:
+            if name in schema['codes']:
+                data = numpy.array(schema['codes'][name])[data]
+            elif dtype.kind == 'S':
+                data = data.astype('U')
+        result[name] = data
+    return result
+
+
+def summarise(data, by='reason'):
+    """
+    Aggregate the decisions by the values of one column.
+
+    :param data: Decoded columns, from load().
+    :param by: Name of the column to group by, eg 'reason', 'source' or 'outcome'.
+    :return: A list of (value, count, median notice latency, 90th percentile notice latency) tuples, most common first.
+    """
+    values, inverse, counts = numpy.unique(data[by], return_inverse=True, return_counts=True)
+    latencies = data['notice_latency']
+    result = []
+    for i, value in enumerate(values):
+        lat = latencies[(inverse == i) & ~numpy.isnan(latencies)]
+        if len(lat):
+            p50, p90 = numpy.percentile(lat, [50, 90])
+        else:
+            p50 = p90 = float('nan')
+        result.append((value, int(counts[i]), float(p50), float(p90)))
+    result.sort(key=lambda x: -x[1])
+    return result
+
+
+def _parse_date(text):
+    if text is None:
+        return None
+    return calendar.timegm(time.strptime(text, '%Y-%m-%d'))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Summarise the decision ledger.')
+    parser.add_argument('directory', help='Ledger directory')
+    parser.add_argument('--by', default='reason', help='Column to group by: reason, source, outcome or trigger_id')
+    parser.add_argument('--source', help='Only decisions about events from this source, eg Swift')
+    parser.add_argument('--since', help='Only decisions on or after this UTC date, eg 2020-01-01')
+    parser.add_argument('--until', help='Only decisions before this UTC date')
+    args = parser.parse_args(args)
+
+    start = time.time()
+    data = load(args.directory)
+    mask = numpy.ones(len(data['decided']), dtype=bool)
+    if args.source:
+        mask &= (data['source'] == args.source)
+    if args.since:
+        mask &= (data['decided'] >= _parse_date(args.since))
+    if args.until:
+        mask &= (data['decided'] < _parse_date(args.until))
+    data = dict([(name, values[mask]) for name, values in data.items()])
+    rows = summarise(data, by=args.by)
+    print('%-28s %8s %14s %14s' % (args.by, 'count', 'p50 latency', 'p90 latency'))
+    for value, count, p50, p90 in rows:
+        print('%-28s %8d %14s %14s' % (value, count,
+                                       '-' if math.isnan(p50) else '%.1f s' % p50,
+                                       '-' if math.isnan(p90) else '%.1f s' % p90))
+    print('%d decisions, loaded and summarised in %.2f s' % (mask.sum(), time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
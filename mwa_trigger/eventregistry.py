@@ -0,0 +1,400 @@
+"""
+One registry of the TriggerEvents held by all the handler modules, replacing the separate, unbounded xml_cache
+dictionaries, with indexes by trigger ID, ivorn, source and last update time, and a limit on the number of events
+and on their (estimated) memory use.
+
+Each handler module still has an 'xml_cache', but it's now a HandlerCache - a dictionary-like view of that handler's
+entries in the registry, so the handler code doesn't change. After the handlers have run on each event, the
+QueueWorker calls EVENTS.flush(), which:
+
+    - updates the indexes, size estimate and last update time of each TriggerEvent the handlers looked up or added,
+    - saves their state to the trigger state database (statestore.py), if that's enabled,
+    - evicts events not updated for 'ttl' seconds, then the least recently used events, until the registry is within
+      its limits on the number of events and memory.
+
+An evicted TriggerEvent is gone from memory, but if the state database is enabled, it's restored from there if its
+trigger ID is seen again, exactly as after a restart.
+
+The size of each TriggerEvent is estimated from the length of its (compressed) VOEvents, plus an allowance for
+each position and log message, plus the size of any large arrays it holds, from its array_bytes() method (eg the GW
+skymaps). It's only an estimate, but it's cheap to keep up to date, and good enough to stop the registry growing
+without limit.
+"""
+
+import collections
+import logging
+import sys
+import threading
+
+from . import clock
+from . import latency
+from . import statestore
+
+log = logging.getLogger('voevent.handlers.eventregistry')   # Inherit the logging setup from handlers.py
+
+MAX_ENTRIES = 2000                # Evict the least recently used events beyond this number
+MAX_BYTES = 500 * 1024 * 1024     # Evict the least recently used events if their estimated size is more than this
+TTL = 30 * 86400.0                # Evict events that haven't been updated for this many seconds
+
+BASE_BYTES = 2048          # Allowance for the TriggerEvent object itself
+POSITION_BYTES = 24        # Allowance for each (ra, dec, err) position
+JOURNAL_BYTES = 200        # Allowance for each journal (log message) entry
+
+
+class RegistryEntry(object):
+    """
+    One TriggerEvent in the registry, with the information needed for the indexes and eviction.
+    """
+    def __init__(self, handler, trigger_id, tevent):
+        self.handler = handler
+        self.trigger_id = trigger_id
+        self.tevent = tevent
+        self.ivorns = set()     # ivorns of the VOEvents added to this TriggerEvent
+        self.source = None      # Source name, from latency.source_name(), of the most recent VOEvent
+        self.updated = None     # Unix timestamp when the entry was last flushed
+        self.event_bytes = 0    # Estimated size of the VOEvents counted so far
+        self.counted = 0        # Number of the TriggerEvent's VOEvents included in event_bytes
+        self.nbytes = 0         # Estimated total size of the TriggerEvent
+
+
+class EventRegistry(object):
+    """
+    The TriggerEvents for all handlers, keyed by (handler, trigger ID). Safe to use from more than one thread.
+    """
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES, ttl=TTL, logger=log):
+        """
+        :param max_entries: Maximum number of TriggerEvents to keep, or None for no limit.
+        :param max_bytes: Maximum estimated size of all the TriggerEvents, in bytes, or None for no limit.
+        :param ttl: Evict TriggerEvents that haven't been updated for this many seconds, or None to keep them.
+        :param logger: optional logger object.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.logger = logger
+        self.lock = threading.RLock()
+        self.entries = collections.OrderedDict()     # RegistryEntry objects by key, least recently used first
+        self.by_update = collections.OrderedDict()   # Keys, least recently updated first
+        self.by_ivorn = {}                           # Key, by ivorn
+        self.by_source = collections.defaultdict(set)   # Set of keys, by source name
+        self.nbytes = 0
+        self.caches = {}   # HandlerCache objects by handler name, so flush() can find the entries looked at
+        self.stats = {'hits': 0, 'misses': 0, 'added': 0, 'restored': 0,
+                      'evicted': collections.Counter()}   # by reason - 'ttl', 'entries' or 'bytes'
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, handler, trigger_id):
+        """
+        :return: The TriggerEvent for the given handler and trigger ID, or None. Marks it as recently used.
+        """
+        key = (handler, trigger_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            if sys.version_info.major == 2:
+                self.entries[key] = self.entries.pop(key)
+            else:
+                self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry.tevent
+
+    def contains(self, handler, trigger_id):
+        """
+        :return: True if there's a TriggerEvent for the given handler and trigger ID in memory, without marking it
+                 as used.
+        """
+        with self.lock:
+            return (handler, trigger_id) in self.entries
+
+    def put(self, handler, trigger_id, tevent, restored=False):
+        """
+        Add (or replace) the TriggerEvent for the given handler and trigger ID. The indexes are updated when it's
+        flushed.
+
+        :param restored: True if the TriggerEvent was restored from the state database.
+        """
+        key = (handler, trigger_id)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = RegistryEntry(handler, trigger_id, tevent)
+            self.stats['restored' if restored else 'added'] += 1
+
+    def remove(self, handler, trigger_id):
+        """
+        Remove the TriggerEvent for the given handler and trigger ID, if it's in memory.
+
+        :return: The TriggerEvent, or None.
+        """
+        with self.lock:
+            entry = self._remove((handler, trigger_id))
+        return entry.tevent if entry is not None else None
+
+    def replace(self, handler, trigger_id, tevent):
+        """
+        Swap in a new TriggerEvent object for an existing entry, keeping its indexes and size estimate (eg when the
+        handler module has been reloaded, and its TriggerEvent subclass has been re-created).
+
+        :return: True if there was an entry to replace.
+        """
+        with self.lock:
+            entry = self.entries.get((handler, trigger_id))
+            if entry is None:
+                return False
+            entry.tevent = tevent
+            return True
+
+    def clear(self):
+        """
+        Forget all the TriggerEvents in memory, without touching the state database.
+        """
+        with self.lock:
+            for key in list(self.entries.keys()):
+                self._remove(key)
+            caches = list(self.caches.values())
+        for cache in caches:
+            with cache.lock:
+                cache.touched.clear()
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        self.by_update.pop(key, None)
+        for ivorn in entry.ivorns:
+            if self.by_ivorn.get(ivorn) == key:
+                del self.by_ivorn[ivorn]
+        if entry.source is not None:
+            self.by_source[entry.source].discard(key)
+            if not self.by_source[entry.source]:
+                del self.by_source[entry.source]
+        self.nbytes -= entry.nbytes
+        return entry
+
+    def handler_items(self, handler):
+        """
+        :return: A list of (trigger ID, TriggerEvent) tuples for the given handler, least recently used first.
+        """
+        with self.lock:
+            return [(e.trigger_id, e.tevent) for e in self.entries.values() if e.handler == handler]
+
+    def update(self, handler, trigger_id):
+        """
+        Update the indexes, size estimate and last update time for a TriggerEvent, after a handler has looked at it.
+
+        :return: The TriggerEvent, or None if it's not in the registry.
+        """
+        key = (handler, trigger_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            tevent = entry.tevent
+            for ivorn in tevent.ivorns[entry.counted:]:
+                if ivorn:
+                    entry.ivorns.add(ivorn)
+                    self.by_ivorn[ivorn] = key
+                    source = latency.source_name(ivorn)
+                    if source != entry.source:
+                        if entry.source is not None:
+                            self.by_source[entry.source].discard(key)
+                            if not self.by_source[entry.source]:
+                                del self.by_source[entry.source]
+                        entry.source = source
+                        self.by_source[source].add(key)
+            entry.event_bytes += sum([len(x) for x in tevent.events[entry.counted:]])   # Compressed XML
+            entry.counted = len(tevent.events)
+            nbytes = (BASE_BYTES + entry.event_bytes + POSITION_BYTES * len(tevent.ra) +
+                      JOURNAL_BYTES * len(tevent.journal.entries) + tevent.array_bytes())
+            self.nbytes += nbytes - entry.nbytes
+            entry.nbytes = nbytes
+            entry.updated = clock.now()
+            self.by_update.pop(key, None)
+            self.by_update[key] = entry.updated
+            return tevent
+
+    def find_ivorn(self, ivorn):
+        """
+        :return: The TriggerEvent (from any handler) that a VOEvent with the given ivorn was added to, or None.
+        """
+        with self.lock:
+            key = self.by_ivorn.get(ivorn)
+            return self.entries[key].tevent if key is not None else None
+
+    def find_source(self, source):
+        """
+        :param source: Source name, as returned by latency.source_name(), eg 'Swift'.
+        :return: A list of the TriggerEvents (from any handler) whose most recent VOEvent came from that source.
+        """
+        with self.lock:
+            return [self.entries[key].tevent for key in self.by_source.get(source, ())]
+
+    def updated_since(self, unixtime):
+        """
+        :return: A list of the TriggerEvents (from any handler) updated at or after the given time, oldest first.
+        """
+        with self.lock:
+            return [self.entries[key].tevent for key, updated in self.by_update.items() if updated >= unixtime]
+
+    def flush(self):
+        """
+        Update every TriggerEvent looked up or added by a handler since the last flush(), save their state to the
+        state database if it's enabled, and evict events to keep within the limits. Called by the QueueWorker after
+        the handlers have run on each event.
+        """
+        for cache in list(self.caches.values()):
+            cache.flush()
+        self.evict()
+
+    def evict(self):
+        """
+        Evict TriggerEvents not updated for self.ttl seconds, then the least recently used, until the registry is
+        within its limits.
+        """
+        evicted = []
+        with self.lock:
+            if self.ttl is not None:
+                cutoff = clock.now() - self.ttl
+                while self.by_update:
+                    key, updated = next(iter(self.by_update.items()))
+                    if updated >= cutoff:
+                        break
+                    evicted.append((self._remove(key), 'ttl'))
+            while self.entries and ((self.max_entries is not None and len(self.entries) > self.max_entries) or
+                                    (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+                reason = 'entries' if self.max_entries is not None and len(self.entries) > self.max_entries else 'bytes'
+                key = next(iter(self.entries))
+                evicted.append((self._remove(key), reason))
+            for entry, reason in evicted:
+                self.stats['evicted'][reason] += 1
+        for entry, reason in evicted:
+            self.logger.debug('Evicted %s trigger %s from the event registry (%s)' % (entry.handler,
+                                                                                     entry.trigger_id,
+                                                                                     reason))
+
+    def status(self):
+        """
+        :return: A dictionary containing the limits, the number and estimated size of the TriggerEvents in memory,
+                 in total, by handler and by source, and counts of hits, misses, additions, restores and evictions.
+        """
+        with self.lock:
+            handlers = collections.Counter([e.handler for e in self.entries.values()])
+            handler_bytes = collections.Counter()
+            for e in self.entries.values():
+                handler_bytes[e.handler] += e.nbytes
+            result = {'entries': len(self.entries),
+                      'bytes': self.nbytes,
+                      'max_entries': self.max_entries,
+                      'max_bytes': self.max_bytes,
+                      'ttl': self.ttl,
+                      'handlers': dict([(h, {'entries': n, 'bytes': handler_bytes[h]}) for h, n in handlers.items()]),
+                      'sources': dict([(s, len(keys)) for s, keys in self.by_source.items()]),
+                      'ivorns': len(self.by_ivorn),
+                      'oldest_update': next(iter(self.by_update.values())) if self.by_update else None}
+            result.update(self.stats)
+            result['evicted'] = dict(self.stats['evicted'])
+        return result
+
+
+class HandlerCache(object):
+    """
+    Dictionary-like view of one handler's TriggerEvents in the registry, used as the xml_cache in each handler
+    module. A trigger ID that isn't in memory (because it was evicted, or the daemon has restarted) is looked up in
+    the state database, if that's enabled, and if found, a new TriggerEvent is created with factory() and its state
+    restored.
+    """
+    def __init__(self, handler, factory, registry=None, store=None):
+        """
+        :param handler: Name of the handler module, used as part of the key.
+        :param factory: A function (usually the TriggerEvent subclass) that returns a new, empty TriggerEvent.
+        :param registry: The EventRegistry to use, defaults to EVENTS.
+        :param store: The StateStore to use, defaults to statestore.STORE.
+        """
+        self.handler = handler
+        self.factory = factory
+        self.registry = registry if registry is not None else EVENTS
+        self.store = store if store is not None else statestore.STORE
+        self.touched = set()
+        self.lock = threading.Lock()
+        self.registry.caches[handler] = self
+
+    def _restore(self, trigger_id):
+        """
+        :return: True if the TriggerEvent for trigger_id was loaded from the state database into the registry.
+        """
+        if not self.store.enabled:
+            return False
+        state = self.store.load(self.handler, trigger_id)
+        if state is None:
+            return False
+        tevent = self.factory()
+        statestore.set_state(tevent, state)
+        tevent.info('State restored from %s', self.store.filename)
+        self.registry.put(self.handler, trigger_id, tevent, restored=True)
+        return True
+
+    def _touch(self, trigger_id):
+        with self.lock:
+            self.touched.add(trigger_id)
+
+    def __contains__(self, trigger_id):
+        return self.registry.contains(self.handler, trigger_id) or self._restore(trigger_id)
+
+    def __getitem__(self, trigger_id):
+        tevent = self.registry.get(self.handler, trigger_id)
+        if tevent is None and self._restore(trigger_id):
+            tevent = self.registry.get(self.handler, trigger_id)
+        if tevent is None:
+            raise KeyError(trigger_id)
+        self._touch(trigger_id)
+        return tevent
+
+    def __setitem__(self, trigger_id, tevent):
+        self.registry.put(self.handler, trigger_id, tevent)
+        self._touch(trigger_id)
+
+    def __delitem__(self, trigger_id):
+        if self.registry.remove(self.handler, trigger_id) is None:
+            raise KeyError(trigger_id)
+
+    def get(self, trigger_id, default=None):
+        if trigger_id in self:
+            return self[trigger_id]
+        return default
+
+    def items(self):
+        return self.registry.handler_items(self.handler)
+
+    def keys(self):
+        return [tid for tid, tevent in self.items()]
+
+    def values(self):
+        return [tevent for tid, tevent in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.items())
+
+    def flush(self):
+        """
+        Update the registry indexes for every entry looked up or added since the last flush(), and save their state
+        to the state database, if it's enabled.
+        """
+        with self.lock:
+            touched, self.touched = self.touched, set()
+        states = []
+        for trigger_id in touched:
+            tevent = self.registry.update(self.handler, trigger_id)
+            if tevent is not None and self.store.enabled:
+                states.append((trigger_id, statestore.get_state(tevent)))
+        self.store.save(self.handler, states)
+
+
+# The registry used by all the handler modules, configured by the handler daemon
+EVENTS = EventRegistry()
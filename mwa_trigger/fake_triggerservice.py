@@ -0,0 +1,586 @@
+#!/usr/bin/env python
+
+"""
+Stand-in for the on-site 'trigger' web services (busy, vcsfree, obslist, triggerobs, triggervcs and triggerbuffer),
+for offline testing and benchmarking of the trigger front end. Nothing here talks to the real telescope - a simple
+in-memory model of the observing schedule is updated by each trigger request, and the results returned have the
+same structure as those from the real web service (see triggerservice.trigger() for a description).
+
+The response latency, and the rate at which requests fail with an HTTP error, can be configured, to test how the
+rest of the system copes with a slow or unreliable back end.
+
+To run the whole handler daemon against it, start this server, eg:
+
+    python -m mwa_trigger.fake_triggerservice --port 8765 --latency 0.3
+
+and add this to trigger.conf:
+
+    [triggerservice]
+    baseurl = http://localhost:8765/trigger/
+"""
+
+import argparse
+import json
+import logging
+import random
+import sys
+import threading
+import time
+
+if sys.version_info.major == 2:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qsl
+    from urllib import urlencode
+else:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qsl, urlencode
+
+from . import clock
+
+log = logging.getLogger('voevent.fake_triggerservice')
+
+GPS_EPOCH_UNIX = 315964800   # Unix timestamp of the GPS epoch, 1980-01-06 00:00:00 UTC
+GPS_LEAP_SECONDS = 18        # GPS-UTC offset, correct since 2017-01-01
+
+BUFFER_SECONDS = 150   # Seconds of past data held in the VCS memory buffers
+
+ENDPOINTS = ['busy', 'vcsfree', 'obslist', 'triggerobs', 'triggervcs', 'triggerbuffer']
+
+
+def gps_now():
+    """
+    Return the current time from the clock (see clock.py) in GPS seconds.
+
+    :return: float
+    """
+    return clock.now() - GPS_EPOCH_UNIX + GPS_LEAP_SECONDS
+
+
+def to_bool(value):
+    """
+    Convert a value passed in a URL or POST body into a boolean.
+
+    :param value: string (eg 'True', 'false', '1'), boolean, integer or None
+    :return: boolean
+    """
+    if isinstance(value, str):
+        return value.strip().lower() in ['true', '1', 'yes', 't', 'y']
+    return bool(value)
+
+
+class Observation(object):
+    """
+    One observation in the fake schedule.
+    """
+    def __init__(self, starttime=0, stoptime=0, obsname='', creator='', projectid='', mode='HW_LFILES'):
+        self.starttime = int(starttime)  # GPS seconds, always a multiple of 8
+        self.stoptime = int(stoptime)    # GPS seconds, always a multiple of 8
+        self.obsname = obsname
+        self.creator = creator
+        self.projectid = projectid
+        self.mode = mode
+        self.group_id = self.starttime
+
+    def summary(self):
+        """
+        :return: The (starttime, obsname, creator, projectid, mode, group_id) tuple returned by obslist()
+        """
+        return [self.starttime, self.obsname, self.creator, self.projectid, self.mode, self.group_id]
+
+
+class ScheduleModel(object):
+    """
+    In-memory model of the MWA observing schedule, updated by the fake trigger calls.
+    """
+    def __init__(self, filler_project='G0008', filler_length=120, voltage_buffer=False,
+                 vcs_capacity=3600, secure_keys=None, override_projects=None):
+        """
+        :param filler_project: If not None, the schedule is filled with back-to-back ordinary observations from this
+                               project wherever there are no triggered observations.
+        :param filler_length: Length of each of the filler observations, in seconds.
+        :param voltage_buffer: If True, the filler observations are VOLTAGE_BUFFER observations, so that
+                               triggerbuffer() calls can succeed.
+        :param vcs_capacity: Total number of seconds of VCS observations that the voltage capture disks can hold. The
+                             space used by each VCS observation is released when it ends.
+        :param secure_keys: Optional dictionary of project_id:secure_key. If given, trigger requests are checked
+                            against it, otherwise any secure_key is accepted.
+        :param override_projects: Optional list of project IDs that are NOT allowed to be overridden by a trigger.
+        """
+        self.filler_project = filler_project
+        self.filler_length = int(filler_length) // 8 * 8
+        self.voltage_buffer = voltage_buffer
+        self.vcs_capacity = vcs_capacity
+        self.vcs_reserved = []   # (stoptime, seconds) for each VCS observation that hasn't ended yet
+        self.secure_keys = secure_keys
+        self.override_projects = override_projects or []
+        self.observations = []   # Triggered observations, in start time order
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def next_start(now=None):
+        """
+        Triggered observations can't start less than four seconds in the future, and must start on a multiple of 8
+        GPS seconds.
+
+        :param now: Optional time in GPS seconds, defaults to the current time.
+        :return: Start time of a new observation, in GPS seconds.
+        """
+        if now is None:
+            now = gps_now()
+        return (int(now + 4) // 8 + 1) * 8
+
+    def _filler(self, starttime, stoptime):
+        """
+        Return the filler observations in the given time range, skipping any already covered by a triggered
+        observation.
+        """
+        result = []
+        if self.filler_project is None or self.filler_length <= 0:
+            return result
+        if self.voltage_buffer:
+            mode = 'VOLTAGE_BUFFER'
+        else:
+            mode = 'HW_LFILES'
+        t = int(starttime) // self.filler_length * self.filler_length
+        while t < stoptime:
+            if not self._triggered_at(t):
+                # Filler observations are truncated by the start of any following triggered observation
+                stop = min([t + self.filler_length] + [obs.starttime for obs in self.observations
+                                                       if t < obs.starttime < t + self.filler_length])
+                result.append(Observation(starttime=t, stoptime=stop,
+                                          obsname='%s_filler_%d' % (self.filler_project, t),
+                                          creator='fake_triggerservice',
+                                          projectid=self.filler_project,
+                                          mode=mode))
+            t += self.filler_length
+        return result
+
+    def _triggered_at(self, t):
+        for obs in self.observations:
+            if obs.starttime <= t < obs.stoptime:
+                return True
+        return False
+
+    def current(self, obstime=0, now=None):
+        """
+        Return all observations (triggered or filler) that overlap the period from now until obstime seconds in the
+        future, sorted by start time.
+
+        :param obstime: Time range, in seconds.
+        :param now: Optional time in GPS seconds, defaults to the current time.
+        :return: list of Observation objects
+        """
+        if now is None:
+            now = gps_now()
+        stoptime = now + max(int(obstime or 0), 1)
+        with self.lock:
+            obslist = [obs for obs in self.observations if obs.stoptime > now and obs.starttime < stoptime]
+            obslist += self._filler(now, stoptime)
+        obslist.sort(key=lambda o: o.starttime)
+        return obslist
+
+    def busy(self, project_id, obstime):
+        """
+        :return: True if project_id is NOT allowed to override the observations from now until obstime in the future.
+        """
+        for obs in self.current(obstime=obstime):
+            if obs.projectid in self.override_projects:
+                return True
+            if obs.mode == 'VOLTAGE_START' and obs.projectid != project_id:
+                return True   # Ongoing voltage capture observations can't be interrupted
+        return False
+
+    def vcs_used(self, now=None):
+        """
+        Release the VCS space used by observations that have ended.
+
+        :param now: Optional time in GPS seconds, defaults to the current time.
+        :return: The number of seconds of VCS observation in progress or scheduled.
+        """
+        if now is None:
+            now = gps_now()
+        with self.lock:
+            self.vcs_reserved = [(stoptime, seconds) for stoptime, seconds in self.vcs_reserved if stoptime > now]
+            return sum([seconds for stoptime, seconds in self.vcs_reserved])
+
+    def vcsfree(self):
+        """
+        :return: The number of seconds of VCS observation that could be requested now.
+        """
+        with self.lock:
+            return max(int(self.vcs_capacity - self.vcs_used()), 0)
+
+    def check_auth(self, project_id, secure_key):
+        """
+        :return: An error message if the project_id/secure_key pair is invalid, or None if it's OK.
+        """
+        if not project_id:
+            return 'No project_id given'
+        if self.secure_keys is not None and self.secure_keys.get(project_id) != secure_key:
+            return 'Invalid secure_key for project %s' % project_id
+        return None
+
+    def _clear(self, starttime, stoptime):
+        """
+        Truncate or remove any triggered observations in the given period, and return the 'clear' dictionary.
+        """
+        kept = []
+        for obs in self.observations:
+            if obs.stoptime <= starttime or obs.starttime >= stoptime:
+                kept.append(obs)
+            elif obs.starttime < starttime:
+                obs.stoptime = starttime
+                kept.append(obs)
+        self.observations = kept
+        command = 'clear_schedule.py --starttime=%d --stoptime=%d' % (starttime, stoptime)
+        return {'command': command,
+                'retcode': 0,
+                'stdout': 'Cleared schedule from %d to %d' % (starttime, stoptime),
+                'stderr': ''}
+
+    def _error_result(self, params, message):
+        return {'success': False,
+                'errors': {0: message},
+                'params': params,
+                'clear': {},
+                'schedule': {}}
+
+    def trigger(self, params, vcsmode=False):
+        """
+        Handle a triggerobs or triggervcs call.
+
+        :param params: dictionary of all URL and POST parameters passed in the request.
+        :param vcsmode: True if this was a triggervcs call.
+        :return: results dictionary, in the same format as the real web service.
+        """
+        project_id = params.get('project_id')
+        error = self.check_auth(project_id, params.get('secure_key'))
+        if error:
+            return self._error_result(params, error)
+
+        nobs = int(params.get('nobs', 1))
+        exptime = int(float(params.get('exptime', 120))) // 8 * 8
+        calexptime = int(float(params.get('calexptime', 120))) // 8 * 8
+        calibrator = params.get('calibrator')
+        calibrate = (calibrator is not None) and (str(calibrator).lower() not in ['false', '0', 'none', ''])
+        obsname = params.get('obsname', 'Trigger')
+        creator = params.get('creator', '')
+        pretend = to_bool(params.get('pretend', False))
+        if vcsmode:
+            mode = 'VOLTAGE_START'
+        else:
+            mode = 'HW_LFILES'
+
+        total = nobs * exptime
+        if calibrate:
+            total += calexptime
+
+        with self.lock:
+            if self.busy(project_id, total):
+                return self._error_result(params, 'Project %s can not override the current schedule' % project_id)
+            if vcsmode and total > self.vcsfree():
+                return self._error_result(params, 'Not enough free VCS disk space for %d seconds' % total)
+
+            starttime = self.next_start()
+            stoptime = starttime + total
+            new_obs = []
+            t = starttime
+            for i in range(nobs):
+                new_obs.append(Observation(starttime=t, stoptime=t + exptime, obsname=obsname,
+                                           creator=creator, projectid=project_id, mode=mode))
+                t += exptime
+            if calibrate:
+                new_obs.append(Observation(starttime=t, stoptime=t + calexptime, obsname=obsname + '_cal',
+                                           creator=creator, projectid=project_id, mode=mode))
+            group_id = int(params.get('group_id', starttime))
+            for obs in new_obs:
+                obs.group_id = group_id
+
+            params = dict(params)
+            if calibrate and str(calibrator).lower() in ['true', '1']:
+                params['calibrator'] = 'HydA'   # Pretend the web service chose a calibrator for us
+
+            commands = '\n'.join(['single_observation.py --starttime=%d --stoptime=%d --obsname=%s --mode=%s '
+                                  '--project=%s --creator="%s"' % (obs.starttime, obs.stoptime, obs.obsname,
+                                                                  obs.mode, obs.projectid, obs.creator)
+                                  for obs in new_obs])
+            if pretend:
+                clear = {'command': 'clear_schedule.py --starttime=%d --stoptime=%d' % (starttime, stoptime),
+                         'retcode': 0,
+                         'stdout': 'Pretend mode, schedule not cleared',
+                         'stderr': ''}
+            else:
+                clear = self._clear(starttime, stoptime)
+                self.observations.extend(new_obs)
+                self.observations.sort(key=lambda o: o.starttime)
+                if vcsmode:
+                    self.vcs_reserved.append((stoptime, total))
+
+        schedule = {'commands': commands,
+                    'retcode': 0,
+                    'stdout': '%d observation(s) scheduled' % len(new_obs),
+                    'stderr': ''}
+        return {'success': True,
+                'errors': {},
+                'params': params,
+                'clear': clear,
+                'schedule': schedule}
+
+    def triggerbuffer(self, params):
+        """
+        Handle a triggerbuffer call.
+
+        :param params: dictionary of all URL and POST parameters passed in the request.
+        :return: results dictionary, in the same format as the real web service.
+        """
+        project_id = params.get('project_id')
+        error = self.check_auth(project_id, params.get('secure_key'))
+        if error:
+            return self._error_result(params, error)
+        pretend = to_bool(params.get('pretend', False))
+        obstime = int(float(params.get('obstime', 0) or 0))
+
+        now = gps_now()
+        with self.lock:
+            current = self.current(obstime=0, now=now)
+            if not current or current[0].mode not in ['VOLTAGE_BUFFER', 'VOLTAGE_START']:
+                return self._error_result(params, 'No VOLTAGE_BUFFER observation currently scheduled')
+            if obstime > self.vcsfree():
+                return self._error_result(params, 'Not enough free VCS disk space for %d seconds' % obstime)
+
+            starttime = self.next_start(now)
+            stoptime = starttime + obstime // 8 * 8
+            # The observations the buffered data came from, up to the start of the new capture, then the capture
+            first_obsid = int(now - BUFFER_SECONDS) // 8 * 8
+            obsid_list = [obs.starttime for obs in self.current(obstime=starttime - first_obsid, now=first_obsid)
+                          if obs.starttime < starttime]
+            if stoptime > starttime:
+                obsid_list.append(starttime)
+            stop_obs = Observation(starttime=stoptime, stoptime=stoptime + 8, obsname='VOLTAGE_STOP',
+                                   creator=params.get('creator', 'triggerbuffer'), projectid=project_id,
+                                   mode='VOLTAGE_STOP')
+            commands = ('voltage_buffer_dump --start=%s --obstime=%d\n'
+                        'single_observation.py --starttime=%d --stoptime=%d --mode=VOLTAGE_STOP' %
+                        (params.get('start_time', 0), obstime, stop_obs.starttime, stop_obs.stoptime))
+            if pretend:
+                clear = {'command': 'clear_schedule.py --starttime=%d --stoptime=%d' % (starttime, stoptime),
+                         'retcode': 0,
+                         'stdout': 'Pretend mode, schedule not cleared',
+                         'stderr': ''}
+            else:
+                clear = self._clear(starttime, stop_obs.stoptime)
+                capture = Observation(starttime=starttime, stoptime=stoptime, obsname='VOLTAGE_CAPTURE',
+                                      creator=stop_obs.creator, projectid=project_id, mode='VOLTAGE_START')
+                self.observations.extend([obs for obs in [capture, stop_obs] if obs.stoptime > obs.starttime])
+                self.observations.sort(key=lambda o: o.starttime)
+                self.vcs_reserved.append((stoptime, obstime + BUFFER_SECONDS))
+
+        schedule = {'commands': commands,
+                    'retcode': 0,
+                    'stdout': 'Buffer dump triggered',
+                    'stderr': ''}
+        return {'success': True,
+                'errors': {},
+                'params': params,
+                'clear': clear,
+                'schedule': schedule,
+                'obsid_list': obsid_list}
+
+
+class FakeTriggerService(object):
+    """
+    Dispatches requests to the ScheduleModel, adding artificial latency and errors, and keeps call statistics.
+    """
+    def __init__(self, model=None, latency=0.0, jitter=0.0, error_rate=0.0, error_endpoints=None):
+        """
+        :param model: A ScheduleModel instance - a new, default one is created if not given.
+        :param latency: Mean delay, in seconds, added to every request.
+        :param jitter: Standard deviation, in seconds, of a random gaussian component added to the latency.
+        :param error_rate: Probability (0-1) that a request will fail with an HTTP 500 error.
+        :param error_endpoints: Optional list of endpoint names that the error_rate applies to. Defaults to all.
+        """
+        if model is None:
+            model = ScheduleModel()
+        self.model = model
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_endpoints = error_endpoints
+        self.stats = {}
+        self.statslock = threading.Lock()
+
+    def handle(self, endpoint, params):
+        """
+        Process one request.
+
+        :param endpoint: One of the names in ENDPOINTS.
+        :param params: dictionary of all URL and POST parameters passed in the request.
+        :return: A tuple of (HTTP status code, result) where result will be returned to the caller in JSON format.
+        """
+        start = time.time()
+        delay = self.latency
+        if self.jitter:
+            delay += random.gauss(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        if self.error_rate and (self.error_endpoints is None or endpoint in self.error_endpoints):
+            if random.random() < self.error_rate:
+                self._count(endpoint, start, error=True)
+                return 500, 'Injected error from fake_triggerservice'
+
+        if endpoint == 'busy':
+            result = self.model.busy(params.get('project_id'), int(params.get('obstime', 0) or 0))
+        elif endpoint == 'vcsfree':
+            result = self.model.vcsfree()
+        elif endpoint == 'obslist':
+            result = [obs.summary() for obs in self.model.current(obstime=int(params.get('obstime', 0) or 0))]
+        elif endpoint == 'triggerobs':
+            result = self.model.trigger(params, vcsmode=False)
+        elif endpoint == 'triggervcs':
+            result = self.model.trigger(params, vcsmode=True)
+        elif endpoint == 'triggerbuffer':
+            result = self.model.triggerbuffer(params)
+        else:
+            return 404, 'Unknown endpoint %s' % endpoint
+        self._count(endpoint, start)
+        return 200, result
+
+    def _count(self, endpoint, start, error=False):
+        elapsed = time.time() - start
+        with self.statslock:
+            s = self.stats.setdefault(endpoint, {'calls': 0, 'errors': 0, 'total_time': 0.0})
+            s['calls'] += 1
+            s['total_time'] += elapsed
+            if error:
+                s['errors'] += 1
+
+
+class LocalTransport(object):
+    """
+    Pass the calls made by triggerservice.web_api() straight to a FakeTriggerService in this process, instead of
+    over HTTP, eg:
+
+        triggerservice.TRANSPORT = fake_triggerservice.LocalTransport(service)
+
+    The parameters and results are encoded and decoded the same way as they would be over HTTP, so the handlers
+    see exactly what they would from start_server(), without the threads and sockets.
+    """
+    def __init__(self, service=None):
+        """
+        :param service: Optional FakeTriggerService instance, a default one is created if not given.
+        """
+        if service is None:
+            service = FakeTriggerService()
+        self.service = service
+
+    def __call__(self, url='', urldict=None, postdict=None, username=None, password=None, logger=None):
+        endpoint = urlparse(url).path.rstrip('/').split('/')[-1]
+        params = {}
+        for data in [urldict, postdict]:
+            if data:
+                params.update(dict(parse_qsl(urlencode(data))))
+        code, result = self.service.handle(endpoint, params)
+        if code != 200:
+            log.error('Error %d from fake trigger service: %s' % (code, result))
+            return None
+        return json.loads(json.dumps(result))
+
+
+class FakeRequestHandler(BaseHTTPRequestHandler):
+    """
+    Parse the URL and POST parameters for each HTTP request, and pass them on to the FakeTriggerService instance
+    attached to the server.
+    """
+    def _respond(self, params):
+        endpoint = urlparse(self.path).path.rstrip('/').split('/')[-1]
+        service = self.server.service
+        if endpoint == '_stats':
+            code, result = 200, service.stats
+        elif endpoint == '_schedule':
+            with service.model.lock:
+                code, result = 200, [obs.summary() for obs in service.model.observations]
+        else:
+            code, result = service.handle(endpoint, params)
+        data = json.dumps(result).encode('latin-1')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=latin-1')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._respond(dict(parse_qsl(urlparse(self.path).query)))
+
+    def do_POST(self):
+        params = dict(parse_qsl(urlparse(self.path).query))
+        length = int(self.headers.get('Content-Length', 0))
+        if length:
+            body = self.rfile.read(length).decode('latin-1')
+            params.update(dict(parse_qsl(body)))
+        self._respond(params)
+
+    def log_message(self, format, *args):
+        log.debug('%s - %s' % (self.address_string(), format % args))
+
+
+class FakeHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, server_address, service):
+        HTTPServer.__init__(self, server_address, FakeRequestHandler)
+        self.service = service
+
+
+def start_server(host='localhost', port=0, service=None):
+    """
+    Start a fake trigger web service in a background thread.
+
+    :param host: Interface to bind to.
+    :param port: Port number to listen on - zero means choose a free port.
+    :param service: Optional FakeTriggerService instance, a default one is created if not given.
+    :return: A tuple of (server, baseurl), where baseurl can be assigned to triggerservice.BASEURL. Call
+             server.shutdown() to stop the server.
+    """
+    if service is None:
+        service = FakeTriggerService()
+    server = FakeHTTPServer((host, port), service)
+    thread = threading.Thread(target=server.serve_forever, name='FakeTriggerService')
+    thread.daemon = True
+    thread.start()
+    baseurl = 'http://%s:%d/trigger/' % (host, server.server_address[1])
+    return server, baseurl
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a fake MWA trigger web service for offline testing.')
+    parser.add_argument('--host', default='localhost', help='Interface to bind to')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on')
+    parser.add_argument('--latency', type=float, default=0.0, help='Mean response latency, in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Standard deviation of the latency, in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests that fail with HTTP 500')
+    parser.add_argument('--error-endpoints', default=None, help='Comma separated list of endpoints to inject errors on')
+    parser.add_argument('--filler-project', default='G0008', help="Project ID for the background observations, or 'none'")
+    parser.add_argument('--voltage-buffer', action='store_true', help='Background observations are in VOLTAGE_BUFFER mode')
+    parser.add_argument('--vcs-capacity', type=int, default=3600, help='Seconds of VCS data the disks can hold')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG)
+    if args.filler_project.lower() == 'none':
+        args.filler_project = None
+    if args.error_endpoints:
+        args.error_endpoints = args.error_endpoints.split(',')
+
+    model = ScheduleModel(filler_project=args.filler_project,
+                          voltage_buffer=args.voltage_buffer,
+                          vcs_capacity=args.vcs_capacity)
+    service = FakeTriggerService(model=model,
+                                 latency=args.latency,
+                                 jitter=args.jitter,
+                                 error_rate=args.error_rate,
+                                 error_endpoints=args.error_endpoints)
+    server = FakeHTTPServer((args.host, args.port), service)
+    print("Fake trigger service running at http://%s:%d/trigger/" % (args.host, args.port))
+    server.serve_forever()
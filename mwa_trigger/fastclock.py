@@ -0,0 +1,123 @@
+"""
+Cheap UTC and GPS timestamps, for log messages and other places where the time is needed many times per event and
+astropy's Time.now() (which costs tens of microseconds for each .iso or .gps) is too slow.
+
+GPS time is calculated from the clock (see clock.py) using a built-in table of leap seconds. The offset in effect is
+cached, along with the range of times it's valid for, so the table is only searched when a leap second boundary is
+crossed. If astropy's (more up to date) leap second table is available, it can be loaded with refresh_leap_seconds().
+
+The ISO format strings match those from astropy's Time.iso (eg '2021-03-04 05:06:07.890').
+"""
+
+import bisect
+import calendar
+import logging
+import threading
+import time
+
+from . import clock
+
+log = logging.getLogger('voevent.handlers.fastclock')   # Inherit the logging setup from handlers.py
+
+GPS_EPOCH_UNIX = 315964800   # Unix timestamp of the GPS epoch, 1980-01-06 00:00:00 UTC
+
+# Dates (year, month, day) of each leap second since the GPS epoch. GPS-UTC is the number of entries before a time.
+LEAP_DATES = [(1981, 7, 1), (1982, 7, 1), (1983, 7, 1), (1985, 7, 1), (1988, 1, 1), (1990, 1, 1), (1991, 1, 1),
+              (1992, 7, 1), (1993, 7, 1), (1994, 7, 1), (1996, 1, 1), (1997, 7, 1), (1999, 1, 1), (2006, 1, 1),
+              (2009, 1, 1), (2012, 7, 1), (2015, 7, 1), (2017, 1, 1)]
+
+LEAP_TIMES = [calendar.timegm((y, m, d, 0, 0, 0)) for (y, m, d) in LEAP_DATES]
+
+_lock = threading.Lock()
+_offset_cache = (0.0, 0.0, 0)   # (valid_from, valid_until, GPS-UTC offset)
+_iso_cache = (None, '')         # (Unix second, ISO string for that second, without the fraction)
+
+
+def gps_offset(unixtime):
+    """
+    Return the GPS-UTC offset (number of leap seconds since the GPS epoch) at the given time.
+
+    :param unixtime: Time in seconds since the Unix epoch.
+    :return: int
+    """
+    global _offset_cache
+    valid_from, valid_until, offset = _offset_cache
+    if valid_from <= unixtime < valid_until:
+        return offset
+    with _lock:
+        offset = bisect.bisect_right(LEAP_TIMES, unixtime)
+        valid_from = LEAP_TIMES[offset - 1] if offset > 0 else float('-inf')
+        valid_until = LEAP_TIMES[offset] if offset < len(LEAP_TIMES) else float('inf')
+        _offset_cache = (valid_from, valid_until, offset)
+    return offset
+
+
+def gps_seconds(unixtime=None):
+    """
+    Convert a Unix timestamp to GPS seconds.
+
+    :param unixtime: Time in seconds since the Unix epoch, defaults to now.
+    :return: float
+    """
+    if unixtime is None:
+        unixtime = clock.now()
+    return unixtime - GPS_EPOCH_UNIX + gps_offset(unixtime)
+
+
+def unix_from_gps(gpstime):
+    """
+    Convert GPS seconds to a Unix timestamp.
+
+    :param gpstime: Time in GPS seconds.
+    :return: float
+    """
+    unixtime = gpstime + GPS_EPOCH_UNIX
+    return unixtime - gps_offset(unixtime - gps_offset(unixtime))
+
+
+def utc_iso(unixtime=None):
+    """
+    Return a UTC time string in the same format as astropy's Time.iso, to the nearest millisecond.
+
+    :param unixtime: Time in seconds since the Unix epoch, defaults to now.
+    :return: string, eg '2021-03-04 05:06:07.890'
+    """
+    global _iso_cache
+    if unixtime is None:
+        unixtime = clock.now()
+    second = int(unixtime // 1)
+    millis = int(round((unixtime - second) * 1000))
+    if millis == 1000:
+        second, millis = second + 1, 0
+    cached_second, prefix = _iso_cache
+    if cached_second != second:
+        prefix = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(second))
+        _iso_cache = (second, prefix)
+    return '%s.%03d' % (prefix, millis)
+
+
+def refresh_leap_seconds(files=None):
+    """
+    Replace the built-in leap second table with astropy's, which may be more recent. Unless automatic downloads have
+    been turned off (see iersdata.py), astropy may try to download an updated table, so this should only be called at
+    startup, not while handling events.
+
+    :param files: Optional list of leap second files to try first (eg the local copy kept by iersdata.py).
+    :return: True if the table was updated.
+    """
+    global LEAP_TIMES, _offset_cache
+    try:
+        from astropy.utils.iers import LeapSeconds
+        table = LeapSeconds.auto_open(files)
+        times = [calendar.timegm((int(row['year']), int(row['month']), 1, 0, 0, 0))
+                 for row in table if int(row['tai_utc']) > 19]
+    except Exception:
+        log.exception('Could not load the astropy leap second table, using the built-in one')
+        return False
+    if not times or times[:len(LEAP_TIMES)] != LEAP_TIMES[:len(times)]:
+        log.error('Astropy leap second table does not match the built-in one, ignoring it')
+        return False
+    with _lock:
+        LEAP_TIMES = times
+        _offset_cache = (0.0, 0.0, 0)
+    return True
@@ -0,0 +1,496 @@
+"""
+Fast lane for buffered VCS triggers. Every second of delay after a short GRB costs data from the voltage capture
+memory buffers, so events matching one of a small set of pre-declared rules are checked by a dedicated worker thread
+as soon as they are received, and trigger an immediate triggerservice.triggerbuffer() call - without waiting for the
+event queue, the full handler logic, an obslist() call, or the astropy coordinate transforms.
+
+The normal handler still processes the event afterwards, and reconciles its decision with what the fast lane did:
+
+  - If the handler also decides to trigger, in VCS mode, it calls fastlane.claim(trigger_id) and, if the fast lane
+    fired and the capture is still running, sends its own request as a buffered trigger, which extends it.
+
+  - If the handler decides NOT to trigger, the voevent_handler.QueueWorker calls finish() for that event, and the fast
+    lane trigger is marked as 'disputed' and the notification list emailed, so that the operators can decide whether
+    to stop the capture and discard the data. There is no web service call to stop a capture, so nothing is
+    stopped automatically.
+
+The QueueWorker waits (for at most a few seconds) for the fast lane only for events that one of the rules matched,
+so that the handler sees the result of the buffer dump.
+
+A rule's thresholds, project ID, capture time and notification list are read from the handler's own settings (see
+HandlerSetting) each time the rule is used, so that the two always make the same decision.
+
+The alert receipt to buffer dump latency is logged, and emailed, for every fast lane trigger.
+
+Fast lane rules are enabled in the [fastlane] section of trigger.conf, eg:
+
+    [fastlane]
+    enabled = True
+    rules = SWIFT_SHORT_GRB
+"""
+
+import collections
+import importlib
+import logging
+import operator
+import re
+import sys
+import threading
+import time
+import traceback
+
+if sys.version_info.major == 2:
+    import Queue
+else:
+    import queue as Queue
+
+import voeventparse
+
+from . import clock
+from . import handlers
+from . import latency
+from . import prefetch
+from . import tracing
+from . import triggerservice
+
+log = logging.getLogger('voevent.handlers.fastlane')   # Inherit the logging setup from handlers.py
+
+IVORN_RE = re.compile(r'''ivorn\s*=\s*["']([^"']+)["']''')
+
+MATCH_TIMEOUT = 1.0   # Maximum time, in seconds, that the QueueWorker will wait to find out if a rule matched
+WAIT_TIMEOUT = 5.0    # Maximum time, in seconds, that the QueueWorker will wait for a matched event's buffer dump
+FIRED_MAX_AGE = 86400.0   # Forget fast lane triggers this many seconds after they fired
+MAX_LATENCIES = 1000      # Number of recent receipt-to-dump latencies kept
+
+NOTIFY_TEMPLATE = """
+The fast lane %(state)s a voltage buffer dump for trigger %(trigger_id)s (rule %(rule)s).
+
+Event:       %(ivorn)s
+Elevation:   %(alt).1f deg
+Received:    %(received)s UTC
+Latency:     %(latency).3f s from alert receipt to buffer dump response
+Result:      %(success)s
+
+%(comment)s
+"""
+
+OPS = {'==': operator.eq,
+       '!=': operator.ne,
+       '<': operator.lt,
+       '<=': operator.le,
+       '>': operator.gt,
+       '>=': operator.ge}
+
+
+def swift_trigger_id(v):
+    """
+    :param v: VOEvent object
+    :return: The trigger ID used by GRB_fermi_swift for a Swift event.
+    """
+    return "SWIFT_" + v.attrib['ivorn'].split('_')[-1].split('-')[0]
+
+
+class HandlerSetting(object):
+    """
+    A rule parameter taken from a module level setting in a handler module, looked up each time the rule is used,
+    so that the fast lane always agrees with the handler, including after a trigger.conf override or a reload (see
+    hotreload.py).
+    """
+    def __init__(self, module, name, convert=None):
+        """
+        :param module: Full name of the handler module, eg 'mwa_trigger.GRB_fermi_swift'.
+        :param name: Name of the setting in that module, eg 'LONG_SHORT_LIMIT'.
+        :param convert: Optional function applied to the setting, eg to convert minutes to seconds.
+        """
+        self.module = module
+        self.name = name
+        self.convert = convert
+
+    def value(self):
+        module = sys.modules.get(self.module)
+        if module is None:
+            module = importlib.import_module(self.module)   # Handler modules import this one, so not at import time
+        value = getattr(module, self.name)
+        return self.convert(value) if self.convert is not None else value
+
+
+def setting(value):
+    """
+    :return: The current value of a HandlerSetting, or value itself if it's anything else.
+    """
+    if isinstance(value, HandlerSetting):
+        return value.value()
+    return value
+
+
+class FastLaneRule(object):
+    """
+    A pre-declared condition that, if matched by an incoming event, causes an immediate buffered VCS trigger.
+    """
+    def __init__(self, name='', ivorn_prefix='', conditions=None, min_elevation=handlers.HORIZON_LIMIT,
+                 trigger_id=None, project_id='', obstime=900, notify_list=None):
+        """
+        :param name: Name used to enable this rule in trigger.conf.
+        :param ivorn_prefix: The event ivorn must start with this string.
+        :param conditions: List of (param_name, operator, value) tuples, all of which must be true. The value of the
+                           named <Param> is converted to the type of 'value' before comparison.
+        :param min_elevation: Minimum elevation of the event position, in degrees.
+        :param trigger_id: Function that takes a VOEvent object and returns the trigger ID used by the handler.
+        :param project_id: Project ID to trigger as.
+        :param obstime: Number of seconds to keep capturing after the buffer dump.
+        :param notify_list: List of email addresses to send the latency report to.
+
+        Any of the condition values, min_elevation, project_id, obstime and notify_list can be a HandlerSetting, to
+        use the handler's own setting.
+        """
+        self.name = name
+        self.ivorn_prefix = ivorn_prefix
+        self.conditions = conditions or []
+        self._min_elevation = min_elevation
+        self.trigger_id = trigger_id
+        self._project_id = project_id
+        self._obstime = obstime
+        self._notify_list = notify_list
+
+    @property
+    def min_elevation(self):
+        return setting(self._min_elevation)
+
+    @property
+    def project_id(self):
+        return setting(self._project_id)
+
+    @property
+    def obstime(self):
+        return setting(self._obstime)
+
+    @property
+    def notify_list(self):
+        return setting(self._notify_list) or []
+
+    def match(self, v):
+        """
+        Test an event against this rule.
+
+        :param v: VOEvent object
+        :return: A tuple of (matched, alt), where alt is the elevation of the event, or None if it wasn't calculated.
+        """
+        if not v.attrib['ivorn'].startswith(self.ivorn_prefix):
+            return False, None
+        for pname, op, value in self.conditions:
+            value = setting(value)
+            param = v.find(".//Param[@name='%s']" % pname)
+            if param is None:
+                return False, None
+            try:
+                pvalue = type(value)(param.attrib['value'])
+            except ValueError:
+                return False, None
+            if not OPS[op](pvalue, value):
+                return False, None
+        ra, dec, err = handlers.get_position_info(v)
+        alt = handlers.get_altitude_fast(ra, dec)
+        return alt > self.min_elevation, alt
+
+
+# All available rules, enabled by name in trigger.conf
+RULES = {'SWIFT_SHORT_GRB': FastLaneRule(name='SWIFT_SHORT_GRB',
+                                         ivorn_prefix='ivo://nasa.gsfc.gcn/SWIFT#BAT_GRB_Pos',
+                                         conditions=[('GRB_Identified', '==', 'true'),
+                                                     ('StarTrack_Lost_Lock', '!=', 'true'),
+                                                     ('Integ_Time', '<', HandlerSetting('mwa_trigger.GRB_fermi_swift',
+                                                                                        'LONG_SHORT_LIMIT'))],
+                                         trigger_id=swift_trigger_id,
+                                         project_id=HandlerSetting('mwa_trigger.GRB_fermi_swift', 'PROJECT_ID'),
+                                         obstime=HandlerSetting('mwa_trigger.GRB_fermi_swift', 'SWIFT_SHORT_VCS_TIME',
+                                                                convert=lambda minutes: minutes * 60),
+                                         notify_list=HandlerSetting('mwa_trigger.GRB_fermi_swift', 'NOTIFY_LIST'))
+         }
+
+
+class FastLaneRecord(object):
+    """
+    What the fast lane did with one event.
+    """
+    def __init__(self, ivorn='', received=None):
+        self.ivorn = ivorn
+        self.received = received   # Unix timestamp when the event was received by the daemon
+        self.rule = None           # Name of the matching rule, or None if no rules matched
+        self.trigger_id = None
+        self.alt = None
+        self.fired = None          # Unix timestamp when triggerbuffer() returned, or None if not fired
+        self.obstime = 0           # Seconds the capture runs for after the buffer dump
+        self.result = None         # Result dictionary from triggerbuffer()
+        self.state = 'pending'     # One of pending, ignored, fired, failed, extended or disputed
+        self.trace_id = tracing.get_trace_id()   # Trace ID of the event
+        self.matched = threading.Event()   # Set once the rules have been checked
+        self.done = threading.Event()
+
+    @property
+    def capturing(self):
+        """True if the fast lane fired for this event, and the capture it started should still be running."""
+        return (self.fired is not None) and (clock.now() < self.fired + self.obstime)
+
+    @property
+    def latency(self):
+        """Seconds from alert receipt to the buffer dump response, or None if the fast lane didn't fire."""
+        if self.fired is None:
+            return None
+        return self.fired - self.received
+
+
+class FastLane(object):
+    """
+    Dedicated worker thread that checks each incoming event against the enabled rules, and fires triggerbuffer()
+    immediately for matching events.
+    """
+    def __init__(self, rules=None, pretend=False, logger=log):
+        """
+        :param rules: List of FastLaneRule objects to check events against.
+        :param pretend: Boolean, True if we don't want to actually trigger the buffer dump.
+        :param logger: optional logger object.
+        """
+        self.rules = rules or []
+        self.pretend = pretend
+        self.logger = logger
+        self.queue = Queue.Queue()
+        self.records = {}        # FastLaneRecord objects, by ivorn
+        self.fired = {}          # FastLaneRecord objects, by trigger_id, for the events that caused a buffer dump
+        self.latencies = collections.deque(maxlen=MAX_LATENCIES)   # recent receipt-to-dump latencies
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        """
+        Start the worker thread.
+        """
+        self.thread = threading.Thread(target=self.run, name='FastLane')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def is_alive(self):
+        return (self.thread is not None) and self.thread.is_alive()
+
+    def submit(self, eventxml, received=None):
+        """
+        Called from the RPC thread as each event arrives - returns immediately.
+
+        :param eventxml: string containing XML format VOEvent.
+        :param received: Unix timestamp when the event was received.
+        """
+        if received is None:
+            received = clock.now()
+        match = IVORN_RE.search(eventxml[:4096])
+        if match is None:
+            return
+        ivorn = match.group(1)
+        if not [rule for rule in self.rules if ivorn.startswith(rule.ivorn_prefix)]:
+            return   # Don't make the QueueWorker wait for events that can't match
+        record = FastLaneRecord(ivorn=ivorn, received=received)
+        with self.lock:
+            if ivorn in self.records:
+                return
+            self.records[ivorn] = record
+        self.queue.put((eventxml, record))
+
+    def run(self):
+        """
+        Worker thread loop, processes events from the fast lane queue.
+        """
+        while True:
+            eventxml, record = self.queue.get()
+            try:
+                with tracing.trace_context(record.trace_id), tracing.span('fastlane', ivorn=record.ivorn) as sp:
+                    self.process(eventxml, record)
+                    sp.set(state=record.state, rule=record.rule)
+            except Exception:
+                record.state = 'failed'
+                self.logger.error('Exception in fast lane: %s' % traceback.format_exc())
+            finally:
+                record.matched.set()
+                record.done.set()
+
+    def process(self, eventxml, record):
+        """
+        Check one event against the rules, and trigger a buffer dump if one matches.
+        """
+        if sys.version_info.major == 2:
+            v = voeventparse.loads(str(eventxml))
+        else:
+            v = voeventparse.loads(eventxml.encode('latin-1'))
+
+        for rule in self.rules:
+            matched, alt = rule.match(v)
+            if matched:
+                break
+        else:
+            record.state = 'ignored'
+            record.matched.set()
+            return
+
+        record.trigger_id = rule.trigger_id(v)
+        record.alt = alt
+        with self.lock:
+            if record.trigger_id in self.fired:
+                self.logger.info('Fast lane already fired for %s, ignoring %s' % (record.trigger_id, record.ivorn))
+                record.state = 'ignored'
+                record.matched.set()
+                return
+        record.rule = rule.name
+        record.obstime = rule.obstime
+        record.matched.set()   # The QueueWorker now waits for the buffer dump
+
+        self.logger.info('Fast lane rule %s matched %s (alt=%.1f), triggering buffer dump' % (rule.name,
+                                                                                              record.ivorn,
+                                                                                              alt))
+        result = triggerservice.triggerbuffer(project_id=rule.project_id,
+                                              secure_key=handlers.get_secure_key(rule.project_id),
+                                              pretend=self.pretend,
+                                              obstime=rule.obstime,
+                                              logger=self.logger)
+        record.fired = clock.now()
+        record.result = result
+        if not self.pretend:
+            prefetch.invalidate()
+        latency.record(v=v,
+                       outcome='fastlane' if (result is not None) and result.get('success') else 'fastlane_failed',
+                       decided=record.fired,
+                       trigger_id=record.trigger_id)
+        if result is not None and result.get('success'):
+            record.state = 'fired'
+            with self.lock:
+                self.prune()
+                self.fired[record.trigger_id] = record
+                self.latencies.append(record.latency)
+        else:
+            record.state = 'failed'
+        self.logger.info('Fast lane %s for %s: %.3f s from receipt to buffer dump' % (record.state,
+                                                                                      record.trigger_id,
+                                                                                      record.latency))
+        try:
+            self.notify(rule, record)
+        except Exception:
+            self.logger.error('Unable to send fast lane notification: %s' % traceback.format_exc())
+
+    def prune(self, max_age=FIRED_MAX_AGE):
+        """
+        Forget the fast lane triggers that fired more than max_age seconds ago. Called with the lock held.
+        """
+        cutoff = clock.now() - max_age
+        for trigger_id in [t for t, record in self.fired.items() if record.fired < cutoff]:
+            del self.fired[trigger_id]
+
+    def notify(self, rule, record, comment=''):
+        """
+        Email the rule's notification list with the state and latency of a fast lane trigger.
+        """
+        if record.result is None:
+            success = 'No response from trigger web service'
+        else:
+            success = record.result.get('success')
+        handlers.queue_email(from_address='mwa@telemetry.mwa128t.org',
+                             to_addresses=rule.notify_list,
+                             subject='Fast lane %s for trigger %s' % (record.state, record.trigger_id),
+                             msg_text=NOTIFY_TEMPLATE % {'state': record.state,
+                                                         'trigger_id': record.trigger_id,
+                                                         'rule': rule.name,
+                                                         'ivorn': record.ivorn,
+                                                         'alt': record.alt,
+                                                         'received': time.strftime('%Y-%m-%d %H:%M:%S',
+                                                                                   time.gmtime(record.received)),
+                                                         'latency': record.latency,
+                                                         'success': success,
+                                                         'comment': comment},
+                             logger=self.logger)
+
+    def wait(self, ivorn, timeout=WAIT_TIMEOUT, match_timeout=MATCH_TIMEOUT):
+        """
+        Called by the QueueWorker before the full handler logic runs, so that the handler sees the result of any fast
+        lane trigger for this event. Only events that matched a rule wait for the buffer dump.
+
+        :param ivorn: ivorn of the event about to be processed.
+        :param timeout: maximum time to wait for the buffer dump, in seconds.
+        :param match_timeout: maximum time to wait to find out if a rule matched, in seconds.
+        :return: The FastLaneRecord for this event, or None if the fast lane never saw it.
+        """
+        with self.lock:
+            record = self.records.get(ivorn)
+        if record is None:
+            return None
+        if not record.matched.wait(match_timeout):
+            self.logger.error('Timed out waiting for the fast lane to check %s' % ivorn)
+        elif record.rule is not None and not record.done.wait(timeout):
+            self.logger.error('Timed out waiting for fast lane buffer dump for %s' % ivorn)
+        return record
+
+    def finish(self, ivorn):
+        """
+        Called by the QueueWorker after all handlers have run on an event. If the fast lane fired for this event, but
+        no handler claimed it, the full decision logic didn't agree with the fast lane, so the trigger is marked as
+        disputed and the notify list emailed, for the operators to decide whether to stop the capture.
+
+        :param ivorn: ivorn of the event just processed.
+        """
+        with self.lock:
+            record = self.records.pop(ivorn, None)
+        if record is None or record.state != 'fired':
+            return
+        record.state = 'disputed'
+        self.logger.warning('Full handler logic did not trigger on %s - fast lane buffer dump disputed' % ivorn)
+        rule = RULES.get(record.rule)
+        if rule is not None:
+            self.notify(rule, record, comment='The full handler logic decided NOT to trigger on this event. The '
+                                              'voltage capture has NOT been stopped - stop it and discard the data '
+                                              'if it is not wanted.')
+
+
+# The fast lane instance used by the handler daemon, created with start_fastlane()
+FASTLANE = None
+
+
+def start_fastlane(pretend=False, logger=log):
+    """
+    Create and start the fast lane worker, if enabled in trigger.conf.
+
+    :param pretend: Boolean, True if we don't want to actually trigger the buffer dump.
+    :param logger: optional logger object.
+    :return: The FastLane object, or None if the fast lane isn't enabled.
+    """
+    global FASTLANE
+    if not (handlers.CP.has_option(section='fastlane', option='enabled') and
+            handlers.CP.getboolean('fastlane', 'enabled')):
+        return None
+    names = []
+    if handlers.CP.has_option(section='fastlane', option='rules'):
+        names = [n.strip() for n in handlers.CP.get(section='fastlane', option='rules').split(',') if n.strip()]
+    rules = []
+    for name in names:
+        if name in RULES:
+            rules.append(RULES[name])
+        else:
+            logger.error('Unknown fast lane rule %s in trigger.conf' % name)
+    if not rules:
+        return None
+    FASTLANE = FastLane(rules=rules, pretend=pretend, logger=logger)
+    FASTLANE.start()
+    logger.info('Fast lane started with rules: %s' % ', '.join([r.name for r in rules]))
+    return FASTLANE
+
+
+def claim(trigger_id):
+    """
+    Called by a handler that has decided to trigger on an event, to find out if the fast lane has triggered a buffer
+    dump for it whose capture is still running. If so, the record is marked as 'extended', and the handler should make
+    this one trigger a buffered one, to extend the capture under way.
+
+    :param trigger_id: The trigger ID as used by the handler (and the fast lane rule).
+    :return: The FastLaneRecord if the fast lane capture for this trigger is still running, or None.
+    """
+    if FASTLANE is None:
+        return None
+    with FASTLANE.lock:
+        record = FASTLANE.fired.get(trigger_id)
+    if record is not None and record.state in ['fired', 'extended'] and record.capturing:
+        record.state = 'extended'
+        return record
+    return None
@@ -9,31 +9,34 @@ inside the processevent() function, to save time.
 __version__ = "0.3.1"
 __author__ = ["Paul Hancock", "Andrew Williams", "Gemma Anderson"]
 
+import array
+import math
 import os
 import sys
+import zlib
 
 if sys.version_info.major == 2:
     from ConfigParser import SafeConfigParser as conparser
 else:
     from configparser import ConfigParser as conparser
 
-import smtplib
-
-from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
-from email.mime.text import MIMEText
-from email.utils import formatdate
-if sys.version_info.major == 2:
-    from email.Encoders import encode_base64
-else:
-    from email.encoders import encode_base64
-
 import logging
 
 import astropy
 from astropy.coordinates import SkyCoord, EarthLocation
-from astropy.time import Time
 
+import voeventparse
+
+from . import clock
+from . import decisions
+from . import journal
+from . import latency
+from . import metrics
+from . import notify
+from . import outbox
+from . import prefetch
+from . import sideeffects
+from . import tracing
 from . import triggerservice
 
 log = logging.getLogger('voevent.handlers')  # Inherit the logging setup from voevent_handler.py
@@ -51,11 +54,21 @@ if CP.has_option(section='mail', option='mailhost'):
     MAILHOST = CP.get(section='mail', option='mailhost')
 else:
     MAILHOST = 'cerberus'    # Using cerberus will only work for computers inside the MWA network, on-site.
+outbox.OUTBOX.mailhost = MAILHOST
 
 # position of the observer
 MWAPOS = EarthLocation.from_geodetic(lon="116:40:14.93",
                                      lat="-26:42:11.95",
                                      height=377.8)
+MWA_LAT_RAD = math.radians(MWAPOS.lat.deg)   # EarthLocation converts to geodetic on every access, so cache these
+MWA_LON_DEG = MWAPOS.lon.deg
+
+
+EVENT_COMPRESSION = 6   # zlib compression level for the VOEvents stored in each TriggerEvent
+
+TRIGGERS = metrics.REGISTRY.counter('voevent_triggers_total',
+                                    'Trigger decisions that reached trigger_observation(), by outcome',
+                                    ['project_id', 'outcome'])
 
 
 EMAIL_FOOTER_TEMPLATE = """
@@ -71,7 +84,21 @@ class TriggerEvent(object):
     Class to encapsulate a single trigger event. It can include multiple VOEvent structures,
     stored in the .events attribute, so long as those VOEvents all refer to the same underlying
     physical event (eg, updates with better positions).
+
+    Many of these are kept in memory for a long time, so the attributes are slots, the positions are kept in
+    arrays of floats, and the VOEvents are stored as zlib compressed XML, only decompressed (with get_event_xml()
+    or get_event()) when they're needed.
     """
+    __slots__ = ['ra', 'dec', 'err', 'triggered', 'trigger_id', 'events', 'ivorns', 'trace_ids', 'first_trig_time',
+                 'last_trig_type', 'journal', 'logger', 'freqspecs', 'avoidsun', 'inttime', 'freqres', 'exptime',
+                 'calibrator', 'calexptime', 'vcsmode', 'buffered']
+
+    # Attributes saved by statestore.py, so they survive a restart - subclasses can add their own. The events, ivorns
+    # and trace_ids lists go together, one entry per VOEvent, so none of them are saved.
+    PERSISTED_ATTRIBUTES = ['trigger_id', 'ra', 'dec', 'err', 'triggered', 'first_trig_time', 'last_trig_type',
+                            'freqspecs', 'avoidsun', 'inttime', 'freqres', 'exptime', 'calibrator', 'calexptime',
+                            'vcsmode', 'buffered']
+
     def __init__(self, event=None, logger=log):
         """
         Create a new trigger event and initialise attributes.
@@ -79,16 +106,18 @@ class TriggerEvent(object):
         :param event: string containing XML format VOEvent.
         :param logger: optional logger object to use for log messages associated with this event.
         """
-        # ra,dec and err are lists of all the position values, with the most recent (and presumably best) last.
-        self.ra = []   # list of RAs in J2000 degrees, most recent last.
-        self.dec = []  # List of DECs in J2000 degrees, most recent last.
-        self.err = []  # List of position error radii, in J2000 degrees, most recent last.
+        # ra,dec and err are arrays of all the position values, with the most recent (and presumably best) last.
+        self.ra = array.array('d')   # RAs in J2000 degrees, most recent last.
+        self.dec = array.array('d')  # DECs in J2000 degrees, most recent last.
+        self.err = array.array('d')  # Position error radii, in J2000 degrees, most recent last.
         self.triggered = False  # True if this event has ever been triggered (generated MWA observations)
         self.trigger_id = ''  # the id for this event as it appears in the observing schedule
-        self.events = []  # a list of all the voevent XML strings, most recent last.
+        self.events = []  # a list of all the voevents, as zlib compressed XML, most recent last.
+        self.ivorns = []  # a list of the ivorns of those voevents, most recent last.
+        self.trace_ids = []  # a list of the trace IDs of those voevents, most recent last.
         self.first_trig_time = None  # when was the TriggerEvent first triggered
         self.last_trig_type = None  # Arbitrary string storing the reason for the last trigger.
-        self.loglist = []   # List of log messages associated with this trigger event.
+        self.journal = journal.Journal()   # Log messages associated with this trigger event.
         self.logger = logger  # Logger object to use for log messages associated with this event.
 
         # default observing parameters to be passed to triggerservice.trigger
@@ -105,15 +134,67 @@ class TriggerEvent(object):
         self.info('Event created')
         self.add_event(event)
 
+    @property
+    def loglist(self):
+        """
+        List of formatted log messages associated with this trigger event, oldest first.
+        """
+        return self.journal.lines()
+
+    def array_bytes(self):
+        """
+        Memory used by any large arrays (eg skymaps) a subclass keeps, in bytes, for the event registry's size estimate
+        (see eventregistry.py). The VOEvents, positions and journal are counted by the registry itself.
+        """
+        return 0
+
+    def since_last_trigger(self):
+        """
+        Return the formatted log messages since this event last generated an observation (or all of them, if it
+        never has), as one string.
+        """
+        return self.journal.text(self.journal.since_mark('trigger'))
+
     def add_event(self, event):
         """
-        Add an XML event string to the .events list for this event.
+        Add a VOEvent to the .events list for this event, compressed.
 
-        :param event: string containing XML format VOEvent.
+        :param event: A parsed VOEvent object, or a string containing XML format VOEvent.
         """
         if event is not None:
-            self.info('New VOEvent added')
-            self.events.append(event)
+            trace_id = tracing.get_trace_id()
+            self.info('New VOEvent added, trace ID %s', trace_id)
+            if isinstance(event, bytes):
+                xml = event
+            elif hasattr(event, 'encode'):
+                xml = event.encode('latin-1')
+            else:
+                xml = voeventparse.dumps(event)
+            self.events.append(zlib.compress(xml, EVENT_COMPRESSION))
+            self.ivorns.append(event.attrib['ivorn'] if hasattr(event, 'attrib') else None)
+            self.trace_ids.append(trace_id)
+
+    def get_event_xml(self, index=-1):
+        """
+        Return one of the VOEvents for this event as an XML string. By default, the most recent is returned.
+
+        :param index: The list index to return, satisying normal Python list indexing rules. Default of -1
+        :return: string containing XML format VOEvent, or None if there aren't that many.
+        """
+        if len(self.events) < abs(index):
+            return None
+        return zlib.decompress(self.events[index]).decode('latin-1')
+
+    def get_event(self, index=-1):
+        """
+        Return one of the VOEvents for this event, parsed. By default, the most recent is returned.
+
+        :param index: The list index to return, satisying normal Python list indexing rules. Default of -1
+        :return: A parsed VOEvent object, or None if there aren't that many.
+        """
+        if len(self.events) < abs(index):
+            return None
+        return voeventparse.loads(zlib.decompress(self.events[index]))
 
     def add_pos(self, pos):
         """
@@ -178,30 +259,23 @@ class TriggerEvent(object):
         # This is the *first* trigger time so only update it once
         if self.first_trig_time is None:
             self.info('First trigger sent')
-            self.first_trig_time = Time.now()
+            self.first_trig_time = clock.astropy_now()
         else:
             self.info('Subsequent trigger sent')
         self.last_trig_type = ttype
 
         if time_min < 2:
             self.debug("Requested time is <2 min. Not triggering")
+            decisions.reason('too_short', trigger_id=self.trigger_id)
+            TRIGGERS.labels(project_id=project_id, outcome='too_short').inc()
             return
 
-        # set up the target, observer, and time
-        ra, dec, err = self.get_pos()   # Find the most recent coordinates added to this event.
-        obs_source = SkyCoord(ra=ra,
-                              dec=dec,
-                              equinox='J2000',
-                              unit=(astropy.units.deg, astropy.units.deg))
-        obs_source.location = MWAPOS
-        t = Time.now()
-        t.delta_ut1_utc = 0   # Prevent automatic IERS data download
-        obs_source.obstime = t
-
         # figure out the altitude of the target
-        obs_source_altaz = obs_source.transform_to('altaz')
-        alt = obs_source_altaz.alt.deg
+        ra, dec, err = self.get_pos()   # Find the most recent coordinates added to this event.
+        t = clock.astropy_now()
+        alt = get_altitude(ra, dec, obstime=t)
         self.debug("Triggered observation at an elevation of {0}".format(alt))
+        decisions.param(alt=alt)
 
         # Determine the number and duration of observations
         if self.vcsmode:
@@ -220,24 +294,51 @@ class TriggerEvent(object):
         # trigger if we are above the horizon limit
         if alt > HORIZON_LIMIT:
             self.info("Triggering at gps time %d ..." % (t.gps,))
-            result = triggerservice.trigger(project_id=project_id, secure_key=secure_key,
-                                            group_id=group_id,
-                                            pretend=pretend,
-                                            ra=ra, dec=dec,
-                                            creator=crstring,
-                                            obsname=obsname, nobs=nobs,
-                                            freqspecs=self.freqspecs,
-                                            avoidsun=self.avoidsun,
-                                            inttime=self.inttime, freqres=self.freqres,
-                                            exptime=exptime,
-                                            calibrator=self.calibrator, calexptime=self.calexptime,
-                                            vcsmode=self.vcsmode,
-                                            buffered=self.buffered,
-                                            logger=self)
+            with tracing.span('trigger', trigger_id=self.trigger_id, project_id=project_id):
+                result = triggerservice.trigger(project_id=project_id, secure_key=secure_key,
+                                                group_id=group_id,
+                                                pretend=pretend,
+                                                ra=ra, dec=dec,
+                                                creator=crstring,
+                                                obsname=obsname, nobs=nobs,
+                                                freqspecs=self.freqspecs,
+                                                avoidsun=self.avoidsun,
+                                                inttime=self.inttime, freqres=self.freqres,
+                                                exptime=exptime,
+                                                calibrator=self.calibrator, calexptime=self.calexptime,
+                                                vcsmode=self.vcsmode,
+                                                buffered=self.buffered,
+                                                logger=self)
+            accepted = clock.now()
+            self.journal.mark('trigger')
+            if not pretend:
+                prefetch.invalidate()   # Any pre-fetched copies of the schedule are now out of date
             # self.debug("Response: {0}".format(result))
+            sideeffects.audit({'type': 'trigger',
+                               'trigger_id': self.trigger_id,
+                               'trace_id': tracing.get_trace_id(),
+                               'obsname': obsname,
+                               'ttype': ttype,
+                               'project_id': project_id,
+                               'pretend': pretend,
+                               'ra': ra,
+                               'dec': dec,
+                               'alt': alt,
+                               'nobs': nobs,
+                               'exptime': exptime,
+                               'vcsmode': self.vcsmode,
+                               'buffered': self.buffered,
+                               'success': (result is not None) and result.get('success'),
+                               'errors': (result is not None) and result.get('errors')})
+            latency.record(eventxml=voevent or self.get_event_xml(),
+                           outcome='trigger' if (result is not None) and result.get('success') else 'trigger_failed',
+                           decided=accepted,
+                           trigger_id=self.trigger_id)
             if result is None:
                 self.error("Trigger Service Error: triggerservice.trigger() returned None")
+                TRIGGERS.labels(project_id=project_id, outcome='error').inc()
                 return
+            TRIGGERS.labels(project_id=project_id, outcome='success' if result['success'] else 'failure').inc()
             if email_tolist:
                 if result['success']:
                     success_string = "SUCCESS - observation inserted into MWA schedule"
@@ -259,48 +360,50 @@ class TriggerEvent(object):
                                                                                       result['clear']['stdout'],
                                                                                       result['clear']['stderr'])
                     attachments.append(('clear_%s.txt' % self.trigger_id, clear_data, 'text/plain'))
-                log_data = '\n'.join([str(x) for x in self.loglist])
+                log_data = self.journal.text()
                 attachments.append(('log_%s.txt' % self.trigger_id, log_data, 'text/plain'))
                 attachments.append(('voevent.xml', voevent, 'text/xml'))
 
-                send_email(from_address='mwa@telemetry.mwa128t.org',
-                           to_addresses=email_tolist,
-                           subject=email_subject,
-                           msg_text=email_text + email_footer,
-                           attachments=attachments)
+                queue_email(from_address='mwa@telemetry.mwa128t.org',
+                            to_addresses=email_tolist,
+                            subject=email_subject,
+                            msg_text=email_text + email_footer,
+                            attachments=attachments)
 
             return result
         else:
             self.debug("not triggering due to horizon limit: alt {0} < {1}".format(alt, HORIZON_LIMIT))
+            decisions.reason('below_horizon', trigger_id=self.trigger_id)
+            TRIGGERS.labels(project_id=project_id, outcome='below_horizon').inc()
             return
 
-    def log(self, level=logging.DEBUG, msg=''):
+    def log(self, level=logging.DEBUG, msg='', *args):
         """
         Wrapper function, so log messages passed to this object by calling the debug, info, warning, error and critical
-        methods can be caught and saved in a 'loglist' attribute, then passed on to the logger object for handling.
+        methods can be caught and saved in the 'journal' attribute, then passed on to the logger object for handling.
 
         :param level: One of logging.DEBUG, logging.INFO, etc.
-        :param msg: string containing the full log message.
+        :param msg: string containing the log message, or a template to be formatted with args using the % operator.
+        :param args: Optional arguments for the message template. The message is only formatted when it's needed.
         :return: None
         """
-        self.logger.log(level=level, msg=msg)
-        now = Time.now()
-        self.loglist.append("%s=(%d): %s" % (now.iso, int(now.gps), msg))
+        self.logger.log(level, msg, *args)
+        self.journal.append(level, msg, args)
 
-    def debug(self, msg=''):
-        self.log(level=logging.DEBUG, msg=msg)
+    def debug(self, msg='', *args):
+        self.log(logging.DEBUG, msg, *args)
 
-    def info(self, msg=''):
-        self.log(level=logging.INFO, msg=msg)
+    def info(self, msg='', *args):
+        self.log(logging.INFO, msg, *args)
 
-    def warning(self, msg=''):
-        self.log(level=logging.WARNING, msg=msg)
+    def warning(self, msg='', *args):
+        self.log(logging.WARNING, msg, *args)
 
-    def error(self, msg=''):
-        self.log(level=logging.ERROR, msg=msg)
+    def error(self, msg='', *args):
+        self.log(logging.ERROR, msg, *args)
 
-    def critical(self, msg=''):
-        self.log(level=logging.CRITICAL, msg=msg)
+    def critical(self, msg='', *args):
+        self.log(logging.CRITICAL, msg, *args)
 
 
 def get_position_info(v):
@@ -317,24 +420,95 @@ def get_position_info(v):
     return ra, dec, err
 
 
-def get_secure_key(project_id):
+def get_altitude(ra, dec, obstime=None):
+    """
+    Return the elevation of a J2000 position as seen from the MWA, using the full astropy coordinate transform.
+
+    :param ra: J2000 RA in degrees.
+    :param dec: J2000 Dec in degrees.
+    :param obstime: astropy Time object, defaults to now.
+    :return: Elevation in degrees.
+    """
+    obs_source = SkyCoord(ra=ra,
+                          dec=dec,
+                          equinox='J2000',
+                          unit=(astropy.units.deg, astropy.units.deg))
+    obs_source.location = MWAPOS
+    if obstime is None:
+        obstime = clock.astropy_now()
+    obstime.delta_ut1_utc = 0   # Prevent automatic IERS data download
+    obs_source.obstime = obstime
+    return obs_source.transform_to('altaz').alt.deg
+
+
+def get_altitude_fast(ra, dec, unixtime=None):
+    """
+    Return the elevation of a J2000 position as seen from the MWA, using the simple GMST formula instead of the
+    astropy coordinate machinery. It ignores precession, nutation and refraction, so it's only good to about half
+    a degree, but takes microseconds instead of tens of milliseconds. Use it for quick horizon checks where latency
+    matters, not for pointing.
+
+    :param ra: J2000 RA in degrees.
+    :param dec: J2000 Dec in degrees.
+    :param unixtime: Time as a Unix timestamp, defaults to now.
+    :return: Elevation in degrees.
+    """
+    if unixtime is None:
+        unixtime = clock.now()
+    jd = unixtime / 86400.0 + 2440587.5
+    gmst = (280.46061837 + 360.98564736629 * (jd - 2451545.0)) % 360.0
+    lat = MWA_LAT_RAD
+    hour_angle = math.radians(gmst + MWA_LON_DEG - ra)
+    dec = math.radians(dec)
+    sinalt = math.sin(dec) * math.sin(lat) + math.cos(dec) * math.cos(lat) * math.cos(hour_angle)
+    return math.degrees(math.asin(sinalt))
+
+
+def get_secure_key(project_id, cp=None):
     """
     Look up the supplied project ID in the configuration file, to find the matching password
 
     :param project_id: Project ID string, eg C001
+    :param cp: optional ConfigParser object to look in, instead of the trigger.conf contents read at startup
     :return: password associated with that project ID
     """
-    if CP.has_option(section='auth', option=project_id):
-        return CP.get(section='auth', option=project_id)
+    if cp is None:
+        cp = CP
+    if cp.has_option(section='auth', option=project_id):
+        return cp.get(section='auth', option=project_id)
     else:
         return ''
 
 
-def send_email(from_address='', to_addresses=None, msg_text='', subject='', attachments=None, logger=log):
+def queue_email(**kwargs):
+    """
+    Queue an email to be built and sent by the side effect pipeline's background workers, and return immediately.
+    Takes the same arguments as send_email().
+    """
+    sideeffects.submit('email', send_email, **kwargs)
+
+
+def debug_notify(trigger_id=None, **kwargs):
+    """
+    Add a debug notification (eg, the reason for not triggering on an event) to the digest for this trigger ID, to be
+    sent as one email with any other debug notifications for the same trigger (see notify.py). Takes the same
+    arguments as send_email(), plus the trigger ID. Don't use this for trigger notifications, which must not be delayed.
+
+    :param trigger_id: The trigger ID the message is about, or None to collect messages by subject line.
+    :param log_text: Optional log messages for the trigger, attached once to the digest rather than to every message.
+    """
+    kwargs.pop('logger', None)
+    notify.AGGREGATOR.add(trigger_id=trigger_id, **kwargs)
+
+
+def send_email(from_address='', to_addresses=None, msg_text='', subject='', attachments=None, batch=False, logger=log):
     """
     Sends an email to the given address list, with the supplied message text. An optional list of attachments
     can be provided as well, to keep the main email concise.
 
+    Once the outbox (outbox.OUTBOX) has been started, the message is queued and this function returns immediately,
+    otherwise the email is sent before it returns.
+
     :param from_address: string containing the email address that the message is sent from.
     :param to_addresses: list of strings containing destination email addresses, or a string containing one address
     :param msg_text: A string containing the full text of the message to send.
@@ -343,61 +517,22 @@ def send_email(from_address='', to_addresses=None, msg_text='', subject='', atta
                             -filename is the name the attachment will be saved as on the client, not a local file name.
                             -payload is the entire content of the attachment (a PNG image, zip file, etc)
                             -mimetype is the type string, and defaults to 'text/plain' if omitted from the tuple
+    :param batch: If True, the outbox may combine this email with others to the same recipients (see outbox.py).
+                  Trigger notifications are never batched.
     :param logger: An optional logger object to use for logging messages, instead of the default logger.
-    :return:
+    :return: False if the email could not be queued (or sent), True otherwise.
     """
-    if attachments is None:
-        attachments = []
-
     if not to_addresses:
         logger.error('Must specify a list of email addresses to send the email to.')
         return False
 
-    msg = MIMEMultipart()
-    msg['From'] = from_address
-    msg['To'] = ', '.join(to_addresses)
-    msg['Date'] = formatdate(localtime=True)
-    msg['Subject'] = subject
-    msg.attach(MIMEText(msg_text))
-
-    for attachspec in attachments:
-        if type(attachspec) != tuple:
-            logger.error('attachments must be a tuple of (filename, payload, mimetype), where payload is the file contents.')
-            return False
-
-        try:
-            if len(attachspec) == 2:
-                filename, payload = attachspec
-                if filename.endswith('.xml'):
-                    mimetype = 'text/xml'
-                else:
-                    mimetype = 'text/plain'
-            else:
-                filename, payload, mimetype = attachspec
+    if isinstance(to_addresses, str):
+        to_addresses = [to_addresses]
 
-            if mimetype:
-                mimemain, mimesub = mimetype.split('/')
-            else:
-                mimemain = 'text'
-                mimesub = 'plain'
-        except ValueError:
-            logger.error('attachments must be a tuple of (filename, payload, mimetype), where payload is the file contents.')
-            return False
-
-        part = MIMEBase(mimemain, mimesub)
-        part.set_payload(payload)
-        encode_base64(part)
-        part.add_header('Content-Disposition', 'attachment; filename="%s"' % os.path.basename(filename))
-        msg.attach(part)
-
-    smtp = None
-    try:
-        smtp = smtplib.SMTP(MAILHOST)
-        errordict = smtp.sendmail(from_address, to_addresses, msg.as_string())
-        for destaddress, sending_error in errordict.items():
-            logger.error('Error sending email to %s: %s' % (destaddress, sending_error))
-    except smtplib.SMTPException:
-        logger.error('Email could not be sent:')
-    finally:
-        if smtp is not None:
-            smtp.close()
+    return outbox.OUTBOX.send(from_address=from_address,
+                              to_addresses=to_addresses,
+                              subject=subject,
+                              msg_text=msg_text,
+                              attachments=attachments,
+                              batch=batch,
+                              logger=logger)
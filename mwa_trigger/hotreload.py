@@ -0,0 +1,318 @@
+"""
+Hot reload of the handler modules and their settings, so that changing a threshold or a NOTIFY_LIST doesn't need a
+restart of voevent_handler.py (which drops the Pyro connection for 15 seconds, and re-imports astropy, healpy, etc).
+
+Any module level setting in a handler module (an upper case name with a number, string, boolean or list value, eg
+FERMI_POBABILITY_THRESHOLD or NOTIFY_LIST) can be overridden in trigger.conf, in a section named after the module:
+
+    [GRB_fermi_swift]
+    fermi_pobability_threshold = 60
+    notify_list = Paul.Hancock@curtin.edu.au, Andrew.Williams@curtin.edu.au
+
+Values are converted to the type of the setting in the module, and lists are comma separated. A setting removed
+from trigger.conf goes back to the value in the module source on the next reload. The settings shared by all the
+handlers (eg HORIZON_LIMIT) go in a [handlers] section - handlers.py itself is never re-imported, as every handler
+module depends on it.
+
+Values worked out from other settings (SECURE_KEY, from PROJECT_ID and the [auth] section) can't be set directly -
+they're recomputed from the new settings and trigger.conf on every reload. The values of secrets (any name containing
+KEY, PASSWORD, SECRET or TOKEN) are never logged, or returned by the RPC calls.
+
+A reload (SIGHUP, or the reloadHandlers() RPC call) re-reads trigger.conf, and optionally re-imports the handler
+modules in place. Either everything changes or nothing does - all the settings are parsed and checked before any are
+applied, and if re-importing any module fails, all the modules are put back as they were. The handler daemon holds
+LOCK while the handlers run on each event, so a reload happens between events, and events that arrive during a
+reload wait in the EventQueue.
+
+The TriggerEvents for each handler live in the event registry (eventregistry.py), not in the module, so they survive
+a re-import. Each one is re-created as an instance of the re-imported TriggerEvent subclass, with all its attributes
+(positions, VOEvents, journal, etc) carried over.
+
+The speculative pre-fetch (prefetch.py) and fast lane (fastlane.py) read their settings at startup, so changes to
+those still need a restart.
+"""
+
+import copy
+import logging
+import re
+import sys
+import threading
+import time
+import traceback
+
+if sys.version_info.major == 2:
+    from ConfigParser import SafeConfigParser as conparser
+    reload_module = reload
+else:
+    from configparser import ConfigParser as conparser
+    from importlib import reload as reload_module
+
+from . import eventregistry
+from . import handlers
+
+log = logging.getLogger('voevent.handlers.hotreload')   # Inherit the logging setup from handlers.py
+
+SETTING_TYPES = (bool, int, float, str, list, tuple)   # Types of module level value that can be set in trigger.conf
+TRUE_VALUES = ['1', 'yes', 'true', 'on']
+FALSE_VALUES = ['0', 'no', 'false', 'off']
+
+# Module level values worked out from the settings, recomputed from the module (after its settings have been applied)
+# and the new trigger.conf contents on every reload, instead of being settings themselves
+DERIVED = {'SECURE_KEY': lambda module, cp: handlers.get_secure_key(module.PROJECT_ID, cp=cp)}
+
+# Upper case module level values that aren't settings
+EXCLUDED = ['CPPATH', 'MWA_LAT_RAD', 'MWA_LON_DEG']
+
+SECRET_RE = re.compile(r'KEY|PASSWORD|SECRET|TOKEN')   # Names of values that must never be logged or returned
+HIDDEN = '<hidden>'
+
+# Held by the QueueWorker while the handlers run on an event, and by reload(), so that they never overlap
+LOCK = threading.RLock()
+
+
+def module_settings(module):
+    """
+    :param module: A handler module.
+    :return: A dictionary of the module level settings in the module that can be overridden in trigger.conf.
+    """
+    result = {}
+    for name, value in vars(module).items():
+        if name in DERIVED or name in EXCLUDED:
+            continue
+        if name.isupper() and not name.startswith('_') and isinstance(value, SETTING_TYPES):
+            result[name] = value
+    return result
+
+
+def hide_secrets(settings):
+    """
+    :param settings: A dictionary of setting name to value (or to a tuple of old and new values).
+    :return: A copy of the dictionary, with the value of every secret replaced by HIDDEN.
+    """
+    result = {}
+    for name, value in settings.items():
+        if SECRET_RE.search(name):
+            value = (HIDDEN, HIDDEN) if isinstance(value, tuple) and len(value) == 2 else HIDDEN
+        result[name] = value
+    return result
+
+
+def convert(default, text):
+    """
+    Convert a value from trigger.conf to the type of the default value for the setting.
+
+    :param default: The value in the module source.
+    :param text: The string from trigger.conf.
+    :return: The converted value.
+    :raises ValueError: if the text can't be converted.
+    """
+    if isinstance(default, bool):
+        if text.strip().lower() in TRUE_VALUES:
+            return True
+        elif text.strip().lower() in FALSE_VALUES:
+            return False
+        raise ValueError('Not a boolean: %r' % text)
+    elif isinstance(default, (int, float)):
+        return type(default)(text.strip())
+    elif isinstance(default, (list, tuple)):
+        itemtype = type(default[0]) if default and isinstance(default[0], (int, float)) else str
+        items = [itemtype(item.strip()) for item in text.split(',') if item.strip()]
+        return type(default)(items)
+    return text
+
+
+def _slot_names(cls):
+    names = []
+    for klass in cls.__mro__:
+        slots = getattr(klass, '__slots__', [])
+        if isinstance(slots, str):
+            slots = [slots]
+        names += [name for name in slots if name not in names]
+    return names
+
+
+def rebuild(tevent, template):
+    """
+    Re-create a TriggerEvent as an instance of the class of template (a new TriggerEvent from the re-imported module),
+    with all of its attributes. Attributes that the new class has and the old one didn't are copied from template.
+
+    :return: The new TriggerEvent.
+    """
+    cls = type(template)
+    new = cls.__new__(cls)
+    for name in _slot_names(cls):
+        if hasattr(tevent, name):
+            setattr(new, name, getattr(tevent, name))
+        elif hasattr(template, name):
+            setattr(new, name, copy.deepcopy(getattr(template, name)))
+    return new
+
+
+class HandlerReloader(object):
+    """
+    Applies the handler settings from trigger.conf, and re-imports handler modules, keeping a record of the compiled-in
+    defaults, so that removing a setting from trigger.conf restores the default.
+    """
+    def __init__(self, cppath=None, registry=None, logger=log):
+        """
+        :param cppath: List of trigger.conf paths to read, defaults to handlers.CPPATH.
+        :param registry: The EventRegistry holding the handlers' TriggerEvents, defaults to eventregistry.EVENTS.
+        :param logger: optional logger object.
+        """
+        self.cppath = cppath if cppath is not None else handlers.CPPATH
+        self.registry = registry if registry is not None else eventregistry.EVENTS
+        self.logger = logger
+        self.defaults = {}    # Compiled-in settings by module name, captured before any are overridden
+        self.overrides = {}   # Settings from trigger.conf currently in effect, by module name
+        self.reloads = 0
+        self.last = None      # Result of the most recent reload()
+
+    def _defaults(self, module):
+        name = module.__name__.split('.')[-1]
+        if name not in self.defaults:
+            self.defaults[name] = module_settings(module)
+        return self.defaults[name]
+
+    def parse(self, modules, cp):
+        """
+        Work out the value of every setting in each module, from trigger.conf or the module default.
+
+        :param modules: List of handler modules.
+        :param cp: ConfigParser instance, with trigger.conf read.
+        :return: A tuple of (settings, overrides, errors). settings is a dictionary of module name to a dictionary of
+                 every setting's new value, overrides has only the ones from trigger.conf, and errors is a list of
+                 strings, one for each unknown or invalid setting.
+        """
+        settings, overrides, errors = {}, {}, []
+        for module in modules:
+            name = module.__name__.split('.')[-1]
+            defaults = self._defaults(module)
+            settings[name] = dict(defaults)
+            overrides[name] = {}
+            if not cp.has_section(name):
+                continue
+            for option in cp.options(name):
+                attr = option.upper()
+                if attr not in defaults:
+                    errors.append('[%s] %s: no such setting in %s' % (name, option, module.__name__))
+                    continue
+                try:
+                    value = convert(defaults[attr], cp.get(name, option, raw=True))
+                except ValueError as error:
+                    errors.append('[%s] %s: %s' % (name, option, 'invalid value' if SECRET_RE.search(attr) else error))
+                    continue
+                settings[name][attr] = overrides[name][attr] = value
+        return settings, overrides, errors
+
+    def reload(self, modules, reimport=False, shared=None):
+        """
+        Re-read trigger.conf, and apply the settings for each handler module, after re-importing the modules if
+        reimport is True. Nothing is changed if any setting is invalid or any module fails to import.
+
+        :param modules: List of handler modules.
+        :param reimport: If True, re-import the modules in place, and re-create their TriggerEvents.
+        :param shared: Optional list of other modules (eg handlers) to apply settings to, that are never re-imported.
+        :return: A dictionary with 'ok', the names of the modules 'reimported', the settings 'changed' (as a dictionary
+                 of module name to a dictionary of setting name to (old value, new value), with secrets hidden, and
+                 including any DERIVED values that changed), the number of
+                 TriggerEvents 'rebuilt', any 'errors', and the 'seconds' taken.
+        """
+        start = time.time()
+        result = {'ok': False, 'reimported': [], 'changed': {}, 'rebuilt': 0, 'errors': [], 'seconds': 0.0}
+        cp = conparser()
+        cp.read(self.cppath)
+        allmodules = modules + list(shared or [])
+        with LOCK:
+            before = dict([(m.__name__.split('.')[-1], module_settings(m)) for m in allmodules])
+            derived = dict([(m.__name__.split('.')[-1], dict([(attr, getattr(m, attr)) for attr in DERIVED
+                                                              if hasattr(m, attr)]))
+                            for m in allmodules])
+            if reimport:
+                saved = dict([(m.__name__, dict(vars(m))) for m in modules])
+                defaults = dict(self.defaults)
+                try:
+                    for module in modules:
+                        reload_module(module)
+                        self.defaults[module.__name__.split('.')[-1]] = module_settings(module)
+                except Exception:
+                    result['errors'].append(traceback.format_exc())
+                    self._restore(modules, saved)
+                    self.defaults = defaults
+            if not result['errors']:
+                settings, overrides, errors = self.parse(allmodules, cp)
+                result['errors'] += errors
+                if reimport and errors:
+                    self._restore(modules, saved)
+                    self.defaults = defaults
+            if not result['errors']:
+                for module in allmodules:
+                    name = module.__name__.split('.')[-1]
+                    for attr, value in settings[name].items():
+                        setattr(module, attr, value)
+                        if before[name].get(attr) != value:
+                            result['changed'].setdefault(name, {})[attr] = (before[name].get(attr), value)
+                    for attr, func in DERIVED.items():
+                        if hasattr(module, attr):
+                            value = func(module, cp)
+                            setattr(module, attr, value)
+                            if derived[name].get(attr) != value:
+                                result['changed'].setdefault(name, {})[attr] = (derived[name].get(attr), value)
+                    if name in result['changed']:
+                        result['changed'][name] = hide_secrets(result['changed'][name])
+                self.overrides = overrides
+                if reimport:
+                    result['reimported'] = [m.__name__ for m in modules]
+                    result['rebuilt'] = self._rebuild(modules)
+                result['ok'] = True
+            self.reloads += 1
+        result['seconds'] = time.time() - start
+        if result['ok']:
+            self.logger.info('Handler settings reloaded in %.2f s (re-imported: %s, %d trigger events rebuilt): %s' %
+                             (result['seconds'], ', '.join(result['reimported']) or 'none', result['rebuilt'],
+                              result['changed'] or 'no changes'))
+        else:
+            self.logger.error('Handler reload failed, nothing changed: %s' % '\n'.join(result['errors']))
+        self.last = result
+        return result
+
+    def _restore(self, modules, saved):
+        """
+        Put the modules back as they were before a failed re-import, including their xml_cache in the registry.
+        """
+        for module in modules:
+            namespace, name = vars(module), module.__name__
+            namespace.clear()
+            namespace.update(saved[name])
+            cache = namespace.get('xml_cache')
+            if isinstance(cache, eventregistry.HandlerCache):
+                cache.registry.caches[cache.handler] = cache
+
+    def _rebuild(self, modules):
+        """
+        Re-create each module's TriggerEvents in the registry as instances of the re-imported class.
+
+        :return: The number of TriggerEvents re-created.
+        """
+        count = 0
+        for module in modules:
+            cache = getattr(module, 'xml_cache', None)
+            if not isinstance(cache, eventregistry.HandlerCache):
+                continue
+            template = cache.factory()
+            for trigger_id, tevent in self.registry.handler_items(cache.handler):
+                if self.registry.replace(cache.handler, trigger_id, rebuild(tevent, template)):
+                    count += 1
+        return count
+
+    def status(self):
+        """
+        :return: A dictionary with the settings from trigger.conf currently in effect, the number of reloads, and the
+                 result of the last one.
+        """
+        return {'overrides': dict([(name, hide_secrets(values)) for name, values in self.overrides.items()]),
+                'reloads': self.reloads,
+                'last': self.last}
+
+
+# The reloader used by the handler daemon
+RELOADER = HandlerReloader()
@@ -0,0 +1,233 @@
+"""
+Local copies of the IERS Earth orientation table (finals2000A.all) and leap second table (Leap_Second.dat) used by
+astropy, so that handling an alert never waits for a download.
+
+By default, astropy downloads a new IERS-A table the first time it needs Earth orientation data (eg for polar
+motion, in SkyCoord.transform_to('altaz')) for a time past the end of the table it has, or if that table is more
+than 30 days old, and a new leap second table when its copy expires - so the download happens in the middle of
+handling an event, and the event waits for it, however slow or unreachable the IERS servers are.
+
+The handler daemon calls configure() at startup (and again on a SIGHUP), which turns astropy's automatic
+downloads off, and loads the tables from the directory given as 'directory' in the [iers] section of trigger.conf
+(default data/iers/ in this repository). If there are no tables there, the ones bundled with astropy are used.
+Times past the end of the table use the last values in it, with a warning, instead of failing. The leap second
+table is also loaded into fastclock.py, which timestamps the log messages.
+
+The local copies are created, and should be refreshed regularly (eg weekly, from cron), with:
+
+    python -m mwa_trigger.iersdata refresh [--directory /var/lib/mwa/iers]
+
+Each file is downloaded to a temporary name, checked by reading it with astropy, and only then renamed into place,
+so a failed or partial download never replaces a good table. On a machine with no internet access, use
+'refresh --from-astropy' to copy the tables bundled with the installed astropy instead. 'status' prints the age of
+each local table, and how far ahead its predictions go.
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import time
+
+if sys.version_info.major == 2:
+    from urllib2 import urlopen, URLError
+else:
+    from urllib.request import urlopen
+    from urllib.error import URLError
+
+try:
+    import erfa
+except ImportError:
+    from astropy import _erfa as erfa
+
+from astropy.time import Time
+from astropy.utils import iers
+
+from . import fastclock
+
+log = logging.getLogger('voevent.handlers.iersdata')   # Inherit the logging setup from handlers.py
+
+DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'iers')
+IERS_A_NAME = 'finals2000A.all'
+LEAP_SECOND_NAME = 'Leap_Second.dat'
+
+# Where refresh() downloads the tables from, in order of preference
+IERS_A_URLS = [iers.IERS_A_URL, iers.IERS_A_URL_MIRROR]
+LEAP_SECOND_URLS = [iers.IERS_LEAP_SECOND_URL, iers.conf.ietf_leap_second_auto_url]
+
+DOWNLOAD_TIMEOUT = 60    # Seconds to wait for each download
+WARN_PREDICTION_DAYS = 60   # Warn if the IERS-A predictions end less than this many days from now
+
+# What configure() loaded, for status()
+LOADED = {}
+
+
+def _iers_a_info(table):
+    """
+    :return: A dictionary with the last MJD in an IERS-A table, and the last MJD of measured (not predicted) values.
+    """
+    info = {'last_mjd': float(table['MJD'][-1].value)}
+    if table.meta and 'predictive_mjd' in table.meta:
+        info['measured_until_mjd'] = float(table.meta['predictive_mjd'])
+    return info
+
+
+def configure(directory=None, logger=log):
+    """
+    Stop astropy from downloading anything, and load the local IERS-A and leap second tables, if there are any.
+
+    :param directory: Directory holding the tables, defaults to DIRECTORY.
+    :param logger: optional logger object.
+    :return: A dictionary describing the tables in use (see status()).
+    """
+    if directory is None:
+        directory = DIRECTORY
+    iers.conf.auto_download = False
+    if hasattr(iers.conf, 'iers_degraded_accuracy'):
+        iers.conf.iers_degraded_accuracy = 'warn'   # Use the end of the table, rather than raise, past its range
+
+    loaded = {'directory': directory, 'auto_download': False, 'loaded': time.time()}
+    iers_a = os.path.join(directory, IERS_A_NAME)
+    if os.path.exists(iers_a):
+        try:
+            table = iers.IERS_A.open(iers_a)
+        except Exception:
+            logger.exception('Could not read %s, using the IERS table bundled with astropy' % iers_a)
+        else:
+            if hasattr(iers, 'earth_orientation_table'):
+                iers.earth_orientation_table.set(table)
+            else:
+                iers.IERS_Auto.iers_table = table
+            loaded['iers_a'] = dict(_iers_a_info(table), file=iers_a, mtime=os.path.getmtime(iers_a))
+    if 'iers_a' not in loaded:
+        loaded['iers_a'] = dict(_iers_a_info(iers.IERS_Auto.open()), file='astropy')
+
+    leap = os.path.join(directory, LEAP_SECOND_NAME)
+    if os.path.exists(leap):
+        try:
+            table = iers.LeapSeconds.open(leap)
+            erfa.leap_seconds.update(table)
+        except Exception:
+            logger.exception('Could not read %s, using the leap second table bundled with astropy' % leap)
+        else:
+            loaded['leap_seconds'] = {'file': leap, 'mtime': os.path.getmtime(leap),
+                                      'expires': float(table.expires.unix)}
+    if 'leap_seconds' not in loaded:
+        table = iers.LeapSeconds.auto_open()   # Only looks at local files, with auto_download off
+        erfa.leap_seconds.update(table)
+        loaded['leap_seconds'] = {'file': 'astropy', 'expires': float(table.expires.unix)}
+    fastclock.refresh_leap_seconds(files=[leap] if loaded['leap_seconds']['file'] == leap else None)
+
+    now_mjd = Time(time.time(), format='unix').mjd
+    if loaded['iers_a']['last_mjd'] - now_mjd < WARN_PREDICTION_DAYS:
+        logger.warning('IERS table (%s) ends in %.0f days - run "python -m mwa_trigger.iersdata refresh"' %
+                       (loaded['iers_a']['file'], loaded['iers_a']['last_mjd'] - now_mjd))
+    if loaded['leap_seconds']['expires'] < time.time():
+        logger.warning('Leap second table (%s) has expired - run "python -m mwa_trigger.iersdata refresh"' %
+                       loaded['leap_seconds']['file'])
+    logger.info('Using IERS table %s and leap second table %s, with automatic downloads off' %
+                (loaded['iers_a']['file'], loaded['leap_seconds']['file']))
+    LOADED.clear()
+    LOADED.update(loaded)
+    return loaded
+
+
+def status():
+    """
+    :return: A dictionary with the directory the tables were loaded from, the file each table was read from ('astropy'
+             for the bundled one), the last MJD in the IERS-A table, and when the leap second table expires.
+    """
+    return dict(LOADED)
+
+
+def _download(urls, check, filename, timeout=DOWNLOAD_TIMEOUT, logger=log):
+    """
+    Download the first of the urls that works, check it, and rename it to filename.
+
+    :param check: Function that reads a file and raises an exception if it isn't valid.
+    :return: The URL downloaded, or None if none of them worked.
+    """
+    tmpname = filename + '.tmp'
+    for url in urls:
+        try:
+            response = urlopen(url, timeout=timeout)
+            with open(tmpname, 'wb') as f:
+                shutil.copyfileobj(response, f)
+            check(tmpname)
+        except (URLError, IOError, OSError, ValueError) as error:
+            logger.error('Could not download %s: %s' % (url, error))
+            continue
+        except Exception:
+            logger.exception('Downloaded %s, but could not read it' % url)
+            continue
+        os.rename(tmpname, filename)
+        return url
+    if os.path.exists(tmpname):
+        os.remove(tmpname)
+    return None
+
+
+def refresh(directory=None, from_astropy=False, timeout=DOWNLOAD_TIMEOUT, logger=log):
+    """
+    Replace the local copies of the IERS-A and leap second tables with new ones.
+
+    :param directory: Directory to write the tables to, defaults to DIRECTORY.
+    :param from_astropy: If True, copy the tables bundled with astropy instead of downloading them.
+    :param timeout: Seconds to wait for each download.
+    :param logger: optional logger object.
+    :return: True if both tables were replaced.
+    """
+    if directory is None:
+        directory = DIRECTORY
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    ok = True
+    for name, urls, bundled, check in [(IERS_A_NAME, IERS_A_URLS, iers.IERS_A_FILE, iers.IERS_A.open),
+                                       (LEAP_SECOND_NAME, LEAP_SECOND_URLS, iers.IERS_LEAP_SECOND_FILE,
+                                        iers.LeapSeconds.open)]:
+        filename = os.path.join(directory, name)
+        if from_astropy:
+            urls = ['file://' + os.path.abspath(bundled)]
+        source = _download(urls, check, filename, timeout=timeout, logger=logger)
+        if source is None:
+            logger.error('Kept the existing %s' % filename if os.path.exists(filename) else 'No %s' % filename)
+            ok = False
+        else:
+            logger.info('Updated %s from %s' % (filename, source))
+    return ok
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Refresh, or show the status of, the local IERS and leap second tables.')
+    parser.add_argument('command', choices=['refresh', 'status'], help='refresh the tables, or show their status')
+    parser.add_argument('--directory', default=DIRECTORY, help='Directory for the tables, default %(default)s')
+    parser.add_argument('--from-astropy', action='store_true',
+                        help='Copy the tables bundled with astropy, instead of downloading them')
+    parser.add_argument('--timeout', type=float, default=DOWNLOAD_TIMEOUT, help='Seconds to wait for each download')
+    args = parser.parse_args(args)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    if args.command == 'refresh':
+        if not refresh(args.directory, from_astropy=args.from_astropy, timeout=args.timeout):
+            sys.exit(1)
+        return
+    info = configure(args.directory)
+    now = time.time()
+    now_mjd = Time(now, format='unix').mjd
+    iers_a, leap = info['iers_a'], info['leap_seconds']
+    print('IERS-A table:       %s' % iers_a['file'])
+    if 'mtime' in iers_a:
+        print('    age:            %.1f days' % ((now - iers_a['mtime']) / 86400.0))
+    if 'measured_until_mjd' in iers_a:
+        print('    measured until: %s' % Time(iers_a['measured_until_mjd'], format='mjd').iso[:10])
+    print('    predicted until: %s (%.0f days from now)' % (Time(iers_a['last_mjd'], format='mjd').iso[:10],
+                                                           iers_a['last_mjd'] - now_mjd))
+    print('Leap second table:  %s' % leap['file'])
+    if 'mtime' in leap:
+        print('    age:            %.1f days' % ((now - leap['mtime']) / 86400.0))
+    print('    expires:        %s' % Time(leap['expires'], format='unix').iso[:10])
+
+
+if __name__ == '__main__':
+    main()
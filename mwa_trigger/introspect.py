@@ -0,0 +1,142 @@
+"""
+Runtime introspection of the long running handler daemon - thread stacks, the size of the handler caches, process
+memory use, and (if it has been started) a tracemalloc snapshot of the top allocation sites - for diagnosing memory
+growth and stalls without restarting the daemon or attaching a debugger.
+
+These functions are called by the read-only RPC methods on VOEventHandler in voevent_handler.py, and everything they
+return is made of plain lists, dictionaries, strings and numbers, so it can be sent with any Pyro4 serializer.
+"""
+
+import gc
+import logging
+import sys
+import threading
+import traceback
+
+try:
+    import tracemalloc
+except ImportError:   # Python 2
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:   # Windows
+    resource = None
+
+log = logging.getLogger('voevent.handlers.introspect')   # Inherit the logging setup from handlers.py
+
+TRACEMALLOC_FRAMES = 10   # Number of stack frames to record for each allocation
+
+
+def thread_stacks():
+    """
+    :return: A dictionary of thread name (with the thread ID, as names can repeat) to a list of strings, one for each
+             stack frame, innermost last.
+    """
+    names = dict([(t.ident, t.name) for t in threading.enumerate()])
+    result = {}
+    for ident, frame in sys._current_frames().items():
+        name = '%s (%d)' % (names.get(ident, 'unknown'), ident)
+        result[name] = [line.rstrip() for line in traceback.format_stack(frame)]
+    return result
+
+
+def rss_bytes():
+    """
+    :return: The resident set size of this process in bytes, or the peak RSS if the current value isn't available,
+             or None.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    if resource is not None:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            return maxrss   # In bytes on MacOS, kilobytes elsewhere
+        return maxrss * 1024
+    return None
+
+
+def cache_sizes(modules):
+    """
+    :param modules: A list of handler modules.
+    :return: A dictionary of module name to a dictionary containing the number of TriggerEvent objects in that
+             module's xml_cache, the total number of VOEvents and log messages they hold, and the total size of the
+             compressed VOEvents in bytes.
+    """
+    result = {}
+    for module in modules:
+        cache = getattr(module, 'xml_cache', None)
+        if cache is None:
+            continue
+        events = list(cache.values())   # Copy, as the QueueWorker may add to it while we're counting
+        result[module.__name__.split('.')[-1]] = {'entries': len(events),
+                                                  'voevents': sum([len(e.events) for e in events]),
+                                                  'voevent_bytes': sum([sum([len(x) for x in e.events]) for e in events]),
+                                                  'log_messages': sum([len(e.journal) for e in events])}
+    return result
+
+
+def start_tracemalloc(nframes=TRACEMALLOC_FRAMES):
+    """
+    Start tracing memory allocations. This slows down every allocation, so only leave it running while diagnosing a
+    problem.
+
+    :param nframes: Number of stack frames to record for each allocation.
+    :return: True if tracing was started (or was already running).
+    """
+    if tracemalloc is None:
+        return False
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(nframes)
+        log.warning('Started tracemalloc, with %d frames' % nframes)
+    return True
+
+
+def stop_tracemalloc():
+    """
+    Stop tracing memory allocations, and free the trace data.
+    """
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        tracemalloc.stop()
+        log.warning('Stopped tracemalloc')
+
+
+def top_allocations(limit=20, key_type='lineno'):
+    """
+    Take a tracemalloc snapshot, and return the allocation sites using the most memory.
+
+    :param limit: Number of allocation sites to return.
+    :param key_type: 'lineno', 'filename' or 'traceback', as for tracemalloc.Snapshot.statistics().
+    :return: A list of dictionaries with the size in bytes, number of blocks and location (a list of 'file:line'
+             strings, innermost last) of each site, largest first, or None if tracemalloc isn't running.
+    """
+    if tracemalloc is None or not tracemalloc.is_tracing():
+        return None
+    snapshot = tracemalloc.take_snapshot()
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                       tracemalloc.Filter(False, '<frozen importlib._bootstrap>')])
+    result = []
+    for stat in snapshot.statistics(key_type)[:limit]:
+        result.append({'size': stat.size,
+                       'count': stat.count,
+                       'traceback': ['%s:%d' % (frame.filename, frame.lineno) for frame in stat.traceback]})
+    return result
+
+
+def memory_status():
+    """
+    :return: A dictionary containing the process RSS in bytes, the number of threads, the number of objects tracked
+             by the garbage collector, and the memory traced by tracemalloc (if it's running).
+    """
+    result = {'rss': rss_bytes(),
+              'threads': threading.active_count(),
+              'gc_objects': len(gc.get_objects()),
+              'tracemalloc': tracemalloc is not None and tracemalloc.is_tracing()}
+    if result['tracemalloc']:
+        result['traced_current'], result['traced_peak'] = tracemalloc.get_traced_memory()
+    return result
@@ -0,0 +1,103 @@
+"""
+Bounded, structured log of the messages associated with one trigger event. Each message is stored as a
+(timestamp, level, template, args) tuple in a ring buffer, and only formatted into a string when it's needed for an
+email or a dump, instead of every message being formatted (with an astropy timestamp) when it's logged, and kept
+forever.
+
+Named marks (eg 'trigger', set each time the event generates an observation) record a point in the journal, so that
+the messages since then can be retrieved.
+"""
+
+import collections
+import logging
+
+from . import clock
+from . import fastclock
+
+JOURNAL_LENGTH = 500   # Maximum number of messages kept for each trigger event
+
+
+class Journal(object):
+    """
+    Ring buffer of log messages.
+    """
+    def __init__(self, maxlen=JOURNAL_LENGTH):
+        """
+        :param maxlen: Maximum number of messages to keep - once full, the oldest messages are discarded.
+        """
+        self.entries = collections.deque(maxlen=maxlen)
+        self.dropped = 0   # Number of messages discarded because the buffer was full
+        self.marks = {}
+
+    def append(self, level, template, args=(), timestamp=None):
+        """
+        Add a message to the journal.
+
+        :param level: One of logging.DEBUG, logging.INFO, etc.
+        :param template: The message string, or a template to be formatted with args using the % operator.
+        :param args: Tuple of arguments for the template.
+        :param timestamp: Time of the message, in seconds since the Unix epoch. Defaults to now.
+        """
+        if timestamp is None:
+            timestamp = clock.now()
+        if len(self.entries) == self.entries.maxlen:
+            self.dropped += 1
+        self.entries.append((timestamp, level, template, args))
+
+    def mark(self, name, timestamp=None):
+        """
+        Record the current time under the given name (eg 'trigger'), for use with since_mark().
+        """
+        if timestamp is None:
+            timestamp = clock.now()
+        self.marks[name] = timestamp
+
+    @staticmethod
+    def format_entry(entry):
+        """
+        Format one journal entry in the same way as the log file, eg '2021-03-04 05:06:07.890=(1298873185): message'
+        """
+        timestamp, level, template, args = entry
+        if args:
+            try:
+                msg = template % args
+            except (TypeError, ValueError):
+                msg = '%s %s' % (template, args)
+        else:
+            msg = template
+        return "%s=(%d): %s" % (fastclock.utc_iso(timestamp), int(fastclock.gps_seconds(timestamp)), msg)
+
+    def since(self, timestamp=None, level=logging.NOTSET):
+        """
+        Return the entries at or after the given time, and at or above the given level.
+
+        :param timestamp: Time in seconds since the Unix epoch, or None for all entries.
+        :param level: Minimum level, eg logging.INFO
+        :return: list of (timestamp, level, template, args) tuples
+        """
+        return [e for e in self.entries if (timestamp is None or e[0] >= timestamp) and e[1] >= level]
+
+    def since_mark(self, name, level=logging.NOTSET):
+        """
+        Return the entries at or after the named mark, or all the entries if that mark hasn't been set.
+        """
+        return self.since(self.marks.get(name), level=level)
+
+    def lines(self, entries=None):
+        """
+        Format the given entries (default all of them) as a list of strings.
+        """
+        if entries is None:
+            entries = list(self.entries)
+            if self.dropped:
+                return ['(%d earlier messages discarded)' % self.dropped] + [self.format_entry(e) for e in entries]
+        return [self.format_entry(e) for e in entries]
+
+    def text(self, entries=None):
+        """
+        Format the given entries (default all of them) as one string, with one message per line.
+        """
+        return '\n'.join(self.lines(entries))
+
+    def __len__(self):
+        return len(self.entries)
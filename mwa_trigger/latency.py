@@ -0,0 +1,302 @@
+"""
+Alert-to-trigger latency ledger. For every decision made about a VOEvent - a trigger request accepted (or refused)
+by the web service, a fast lane buffer dump, or a decision not to trigger - this records:
+
+    event_latency  - seconds from the instrument event (the WhereWhen ISOTime) to the decision
+    notice_latency - seconds from the notice being issued (the Who Date) to the decision
+
+Rolling percentiles of both are kept for each source (Swift, Fermi, LVC, IceCube, Antares, MAXI), separately for
+accepted triggers and for all decisions, and are available from status(). Each accepted trigger is checked against
+the service level objective (SLO) for its source - the maximum number of seconds from notice to accepted trigger -
+and a breach is logged as an error, counted, and (if an alert list is configured) emailed as a debug notification.
+
+The records themselves are written (as one JSON object per line) to the ledger file, if one is configured, and
+to the columnar decision ledger (see decisions.py), with the reason the handler gave for its decision.
+"""
+
+import calendar
+import collections
+import json
+import logging
+import re
+import threading
+
+import voeventparse
+
+from . import clock
+from . import decisions
+from . import metrics
+from . import notify
+from . import sideeffects
+from . import tracing
+
+log = logging.getLogger('voevent.handlers.latency')   # Inherit the logging setup from handlers.py
+
+WINDOW = 500   # Number of recent decisions to keep for the rolling percentiles, for each source
+PERCENTILES = (50, 90, 99)
+
+# (ivorn substring, source name) pairs, the first match wins.
+SOURCES = [('/SWIFT', 'Swift'),
+           ('/Fermi', 'Fermi'),
+           ('/LVC', 'LVC'),
+           ('/AMON', 'IceCube'),
+           ('/ICECUBE', 'IceCube'),
+           ('/Antares', 'Antares'),
+           ('/MAXI', 'MAXI')]
+
+TRIGGER_OUTCOMES = ['trigger', 'trigger_failed', 'fastlane', 'fastlane_failed']
+ACCEPTED_OUTCOMES = ['trigger', 'fastlane']
+
+LATENCY_BUCKETS = (1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0, 7200.0, 86400.0)
+ALERT_LATENCY_SECONDS = metrics.REGISTRY.histogram('voevent_alert_latency_seconds',
+                                                   'Seconds from the instrument event or notice issue time to the '
+                                                   'trigger decision',
+                                                   ['source', 'interval', 'outcome'],
+                                                   buckets=LATENCY_BUCKETS)
+SLO_BREACHES = metrics.REGISTRY.counter('voevent_latency_slo_breaches_total',
+                                        'Accepted triggers slower than the latency SLO for their source',
+                                        ['source'])
+
+SLO_ALERT_TEMPLATE = """
+The trigger for %(ivorn)s (trigger ID %(trigger_id)s) was accepted %(notice_latency).1f seconds after the notice was
+issued, and %(event_latency)s seconds after the event, which breaches the %(slo).0f second SLO for %(source)s.
+
+Rolling notice-to-trigger latency percentiles for %(source)s: %(percentiles)s
+
+Trace ID: %(trace_id)s
+"""
+
+ISOTIME_RE = re.compile(r'^(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2}(?:\.\d*)?)(Z|[+-]\d{2}:?\d{2})?$')
+
+
+def source_name(ivorn):
+    """
+    :param ivorn: The ivorn of a VOEvent, eg 'ivo://nasa.gsfc.gcn/SWIFT#BAT_GRB_Pos_...'
+    :return: The name of the source (eg 'Swift'), or 'other'.
+    """
+    for pattern, name in SOURCES:
+        if pattern.lower() in ivorn.lower():
+            return name
+    return 'other'
+
+
+def parse_isotime(text):
+    """
+    Convert an ISO 8601 time string from a VOEvent (eg '2017-09-10T08:50:00.36', with an optional 'Z' or UTC offset)
+    to seconds since the Unix epoch. This is much faster than astropy, and leap seconds don't matter at this accuracy.
+
+    :param text: The time string.
+    :return: Seconds since the Unix epoch, or None if the string can't be parsed.
+    """
+    if not text:
+        return None
+    m = ISOTIME_RE.match(text.strip())
+    if m is None:
+        return None
+    year, month, day, hour, minute = [int(x) for x in m.groups()[:5]]
+    result = calendar.timegm((year, month, day, hour, minute, 0)) + float(m.group(6))
+    zone = m.group(7)
+    if zone and zone != 'Z':
+        offset = int(zone[1:3]) * 3600 + int(zone[-2:]) * 60
+        if zone[0] == '+':
+            result -= offset
+        else:
+            result += offset
+    return result
+
+
+def event_times(v):
+    """
+    :param v: A parsed VOEvent object.
+    :return: A tuple of (event_time, issued), where event_time is the WhereWhen ISOTime and issued is the Who Date,
+             both in seconds since the Unix epoch, or None if missing.
+    """
+    try:
+        event_time = parse_isotime(v.WhereWhen.ObsDataLocation.ObservationLocation.AstroCoords.Time.TimeInstant.ISOTime.text)
+    except AttributeError:
+        event_time = None
+    try:
+        issued = parse_isotime(v.Who.Date.text)
+    except AttributeError:
+        issued = None
+    return event_time, issued
+
+
+def percentile(values, pct):
+    """
+    Nearest rank percentile of a sorted list of values.
+    """
+    if not values:
+        return None
+    index = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+class LatencyLedger(object):
+    """
+    Records the latency of each decision, and keeps rolling percentiles for each source.
+    """
+    def __init__(self, window=WINDOW, slo=None, ledger_file=None, alert_to=None, logger=log):
+        """
+        :param window: Number of recent decisions to keep for the rolling percentiles, for each source.
+        :param slo: Dictionary of source name (eg 'Swift', or 'default' for any other source) to the maximum number
+                    of seconds from notice issue to accepted trigger.
+        :param ledger_file: Name of a file to append the records to, one JSON object per line, or None.
+        :param alert_to: List of email addresses to notify when the SLO is breached.
+        :param logger: optional logger object.
+        """
+        self.window = window
+        self.slo = dict(slo or {})
+        self.ledger_file = ledger_file
+        self.alert_to = list(alert_to or [])
+        self.logger = logger
+        self.history = {}   # Key is (source, 'trigger' or 'all'), value is a deque of (event, notice) latency tuples
+        self.recent = collections.deque(maxlen=window)
+        self.triggered = collections.OrderedDict()   # ivorns that have had a trigger outcome recorded
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+        self.filelock = threading.Lock()
+
+    def record(self, v=None, eventxml=None, outcome='ignored', decided=None, trigger_id=None):
+        """
+        Record a decision about a VOEvent.
+
+        Decisions not to trigger (outcomes other than those in TRIGGER_OUTCOMES) are ignored for events that already
+        have a trigger outcome recorded, so the QueueWorker can record every event after the handlers have run.
+
+        :param v: A parsed VOEvent object, or None to parse eventxml.
+        :param eventxml: string containing the VOEvent XML, used if v is None.
+        :param outcome: One of 'trigger', 'trigger_failed', 'fastlane', 'fastlane_failed', 'handled' or 'ignored'.
+        :param decided: The time of the decision (eg, when the trigger request was accepted), defaults to now.
+        :param trigger_id: Optional trigger ID.
+        :return: The record, as a dictionary, or None if it wasn't recorded.
+        """
+        if decided is None:
+            decided = clock.now()
+        if v is None:
+            if not eventxml:
+                return None
+            if not isinstance(eventxml, bytes):
+                eventxml = eventxml.encode('latin-1')
+            v = voeventparse.loads(eventxml)
+        ivorn = v.attrib['ivorn']
+        with self.lock:
+            if outcome in TRIGGER_OUTCOMES:
+                self.triggered[ivorn] = outcome
+                while len(self.triggered) > self.window:
+                    self.triggered.popitem(last=False)
+            elif ivorn in self.triggered:
+                return None
+
+        event_time, issued = event_times(v)
+        source = source_name(ivorn)
+        rec = {'ivorn': ivorn,
+               'source': source,
+               'outcome': outcome,
+               'trigger_id': trigger_id,
+               'trace_id': tracing.get_trace_id(),
+               'event_time': event_time,
+               'issued': issued,
+               'decided': decided,
+               'event_latency': None if event_time is None else decided - event_time,
+               'notice_latency': None if issued is None else decided - issued}
+
+        groups = ['all']
+        if outcome in ACCEPTED_OUTCOMES:
+            groups.append('trigger')
+        with self.lock:
+            self.counts[outcome] += 1
+            self.recent.append(rec)
+            for group in groups:
+                key = (source, group)
+                if key not in self.history:
+                    self.history[key] = collections.deque(maxlen=self.window)
+                self.history[key].append((rec['event_latency'], rec['notice_latency']))
+        for interval in ['event', 'notice']:
+            if rec[interval + '_latency'] is not None:
+                ALERT_LATENCY_SECONDS.labels(source=source,
+                                             interval=interval,
+                                             outcome=outcome).observe(rec[interval + '_latency'])
+
+        if self.ledger_file:
+            sideeffects.submit('latency', self._write, rec)
+        decisions.LEDGER.record(rec)   # With the reason code and parameters given by the handler
+        if outcome in ACCEPTED_OUTCOMES:
+            self.logger.info('Latency for %s %s: %s s from event, %s s from notice' % (outcome,
+                                                                                      ivorn,
+                                                                                      _fmt(rec['event_latency']),
+                                                                                      _fmt(rec['notice_latency'])))
+            self._check_slo(rec)
+        return rec
+
+    def _write(self, rec):
+        line = json.dumps(rec)
+        with self.filelock:
+            with open(self.ledger_file, 'a') as f:
+                f.write(line + '\n')
+
+    def _check_slo(self, rec):
+        slo = self.slo.get(rec['source'], self.slo.get('default'))
+        if slo is None or rec['notice_latency'] is None or rec['notice_latency'] <= slo:
+            return
+        SLO_BREACHES.labels(source=rec['source']).inc()
+        with self.lock:
+            self.counts['slo_breaches'] += 1
+        percentiles = self.percentiles(rec['source'], group='trigger')['notice']
+        params = dict(rec)
+        params.update({'slo': slo,
+                       'event_latency': _fmt(rec['event_latency']),
+                       'percentiles': ', '.join(['p%d=%s s' % (p, _fmt(percentiles['p%d' % p])) for p in PERCENTILES])})
+        self.logger.error('Latency SLO breached for %(ivorn)s: %(notice_latency).1f s from notice to trigger, '
+                          'SLO for %(source)s is %(slo).0f s' % params)
+        if self.alert_to:
+            notify.AGGREGATOR.add(trigger_id='latency SLO %s' % rec['source'],
+                                  from_address='mwa@telemetry.mwa128t.org',
+                                  to_addresses=self.alert_to,
+                                  subject='Trigger latency SLO breached for %s' % rec['source'],
+                                  msg_text=SLO_ALERT_TEMPLATE % params)
+
+    def percentiles(self, source, group='all'):
+        """
+        :param source: Source name, eg 'Swift'.
+        :param group: 'trigger' for accepted triggers only, or 'all' for all decisions.
+        :return: A dictionary with 'count', and 'event' and 'notice' dictionaries of seconds, with keys 'p50', etc.
+        """
+        with self.lock:
+            values = list(self.history.get((source, group), []))
+        result = {'count': len(values)}
+        for i, interval in enumerate(['event', 'notice']):
+            latencies = sorted([x[i] for x in values if x[i] is not None])
+            result[interval] = dict([('p%d' % p, percentile(latencies, p)) for p in PERCENTILES])
+        return result
+
+    def status(self):
+        """
+        :return: A dictionary containing the number of decisions recorded by outcome, the number of SLO breaches, and
+                 the rolling percentiles for each source and group.
+        """
+        with self.lock:
+            keys = sorted(self.history.keys())
+            result = {'counts': dict(self.counts), 'slo': dict(self.slo)}
+        result['percentiles'] = dict([('%s/%s' % key, self.percentiles(*key)) for key in keys])
+        return result
+
+
+def _fmt(value):
+    if value is None:
+        return 'unknown'
+    return '%.1f' % value
+
+
+# The ledger used by the handlers, fast lane and QueueWorker, configured by the handler daemon
+LEDGER = LatencyLedger()
+
+
+def record(v=None, eventxml=None, outcome='ignored', decided=None, trigger_id=None):
+    """
+    Record a decision in the shared ledger (see LatencyLedger.record), logging rather than raising any exception.
+    """
+    try:
+        return LEDGER.record(v=v, eventxml=eventxml, outcome=outcome, decided=decided, trigger_id=trigger_id)
+    except Exception:
+        log.exception('Error recording decision latency')
@@ -0,0 +1,121 @@
+"""
+Logging setup for the handler daemon. Log records are put on a queue by the thread that logs them, and a single
+listener thread formats them and writes them to the log file, so that handler code never waits for disk I/O.
+Timestamps come from fastclock, not astropy, and use the time the record was created, not the time it was written.
+
+The log file is rotated (at midnight UTC by default), and old log files are gzip compressed.
+"""
+
+import atexit
+import gzip
+import logging
+import logging.handlers
+import os
+import shutil
+import sys
+
+if sys.version_info.major == 2:
+    import Queue
+else:
+    import queue as Queue
+
+from . import fastclock
+
+
+class MWALogFormatter(logging.Formatter):
+    """
+    Add a time string to the start of any log messages sent to the log file, and append any exception traceback
+    (already formatted as record.exc_text, if the record came through a LightQueueHandler) and stack.
+    """
+    def format(self, record):
+        msg = "%s=(%d): %s" % (fastclock.utc_iso(record.created),
+                               int(fastclock.gps_seconds(record.created)),
+                               record.getMessage())
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            msg = msg + '\n' + record.exc_text
+        if getattr(record, 'stack_info', None):
+            msg = msg + '\n' + self.formatStack(record.stack_info)
+        return msg
+
+
+def gzip_namer(name):
+    return name + '.gz'
+
+
+def gzip_rotator(source, dest):
+    """
+    Compress the log file that has just been rotated out, and remove the uncompressed copy.
+    """
+    with open(source, 'rb') as fin:
+        with gzip.open(dest, 'wb') as fout:
+            shutil.copyfileobj(fin, fout)
+    os.remove(source)
+
+
+def rotating_file_handler(filename, when='midnight', backup_count=30, compress=True):
+    """
+    Create a log file handler that starts a new log file at the given interval.
+
+    :param filename: Name of the log file.
+    :param when: When to rotate the log file, as for logging.handlers.TimedRotatingFileHandler (eg 'midnight', 'H').
+                 If None (or 'none'), the file is never rotated.
+    :param backup_count: Number of old log files to keep.
+    :param compress: If True, old log files are gzip compressed.
+    :return: logging.Handler object
+    """
+    if (not when) or (str(when).lower() == 'none'):
+        return logging.FileHandler(filename)
+    handler = logging.handlers.TimedRotatingFileHandler(filename, when=when, backupCount=backup_count, utc=True)
+    if compress:
+        handler.namer = gzip_namer
+        handler.rotator = gzip_rotator
+    return handler
+
+
+if hasattr(logging.handlers, 'QueueHandler'):
+    class LightQueueHandler(logging.handlers.QueueHandler):
+        """
+        QueueHandler that does as little as possible in the logging thread - it merges the message arguments (which
+        may not be safe to pass to another thread) and formats any exception traceback, but leaves the timestamp and
+        the rest of the formatting to the listener thread.
+        """
+        def prepare(self, record):
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            return record
+
+
+def start_queue_logging(logger, handlers):
+    """
+    Attach the given handlers to the logger through a queue, so that they run in a background listener thread. Under
+    Python 2, which has no QueueHandler, the handlers are attached directly.
+
+    :param logger: The logging.Logger object to attach the handlers to.
+    :param handlers: A list of logging.Handler objects.
+    :return: The logging.handlers.QueueListener object, or None under Python 2.
+    """
+    if not hasattr(logging.handlers, 'QueueListener'):
+        for handler in handlers:
+            logger.addHandler(handler)
+        return None
+    logqueue = Queue.Queue(-1)
+    listener = logging.handlers.QueueListener(logqueue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(stop_queue_logging, listener)   # Write out anything still in the queue on exit
+    logger.addHandler(LightQueueHandler(logqueue))
+    return listener
+
+
+def stop_queue_logging(listener):
+    """
+    Stop the listener thread, after it has written out all the records in the queue. Safe to call more than once.
+
+    :param listener: The QueueListener object returned by start_queue_logging(), or None.
+    """
+    if listener is not None and listener._thread is not None:
+        listener.stop()
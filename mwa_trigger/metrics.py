@@ -0,0 +1,276 @@
+"""
+Embedded metrics registry - counters, gauges and fixed-bucket histograms, with optional labels - exported in the
+Prometheus text format on a local HTTP port, so that queue depth, handler decision time, web service and SMTP latency,
+dedupe hits and trigger outcomes can be monitored without reading the logs.
+
+Metrics are created at import time by the modules that update them, eg:
+
+    TRIGGERS = metrics.REGISTRY.counter('voevent_triggers_total', 'Trigger requests sent', ['outcome'])
+    ...
+    TRIGGERS.labels(outcome='success').inc()
+
+and are always updated, whether or not the HTTP endpoint is running. Each update takes about a microsecond (one
+uncontended lock), compared with the hundreds of milliseconds it takes to handle an event.
+
+Creating a metric that already exists returns the existing one, so modules can safely be re-imported.
+"""
+
+import bisect
+import logging
+import sys
+import threading
+import time
+
+if sys.version_info.major == 2:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+else:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+log = logging.getLogger('voevent.handlers.metrics')   # Inherit the logging setup from handlers.py
+
+# Default histogram buckets, in seconds, from 1ms to 2 minutes
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                              for k, v in pairs])
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class CounterChild(object):
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1.0):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labelnames, labelvalues):
+        return ['%s%s %s' % (name, _format_labels(labelnames, labelvalues), _format_value(self.value))]
+
+
+class GaugeChild(object):
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+        self.lock = threading.Lock()
+
+    def set(self, value):
+        self.value = float(value)
+
+    def inc(self, amount=1.0):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1.0):
+        with self.lock:
+            self.value -= amount
+
+    def set_function(self, function):
+        """
+        Call function() to get the value of this gauge each time the metrics are read, eg lambda: queue.qsize()
+        """
+        self.function = function
+
+    def samples(self, name, labelnames, labelvalues):
+        value = self.value
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception:
+                value = float('nan')
+        return ['%s%s %s' % (name, _format_labels(labelnames, labelvalues), _format_value(value))]
+
+
+class HistogramChild(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)   # Last element is the +Inf bucket
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        """
+        Context manager that observes the time taken by the enclosed block, eg:
+
+            with HANDLER_SECONDS.labels(handler='grb').time():
+                ...
+        """
+        return _Timer(self)
+
+    def samples(self, name, labelnames, labelvalues):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        result = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            result.append('%s_bucket%s %d' % (name,
+                                              _format_labels(labelnames, labelvalues, ('le', _format_value(bound))),
+                                              cumulative))
+        result.append('%s_sum%s %s' % (name, _format_labels(labelnames, labelvalues), _format_value(total)))
+        result.append('%s_count%s %d' % (name, _format_labels(labelnames, labelvalues), cumulative))
+        return result
+
+
+class _Timer(object):
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.child.observe(time.time() - self.start)
+        return False
+
+
+class Metric(object):
+    """
+    A named metric, with zero or more label names. Unlabelled metrics can be updated directly (eg COUNTER.inc()),
+    labelled ones through the child for a set of label values (eg COUNTER.labels(outcome='success').inc()).
+    """
+    def __init__(self, mtype, name, documentation='', labelnames=(), childfactory=None):
+        self.mtype = mtype
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.childfactory = childfactory
+        self.children = {}
+        self.lock = threading.Lock()
+        if not self.labelnames:
+            self.children[()] = childfactory()
+
+    def labels(self, *labelvalues, **labelkwargs):
+        """
+        Return the child metric for the given label values, creating it if necessary.
+        """
+        if labelkwargs:
+            labelvalues = tuple([labelkwargs[name] for name in self.labelnames])
+        else:
+            labelvalues = tuple(labelvalues)
+        child = self.children.get(labelvalues)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(labelvalues, self.childfactory())
+        return child
+
+    def __getattr__(self, attr):
+        # Pass inc(), observe(), set(), etc on an unlabelled metric through to its only child
+        if attr in ['inc', 'dec', 'set', 'set_function', 'observe', 'time']:
+            return getattr(self.children[()], attr)
+        raise AttributeError(attr)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.mtype)]
+        with self.lock:
+            children = sorted(self.children.items())
+        for labelvalues, child in children:
+            lines += child.samples(self.name, self.labelnames, labelvalues)
+        return lines
+
+
+class Registry(object):
+    """
+    Collection of metrics, rendered together in the Prometheus text format.
+    """
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get(self, mtype, name, documentation, labelnames, childfactory):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = Metric(mtype, name, documentation, labelnames, childfactory)
+            elif metric.mtype != mtype or metric.labelnames != tuple(labelnames):
+                raise ValueError('Metric %s already exists with a different type or labels' % name)
+            return metric
+
+    def counter(self, name, documentation='', labelnames=()):
+        return self._get('counter', name, documentation, labelnames, CounterChild)
+
+    def gauge(self, name, documentation='', labelnames=()):
+        return self._get('gauge', name, documentation, labelnames, GaugeChild)
+
+    def histogram(self, name, documentation='', labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get('histogram', name, documentation, labelnames, lambda: HistogramChild(buckets))
+
+    def render(self):
+        """
+        :return: All the metrics, as a string in the Prometheus text exposition format.
+        """
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        lines = []
+        for name, metric in metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+# The registry used by all modules
+REGISTRY = Registry()
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        data = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, registry):
+        HTTPServer.__init__(self, server_address, MetricsRequestHandler)
+        self.registry = registry
+
+
+def start_http_server(port=9108, host='localhost', registry=None):
+    """
+    Serve the metrics in the Prometheus text format, at any URL on the given port, from a background thread.
+
+    :param port: Port number to listen on - zero means choose a free port.
+    :param host: Interface to bind to. The default only accepts local connections.
+    :param registry: Registry to serve, defaults to REGISTRY.
+    :return: The server object - server.server_address[1] is the port number.
+    """
+    if registry is None:
+        registry = REGISTRY
+    server = MetricsHTTPServer((host, port), registry)
+    thread = threading.Thread(target=server.serve_forever, name='MetricsHTTP')
+    thread.daemon = True
+    thread.start()
+    log.info('Serving metrics on http://%s:%d/metrics' % (host, server.server_address[1]))
+    return server
@@ -0,0 +1,302 @@
+"""
+Debug notification aggregator. The handlers send a debug email every time they decide not to trigger on an event,
+and a single physical event (eg a Fermi GRB, with its Flt, Gnd and Fin packets) can produce many of these within a
+few seconds. Instead of sending each one, handlers.debug_notify() adds them to a digest for that trigger ID, and the
+digest is sent as one email once the window (in seconds) since the first message for that trigger has passed.
+
+Digests are also rate limited with a token bucket for each recipient list - up to 'burst' emails can be sent at once,
+after which the bucket refills at 'per_hour' emails per hour. A digest that can't be sent because the bucket is empty
+is kept, and tried again after another window, with any messages for the same trigger that arrived in the meantime.
+At most MAX_MESSAGES messages are kept for each digest - if there are more, the oldest are dropped, and the number
+dropped is given in the digest.
+
+The handlers pass the log messages for the trigger separately from each message's text (the log_text argument).
+As the log for a trigger only grows, it's attached to the digest once, as log_<trigger ID>.txt, using the most recent
+copy, instead of being repeated in every message.
+
+Trigger success emails are sent directly (with handlers.queue_email()) and never delayed or suppressed.
+
+Until start() is called (eg, when a handler module is used from a script), each notification is sent immediately,
+as before.
+"""
+
+import collections
+import logging
+import os
+import re
+import threading
+import time
+
+from . import sideeffects
+from . import tracing
+
+log = logging.getLogger('voevent.handlers.notify')   # Inherit the logging setup from handlers.py
+
+WINDOW = 60.0      # Seconds after the first debug message for a trigger, before the digest is sent
+BURST = 10         # Maximum number of debug emails sent at once, to each recipient list
+PER_HOUR = 30.0    # Sustained rate of debug emails, to each recipient list
+MAX_MESSAGES = 100   # Maximum number of messages kept for a digest that's waiting for the rate limit
+
+DIGEST_HEADER_TEMPLATE = """
+%(count)d debug notifications for %(key)s in the last %(window)d seconds.
+%(deferred)s"""
+
+DIGEST_DEFERRED_TEMPLATE = """
+(This digest was held back %(deferred)d times by the rate limit, and %(dropped)d older messages were dropped)
+"""
+
+DIGEST_PART_TEMPLATE = """
+==== %(index)d/%(count)d: %(subject)s (%(queued)s) ====
+%(msg_text)s
+"""
+
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter.
+    """
+    def __init__(self, burst=BURST, per_hour=PER_HOUR):
+        """
+        :param burst: Maximum number of tokens in the bucket.
+        :param per_hour: Number of tokens added per hour.
+        """
+        self.burst = burst
+        self.rate = per_hour / 3600.0
+        self.tokens = float(burst)
+        self.last = time.time()
+
+    def take(self, now=None):
+        """
+        Take one token from the bucket, if there is one.
+
+        :param now: Optional current time, in seconds since the Unix epoch.
+        :return: True if a token was available.
+        """
+        if now is None:
+            now = time.time()
+        self.tokens = min(float(self.burst), self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+
+class Digest(object):
+    """
+    The debug messages collected for one trigger ID (and recipient list).
+    """
+    def __init__(self, key='', from_address='', to_addresses=None):
+        self.key = key
+        self.from_address = from_address
+        self.to_addresses = list(to_addresses or [])
+        self.started = time.time()
+        self.trace_id = tracing.get_trace_id()   # Trace ID of the event that generated the first message
+        self.messages = []    # List of (time, subject, msg_text, attachments) tuples
+        self.log_text = ''    # The most recent log messages for the trigger, attached once to the digest
+        self.deferred = 0     # Number of times the digest has been held back by the rate limit
+        self.dropped = 0      # Number of the oldest messages dropped while it was held back
+
+    @property
+    def log_attachment(self):
+        """
+        :return: The (filename, payload, mimetype) tuple for the log, or None if there isn't one.
+        """
+        if not self.log_text:
+            return None
+        return ('log_%s.txt' % re.sub(r'[^A-Za-z0-9_.+-]+', '_', str(self.key)), self.log_text, 'text/plain')
+
+
+class NotificationAggregator(object):
+    """
+    Collects debug notifications into per-trigger digests, and sends them when their window has passed.
+    """
+    def __init__(self, window=WINDOW, burst=BURST, per_hour=PER_HOUR, logger=log):
+        """
+        :param window: Seconds to collect messages for a trigger before sending the digest.
+        :param burst: Token bucket size, for each recipient list.
+        :param per_hour: Token bucket refill rate, in emails per hour, for each recipient list.
+        :param logger: optional logger object.
+        """
+        self.window = window
+        self.burst = burst
+        self.per_hour = per_hour
+        self.logger = logger
+        self.digests = collections.OrderedDict()
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.counts = collections.Counter()
+
+    @property
+    def running(self):
+        return (self.thread is not None) and self.thread.is_alive()
+
+    def start(self):
+        """
+        Start (or restart, if it has died) the thread that sends digests when their window has passed.
+        """
+        if self.running:
+            return
+        self.thread = threading.Thread(target=self.run, name='NotifyDigest')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, trigger_id=None, from_address='', to_addresses=None, subject='', msg_text='', attachments=None,
+            log_text=None):
+        """
+        Add a debug message to the digest for this trigger ID, starting a new digest if there isn't one.
+
+        :param trigger_id: The trigger ID the message is about. If None, messages are collected by subject line.
+        :param from_address: string containing the email address that the message is sent from.
+        :param to_addresses: list of strings containing destination email addresses.
+        :param subject: A string containing the subject line of the email.
+        :param msg_text: A string containing the full text of the message to send.
+        :param attachments: A list of (filename, payload) or (filename, payload, mimetype) tuples.
+        :param log_text: Optional log messages for the trigger, attached once to the digest.
+        """
+        if not to_addresses:
+            return
+        with self.lock:
+            self.counts['messages'] += 1
+        if trigger_id is None:
+            trigger_id = subject
+        if not self.running or self.window <= 0:
+            digest = Digest(key=trigger_id, from_address=from_address, to_addresses=to_addresses)
+            digest.log_text = log_text or ''
+            attachments = list(attachments or [])
+            if digest.log_attachment is not None:
+                attachments.append(digest.log_attachment)
+            self._send(from_address=from_address,
+                       to_addresses=to_addresses,
+                       subject=subject,
+                       msg_text=msg_text,
+                       attachments=attachments)
+            return
+        key = (trigger_id, tuple(sorted(to_addresses)))
+        with self.lock:
+            digest = self.digests.get(key)
+            if digest is None:
+                digest = Digest(key=trigger_id, from_address=from_address, to_addresses=to_addresses)
+                self.digests[key] = digest
+            digest.messages.append((time.time(), subject, msg_text, attachments or []))
+            if log_text:
+                digest.log_text = log_text
+
+    def run(self):
+        """
+        Digest thread loop.
+        """
+        while True:
+            time.sleep(0.5)
+            try:
+                self.flush(force=False)
+            except Exception:
+                self.logger.exception('Exception sending debug notification digests')
+
+    def flush(self, force=True):
+        """
+        Send the digests whose window has passed.
+
+        :param force: If True, send all digests now, regardless of their window.
+        """
+        now = time.time()
+        with self.lock:
+            ready = [k for k, d in self.digests.items() if force or (now - d.started >= self.window)]
+            digests = [self.digests.pop(k) for k in ready]
+        for digest in digests:
+            self._send_digest(digest)
+
+    def _send_digest(self, digest):
+        with tracing.trace_context(digest.trace_id):
+            self._send_digest_traced(digest)
+
+    def _send_digest_traced(self, digest):
+        recipients = tuple(sorted(digest.to_addresses))
+        with self.lock:
+            bucket = self.buckets.get(recipients)
+            if bucket is None:
+                bucket = self.buckets[recipients] = TokenBucket(burst=self.burst, per_hour=self.per_hour)
+            if not bucket.take():
+                self._defer(digest, recipients)
+                return
+
+        if len(digest.messages) == 1 and not digest.deferred:
+            queued, subject, msg_text, attachments = digest.messages[0]
+            attachments = list(attachments)
+            if digest.log_attachment is not None:
+                attachments.append(digest.log_attachment)
+            self._send(from_address=digest.from_address,
+                       to_addresses=digest.to_addresses,
+                       subject=subject,
+                       msg_text=msg_text,
+                       attachments=attachments)
+            return
+
+        deferred_text = ''
+        if digest.deferred:
+            deferred_text = DIGEST_DEFERRED_TEMPLATE % {'deferred': digest.deferred, 'dropped': digest.dropped}
+        texts = [DIGEST_HEADER_TEMPLATE % {'count': len(digest.messages),
+                                           'key': digest.key,
+                                           'window': max(1, round(self.window)),
+                                           'deferred': deferred_text}]
+        allattachments = []
+        for i, (queued, subject, msg_text, attachments) in enumerate(digest.messages):
+            texts.append(DIGEST_PART_TEMPLATE % {'index': i + 1,
+                                                 'count': len(digest.messages),
+                                                 'subject': subject,
+                                                 'queued': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(queued)),
+                                                 'msg_text': msg_text})
+            for attachspec in attachments:
+                allattachments.append(('%d_%s' % (i + 1, os.path.basename(attachspec[0])),) + tuple(attachspec[1:]))
+        if digest.log_attachment is not None:
+            allattachments.append(digest.log_attachment)
+        self._send(from_address=digest.from_address,
+                   to_addresses=digest.to_addresses,
+                   subject='%s [digest of %d]' % (digest.messages[0][1], len(digest.messages)),
+                   msg_text=''.join(texts),
+                   attachments=allattachments)
+        with self.lock:
+            self.counts['digests'] += 1
+
+    def _defer(self, digest, recipients):
+        """
+        Put a digest that the rate limit stopped back in the queue, to be tried again after another window, merged
+        with any newer digest for the same trigger. Called with the lock held.
+        """
+        key = (digest.key, recipients)
+        newer = self.digests.pop(key, None)
+        if newer is not None:
+            digest.messages += newer.messages
+            digest.log_text = newer.log_text or digest.log_text
+        if len(digest.messages) > MAX_MESSAGES:
+            digest.dropped += len(digest.messages) - MAX_MESSAGES
+            self.counts['dropped'] += len(digest.messages) - MAX_MESSAGES
+            digest.messages = digest.messages[-MAX_MESSAGES:]
+        digest.deferred += 1
+        digest.started = time.time()
+        self.digests[key] = digest
+        self.counts['deferred'] += 1
+        self.logger.info('Debug digest for %s (%d messages) held back, rate limit reached for %s' %
+                         (digest.key, len(digest.messages), ', '.join(recipients)))
+
+    def _send(self, **kwargs):
+        from . import handlers   # Imported here, because handlers imports this module
+        with self.lock:
+            self.counts['sent'] += 1
+        sideeffects.submit('email', handlers.send_email, batch=True, logger=self.logger, **kwargs)
+
+    def status(self):
+        """
+        :return: A dictionary containing the number of digests waiting, the number of debug messages received,
+                 and the number of emails sent, digests sent, digests held back by the rate limit, and messages
+                 dropped from digests while they were held back.
+        """
+        with self.lock:
+            result = {'pending': len(self.digests)}
+            result.update(self.counts)
+            return result
+
+
+# The aggregator used by handlers.debug_notify(), started by the handler daemon
+AGGREGATOR = NotificationAggregator()
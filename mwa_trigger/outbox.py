@@ -0,0 +1,582 @@
+"""
+Email outbox. Once started, handlers.send_email() just adds each message to the outbox and returns, and a single
+background thread sends them, keeping one SMTP connection open between messages instead of connecting to the
+mail host for every email.
+
+Messages queued with batch=True (the debug notification digests from notify.py) to the same sender and recipient
+list that arrive within batch_window seconds of each other are combined into one digest email (with all the
+attachments). Other messages, including every trigger notification, are always sent on their own. Every message is
+written to the spool directory (if one is configured) before send() returns, and only removed once the mail host has
+accepted it. Messages that can't be sent because of a temporary error are retried with exponential backoff, and any
+left in the spool when the daemon exits are sent when it next starts. If the spool directory can't be created, the
+outbox keeps unsent messages in memory only. Messages that are permanently rejected, or that still can't be sent
+after max_attempts, are moved to the 'failed' subdirectory of the spool.
+
+Until start() is called (eg, when a handler module is used from a script), send() builds and sends each message
+synchronously, as before.
+
+To test without sending real email, point it at a local SMTP sink (see smtpsink.py).
+"""
+
+import base64
+import collections
+import json
+import logging
+import os
+import smtplib
+import socket
+import sys
+import threading
+import time
+import uuid
+
+if sys.version_info.major == 2:
+    import Queue
+else:
+    import queue as Queue
+
+from email.mime.multipart import MIMEMultipart
+from email.mime.base import MIMEBase
+from email.mime.text import MIMEText
+from email.utils import formatdate
+if sys.version_info.major == 2:
+    from email.Encoders import encode_base64
+else:
+    from email.encoders import encode_base64
+
+from . import metrics
+from . import tracing
+
+log = logging.getLogger('voevent.handlers.outbox')   # Inherit the logging setup from handlers.py
+
+SMTP_SECONDS = metrics.REGISTRY.histogram('voevent_smtp_seconds',
+                                          'Time taken to send each email (or digest) to the mail host',
+                                          ['status'])
+
+BATCH_WINDOW = 2.0     # Seconds to wait for more messages to the same recipients, to send as one digest
+MAX_BATCH = 20         # Maximum number of messages combined into one digest
+IDLE_TIMEOUT = 60.0    # Close the SMTP connection if it hasn't been used for this many seconds
+RETRY_BASE = 30.0      # Delay before the first retry, doubled for each further attempt
+RETRY_MAX = 3600.0     # Maximum delay between retries
+MAX_ATTEMPTS = 12      # Give up on a message after this many failed attempts
+
+DIGEST_HEADER_TEMPLATE = """
+%(count)d messages to these recipients were sent within %(window)d seconds, and have been combined into this email.
+"""
+
+DIGEST_PART_TEMPLATE = """
+==== %(index)d/%(count)d: %(subject)s (queued %(queued)s) ====
+
+%(msg_text)s
+"""
+
+
+def normalise_attachments(attachments, logger=log):
+    """
+    Check the attachment list passed to send_email(), and return it as a list of (filename, payload, mimetype) tuples.
+
+    :param attachments: A list of (filename, payload) or (filename, payload, mimetype) tuples.
+    :param logger: optional logger object.
+    :return: list of (filename, payload, mimetype) tuples, or None if the attachment list isn't valid.
+    """
+    result = []
+    for attachspec in attachments or []:
+        if type(attachspec) != tuple:
+            logger.error('attachments must be a tuple of (filename, payload, mimetype), where payload is the file contents.')
+            return None
+
+        try:
+            if len(attachspec) == 2:
+                filename, payload = attachspec
+                if filename.endswith('.xml'):
+                    mimetype = 'text/xml'
+                else:
+                    mimetype = 'text/plain'
+            else:
+                filename, payload, mimetype = attachspec
+
+            if not mimetype:
+                mimetype = 'text/plain'
+            mimemain, mimesub = mimetype.split('/')
+        except ValueError:
+            logger.error('attachments must be a tuple of (filename, payload, mimetype), where payload is the file contents.')
+            return None
+        result.append((filename, payload, mimetype))
+    return result
+
+
+def build_message(from_address='', to_addresses=None, subject='', msg_text='', attachments=None):
+    """
+    Assemble a MIME message.
+
+    :param from_address: string containing the email address that the message is sent from.
+    :param to_addresses: list of strings containing destination email addresses.
+    :param subject: A string containing the subject line of the email.
+    :param msg_text: A string containing the full text of the message to send.
+    :param attachments: A list of (filename, payload, mimetype) tuples (see normalise_attachments()).
+    :return: MIMEMultipart object.
+    """
+    msg = MIMEMultipart()
+    msg['From'] = from_address
+    msg['To'] = ', '.join(to_addresses)
+    msg['Date'] = formatdate(localtime=True)
+    msg['Subject'] = subject
+    msg.attach(MIMEText(msg_text))
+
+    for filename, payload, mimetype in attachments or []:
+        mimemain, mimesub = mimetype.split('/')
+        part = MIMEBase(mimemain, mimesub)
+        part.set_payload(payload)
+        encode_base64(part)
+        part.add_header('Content-Disposition', 'attachment; filename="%s"' % os.path.basename(filename))
+        msg.attach(part)
+    return msg
+
+
+class OutboxMessage(object):
+    """
+    One email waiting to be sent.
+    """
+    def __init__(self, from_address='', to_addresses=None, subject='', msg_text='', attachments=None, batch=False):
+        self.id = '%d-%s' % (int(time.time() * 1000), uuid.uuid4().hex[:8])
+        self.from_address = from_address
+        self.to_addresses = list(to_addresses or [])
+        self.subject = subject
+        self.msg_text = msg_text
+        self.attachments = attachments or []
+        self.batch = batch       # If True, this message may be combined with others into a digest
+        self.queued = time.time()
+        self.attempts = 0
+        self.next_attempt = 0.0
+        self.last_error = ''
+        self.trace_id = tracing.get_trace_id()   # Trace ID of the event that generated this message
+
+    @property
+    def key(self):
+        """
+        Messages with the same key can be combined into one digest. Messages not queued with batch=True have a key of
+        their own.
+        """
+        if not self.batch:
+            return self.id
+        return (self.from_address, tuple(sorted(self.to_addresses)))
+
+    def to_dict(self):
+        attachments = []
+        for filename, payload, mimetype in self.attachments:
+            if isinstance(payload, bytes):
+                attachments.append([filename, base64.b64encode(payload).decode('ascii'), mimetype, 'bytes'])
+            else:
+                attachments.append([filename, payload, mimetype, 'text'])
+        return {'id': self.id,
+                'from_address': self.from_address,
+                'to_addresses': self.to_addresses,
+                'subject': self.subject,
+                'msg_text': self.msg_text,
+                'attachments': attachments,
+                'batch': self.batch,
+                'queued': self.queued,
+                'attempts': self.attempts,
+                'next_attempt': self.next_attempt,
+                'last_error': self.last_error,
+                'trace_id': self.trace_id}
+
+    @classmethod
+    def from_dict(cls, d):
+        attachments = []
+        for filename, payload, mimetype, encoding in d['attachments']:
+            if encoding == 'bytes':
+                payload = base64.b64decode(payload.encode('ascii'))
+            attachments.append((filename, payload, mimetype))
+        msg = cls(from_address=d['from_address'],
+                  to_addresses=d['to_addresses'],
+                  subject=d['subject'],
+                  msg_text=d['msg_text'],
+                  attachments=attachments,
+                  batch=d.get('batch', False))
+        msg.id = d['id']
+        msg.queued = d['queued']
+        msg.attempts = d['attempts']
+        msg.next_attempt = d['next_attempt']
+        msg.last_error = d.get('last_error', '')
+        msg.trace_id = d.get('trace_id')
+        return msg
+
+
+class PermanentFailure(Exception):
+    """
+    Raised when the mail host rejects a message with a permanent (5xx) error, so there's no point retrying.
+    """
+    pass
+
+
+class Outbox(object):
+    """
+    A queue of outgoing email, and the background thread that sends it.
+    """
+    def __init__(self, mailhost='cerberus', spool_dir=None, batch_window=BATCH_WINDOW, max_attempts=MAX_ATTEMPTS,
+                 logger=log):
+        """
+        :param mailhost: SMTP server to send email through, optionally with a port number (eg 'localhost:8025'), or
+                         None to count and discard every message without sending it (eg for offline evaluation).
+        :param spool_dir: Directory to keep unsent messages in. If None, unsent messages are only kept in memory.
+        :param batch_window: Messages to the same recipients queued within this many seconds are sent as one digest.
+                             Zero means never combine messages.
+        :param max_attempts: Number of failed attempts after which a message is abandoned.
+        :param logger: optional logger object.
+        """
+        self.mailhost = mailhost
+        self.spool_dir = spool_dir
+        self.batch_window = batch_window
+        self.max_attempts = max_attempts
+        self.logger = logger
+        self.queue = Queue.Queue()
+        self.retries = {}          # Messages waiting to be retried, by message ID
+        self.loaded = False        # True once the spool has been loaded, which is only done on the first start()
+        self.thread = None
+        self.smtp = None
+        self.smtp_used = 0.0
+        self.busy = False
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    @property
+    def running(self):
+        return (self.thread is not None) and self.thread.is_alive()
+
+    def start(self):
+        """
+        Start (or restart, if it has died) the sending thread. On the first start, any messages left in the spool by
+        the last process are loaded first - on a restart, every message in the spool is already queued or waiting to
+        be retried.
+        """
+        if self.running:
+            return
+        if self.spool_dir and not self.loaded:
+            try:
+                for dirname in [self.spool_dir, os.path.join(self.spool_dir, 'failed')]:
+                    if not os.path.isdir(dirname):
+                        os.makedirs(dirname)
+            except OSError:
+                self.logger.exception('Could not create the outbox spool %s, unsent messages will only be kept '
+                                      'in memory' % self.spool_dir)
+                self.spool_dir = None
+        if self.spool_dir and not self.loaded:
+            for fname in sorted(os.listdir(self.spool_dir)):
+                if not fname.endswith('.json'):
+                    continue
+                try:
+                    with open(os.path.join(self.spool_dir, fname)) as f:
+                        msg = OutboxMessage.from_dict(json.load(f))
+                except Exception:
+                    self.logger.exception('Unreadable message %s in outbox spool, ignoring it' % fname)
+                    continue
+                msg.next_attempt = 0.0
+                with self.lock:
+                    self.retries.setdefault(msg.id, msg)
+            if self.retries:
+                self.logger.info('Loaded %d unsent messages from the outbox spool' % len(self.retries))
+        self.loaded = True
+        self.thread = threading.Thread(target=self.run, name='Outbox')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send(self, from_address='', to_addresses=None, subject='', msg_text='', attachments=None, batch=False,
+             logger=None):
+        """
+        Add a message to the outbox, or send it immediately if the outbox hasn't been started.
+
+        :param from_address: string containing the email address that the message is sent from.
+        :param to_addresses: list of strings containing destination email addresses.
+        :param subject: A string containing the subject line of the email.
+        :param msg_text: A string containing the full text of the message to send.
+        :param attachments: A list of (filename, payload) or (filename, payload, mimetype) tuples.
+        :param batch: If True, the message may be combined with others to the same recipients into one digest. Never
+                      set this for trigger notifications.
+        :param logger: optional logger object, for errors in the arguments.
+        :return: False if the message couldn't be queued or sent, True otherwise.
+        """
+        if logger is None:
+            logger = self.logger
+        attachments = normalise_attachments(attachments, logger=logger)
+        if attachments is None:
+            return False
+        msg = OutboxMessage(from_address=from_address,
+                            to_addresses=to_addresses,
+                            subject=subject,
+                            msg_text=msg_text,
+                            attachments=attachments,
+                            batch=batch)
+        with self.lock:
+            self.counts['queued'] += 1
+            if self.mailhost is None:
+                self.counts['discarded'] += 1
+                return True
+        if not self.running:
+            return self._send_now(msg)
+        self._spool(msg)
+        self.queue.put(msg)
+        return True
+
+    def _send_now(self, msg):
+        smtp = None
+        start = time.time()
+        try:
+            smtp = smtplib.SMTP(self.mailhost)
+            errordict = smtp.sendmail(msg.from_address, msg.to_addresses, build_message(**self._fields(msg)).as_string())
+            for destaddress, sending_error in errordict.items():
+                self.logger.error('Error sending email to %s: %s' % (destaddress, sending_error))
+            with self.lock:
+                self.counts['sent'] += 1
+            self._observe([msg], start, 'ok')
+            return True
+        except smtplib.SMTPException:
+            self.logger.error('Email could not be sent:')
+            with self.lock:
+                self.counts['failed'] += 1
+            self._observe([msg], start, 'error')
+            return False
+        finally:
+            if smtp is not None:
+                smtp.close()
+
+    @staticmethod
+    def _fields(msg):
+        return {'from_address': msg.from_address,
+                'to_addresses': msg.to_addresses,
+                'subject': msg.subject,
+                'msg_text': msg.msg_text,
+                'attachments': msg.attachments}
+
+    def _spool_name(self, msg):
+        return os.path.join(self.spool_dir, msg.id + '.json')
+
+    def _spool(self, msg):
+        if not self.spool_dir:
+            return
+        tmpname = self._spool_name(msg) + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump(msg.to_dict(), f)
+        os.rename(tmpname, self._spool_name(msg))
+
+    def _unspool(self, msg, failed=False):
+        if not self.spool_dir:
+            return
+        try:
+            if failed:
+                self._spool(msg)
+                os.rename(self._spool_name(msg), os.path.join(self.spool_dir, 'failed', msg.id + '.json'))
+            else:
+                os.remove(self._spool_name(msg))
+        except OSError:
+            self.logger.exception('Error removing message %s from the outbox spool' % msg.id)
+
+    def run(self):
+        """
+        Sending thread loop.
+        """
+        while True:
+            batch = []
+            nqueued = 0   # Number of messages in this batch taken from the queue, rather than the retry list
+            with self.lock:
+                due = [m.next_attempt for m in self.retries.values()]
+            timeout = min(due + [time.time() + 1.0]) - time.time()
+            try:
+                batch.append(self.queue.get(timeout=max(timeout, 0.01)))
+                nqueued += 1
+                deadline = batch[0].queued + self.batch_window
+                while len(batch) < MAX_BATCH * 10:
+                    batch.append(self.queue.get(timeout=max(deadline - time.time(), 0.0)))
+                    nqueued += 1
+            except Queue.Empty:
+                pass
+
+            now = time.time()
+            with self.lock:
+                for msg in list(self.retries.values()):
+                    if msg.next_attempt <= now:
+                        batch.append(self.retries.pop(msg.id))
+                self.busy = bool(batch)
+
+            if (self.smtp is not None) and (now - self.smtp_used > IDLE_TIMEOUT):
+                self._disconnect()
+
+            try:
+                if batch:
+                    self._process(batch)
+            except Exception:
+                self.logger.exception('Exception in outbox, will retry')
+                self._retry(batch, 'Exception in outbox')
+            finally:
+                for i in range(nqueued):
+                    self.queue.task_done()
+                with self.lock:
+                    self.busy = False
+
+    def _process(self, batch):
+        groups = collections.OrderedDict()
+        for msg in sorted(batch, key=lambda m: m.queued):
+            groups.setdefault(msg.key, []).append(msg)
+        for key, msglist in groups.items():
+            if self.batch_window <= 0:
+                chunks = [[msg] for msg in msglist]
+            else:
+                chunks = [msglist[i:i + MAX_BATCH] for i in range(0, len(msglist), MAX_BATCH)]
+            for chunk in chunks:
+                if len(chunk) == 1:
+                    mime = build_message(**self._fields(chunk[0]))
+                else:
+                    mime = self._digest(chunk)
+                start = time.time()
+                try:
+                    self._deliver(chunk[0].from_address, chunk[0].to_addresses, mime.as_string())
+                except PermanentFailure as error:
+                    self._observe(chunk, start, 'rejected')
+                    for msg in chunk:
+                        msg.attempts += 1
+                    self._fail(chunk, str(error))
+                except (smtplib.SMTPException, socket.error) as error:
+                    self._observe(chunk, start, 'error')
+                    self._retry(chunk, '%s: %s' % (type(error).__name__, error))
+                else:
+                    self._observe(chunk, start, 'ok')
+                    with self.lock:
+                        self.counts['sent'] += 1
+                        self.counts['messages'] += len(chunk)
+                        if len(chunk) > 1:
+                            self.counts['digests'] += 1
+                    for msg in chunk:
+                        self._unspool(msg)
+
+    @staticmethod
+    def _observe(chunk, start, status):
+        """
+        Record the time taken to send a message (or digest) in the SMTP metrics, and as an 'smtp' span in the trace of
+        each event that generated one of the messages.
+        """
+        end = time.time()
+        SMTP_SECONDS.labels(status=status).observe(end - start)
+        for trace_id in set([msg.trace_id for msg in chunk if msg.trace_id]):
+            tracing.record_span('smtp', start, end, trace_id=trace_id, status=status, messages=len(chunk),
+                                queued=min([msg.queued for msg in chunk]))
+
+    def _digest(self, chunk):
+        """
+        Combine a list of messages to the same recipients into one.
+        """
+        texts = [DIGEST_HEADER_TEMPLATE % {'count': len(chunk), 'window': max(1, round(self.batch_window))}]
+        attachments = []
+        for i, msg in enumerate(chunk):
+            texts.append(DIGEST_PART_TEMPLATE % {'index': i + 1,
+                                                 'count': len(chunk),
+                                                 'subject': msg.subject,
+                                                 'queued': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(msg.queued)),
+                                                 'msg_text': msg.msg_text})
+            for filename, payload, mimetype in msg.attachments:
+                attachments.append(('%d_%s' % (i + 1, os.path.basename(filename)), payload, mimetype))
+        subject = '%s [+%d more]' % (chunk[0].subject, len(chunk) - 1)
+        return build_message(from_address=chunk[0].from_address,
+                             to_addresses=chunk[0].to_addresses,
+                             subject=subject,
+                             msg_text=''.join(texts),
+                             attachments=attachments)
+
+    def _connect(self):
+        self.smtp = smtplib.SMTP(self.mailhost, timeout=30)
+        with self.lock:
+            self.counts['connections'] += 1
+
+    def _disconnect(self):
+        if self.smtp is None:
+            return
+        try:
+            self.smtp.quit()
+        except (smtplib.SMTPException, socket.error):
+            pass
+        finally:
+            self.smtp.close()
+            self.smtp = None
+
+    def _deliver(self, from_address, to_addresses, text):
+        """
+        Send one message over the shared connection, reconnecting once if the existing connection has gone away.
+        """
+        for attempt in [0, 1]:
+            reused = self.smtp is not None
+            if not reused:
+                self._connect()
+            try:
+                errordict = self.smtp.sendmail(from_address, to_addresses, text)
+            except smtplib.SMTPRecipientsRefused as error:
+                raise PermanentFailure('All recipients refused: %s' % error.recipients)
+            except smtplib.SMTPResponseException as error:
+                if error.smtp_code >= 500:
+                    raise PermanentFailure('%d %s' % (error.smtp_code, error.smtp_error))
+                raise
+            except (smtplib.SMTPServerDisconnected, socket.error):
+                self._disconnect()
+                if reused and attempt == 0:
+                    continue   # The server probably closed an idle connection, try again with a new one
+                raise
+            self.smtp_used = time.time()
+            for destaddress, sending_error in errordict.items():
+                self.logger.error('Error sending email to %s: %s' % (destaddress, sending_error))
+            return
+
+    def _retry(self, chunk, error):
+        for msg in chunk:
+            msg.attempts += 1
+            msg.last_error = error
+            if msg.attempts >= self.max_attempts:
+                self._fail([msg], error)
+                continue
+            msg.next_attempt = time.time() + min(RETRY_BASE * 2 ** (msg.attempts - 1), RETRY_MAX)
+            self._spool(msg)
+            with self.lock:
+                self.retries[msg.id] = msg
+                self.counts['retried'] += 1
+            self.logger.warning('Email "%s" not sent (%s), attempt %d, retrying in %d seconds' %
+                                (msg.subject, error, msg.attempts, msg.next_attempt - time.time()))
+
+    def _fail(self, chunk, error):
+        for msg in chunk:
+            msg.last_error = error
+            with self.lock:
+                self.counts['failed'] += 1
+            self._unspool(msg, failed=True)
+            self.logger.error('Email "%s" to %s abandoned after %d attempts: %s' % (msg.subject,
+                                                                                   ', '.join(msg.to_addresses),
+                                                                                   msg.attempts,
+                                                                                   error))
+
+    def flush(self, timeout=None):
+        """
+        Wait until all queued messages have been sent or scheduled for retry, or the timeout expires.
+
+        :param timeout: Maximum time to wait, in seconds, or None to wait forever.
+        :return: True if the queue was emptied.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while self.queue.unfinished_tasks or self.busy:
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def status(self):
+        """
+        :return: A dictionary containing the number of messages waiting to be sent and waiting to be retried, and
+                 counts of messages queued, emails sent (including digests), messages sent, digests, retries,
+                 failures and SMTP connections made.
+        """
+        with self.lock:
+            result = {'queued_now': self.queue.qsize(),
+                      'retrying_now': len(self.retries)}
+            result.update(self.counts)
+            return result
+
+
+# The outbox used by handlers.send_email(), started by the handler daemon
+OUTBOX = Outbox()
@@ -0,0 +1,248 @@
+"""
+Speculative schedule pre-fetch. As soon as the handler daemon accepts an event that one of the handler modules is
+interested in, the schedule (obslist()) is fetched from the trigger web service in the background, overlapping the
+web service round trip with the time the event spends in the queue and being parsed. Handlers call prefetch.obslist()
+instead of triggerservice.obslist(), and get the pre-fetched result if it's available and fresh, or a live one if not.
+
+Handler modules opt in by defining:
+
+    PREFETCH_IVORNS = [...]   # list of ivorn prefixes to pre-fetch the schedule for
+    PREFETCH_OBSTIME = 1800   # the obstime argument the handler passes to obslist()
+
+and the pre-fetch stage is enabled in the [prefetch] section of trigger.conf. Any trigger sent by this process
+invalidates all pre-fetched results, as the schedule will have changed.
+
+For each pre-fetched result used, the round trip time that was hidden (the time the fetch took, minus any time the
+handler still had to wait for it) is logged, and totals are available from stats().
+"""
+
+import logging
+import re
+import sys
+import threading
+import time
+
+if sys.version_info.major == 2:
+    import Queue
+else:
+    import queue as Queue
+
+from . import tracing
+from . import triggerservice
+
+log = logging.getLogger('voevent.handlers.prefetch')   # Inherit the logging setup from handlers.py
+
+IVORN_RE = re.compile(r'''ivorn\s*=\s*["']([^"']+)["']''')
+
+MAX_AGE = 60        # Seconds after which a pre-fetched result is considered stale
+WAIT_TIMEOUT = 15   # Maximum time to wait for an in-progress pre-fetch, before doing a live call
+
+
+class PrefetchEntry(object):
+    """
+    The pre-fetched schedule information for one event.
+    """
+    def __init__(self, ivorn='', obstime=None):
+        self.ivorn = ivorn
+        self.obstime = obstime
+        self.started = time.time()
+        self.fetched = None     # Time the web service call was started
+        self.finished = None
+        self.obslist = None
+        self.generation = 0     # Value of Prefetcher.generation when the fetch started
+        self.trace_id = None    # Trace ID of the event that started the fetch
+        self.done = threading.Event()
+
+
+class Prefetcher(object):
+    """
+    Pool of background threads that fetch the schedule for newly accepted events.
+    """
+    def __init__(self, modules=None, nworkers=2, max_age=MAX_AGE, logger=log):
+        """
+        :param modules: List of handler modules, checked for PREFETCH_IVORNS and PREFETCH_OBSTIME.
+        :param nworkers: Number of fetch threads.
+        :param max_age: Maximum age, in seconds, of a pre-fetched result that will be used.
+        :param logger: optional logger object.
+        """
+        self.specs = []
+        for module in modules or []:
+            for prefix in getattr(module, 'PREFETCH_IVORNS', []):
+                self.specs.append((prefix, getattr(module, 'PREFETCH_OBSTIME', None)))
+        self.nworkers = nworkers
+        self.max_age = max_age
+        self.logger = logger
+        self.queue = Queue.Queue()
+        self.entries = {}
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.threads = []
+        self.counts = {'submitted': 0, 'hits': 0, 'misses': 0, 'stale': 0, 'hidden': 0.0, 'rtt': 0.0}
+
+    def start(self):
+        """
+        Start (or restart, if any have died) the fetch threads.
+        """
+        self.threads = [t for t in self.threads if t.is_alive()]
+        while len(self.threads) < self.nworkers:
+            t = threading.Thread(target=self.run, name='Prefetch-%d' % len(self.threads))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, eventxml):
+        """
+        Called from the RPC thread as each event arrives. If any handler wants the schedule for this event, start
+        fetching it, and return immediately.
+
+        :param eventxml: string containing XML format VOEvent.
+        """
+        match = IVORN_RE.search(eventxml[:4096])
+        if match is None:
+            return
+        ivorn = match.group(1)
+        for prefix, obstime in self.specs:
+            if ivorn.startswith(prefix):
+                break
+        else:
+            return
+        entry = PrefetchEntry(ivorn=ivorn, obstime=obstime)
+        entry.trace_id = tracing.get_trace_id()
+        with self.lock:
+            self._prune()
+            if ivorn in self.entries:
+                return
+            entry.generation = self.generation
+            self.entries[ivorn] = entry
+            self.counts['submitted'] += 1
+        self.queue.put(entry)
+
+    def _prune(self):
+        now = time.time()
+        for ivorn in [k for k, e in self.entries.items() if now - e.started > self.max_age]:
+            del self.entries[ivorn]
+
+    def run(self):
+        """
+        Fetch thread loop.
+        """
+        while True:
+            entry = self.queue.get()
+            entry.fetched = time.time()
+            try:
+                with tracing.trace_context(entry.trace_id), tracing.span('prefetch', ivorn=entry.ivorn):
+                    entry.obslist = triggerservice.obslist(obstime=entry.obstime, logger=self.logger)
+            except Exception:
+                self.logger.exception('Exception pre-fetching schedule for %s' % entry.ivorn)
+            finally:
+                entry.finished = time.time()
+                entry.done.set()
+
+    def invalidate(self):
+        """
+        Mark all pre-fetched results (including those in progress) as stale - called whenever the schedule changes.
+        """
+        with self.lock:
+            self.generation += 1
+
+    def discard(self, ivorn):
+        """
+        Forget the pre-fetched result for an event, called after all handlers have processed it.
+        """
+        with self.lock:
+            self.entries.pop(ivorn, None)
+
+    def get(self, ivorn, obstime=None):
+        """
+        Return the pre-fetched entry for this event, waiting for it if the fetch is still in progress.
+
+        :param ivorn: ivorn of the event being handled.
+        :param obstime: The obstime argument the handler would pass to obslist().
+        :return: A PrefetchEntry, or None if there's no usable pre-fetched result.
+        """
+        called = time.time()
+        with self.lock:
+            entry = self.entries.get(ivorn)
+            generation = self.generation
+        if entry is None or entry.obstime != obstime:
+            with self.lock:
+                self.counts['misses'] += 1
+            return None
+        if not entry.done.wait(WAIT_TIMEOUT) or entry.obslist is None:
+            with self.lock:
+                self.counts['misses'] += 1
+            return None
+        if entry.generation != generation or time.time() - entry.started > self.max_age:
+            with self.lock:
+                self.counts['stale'] += 1
+            return None
+        rtt = entry.finished - entry.fetched
+        hidden = rtt - max(entry.finished - called, 0.0)
+        with self.lock:
+            self.counts['hits'] += 1
+            self.counts['rtt'] += rtt
+            self.counts['hidden'] += hidden
+        self.logger.debug('Pre-fetched schedule for %s hid %.3f s of a %.3f s round trip' % (ivorn, hidden, rtt))
+        return entry
+
+    def stats(self):
+        """
+        :return: Dictionary of counts of submitted, used (hits), unusable (misses) and stale pre-fetches, and
+                 the total round trip time fetched and hidden, in seconds.
+        """
+        with self.lock:
+            return dict(self.counts)
+
+
+# The pre-fetcher used by the handler daemon, created with start_prefetcher()
+PREFETCHER = None
+
+
+def start_prefetcher(modules=None, cp=None, logger=log):
+    """
+    Create and start the pre-fetcher, if enabled in trigger.conf.
+
+    :param modules: List of handler modules to pre-fetch the schedule for.
+    :param cp: ConfigParser object containing the trigger.conf contents.
+    :param logger: optional logger object.
+    :return: The Prefetcher object, or None if not enabled.
+    """
+    global PREFETCHER
+    if cp is None or not (cp.has_option(section='prefetch', option='enabled') and
+                          cp.getboolean('prefetch', 'enabled')):
+        return None
+    nworkers = 2
+    max_age = MAX_AGE
+    if cp.has_option(section='prefetch', option='workers'):
+        nworkers = cp.getint('prefetch', 'workers')
+    if cp.has_option(section='prefetch', option='max_age'):
+        max_age = cp.getfloat('prefetch', 'max_age')
+    PREFETCHER = Prefetcher(modules=modules, nworkers=nworkers, max_age=max_age, logger=logger)
+    PREFETCHER.start()
+    logger.info('Schedule pre-fetch started for: %s' % ', '.join([s[0] for s in PREFETCHER.specs]))
+    return PREFETCHER
+
+
+def obslist(ivorn=None, obstime=None, logger=triggerservice.DEFAULTLOGGER):
+    """
+    Drop-in replacement for triggerservice.obslist(), that returns the pre-fetched schedule for this event if there is
+    a fresh one, or calls the web service if not.
+
+    :param ivorn: ivorn of the event being handled.
+    :param obstime: eg 1800
+    :param logger:  optional logging.logger object
+    :return: list of (starttime, obsname, creator, projectid, mode) tuples
+    """
+    if PREFETCHER is not None and ivorn is not None:
+        entry = PREFETCHER.get(ivorn, obstime=obstime)
+        if entry is not None:
+            return entry.obslist
+    return triggerservice.obslist(obstime=obstime, logger=logger)
+
+
+def invalidate():
+    """
+    Mark all pre-fetched schedule information as stale, called whenever this process changes the schedule.
+    """
+    if PREFETCHER is not None:
+        PREFETCHER.invalidate()
@@ -0,0 +1,143 @@
+"""
+On-demand profiling of the handlers, for finding out why a particular kind of event is slow, in production.
+
+The profiler is armed either from the [profiling] section of trigger.conf, or with the profileEvents() RPC call on the
+handler daemon, to profile the events whose ivorn matches a regular expression, and/or the next N events. The
+QueueWorker then runs the handlers for each matching event under cProfile, and writes the statistics to a file named
+after the ivorn and trace ID, eg:
+
+    /var/log/mwa/profiles/SWIFT_BAT_GRB_Pos_772006-7987_3f2a9c1b0d4e5f60.prof
+
+which can be read with 'python -m pstats <filename>', or snakeviz, etc.
+
+While the profiler isn't armed, the only cost is checking one attribute for each event.
+"""
+
+import collections
+import cProfile
+import logging
+import os
+import re
+import threading
+import time
+
+log = logging.getLogger('voevent.handlers.profiling')   # Inherit the logging setup from handlers.py
+
+PROFILE_DIR = '/tmp/voevent_profiles'   # Directory to write profile files to
+MAX_FILES = 200   # Stop profiling (and disarm) once this many profiles have been written since it was armed
+RECENT_FILES = 10   # Number of recent profile file names returned by status()
+
+
+class EventProfiler(object):
+    """
+    Decides which events to profile, and writes the profile for each one to a file.
+    """
+    def __init__(self, directory=PROFILE_DIR, logger=log):
+        """
+        :param directory: Directory to write profile files to, created if it doesn't exist.
+        :param logger: optional logger object.
+        """
+        self.directory = directory
+        self.logger = logger
+        self.pattern = None    # Compiled regular expression, or None
+        self.count = 0         # Number of (any) events still to profile
+        self.armed = False     # True if either pattern or count is set - the only thing checked for each event
+        self.written = collections.deque(maxlen=RECENT_FILES)   # Names of the most recent profile files written
+        self.total = 0         # Number of profile files written
+        self.since_armed = 0   # Number of profile files written since the last arm()
+        self.lock = threading.Lock()
+
+    def arm(self, pattern=None, count=0):
+        """
+        Profile the events whose ivorn matches the given pattern, and/or the next 'count' events. Replaces any
+        previous settings.
+
+        :param pattern: Regular expression string, matched anywhere in the ivorn, eg 'SWIFT#BAT_GRB_Pos'. None or ''
+                        for no pattern.
+        :param count: Number of events to profile, regardless of their ivorn.
+        """
+        with self.lock:
+            self.pattern = re.compile(pattern) if pattern else None
+            self.count = max(0, int(count))
+            self.armed = (self.pattern is not None) or (self.count > 0)
+            self.since_armed = 0
+        self.logger.info('Event profiling %s (pattern=%r, count=%d, directory=%s)' % ('armed' if self.armed else 'disarmed',
+                                                                                   pattern,
+                                                                                   self.count,
+                                                                                   self.directory))
+
+    def disarm(self):
+        """
+        Stop profiling events.
+        """
+        self.arm(pattern=None, count=0)
+
+    def start(self, ivorn, trace_id=None):
+        """
+        Start profiling the handlers for an event, if it should be profiled. Only call this if self.armed is True.
+
+        :param ivorn: The ivorn of the event.
+        :param trace_id: The trace ID of the event, used in the profile filename.
+        :return: A (profile, filename) tuple to pass to stop(), or None if this event isn't being profiled.
+        """
+        with self.lock:
+            if self.pattern is not None and self.pattern.search(ivorn):
+                pass
+            elif self.count > 0:
+                self.count -= 1
+            else:
+                return None
+            if self.since_armed >= MAX_FILES:
+                self.pattern = None
+                self.count = 0
+                self.armed = False
+                self.logger.error('%d profiles written, disarming the event profiler' % MAX_FILES)
+                return None
+            self.armed = (self.pattern is not None) or (self.count > 0)
+
+        name = re.sub(r'[^A-Za-z0-9_.+-]+', '_', ivorn.split('//')[-1].split('/', 1)[-1])
+        filename = os.path.join(self.directory, '%s_%s.prof' % (name, trace_id or int(time.time())))
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile, filename
+
+    def stop(self, started):
+        """
+        Stop a profile started by start(), and write it to its file.
+
+        :param started: The (profile, filename) tuple returned by start().
+        :return: The name of the file written, or None if it couldn't be written.
+        """
+        profile, filename = started
+        profile.disable()
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            profile.dump_stats(filename)
+        except (IOError, OSError):
+            self.logger.exception('Unable to write event profile to %s' % filename)
+            return None
+        with self.lock:
+            self.written.append(filename)
+            self.total += 1
+            self.since_armed += 1
+        self.logger.info('Wrote event profile to %s' % filename)
+        return filename
+
+    def status(self):
+        """
+        :return: A dictionary containing whether the profiler is armed, the current pattern and count, the number of
+                 profile files written in total and since it was armed, and the most recent ones.
+        """
+        with self.lock:
+            return {'armed': self.armed,
+                    'pattern': self.pattern.pattern if self.pattern is not None else None,
+                    'count': self.count,
+                    'directory': self.directory,
+                    'written': self.total,
+                    'since_armed': self.since_armed,
+                    'recent': list(self.written)}
+
+
+# The profiler used by the QueueWorker, configured by the handler daemon
+PROFILER = EventProfiler()
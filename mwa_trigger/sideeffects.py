@@ -0,0 +1,185 @@
+"""
+Post-decision side effects (notification emails, their attachments, and audit records) are queued here and handled
+by background worker threads, so that the QueueWorker can move on to the next event as soon as the trigger request
+itself has been made, instead of waiting for MIME assembly and an SMTP conversation.
+
+Until start() is called (eg, when a handler module is used from a script, or for testing), submitted jobs are run
+synchronously in the caller's thread, as before.
+
+The number of queued jobs, and the number and details of recent failures, are available from status(), and failures
+are logged as errors.
+"""
+
+import collections
+import json
+import logging
+import sys
+import threading
+import time
+import traceback
+
+if sys.version_info.major == 2:
+    import Queue
+else:
+    import queue as Queue
+
+from . import tracing
+
+log = logging.getLogger('voevent.handlers.sideeffects')   # Inherit the logging setup from handlers.py
+
+MAX_FAILURES = 50   # Number of recent failures to keep details of
+
+
+class SideEffectPipeline(object):
+    """
+    A queue of side effect jobs, and the worker threads that run them.
+    """
+    def __init__(self, nworkers=2, maxsize=1000, audit_file=None, logger=log):
+        """
+        :param nworkers: Number of background worker threads.
+        :param maxsize: Maximum number of queued jobs. If the queue is full, jobs are run synchronously.
+        :param audit_file: Name of a file to append audit records to, one JSON object per line. If None, audit
+                           records are written to the log instead.
+        :param logger: optional logger object.
+        """
+        self.nworkers = nworkers
+        self.audit_file = audit_file
+        self.logger = logger
+        self.queue = Queue.Queue(maxsize=maxsize)
+        self.threads = []
+        self.lock = threading.Lock()
+        self.auditlock = threading.Lock()
+        self.submitted = collections.Counter()
+        self.completed = collections.Counter()
+        self.failed = collections.Counter()
+        self.failures = collections.deque(maxlen=MAX_FAILURES)
+
+    @property
+    def running(self):
+        return len([t for t in self.threads if t.is_alive()]) > 0
+
+    def start(self):
+        """
+        Start (or restart, if any have died) the worker threads.
+        """
+        self.threads = [t for t in self.threads if t.is_alive()]
+        while len(self.threads) < self.nworkers:
+            t = threading.Thread(target=self.run, name='SideEffects-%d' % len(self.threads))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, kind, func, *args, **kwargs):
+        """
+        Queue func(*args, **kwargs) to be run by a worker thread, and return immediately.
+
+        :param kind: Short string describing the job type (eg 'email'), used for the statistics.
+        :param func: Function to call.
+        :return: None
+        """
+        with self.lock:
+            self.submitted[kind] += 1
+        trace_id = tracing.get_trace_id()   # The job runs as part of the trace of the event that queued it
+        if self.running:
+            try:
+                self.queue.put_nowait((kind, func, args, kwargs, time.time(), trace_id))
+                return
+            except Queue.Full:
+                self.logger.error('Side effect queue full, running %s job synchronously' % kind)
+        self._execute(kind, func, args, kwargs, time.time(), trace_id)
+
+    def audit(self, record):
+        """
+        Queue an audit record to be written.
+
+        :param record: A dictionary, which must be serialisable as JSON.
+        """
+        record = dict(record)
+        record.setdefault('time', time.time())
+        self.submit('audit', self._write_audit, record)
+
+    def _write_audit(self, record):
+        line = json.dumps(record, default=str)
+        if self.audit_file is None:
+            self.logger.info('AUDIT: %s' % line)
+            return
+        with self.auditlock:
+            with open(self.audit_file, 'a') as f:
+                f.write(line + '\n')
+
+    def run(self):
+        """
+        Worker thread loop.
+        """
+        while True:
+            kind, func, args, kwargs, queued, trace_id = self.queue.get()
+            try:
+                with tracing.trace_context(trace_id):
+                    tracing.record_span('sideeffect_wait', queued, time.time(), kind=kind)
+                    self._execute(kind, func, args, kwargs, queued, trace_id)
+            finally:
+                self.queue.task_done()
+
+    def _execute(self, kind, func, args, kwargs, queued, trace_id=None):
+        try:
+            with tracing.span('sideeffect', kind=kind):
+                func(*args, **kwargs)
+        except Exception:
+            with self.lock:
+                self.failed[kind] += 1
+                self.failures.append({'kind': kind,
+                                      'trace_id': trace_id,
+                                      'queued': queued,
+                                      'failed': time.time(),
+                                      'error': traceback.format_exc()})
+            self.logger.error('Side effect job (%s) failed: %s' % (kind, traceback.format_exc()))
+        else:
+            with self.lock:
+                self.completed[kind] += 1
+
+    def join(self, timeout=None):
+        """
+        Wait until all queued jobs have been run, or the timeout expires.
+
+        :param timeout: Maximum time to wait, in seconds, or None to wait forever.
+        :return: True if the queue was emptied.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while self.queue.unfinished_tasks:
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def status(self):
+        """
+        :return: A dictionary containing the current backlog, counts of submitted, completed and failed jobs of
+                 each kind, and details of the most recent failures.
+        """
+        with self.lock:
+            return {'backlog': self.queue.qsize(),
+                    'workers': len([t for t in self.threads if t.is_alive()]),
+                    'submitted': dict(self.submitted),
+                    'completed': dict(self.completed),
+                    'failed': dict(self.failed),
+                    'recent_failures': list(self.failures)}
+
+
+# The pipeline used by all handlers, started by the handler daemon
+PIPELINE = SideEffectPipeline()
+
+
+def submit(kind, func, *args, **kwargs):
+    """
+    Queue a side effect job on the shared pipeline (see SideEffectPipeline.submit).
+    """
+    PIPELINE.submit(kind, func, *args, **kwargs)
+
+
+def audit(record):
+    """
+    Queue an audit record on the shared pipeline (see SideEffectPipeline.audit).
+    """
+    PIPELINE.audit(record)
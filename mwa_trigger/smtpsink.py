@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+"""
+Minimal local SMTP server that accepts and stores every message sent to it, for offline testing of the email
+outbox (outbox.py) without sending real mail. It can be told to reject a fraction of messages with a temporary
+error, or to drop the connection, to test the retry spool.
+
+To run the whole handler daemon against it, start this server, eg:
+
+    python -m mwa_trigger.smtpsink --port 8025
+
+and add this to trigger.conf:
+
+    [mail]
+    mailhost = localhost:8025
+"""
+
+import argparse
+import email
+import logging
+import random
+import sys
+import threading
+import time
+
+if sys.version_info.major == 2:
+    from SocketServer import ThreadingMixIn, TCPServer, StreamRequestHandler
+else:
+    from socketserver import ThreadingMixIn, TCPServer, StreamRequestHandler
+
+log = logging.getLogger('voevent.smtpsink')
+
+
+class SinkMessage(object):
+    """
+    One message received by the sink.
+    """
+    def __init__(self, mail_from='', rcpt_to=None, data=b'', connection=0):
+        self.received = time.time()
+        self.mail_from = mail_from
+        self.rcpt_to = rcpt_to or []
+        self.data = data
+        self.connection = connection   # Serial number of the SMTP connection it arrived on
+
+    @property
+    def message(self):
+        """
+        :return: The message parsed into an email.message.Message object.
+        """
+        if sys.version_info.major == 2:
+            return email.message_from_string(self.data)
+        return email.message_from_bytes(self.data)
+
+
+class SMTPSink(object):
+    """
+    Stores the messages received, and decides whether each one should be accepted.
+    """
+    def __init__(self, error_rate=0.0, disconnect_rate=0.0, latency=0.0):
+        """
+        :param error_rate: Fraction of messages rejected with a temporary (451) error after the DATA.
+        :param disconnect_rate: Fraction of messages where the connection is dropped instead of replying to the DATA.
+        :param latency: Delay, in seconds, before replying to each DATA command.
+        """
+        self.error_rate = error_rate
+        self.disconnect_rate = disconnect_rate
+        self.latency = latency
+        self.messages = []
+        self.lock = threading.Lock()
+        self.stats = {'connections': 0, 'accepted': 0, 'rejected': 0, 'disconnected': 0}
+
+    def new_connection(self):
+        with self.lock:
+            self.stats['connections'] += 1
+            return self.stats['connections']
+
+    def deliver(self, msg):
+        """
+        :param msg: SinkMessage object.
+        :return: One of 'accepted', 'rejected' or 'disconnected'
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        roll = random.random()
+        if roll < self.disconnect_rate:
+            outcome = 'disconnected'
+        elif roll < self.disconnect_rate + self.error_rate:
+            outcome = 'rejected'
+        else:
+            outcome = 'accepted'
+        with self.lock:
+            self.stats[outcome] += 1
+            if outcome == 'accepted':
+                self.messages.append(msg)
+        return outcome
+
+    def wait(self, count, timeout=10.0):
+        """
+        Wait until at least count messages have been accepted, or the timeout expires.
+
+        :return: True if there are at least count messages.
+        """
+        deadline = time.time() + timeout
+        while len(self.messages) < count and time.time() < deadline:
+            time.sleep(0.01)
+        return len(self.messages) >= count
+
+
+class SMTPSinkHandler(StreamRequestHandler):
+    """
+    Speaks just enough SMTP for smtplib.
+    """
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('latin-1'))
+        self.wfile.flush()
+
+    def handle(self):
+        sink = self.server.sink
+        connection = sink.new_connection()
+        mail_from, rcpt_to = '', []
+        self.reply('220 localhost SMTP sink ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('latin-1').strip()
+            verb = command[:4].upper()
+            if verb in ['HELO', 'EHLO']:
+                self.reply('250 localhost')
+            elif verb == 'MAIL':
+                mail_from, rcpt_to = command.split(':', 1)[1].strip(), []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                rcpt_to.append(command.split(':', 1)[1].strip())
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                lines = []
+                while True:
+                    dline = self.rfile.readline()
+                    if not dline or dline in [b'.\r\n', b'.\n']:
+                        break
+                    if dline.startswith(b'..'):
+                        dline = dline[1:]
+                    lines.append(dline)
+                outcome = sink.deliver(SinkMessage(mail_from=mail_from,
+                                                   rcpt_to=rcpt_to,
+                                                   data=b''.join(lines),
+                                                   connection=connection))
+                if outcome == 'disconnected':
+                    return
+                elif outcome == 'rejected':
+                    self.reply('451 Temporary failure, try again later')
+                else:
+                    self.reply('250 OK')
+                mail_from, rcpt_to = '', []
+            elif verb == 'RSET':
+                mail_from, rcpt_to = '', []
+                self.reply('250 OK')
+            elif verb == 'NOOP':
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class SMTPSinkServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, sink):
+        TCPServer.__init__(self, server_address, SMTPSinkHandler)
+        self.sink = sink
+
+
+def start_sink(host='localhost', port=0, sink=None):
+    """
+    Start an SMTP sink in a background thread.
+
+    :param host: Interface to bind to.
+    :param port: Port number to listen on - zero means choose a free port.
+    :param sink: Optional SMTPSink instance, a default one is created if not given.
+    :return: A tuple of (server, mailhost), where mailhost can be assigned to outbox.OUTBOX.mailhost. Call
+             server.shutdown() to stop the server, and look at server.sink.messages for the messages received.
+    """
+    if sink is None:
+        sink = SMTPSink()
+    server = SMTPSinkServer((host, port), sink)
+    thread = threading.Thread(target=server.serve_forever, name='SMTPSink')
+    thread.daemon = True
+    thread.start()
+    return server, '%s:%d' % (host, server.server_address[1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a local SMTP server that prints and discards all mail.')
+    parser.add_argument('--host', default='localhost', help='Interface to bind to')
+    parser.add_argument('--port', type=int, default=8025, help='Port to listen on')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of messages rejected with a 451')
+    parser.add_argument('--disconnect-rate', type=float, default=0.0, help='Fraction of messages where the connection is dropped')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG)
+    server, mailhost = start_sink(host=args.host,
+                                  port=args.port,
+                                  sink=SMTPSink(error_rate=args.error_rate, disconnect_rate=args.disconnect_rate))
+    print("SMTP sink running at %s" % mailhost)
+    nseen = 0
+    while True:
+        time.sleep(1)
+        for msg in server.sink.messages[nseen:]:
+            print("%s From: %s To: %s Subject: %s" % (time.ctime(msg.received),
+                                                      msg.mail_from,
+                                                      ', '.join(msg.rcpt_to),
+                                                      msg.message['Subject']))
+        nseen = len(server.sink.messages)
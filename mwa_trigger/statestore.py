@@ -0,0 +1,191 @@
+"""
+Persistent storage of the trigger state held by each handler module (in its xml_cache), so that it survives a restart
+of the handler daemon - eg, so that a Fermi Gnd or Fin notice arriving after a restart still knows that the Flt notice
+for the same trigger was observed, and when, so the requested observing time is still shortened correctly.
+
+The state of each TriggerEvent (the attributes listed in its PERSISTED_ATTRIBUTES - position history, whether and
+when it was triggered, the last trigger type, observing parameters, and any handler specific flags like 'short') is
+written to an SQLite database, one row per trigger ID, by eventregistry.EVENTS.flush(), which the QueueWorker calls
+after the handlers have run on each event. Nothing is loaded at startup - a TriggerEvent is only read from the
+database the first time its trigger ID is looked up in the handler's xml_cache after a restart (or after it was
+evicted from the event registry), so startup time doesn't depend on the size of the database. The VOEvents themselves
+(and their ivorns and trace IDs, which are kept in step with them) and the log messages for each trigger are not
+stored, so a restored TriggerEvent starts with no VOEvents.
+
+Storage is enabled in trigger.conf with:
+
+    [statestore]
+    file = /var/lib/mwa/trigger_state.sqlite
+    max_age = 30
+
+where rows not updated for max_age days are deleted when the database is opened.
+"""
+
+import array
+import json
+import logging
+import sqlite3
+import threading
+
+from astropy.time import Time
+
+from . import clock
+
+log = logging.getLogger('voevent.handlers.statestore')   # Inherit the logging setup from handlers.py
+
+MAX_AGE = 30   # Delete the state of triggers that haven't been updated for this many days, when the store is opened
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS trigger_state (
+    handler TEXT NOT NULL,
+    trigger_id TEXT NOT NULL,
+    updated REAL NOT NULL,
+    state TEXT NOT NULL,
+    PRIMARY KEY (handler, trigger_id)
+);
+CREATE INDEX IF NOT EXISTS trigger_state_updated ON trigger_state (updated);
+"""
+
+
+def get_state(tevent):
+    """
+    :param tevent: A TriggerEvent (or subclass) instance.
+    :return: A dictionary containing the attributes of tevent listed in its PERSISTED_ATTRIBUTES, that can be
+             serialised as JSON.
+    """
+    state = {}
+    for name in tevent.PERSISTED_ATTRIBUTES:
+        value = getattr(tevent, name, None)
+        if isinstance(value, Time):
+            value = {'unix': float(value.unix)}
+        elif isinstance(value, array.array):
+            value = value.tolist()
+        state[name] = value
+    return state
+
+
+def set_state(tevent, state):
+    """
+    Restore the attributes saved by get_state() to a TriggerEvent.
+
+    :param tevent: A TriggerEvent (or subclass) instance.
+    :param state: A dictionary returned by get_state().
+    """
+    for name in tevent.PERSISTED_ATTRIBUTES:
+        if name not in state:
+            continue
+        value = state[name]
+        if isinstance(value, dict) and list(value.keys()) == ['unix']:
+            value = Time(value['unix'], format='unix', scale='utc')
+        elif isinstance(getattr(tevent, name, None), array.array):
+            value = array.array(getattr(tevent, name).typecode, value)
+        setattr(tevent, name, value)
+
+
+class StateStore(object):
+    """
+    SQLite database holding the state of every TriggerEvent, for all handler modules. Safe to use from more than
+    one thread.
+    """
+    def __init__(self, logger=log):
+        """
+        :param logger: optional logger object.
+        """
+        self.filename = None   # Name of the database file, or None if persistent storage isn't enabled
+        self.logger = logger
+        self.conn = None
+        self.lock = threading.RLock()
+        self.stats = {'loaded': 0, 'misses': 0, 'written': 0, 'errors': 0}
+
+    @property
+    def enabled(self):
+        return self.conn is not None
+
+    def open(self, filename, max_age=MAX_AGE):
+        """
+        Open (creating if necessary) the database file, and delete any state older than max_age days.
+
+        :param filename: Name of the SQLite database file.
+        :param max_age: Age in days, or None to keep everything.
+        """
+        with self.lock:
+            self.close()
+            conn = sqlite3.connect(filename, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')     # Writes don't block reads, and commit without an fsync
+            conn.execute('PRAGMA synchronous=NORMAL')   # ...of the main database file
+            conn.executescript(SCHEMA)
+            if max_age is not None:
+                cursor = conn.execute('DELETE FROM trigger_state WHERE updated < ?', (clock.now() - max_age * 86400.0,))
+                if cursor.rowcount:
+                    self.logger.info('Deleted the stored state of %d old triggers' % cursor.rowcount)
+            conn.commit()
+            self.conn = conn
+            self.filename = filename
+        self.logger.info('Trigger state stored in %s' % filename)
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def load(self, handler, trigger_id):
+        """
+        :return: The state dictionary stored for the given handler and trigger ID, or None.
+        """
+        with self.lock:
+            if self.conn is None:
+                return None
+            try:
+                row = self.conn.execute('SELECT state FROM trigger_state WHERE handler=? AND trigger_id=?',
+                                        (handler, trigger_id)).fetchone()
+            except sqlite3.Error:
+                self.stats['errors'] += 1
+                self.logger.exception('Unable to read the state of %s from %s' % (trigger_id, self.filename))
+                return None
+        if row is None:
+            self.stats['misses'] += 1
+            return None
+        self.stats['loaded'] += 1
+        return json.loads(row[0])
+
+    def save(self, handler, states):
+        """
+        Write the state of one or more TriggerEvents to the database, in one transaction.
+
+        :param handler: Name of the handler module.
+        :param states: A list of (trigger_id, state dictionary) tuples.
+        """
+        if not states:
+            return
+        now = clock.now()
+        with self.lock:
+            if self.conn is None:
+                return
+            try:
+                with self.conn:
+                    self.conn.executemany('INSERT OR REPLACE INTO trigger_state (handler, trigger_id, updated, state) '
+                                          'VALUES (?, ?, ?, ?)',
+                                          [(handler, tid, now, json.dumps(state)) for tid, state in states])
+            except (sqlite3.Error, TypeError, ValueError):
+                self.stats['errors'] += 1
+                self.logger.exception('Unable to write trigger state to %s' % self.filename)
+                return
+        self.stats['written'] += len(states)
+
+    def status(self):
+        """
+        :return: A dictionary containing the database filename, number of stored triggers, and counts of triggers
+                 loaded, not found, written and errors.
+        """
+        result = dict(self.stats)
+        result['file'] = self.filename
+        result['stored'] = None
+        with self.lock:
+            if self.conn is not None:
+                result['stored'] = self.conn.execute('SELECT COUNT(*) FROM trigger_state').fetchone()[0]
+        return result
+
+
+# The store used by all the handler modules, opened by the handler daemon if enabled in trigger.conf
+STORE = StateStore()
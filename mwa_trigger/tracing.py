@@ -0,0 +1,173 @@
+"""
+End-to-end tracing of each VOEvent. push_voevent.py gives every packet a trace ID (or putEvent() does, if the
+caller didn't), which is carried with the event through the EventQueue, and then held in a thread-local context while
+the event is handled, so that the handler, TriggerEvent, triggerservice.web_api() and the email code can all tag what
+they do with it, without passing it through every function call. Background workers (side effects, pre-fetch, fast
+lane, outbox) carry the trace ID of the event that queued each job.
+
+Each stage is recorded as a timed span, written as one JSON object per line to the trace file, eg:
+
+    {"trace_id": "3f2a...", "span_id": "9c1b...", "parent_id": null, "name": "handler", "start": 1600000000.123,
+     "duration": 0.456, "thread": "QueueDaemon", "handler": "GRB_fermi_swift", "handled": true}
+
+Tracing is off (and spans cost almost nothing) unless a trace file is configured in the [tracing] section of
+trigger.conf.
+"""
+
+import binascii
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger('voevent.handlers.tracing')   # Inherit the logging setup from handlers.py
+
+_local = threading.local()
+
+
+def new_trace_id():
+    """
+    :return: A new, random, 16 character hex trace ID string.
+    """
+    return binascii.hexlify(os.urandom(8)).decode('ascii')
+
+
+def get_trace_id():
+    """
+    :return: The trace ID for the event being handled by this thread, or None.
+    """
+    return getattr(_local, 'trace_id', None)
+
+
+def set_trace_id(trace_id):
+    """
+    Set the trace ID for the event being handled by this thread (None to clear it).
+    """
+    _local.trace_id = trace_id
+    _local.spans = []
+
+
+class trace_context(object):
+    """
+    Context manager that sets the thread's trace ID for the enclosed block, and restores the previous one afterwards.
+    """
+    def __init__(self, trace_id):
+        self.trace_id = trace_id
+
+    def __enter__(self):
+        self.previous = (get_trace_id(), getattr(_local, 'spans', []))
+        set_trace_id(self.trace_id)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _local.trace_id, _local.spans = self.previous
+        return False
+
+
+class Tracer(object):
+    """
+    Writes finished spans to the trace file.
+    """
+    def __init__(self, filename=None):
+        self.filename = None
+        self.fileobj = None
+        self.lock = threading.Lock()
+        self.configure(filename)
+
+    @property
+    def enabled(self):
+        return self.fileobj is not None
+
+    def configure(self, filename=None):
+        """
+        Start writing spans to the given file (appending to it), or stop writing spans if filename is None.
+        """
+        with self.lock:
+            if self.fileobj is not None:
+                self.fileobj.close()
+                self.fileobj = None
+            self.filename = filename
+            if filename:
+                self.fileobj = open(filename, 'a')
+
+    def emit(self, record):
+        line = json.dumps(record, default=str)
+        with self.lock:
+            if self.fileobj is not None:
+                self.fileobj.write(line + '\n')
+                self.fileobj.flush()
+
+
+# The tracer used by all modules, configured by the handler daemon
+TRACER = Tracer()
+
+
+class span(object):
+    """
+    Context manager that records the time taken by the enclosed block as a span in the current trace, eg:
+
+        with tracing.span('web_api', endpoint='obslist') as sp:
+            ...
+            sp.set(status='ok')
+    """
+    def __init__(self, name, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.span_id = None
+
+    def set(self, **attrs):
+        """
+        Add attributes to the span, eg the outcome once it's known.
+        """
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        if TRACER.enabled:
+            self.span_id = new_trace_id()
+            stack = getattr(_local, 'spans', None)
+            if stack is None:
+                stack = _local.spans = []
+            self.parent_id = stack[-1] if stack else None
+            stack.append(self.span_id)
+            self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.span_id is not None:
+            end = time.time()
+            stack = getattr(_local, 'spans', [])
+            if stack and stack[-1] == self.span_id:
+                stack.pop()
+            if exc_type is not None:
+                self.attrs['error'] = exc_type.__name__
+            record_span(self.name, self.start, end, span_id=self.span_id, parent_id=self.parent_id, **self.attrs)
+        return False
+
+
+def record_span(name, start, end, trace_id=None, span_id=None, parent_id=None, **attrs):
+    """
+    Record a span whose start and end times were measured separately (eg, the time an event spent in the queue).
+
+    :param name: Name of the stage, eg 'queue_wait'.
+    :param start: Start time, in seconds since the Unix epoch.
+    :param end: End time, in seconds since the Unix epoch.
+    :param trace_id: The trace ID, defaults to the current thread's.
+    :param span_id: Optional span ID, a new one is generated if not given.
+    :param parent_id: Optional span ID of the enclosing span.
+    :param attrs: Any other attributes to record with the span.
+    """
+    if not TRACER.enabled:
+        return
+    record = {'trace_id': trace_id or get_trace_id(),
+              'span_id': span_id or new_trace_id(),
+              'parent_id': parent_id,
+              'name': name,
+              'start': start,
+              'duration': end - start,
+              'thread': threading.current_thread().name}
+    record.update(attrs)
+    try:
+        TRACER.emit(record)
+    except Exception:
+        log.exception('Error writing trace span')
@@ -6,26 +6,50 @@
 import base64
 import json
 import sys
+import time
 import traceback
 
 import logging
 logging.basicConfig()
 
 if sys.version_info.major == 3:  # Python3
+    from configparser import ConfigParser as conparser
     from urllib.parse import urlencode
     from urllib.request import Request, urlopen
     from urllib.error import HTTPError, URLError
 else:  # Python2
+    from ConfigParser import SafeConfigParser as conparser
     from urllib import urlencode
     from urllib2 import urlopen, HTTPError, URLError, Request
 
 
+from . import metrics
+from . import tracing
+
 DEFAULTLOGGER = logging.getLogger()
 DEFAULTLOGGER.level = logging.DEBUG
 
+WEB_API_SECONDS = metrics.REGISTRY.histogram('voevent_triggerservice_seconds',
+                                             'Time taken by each call to the trigger web service',
+                                             ['endpoint', 'status'])
+
 BASEURL = "http://mro.mwa128t.org/trigger/"
 # BASEURL = "http://52.64.91.219/trigger/"    # Testing Django service - must be used in 'pretend' mode, as it's using a read-only database connection
 
+# If not None, a function called by web_api() instead of making an HTTP request, with the same arguments as _web_api()
+# (eg fake_triggerservice.LocalTransport, to run the handlers against an in-process fake web service).
+TRANSPORT = None
+
+CPPATH = ['/usr/local/etc/trigger.conf', 'mwa_trigger/trigger.conf', './trigger.conf']   # Path list to look for configuration file
+CP = conparser()
+CP.read(CPPATH)
+
+# Point at a different web service (eg a local fake_triggerservice.py instance for testing) if configured
+if CP.has_option(section='triggerservice', option='baseurl'):
+    BASEURL = CP.get(section='triggerservice', option='baseurl')
+    if not BASEURL.endswith('/'):
+        BASEURL += '/'
+
 
 def web_api(url='', urldict=None, postdict=None, username=None, password=None, logger=DEFAULTLOGGER):
     """
@@ -49,6 +73,25 @@ def web_api(url='', urldict=None, postdict=None, username=None, password=None, l
              text), the text itself, or None, and 'header' is the HTTP header object (use
              .get_param() to extract values) or None.
     """
+    endpoint = url.rstrip('/').split('/')[-1]
+    start = time.time()
+    with tracing.span('web_api', endpoint=endpoint) as sp:
+        if TRANSPORT is not None:
+            result = TRANSPORT(url=url, urldict=urldict, postdict=postdict, username=username, password=password,
+                               logger=logger)
+        else:
+            result = _web_api(url=url, urldict=urldict, postdict=postdict, username=username, password=password,
+                              logger=logger)
+        status = 'error' if result is None else 'ok'
+        sp.set(status=status)
+    WEB_API_SECONDS.labels(endpoint=endpoint, status=status).observe(time.time() - start)
+    return result
+
+
+def _web_api(url='', urldict=None, postdict=None, username=None, password=None, logger=DEFAULTLOGGER):
+    """
+    Does the work for web_api(), which times each call.
+    """
     if urldict is not None:
         urldata = '?' + urlencode(urldict)
     else:
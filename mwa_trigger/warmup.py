@@ -0,0 +1,225 @@
+"""
+Warm-up of the handlers when the handler daemon starts, so that the first real event is handled as quickly as the
+ones after it.
+
+Much of what the handlers use is set up the first time it's called - voeventparse and lxml, astropy's Time scales and
+coordinate frame transforms (the first SkyCoord.transform_to('altaz') in TriggerEvent.trigger_observation() takes
+most of a second), and for the GW handler, the MWA grid points file, healpy and the mwa_pb primary beam model. The
+warm-up does all of that on a synthetic VOEvent before the daemon starts accepting events, without sending anything
+or changing any state:
+
+  - The VOEvent is passed to each enabled handler's processevent() function, in pretend mode. Its IVORN doesn't
+    match any real event stream, so every handler parses it, and rejects it.
+  - A TriggerEvent of each handler's type is created from it (but not stored in the event registry), and the
+    position, elevation, time and journal calls made while deciding whether to trigger are run on it.
+  - If a handler module has a warmup() function (eg GW_LIGO.warmup()), it's called, to exercise anything else that
+    handler does on its first event.
+
+The whole thing is done twice, and the time taken by each handler on both passes is logged, and returned by the
+warmupStatus() RPC call - the second pass shows the steady state time the first event now gets.
+
+The warm-up leaves reference cycles behind (from the parsed VOEvents, TriggerEvents and astropy frames), and
+without anything else, the garbage collection that frees them - about 50 ms - happens during the first real event.
+So the warm-up finishes with a full collection, and then (on Python 3.7 and later) moves the hundred thousand or so
+objects left, nearly all of them from the imports, to the garbage collector's permanent generation, so later
+collections never scan them again.
+
+Re-importing the handler modules (see hotreload.py) doesn't undo any of this - astropy, healpy etc stay set up - so
+the warm-up is only run at startup.
+
+The IERS tables used by the coordinate transforms are loaded beforehand from local copies (see iersdata.py), so
+neither the warm-up nor any event ever waits for astropy to download them.
+"""
+
+import gc
+import logging
+import sys
+import time
+import traceback
+
+import astropy.units
+from astropy.coordinates import SkyCoord
+import voeventparse
+
+from . import clock
+from . import eventregistry
+from . import handlers
+from . import latency
+
+log = logging.getLogger('voevent.handlers.warmup')   # Inherit the logging setup from handlers.py
+
+WARMUP_RA = 200.0      # Position of the synthetic event, J2000 degrees
+WARMUP_DEC = -30.0
+WARMUP_ERR = 0.05
+PASSES = 2             # Number of times to run the warm-up, the second showing the steady state
+
+# A minimal VOEvent with the elements the handlers look at, that no handler will accept
+EVENT_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<voe:VOEvent ivorn="ivo://mwa.telemetry/warmup#%(serial)d" role="test" version="2.0"
+    xmlns:voe="http://www.ivoa.net/xml/VOEvent/v2.0" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+  <Who>
+    <AuthorIVORN>ivo://mwa.telemetry/warmup</AuthorIVORN>
+    <Date>%(isotime)s</Date>
+  </Who>
+  <What>
+    <Param name="Packet_Type" dataType="int" value="0" />
+    <Param name="TrigID" dataType="int" value="%(serial)d" />
+    <Description>Synthetic event used to warm up the VOEvent handlers at startup</Description>
+  </What>
+  <WhereWhen>
+    <ObsDataLocation>
+      <ObservatoryLocation id="GEOLUN" />
+      <ObservationLocation>
+        <AstroCoordSystem id="UTC-FK5-GEO" />
+        <AstroCoords coord_system_id="UTC-FK5-GEO">
+          <Time unit="s">
+            <TimeInstant>
+              <ISOTime>%(isotime)s</ISOTime>
+            </TimeInstant>
+          </Time>
+          <Position2D unit="deg">
+            <Name1>RA</Name1>
+            <Name2>Dec</Name2>
+            <Value2>
+              <C1>%(ra).4f</C1>
+              <C2>%(dec).4f</C2>
+            </Value2>
+            <Error2Radius>%(err).4f</Error2Radius>
+          </Position2D>
+        </AstroCoords>
+      </ObservationLocation>
+    </ObsDataLocation>
+  </WhereWhen>
+  <Why importance="0.0">
+    <Inference probability="0.0">
+      <Concept>warm-up</Concept>
+    </Inference>
+  </Why>
+</voe:VOEvent>
+"""
+
+# Result of the most recent run(), for status()
+LAST = {}
+
+
+def synthetic_event(serial=0, ra=WARMUP_RA, dec=WARMUP_DEC, err=WARMUP_ERR, unixtime=None):
+    """
+    :param serial: Number used in the IVORN and TrigID, so that each event is different.
+    :param ra: J2000 RA in degrees.
+    :param dec: J2000 Dec in degrees.
+    :param err: Error radius in degrees.
+    :param unixtime: Event time as a Unix timestamp, defaults to now.
+    :return: A synthetic VOEvent, as an XML string.
+    """
+    if unixtime is None:
+        unixtime = clock.now()
+    isotime = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(unixtime)) + '.%03d' % (int(unixtime * 1000) % 1000)
+    return EVENT_TEMPLATE % {'serial': serial, 'isotime': isotime, 'ra': ra, 'dec': dec, 'err': err}
+
+
+def warm_common(eventxml):
+    """
+    Run the calls shared by all the handlers on the synthetic event.
+
+    :param eventxml: The synthetic VOEvent, as an XML string.
+    :return: The parsed VOEvent.
+    """
+    if sys.version_info.major == 2:
+        v = voeventparse.loads(str(eventxml))
+    else:
+        v = voeventparse.loads(eventxml.encode('latin-1'))
+    voeventparse.convenience.get_event_position(v)
+    voeventparse.convenience.get_event_time_as_utc(v)
+    latency.event_times(v)
+    ra, dec, err = handlers.get_position_info(v)
+    handlers.get_altitude_fast(ra, dec)
+    t = clock.astropy_now()
+    handlers.get_altitude(ra, dec, obstime=t)
+    t.gps, t.iso
+    (clock.astropy_now() - t).sec
+    SkyCoord(ra=ra, dec=dec, unit=astropy.units.degree, frame='icrs').separation(
+        SkyCoord(ra=ra + 1.0, dec=dec, unit=astropy.units.degree, frame='icrs')).degree
+    voeventparse.dumps(v)
+    return v
+
+
+def warm_handler(module, eventxml, v):
+    """
+    Run one handler module's code on the synthetic event, without it being stored or acted on.
+
+    :param module: A handler module, with a processevent() function.
+    :param eventxml: The synthetic VOEvent, as an XML string.
+    :param v: The parsed synthetic VOEvent.
+    :return: None
+    """
+    if module.processevent(event=eventxml, pretend=True):
+        log.error('%s accepted the synthetic warm-up event %s' % (module.__name__, v.attrib['ivorn']))
+    cache = getattr(module, 'xml_cache', None)
+    if isinstance(cache, eventregistry.HandlerCache):
+        tevent = cache.factory()   # Not added to the cache, so it's never saved, indexed or evicted
+    else:
+        tevent = handlers.TriggerEvent()
+    tevent.trigger_id = 'WARMUP'
+    tevent.add_event(v)
+    tevent.add_pos(handlers.get_position_info(v))
+    ra, dec, err = tevent.get_pos()
+    handlers.get_altitude(ra, dec, obstime=clock.astropy_now())
+    tevent.get_event()
+    tevent.since_last_trigger()
+    if hasattr(module, 'warmup'):
+        module.warmup()
+
+
+def run(modules, passes=PASSES, logger=log):
+    """
+    Warm up the handlers, timing each one on every pass. Errors are logged and returned, never raised - the handlers
+    are still usable, just slower on their first event.
+
+    :param modules: List of handler modules.
+    :param passes: Number of times to run the warm-up.
+    :param logger: optional logger object.
+    :return: A dictionary with the 'seconds' taken by each pass for each module ('common' for the shared calls, and
+             'gc' for the final garbage collection), the total 'elapsed' time, and any 'errors'.
+    """
+    start = time.time()
+    result = {'seconds': {}, 'errors': [], 'elapsed': 0.0, 'time': start}
+    for serial in range(passes):
+        eventxml = synthetic_event(serial=serial)
+        t0 = time.time()
+        try:
+            v = warm_common(eventxml)
+        except Exception:
+            result['errors'].append('common: %s' % traceback.format_exc())
+            break
+        result['seconds'].setdefault('common', []).append(time.time() - t0)
+        for module in modules:
+            name = module.__name__.split('.')[-1]
+            t0 = time.time()
+            try:
+                warm_handler(module, eventxml, v)
+            except Exception:
+                result['errors'].append('%s: %s' % (name, traceback.format_exc()))
+                continue
+            result['seconds'].setdefault(name, []).append(time.time() - t0)
+    t0 = time.time()
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    result['seconds']['gc'] = [time.time() - t0]
+    result['elapsed'] = time.time() - start
+
+    summary = ', '.join(['%s %s' % (name, '/'.join(['%.3f' % s for s in seconds]))
+                         for name, seconds in sorted(result['seconds'].items())])
+    logger.info('Handler warm-up finished in %.2f s (seconds per pass: %s)' % (result['elapsed'], summary))
+    for error in result['errors']:
+        logger.error('Handler warm-up failed for %s' % error)
+    LAST.clear()
+    LAST.update(result)
+    return result
+
+
+def status():
+    """
+    :return: The result of the most recent run(), or an empty dictionary if there hasn't been one.
+    """
+    return dict(LAST)
@@ -18,6 +18,7 @@ import os
 import pwd
 import sys
 import traceback
+import uuid
 import warnings
 
 if sys.version_info.major == 2:
@@ -100,11 +101,12 @@ def initPyro(logger=DEFAULTLOGGER):
     return client
 
 
-def PyroTransmit(event='', logger=DEFAULTLOGGER):
+def PyroTransmit(event='', trace_id=None, logger=DEFAULTLOGGER):
     """
     Send an XML string to the remote VOEventHandler for processing.
 
     :param event: string containing VOEvent XML
+    :param trace_id: Optional trace ID string, used to follow this event through the handler's log and trace files.
     :param logger: An optional logging.Logger object to use to log messages from the Pyro4 proxy
     """
     try:
@@ -115,8 +117,8 @@ def PyroTransmit(event='', logger=DEFAULTLOGGER):
 
     try:
         with client:
-            logger.debug('Transmitting event to the handler via Pyro')
-            client.putEvent(event=event)   # Send the XML
+            logger.debug('Transmitting event to the handler via Pyro, trace ID %s' % trace_id)
+            client.putEvent(event=event, trace_id=trace_id)   # Send the XML
     except (Pyro4.errors.ConnectionClosedError, Pyro4.errors.TimeoutError, Pyro4.errors.ProtocolError):
         logger.error('Communication exception in PyroTransmit')
         return False
@@ -129,7 +131,7 @@ def PyroTransmit(event='', logger=DEFAULTLOGGER):
 
 if __name__ == '__main__':
     event = sys.stdin.read()
-    success = PyroTransmit(event)
+    success = PyroTransmit(event, trace_id=uuid.uuid4().hex[:16])
     if success:
         sys.exit(0)
     else:
@@ -8,9 +8,11 @@
    sent.
 """
 
+import collections
 import logging
 import os
 import pwd
+import signal
 import socket
 import sys
 import threading
@@ -24,11 +26,10 @@ else:
     from configparser import ConfigParser as conparser
     import queue as Queue
 
-from astropy.time import Time
-
 import voeventparse
 
 IVORN_LIST = []    # Maintain list of ivorn names that have already been processed by the queue
+RECENT_WAITS = collections.deque(maxlen=100)   # Seconds spent in the EventQueue by the most recent events
 
 EXCEPTION_NOTIFY_LIST = ["Andrew.Williams@curtin.edu.au"]
 
@@ -41,28 +42,38 @@ The VOEvent handler threw an exception:
 
 
 ############### set up the logging before importing Pyro4
-class MWALogFormatter(logging.Formatter):
-    """
-    Add a time string to the start of any log messages sent to the log file.
-    """
-    def format(self, record):
-        now = Time.now()
-        return "%s=(%d): %s" % (now.iso, int(now.gps), record.getMessage())
+from mwa_trigger.logpipeline import MWALogFormatter, rotating_file_handler, start_queue_logging
 
+CPPATH = ['/usr/local/etc/trigger.conf', './trigger.conf']   # Path list to look for configuration file
+CP = conparser()
+CP.read(CPPATH)
 
 LOGLEVEL_LOGFILE = logging.DEBUG      # Logging level for logfile
 
 # Make the log file name include the username, to avoid permission errors
 LOGFILE = "/var/log/mwa/voevents-%s.log" % pwd.getpwuid(os.getuid()).pw_name
+if CP.has_option(section='logging', option='logfile'):
+    LOGFILE = CP.get(section='logging', option='logfile')
+
+LOG_ROTATE_WHEN = 'midnight'   # Start a new log file at midnight UTC
+if CP.has_option(section='logging', option='rotate_when'):
+    LOG_ROTATE_WHEN = CP.get(section='logging', option='rotate_when')
+LOG_BACKUP_COUNT = 30          # Number of old log files to keep
+if CP.has_option(section='logging', option='backup_count'):
+    LOG_BACKUP_COUNT = CP.getint('logging', 'backup_count')
+LOG_COMPRESS = True            # gzip old log files
+if CP.has_option(section='logging', option='compress'):
+    LOG_COMPRESS = CP.getboolean('logging', 'compress')
 
 formatter = MWALogFormatter()
 
-filehandler = logging.FileHandler(LOGFILE)
+filehandler = rotating_file_handler(LOGFILE, when=LOG_ROTATE_WHEN, backup_count=LOG_BACKUP_COUNT, compress=LOG_COMPRESS)
 filehandler.setLevel(LOGLEVEL_LOGFILE)
 filehandler.setFormatter(formatter)
 
+# Records are formatted and written to the log file by a background thread, not the thread that logs them
 DEFAULTLOGGER = logging.getLogger('voevent')
-DEFAULTLOGGER.addHandler(filehandler)
+LOGLISTENER = start_queue_logging(DEFAULTLOGGER, [filehandler])
 ##############
 
 import Pyro4
@@ -73,9 +84,28 @@ sys.excepthook = Pyro4.util.excepthook
 Pyro4.config.DETAILED_TRACEBACK = True
 
 from mwa_trigger import handlers
+from mwa_trigger import archive
+from mwa_trigger import clock
+from mwa_trigger import decisions
+from mwa_trigger import eventregistry
+from mwa_trigger import fastlane
+from mwa_trigger import hotreload
+from mwa_trigger import iersdata
+from mwa_trigger import introspect
+from mwa_trigger import latency
+from mwa_trigger import metrics
+from mwa_trigger import notify
+from mwa_trigger import outbox
+from mwa_trigger import prefetch
+from mwa_trigger import profiling
+from mwa_trigger import sideeffects
+from mwa_trigger import statestore
+from mwa_trigger import tracing
+from mwa_trigger import warmup
 from mwa_trigger import GRB_fermi_swift, FlareStar_swift_maxi, GW_LIGO, Neutrino
 
 PRETEND = False   # Set to true to trigger event in 'pretend' mode, not actually schedule observations.
+WARMUP = True     # Run the handlers on a synthetic event at startup (see warmup.py)
 
 # One or more handler functions - all will be called in turn on each XML event.
 EVENTHANDLERS = [
@@ -89,17 +119,24 @@ Pyro4.config.COMMTIMEOUT = 10.0
 Pyro4.config.THREADPOOL_SIZE_MIN = 8
 Pyro4.config.SERIALIZERS_ACCEPTED.add('pickle')
 
+EVENTS_RECEIVED = metrics.REGISTRY.counter('voevent_events_received_total', 'VOEvents received via putEvent()')
+DUPLICATE_EVENTS = metrics.REGISTRY.counter('voevent_duplicate_events_total', 'VOEvents discarded as already seen')
+QUEUE_DEPTH = metrics.REGISTRY.gauge('voevent_queue_depth', 'Number of VOEvents waiting in the EventQueue')
+QUEUE_WAIT_SECONDS = metrics.REGISTRY.histogram('voevent_queue_wait_seconds',
+                                                'Time each VOEvent spent waiting in the EventQueue')
+HANDLER_SECONDS = metrics.REGISTRY.histogram('voevent_handler_seconds',
+                                             'Time taken by each handler function to make its decision',
+                                             ['handler', 'handled'])
+
+SIDEEFFECT_BACKLOG_WARNING = 20   # Log a warning if more than this many emails, etc, are waiting to be sent
+
 REFERENCEIP = '8.8.8.8'  # A host guaranteed to be visible on the network interface that we want the Pyro server to bind to
 EXITING = None
 PYRO_DAEMON = None
-
-CPPATH = ['/usr/local/etc/trigger.conf', './trigger.conf']   # Path list to look for configuration file
-
+RELOAD_REQUESTED = threading.Event()   # Set by SIGHUP, to reload the handlers from the main thread
 
 ############## Point to a running Pyro nameserver #####################
 # If not on site, start one before running this code, using pyro_nameserver.py
-CP = conparser()
-CP.read(CPPATH)
 
 if CP.has_option(section='pyro', option='ns_host'):
     Pyro4.config.NS_HOST = CP.get(section='pyro', option='ns_host')
@@ -132,16 +169,203 @@ class VOEventHandler(object):
         pass
 
     @Pyro4.expose
-    def putEvent(self, event=None):
+    def queueStatus(self):
+        """
+        Return the EventQueue depth, the age of the oldest queued event, the wait times of recent events, and the size
+        of the IVORN_LIST used to discard duplicate events.
+        """
+        with EventQueue.mutex:
+            queuedtimes = [item[1] for item in EventQueue.queue]
+            unfinished = EventQueue.unfinished_tasks   # Queued, or still being processed
+        now = time.time()
+        waits = list(RECENT_WAITS)
+        return {'depth': len(queuedtimes),
+                'unfinished': unfinished,
+                'maxsize': EventQueue.maxsize,
+                'oldest_age': (now - min(queuedtimes)) if queuedtimes else None,
+                'recent_waits': len(waits),
+                'recent_wait_mean': (sum(waits) / len(waits)) if waits else None,
+                'recent_wait_max': max(waits) if waits else None,
+                'ivorn_list': len(IVORN_LIST)}
+
+    @Pyro4.expose
+    def threadStacks(self):
+        """
+        Return the current stack of every thread, as a dictionary of thread name to a list of frames, innermost last.
+        """
+        return introspect.thread_stacks()
+
+    @Pyro4.expose
+    def cacheSizes(self):
+        """
+        Return the number of events, VOEvents and log messages in each handler module's xml_cache.
+        """
+        return introspect.cache_sizes([sys.modules[h.__module__] for h in EVENTHANDLERS])
+
+    @Pyro4.expose
+    def memoryStatus(self):
+        """
+        Return the process RSS, thread and object counts, the IVORN_LIST size and the tracemalloc totals.
+        """
+        result = introspect.memory_status()
+        result['ivorn_list'] = len(IVORN_LIST)
+        return result
+
+    @Pyro4.expose
+    def startTracemalloc(self, nframes=introspect.TRACEMALLOC_FRAMES):
+        """
+        Start tracing memory allocations (opt-in, as it slows the daemon down), for use with topAllocations().
+        """
+        return introspect.start_tracemalloc(nframes=nframes)
+
+    @Pyro4.expose
+    def stopTracemalloc(self):
+        """
+        Stop tracing memory allocations.
+        """
+        introspect.stop_tracemalloc()
+
+    @Pyro4.expose
+    def topAllocations(self, limit=20, key_type='lineno'):
+        """
+        Return the allocation sites using the most memory, from a tracemalloc snapshot, or None if startTracemalloc()
+        hasn't been called.
+        """
+        return introspect.top_allocations(limit=limit, key_type=key_type)
+
+    @Pyro4.expose
+    def sideEffectStatus(self):
+        """
+        Return the backlog, job counts and recent failures of the background side effect (email, audit) pipeline.
+        """
+        return sideeffects.PIPELINE.status()
+
+    @Pyro4.expose
+    def outboxStatus(self):
+        """
+        Return the number of emails waiting to be sent or retried, and counts of emails sent, retried and abandoned.
+        """
+        return outbox.OUTBOX.status()
+
+    @Pyro4.expose
+    def notifyStatus(self):
+        """
+        Return the number of debug notification digests waiting, and counts of digests sent and rate limited.
+        """
+        return notify.AGGREGATOR.status()
+
+    @Pyro4.expose
+    def latencyStats(self):
+        """
+        Return the rolling percentiles of the latency from event and notice times to trigger decisions, by source.
+        """
+        return latency.LEDGER.status()
+
+    @Pyro4.expose
+    def decisionLedgerStatus(self):
+        """
+        Return the decision ledger directory, and the number of decisions written since startup.
+        """
+        return decisions.LEDGER.status()
+
+    @Pyro4.expose
+    def reloadHandlers(self, reimport=True):
+        """
+        Re-read the handler settings from trigger.conf and, if reimport is True, re-import the handler modules in
+        place, keeping their trigger events. Waits for the event currently being handled, if any. Returns the settings
+        changed and any errors - if there are errors, nothing is changed.
+        """
+        return reload_handlers(reimport=reimport)
+
+    @Pyro4.expose
+    def handlerSettings(self):
+        """
+        Return the handler settings from trigger.conf currently in effect, and the result of the last reload.
+        """
+        return hotreload.RELOADER.status()
+
+    @Pyro4.expose
+    def warmupStatus(self):
+        """
+        Return the time each handler took on each pass of the last warm-up, and the IERS and leap second tables in use.
+        """
+        return {'warmup': warmup.status(), 'iers': iersdata.status()}
+
+    @Pyro4.expose
+    def profileEvents(self, pattern=None, count=0):
+        """
+        Profile the handlers for events whose ivorn matches the regular expression 'pattern', and/or for the next
+        'count' events, writing one profile file per event. Call with no arguments to stop profiling.
+        """
+        profiling.PROFILER.arm(pattern=pattern, count=count)
+        return profiling.PROFILER.status()
+
+    @Pyro4.expose
+    def profileStatus(self):
+        """
+        Return the event profiler settings, and the names of the most recent profile files written.
+        """
+        return profiling.PROFILER.status()
+
+    @Pyro4.expose
+    def eventRegistryStatus(self):
+        """
+        Return the number and estimated size of the trigger events held in memory, by handler and source, and counts
+        of lookups, additions and evictions.
+        """
+        return eventregistry.EVENTS.status()
+
+    @Pyro4.expose
+    def stateStoreStatus(self):
+        """
+        Return the trigger state database filename, number of triggers stored, and counts of triggers loaded and saved.
+        """
+        return statestore.STORE.status()
+
+    @Pyro4.expose
+    def archiveStatus(self):
+        """
+        Return the VOEvent archive directory, current segment, and counts of events archived, bytes written and events
+        dropped because the queue was full.
+        """
+        return archive.ARCHIVE.status()
+
+    @Pyro4.expose
+    def prefetchStats(self):
+        """
+        Return the speculative schedule pre-fetch statistics, including the total web service round trip time hidden.
+        """
+        if prefetch.PREFETCHER is None:
+            return None
+        return prefetch.PREFETCHER.stats()
+
+    @Pyro4.expose
+    def putEvent(self, event=None, trace_id=None):
         """
         Called by the remote client to send a VOEvent XML packet to this server. It just
         pushes the complete XML packet onto the queue for background processing, and returns
         immediately.
 
         :param event: string containing XML format VOEvent.
+        :param trace_id: Optional trace ID string from the client - if not given, a new one is generated.
         """
-        EventQueue.put(event)
-        self.logger.info("Queued VOEvent XML, current queue size is %d" % EventQueue.qsize())
+        if not trace_id:
+            trace_id = tracing.new_trace_id()
+        with tracing.trace_context(trace_id), tracing.span('ingest'):
+            if clock.CLOCK.simulated:
+                # Replaying recorded events (see benchmarks/replay.py) - each one arrives at the time it was issued
+                issued = archive.packet_info(event)[2]
+                if (issued is not None) and (issued > clock.now()):
+                    clock.CLOCK.set(issued)
+            received = clock.now()
+            if fastlane.FASTLANE is not None:
+                fastlane.FASTLANE.submit(event, received=received)   # Before the put(), which can block
+            archive.ARCHIVE.submit(event, received=received, trace_id=trace_id)
+            if prefetch.PREFETCHER is not None:
+                prefetch.PREFETCHER.submit(event)   # Start fetching the schedule while the event waits in the queue
+            EVENTS_RECEIVED.inc()
+            EventQueue.put((event, time.time(), trace_id))
+        self.logger.info("Queued VOEvent XML with trace ID %s, current queue size is %d" % (trace_id, EventQueue.qsize()))
 
     def servePyroRequests(self):
         """
@@ -241,23 +465,52 @@ def QueueWorker():
     global IVORN_LIST
     try:
         while not EXITING:
-            eventxml = EventQueue.get()
+            eventxml, queued, trace_id = EventQueue.get()
+            QUEUE_WAIT_SECONDS.observe(time.time() - queued)
+            RECENT_WAITS.append(time.time() - queued)
+            tracing.set_trace_id(trace_id)
+            tracing.record_span('queue_wait', queued, time.time())
             if sys.version_info.major == 2:
                 # event arrives as a unicode string but loads requires a non-unicode string.
                 v = voeventparse.loads(str(eventxml))
             else:
                 v = voeventparse.loads(eventxml.encode('latin-1'))
             if v.attrib['ivorn'] in IVORN_LIST:
+                DUPLICATE_EVENTS.inc()
                 DEFAULTLOGGER.info("Already seen event %s, discarding. Current queue size is %d" % (v.attrib['ivorn'],
                                                                                                     EventQueue.qsize()))
             else:
-                DEFAULTLOGGER.info("Processing event %s. Current queue size is %d" % (v.attrib['ivorn'],
-                                                                                      EventQueue.qsize()))
+                DEFAULTLOGGER.info("Processing event %s (trace ID %s). Current queue size is %d" % (v.attrib['ivorn'],
+                                                                                                    trace_id,
+                                                                                                    EventQueue.qsize()))
                 IVORN_LIST.append(v.attrib['ivorn'])
-                for hfunc in EVENTHANDLERS:
-                    handled = hfunc(event=eventxml, pretend=PRETEND)
-                    if handled:   # One of the handlers accepted this event
-                        break    # Don't try any more event handlers.
+                if fastlane.FASTLANE is not None:
+                    fastlane.FASTLANE.wait(v.attrib['ivorn'])   # Let the handlers see any fast lane trigger
+                with hotreload.LOCK:   # A handler reload waits until this event has been handled
+                    profile = None
+                    if profiling.PROFILER.armed:
+                        profile = profiling.PROFILER.start(v.attrib['ivorn'], trace_id=trace_id)
+                    handled = False
+                    try:
+                        for hfunc in EVENTHANDLERS:
+                            hname = hfunc.__module__.split('.')[-1]
+                            start = time.time()
+                            with tracing.span('handler', handler=hname, ivorn=v.attrib['ivorn']) as sp:
+                                handled = hfunc(event=eventxml, pretend=PRETEND)
+                                sp.set(handled=bool(handled))
+                            HANDLER_SECONDS.labels(handler=hname, handled=bool(handled)).observe(time.time() - start)
+                            if handled:   # One of the handlers accepted this event
+                                break    # Don't try any more event handlers.
+                    finally:
+                        if profile is not None:
+                            profiling.PROFILER.stop(profile)
+                    latency.record(v=v, outcome='handled' if handled else 'ignored')   # Unless it was triggered on
+                    eventregistry.EVENTS.flush()   # Index and save the triggers the handlers looked at, evict old ones
+            if fastlane.FASTLANE is not None:
+                fastlane.FASTLANE.finish(v.attrib['ivorn'])
+            if prefetch.PREFETCHER is not None:
+                prefetch.PREFETCHER.discard(v.attrib['ivorn'])
+            tracing.set_trace_id(None)
             EventQueue.task_done()
     except Exception:
         DEFAULTLOGGER.error("Exception in QueueWorker. Restarting in 10 sec: %s" % (traceback.format_exc(),))
@@ -267,13 +520,149 @@ def QueueWorker():
                             msg_text=EXCEPTION_EMAIL_TEMPLATE % traceback.format_exc())
 
 
+def reload_handlers(reimport=True):
+    """
+    Re-read the handler settings from trigger.conf, and if reimport is True, re-import the handler modules in place
+    (see mwa_trigger/hotreload.py). This happens between events - any received in the meantime wait in the EventQueue.
+
+    :return: The result dictionary from hotreload.HandlerReloader.reload().
+    """
+    with hotreload.LOCK:
+        modules = [sys.modules[hfunc.__module__] for hfunc in EVENTHANDLERS]
+        result = hotreload.RELOADER.reload(modules, reimport=reimport, shared=[handlers])
+        if result['ok']:
+            EVENTHANDLERS[:] = [module.processevent for module in modules]
+    return result
+
+
 if __name__ == '__main__':
     if (len(sys.argv) > 1) and '-p' in sys.argv:
         PRETEND = True
 
     if PRETEND:
         DEFAULTLOGGER.info('Working in PRETEND mode, not actually scheduling observations.')
-    EventQueue = Queue.Queue(maxsize=10)
+
+    # For replays of recorded events, run the handlers' clock at the time each event was issued (see clock.py)
+    if CP.has_option(section='clock', option='simulated') and CP.getboolean('clock', 'simulated'):
+        if PRETEND:
+            clock.set_clock(clock.SimulatedClock(speed=0.0))
+            DEFAULTLOGGER.info('Using a simulated clock, set to the time each event was issued.')
+        else:
+            DEFAULTLOGGER.error('Ignoring simulated = True in the [clock] section, only allowed in PRETEND mode.')
+
+    # Use the local copies of the IERS and leap second tables, so astropy never downloads them while handling an event
+    if CP.has_option(section='iers', option='directory'):
+        iersdata.DIRECTORY = CP.get(section='iers', option='directory')
+    iersdata.configure(logger=DEFAULTLOGGER)
+    if CP.has_option(section='warmup', option='enabled'):
+        WARMUP = CP.getboolean('warmup', 'enabled')
+
+    EventQueue = Queue.Queue(maxsize=10)   # Items are (eventxml, time queued, trace ID) tuples
+    QUEUE_DEPTH.set_function(EventQueue.qsize)
+
+    # Serve the metrics in Prometheus format, if enabled in trigger.conf
+    if CP.has_option(section='metrics', option='port'):
+        metrics_host = 'localhost'
+        if CP.has_option(section='metrics', option='host'):
+            metrics_host = CP.get(section='metrics', option='host')
+        metrics.start_http_server(port=CP.getint('metrics', 'port'), host=metrics_host)
+
+    # Write a timed span for each stage of handling every event, if enabled in trigger.conf
+    if CP.has_option(section='tracing', option='file'):
+        tracing.TRACER.configure(CP.get(section='tracing', option='file'))
+        DEFAULTLOGGER.info('Writing trace spans to %s' % tracing.TRACER.filename)
+
+    # Profile the handlers for some events, if enabled in trigger.conf (or later, with the profileEvents() RPC call)
+    if CP.has_option(section='profiling', option='directory'):
+        profiling.PROFILER.directory = CP.get(section='profiling', option='directory')
+    if CP.has_option(section='profiling', option='pattern') or CP.has_option(section='profiling', option='count'):
+        profiling.PROFILER.arm(pattern=CP.get('profiling', 'pattern') if CP.has_option('profiling', 'pattern') else None,
+                               count=CP.getint('profiling', 'count') if CP.has_option('profiling', 'count') else 0)
+
+    # Record the latency of every decision, and check accepted triggers against the latency SLO for each source
+    if CP.has_section('latency'):
+        for option in CP.options('latency'):
+            if option.startswith('slo_'):
+                name = option[4:]
+                for source in [s[1] for s in latency.SOURCES] + ['default']:
+                    if source.lower() == name:
+                        name = source
+                latency.LEDGER.slo[name] = CP.getfloat('latency', option)
+        if CP.has_option(section='latency', option='ledger_file'):
+            latency.LEDGER.ledger_file = CP.get(section='latency', option='ledger_file')
+        if CP.has_option(section='latency', option='alert_to'):
+            latency.LEDGER.alert_to = [a.strip() for a in CP.get(section='latency', option='alert_to').split(',')]
+
+    # Write the reason for every decision to the columnar decision ledger, if enabled in trigger.conf
+    if CP.has_option(section='decisions', option='directory'):
+        decisions.LEDGER.configure(CP.get(section='decisions', option='directory'))
+
+    # Limits on the trigger events held in memory by the handlers
+    if CP.has_option(section='registry', option='max_entries'):
+        eventregistry.EVENTS.max_entries = CP.getint('registry', 'max_entries')
+    if CP.has_option(section='registry', option='max_mbytes'):
+        eventregistry.EVENTS.max_bytes = CP.getfloat('registry', 'max_mbytes') * 1024 * 1024
+    if CP.has_option(section='registry', option='ttl_days'):
+        eventregistry.EVENTS.ttl = CP.getfloat('registry', 'ttl_days') * 86400.0
+
+    # Keep the state of each trigger in a database, so it survives a restart, if enabled in trigger.conf
+    if CP.has_option(section='statestore', option='file'):
+        max_age = statestore.MAX_AGE
+        if CP.has_option(section='statestore', option='max_age'):
+            max_age = CP.getfloat('statestore', 'max_age')
+        statestore.STORE.open(CP.get(section='statestore', option='file'), max_age=max_age)
+
+    # Keep a copy of every VOEvent received, if enabled in trigger.conf
+    if CP.has_option(section='archive', option='directory'):
+        archive.ARCHIVE.directory = CP.get(section='archive', option='directory')
+        if CP.has_option(section='archive', option='max_mbytes'):
+            archive.ARCHIVE.max_bytes = CP.getfloat('archive', 'max_mbytes') * 1024 * 1024
+        if CP.has_option(section='archive', option='max_queue'):
+            archive.ARCHIVE.max_queue = CP.getint('archive', 'max_queue')
+        archive.ARCHIVE.start()
+
+    # Start the email outbox, so that sending an email never waits for the mail host
+    if handlers.CP.has_option(section='mail', option='spool_dir'):
+        outbox.OUTBOX.spool_dir = handlers.CP.get(section='mail', option='spool_dir')
+    if handlers.CP.has_option(section='mail', option='batch_window'):
+        outbox.OUTBOX.batch_window = handlers.CP.getfloat('mail', 'batch_window')
+    if handlers.CP.has_option(section='mail', option='max_attempts'):
+        outbox.OUTBOX.max_attempts = handlers.CP.getint('mail', 'max_attempts')
+    outbox.OUTBOX.start()
+
+    # Collect debug notifications into one digest per trigger, sent when the window has passed
+    for option in ['window', 'per_hour']:
+        if handlers.CP.has_option(section='notify', option=option):
+            setattr(notify.AGGREGATOR, option, handlers.CP.getfloat('notify', option))
+    if handlers.CP.has_option(section='notify', option='burst'):
+        notify.AGGREGATOR.burst = handlers.CP.getint('notify', 'burst')
+    notify.AGGREGATOR.start()
+
+    # Start the background workers that send emails and write audit records, so the QueueWorker doesn't wait for them
+    if handlers.CP.has_option(section='sideeffects', option='workers'):
+        sideeffects.PIPELINE.nworkers = handlers.CP.getint('sideeffects', 'workers')
+    if handlers.CP.has_option(section='sideeffects', option='audit_file'):
+        sideeffects.PIPELINE.audit_file = handlers.CP.get(section='sideeffects', option='audit_file')
+    sideeffects.PIPELINE.start()
+    last_failed = 0
+
+    # Apply the handler settings in trigger.conf, and re-read them (re-importing the handlers) on a SIGHUP. This
+    # is done before the pre-fetch starts, as it only reads the PREFETCH_* settings at startup
+    reload_handlers(reimport=False)
+    signal.signal(signal.SIGHUP, lambda signum, frame: RELOAD_REQUESTED.set())
+
+    # Run the handlers on a synthetic event before accepting any, so that the first real one doesn't wait for astropy,
+    # healpy, etc to set themselves up
+    if WARMUP:
+        warmup.run([sys.modules[hfunc.__module__] for hfunc in EVENTHANDLERS], logger=DEFAULTLOGGER)
+
+    # Start the fast lane worker for buffered VCS triggers, if any fast lane rules are enabled in trigger.conf
+    fastlane.start_fastlane(pretend=PRETEND, logger=DEFAULTLOGGER)
+
+    # Start the speculative schedule pre-fetch for the enabled handlers, if enabled in trigger.conf
+    prefetch.start_prefetcher(modules=[sys.modules[hfunc.__module__] for hfunc in EVENTHANDLERS],
+                              cp=handlers.CP,
+                              logger=DEFAULTLOGGER)
 
     while True:
         # Start a background thread accepting network connections that add events to the queue.
@@ -291,7 +680,12 @@ if __name__ == '__main__':
 
         try:
             while True:
-                time.sleep(5)
+                if RELOAD_REQUESTED.wait(5):
+                    RELOAD_REQUESTED.clear()
+                    DEFAULTLOGGER.info('SIGHUP received - reloading the IERS tables and the handlers.')
+                    with hotreload.LOCK:   # Never swap the IERS tables while a handler is using them
+                        iersdata.configure(logger=DEFAULTLOGGER)
+                        reload_handlers(reimport=True)
                 if not pyro_thread.is_alive():
                     DEFAULTLOGGER.error('Pyro request handler thread has died - restarting.')
                     handlers.send_email(from_address='mwa@telemetry.mwa128t.org',
@@ -302,6 +696,30 @@ if __name__ == '__main__':
                 if not queue_thread.is_alive():
                     DEFAULTLOGGER.error('Queue handler thread has died - restarting.')
                     break
+                if not outbox.OUTBOX.running:
+                    DEFAULTLOGGER.error('Outbox thread has died - restarting.')
+                    outbox.OUTBOX.start()
+                if not notify.AGGREGATOR.running:
+                    DEFAULTLOGGER.error('Debug notification digest thread has died - restarting.')
+                    notify.AGGREGATOR.start()
+                if archive.ARCHIVE.enabled and not archive.ARCHIVE.running:
+                    DEFAULTLOGGER.error('Archive thread has died - restarting.')
+                    archive.ARCHIVE.start()
+                sestatus = sideeffects.PIPELINE.status()
+                if sestatus['workers'] < sideeffects.PIPELINE.nworkers:
+                    DEFAULTLOGGER.error('Side effect worker thread has died - restarting.')
+                    sideeffects.PIPELINE.start()
+                failed = sum(sestatus['failed'].values())
+                if failed > last_failed or sestatus['backlog'] > SIDEEFFECT_BACKLOG_WARNING:
+                    DEFAULTLOGGER.warning('Side effect backlog is %d, %d failed jobs (%s)' % (sestatus['backlog'],
+                                                                                            failed,
+                                                                                            sestatus['failed']))
+                    last_failed = failed
+                if prefetch.PREFETCHER is not None:
+                    prefetch.PREFETCHER.start()   # Restarts any fetch threads that have died
+                if (fastlane.FASTLANE is not None) and not fastlane.FASTLANE.is_alive():
+                    DEFAULTLOGGER.error('Fast lane thread has died - restarting.')
+                    fastlane.FASTLANE.start()
         finally:
             EXITING = True
             PYRO_DAEMON.shutdown()